@@ -0,0 +1,528 @@
+# Pipeline benchmark suite, using rsexecute
+#
+# This runs a simulation and data reduction for each combination of the parameters given on the command line,
+# timing each stage, and writes the timings as JSON. The timings may be compared against those of an earlier run
+# (the baseline) to find regressions. It runs on a single node, using a local Dask cluster, a local pool of
+# threads or processes, or immediate (serial) evaluation.
+#
+# For example, to measure the scaling of 2d, wstack and nifty gridder imaging with the number of Dask workers,
+# and compare with an earlier run:
+#
+#   python pipelines_rsexecute_benchmark.py --context 2d wstack ng --nworkers 1 2 4 8 --baseline baseline.json
+#
+import argparse
+import functools
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import platform
+import socket
+import sys
+import time
+import traceback
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from dask.base import collections_to_dsk
+from dask.delayed import Delayed
+from distributed import Client, futures_of, wait
+from tabulate import tabulate
+
+from rascil.data_models import PolarisationFrame
+from rascil.processing_components import create_image, copy_image, qa_image, advise_wide_field, \
+    convert_blockvisibility_to_visibility, create_awterm_convolutionfunction, create_pb_generic, \
+    create_unittest_components, insert_skycomponent
+from rascil.processing_components.calibration.chain_calibration import create_calibration_controls
+from rascil.workflows import invert_list_rsexecute_workflow, weight_list_rsexecute_workflow, \
+    predict_list_rsexecute_workflow, deconvolve_list_rsexecute_workflow, calibrate_list_rsexecute_workflow, \
+    simulate_list_rsexecute_workflow, corrupt_list_rsexecute_workflow
+from rascil.workflows.rsexecute.execution_support.rsexecute import rsexecute, get_dask_client
+
+log = logging.getLogger('logger')
+
+# Version of the layout of the JSON results
+BENCHMARK_FORMAT = 1
+
+# The stages of each trial, in order
+STAGES = ['simulate', 'kernel', 'weight', 'invert', 'deconvolve', 'predict', 'calibrate']
+
+# The parameters that may be swept over: each combination is a trial
+SWEEP = ['rmax', 'nfreqwin', 'npixel', 'context', 'algorithm', 'nworkers']
+
+
+def git_hash():
+    """ Get the hash for this git repository.
+
+    :return: string or "unknown"
+    """
+    import subprocess
+    try:
+        return subprocess.check_output(["git", "rev-parse", 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def environment():
+    """ Describe the node and software, so that results from different runs can be compared sensibly
+
+    :return: dictionary
+    """
+    import astropy
+    import dask
+    import distributed
+    return {'hostname': socket.gethostname(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'astropy': astropy.__version__,
+            'dask': dask.__version__,
+            'distributed': distributed.__version__,
+            'nifty_gridder': importlib.util.find_spec('nifty_gridder') is not None,
+            'git_hash': git_hash(),
+            'epoch': time.strftime("%Y-%m-%d %H:%M:%S"),
+            'command': ' '.join(sys.argv)}
+
+
+def graph_ntasks(graph):
+    """ Number of tasks in a graph, a measure of the scheduling overhead
+
+    Persisted inputs count as one task each.
+
+    :param graph: list of Delayed
+    :return: number of tasks, or 0 if not using Dask
+    """
+    delayeds = [g for g in graph if isinstance(g, Delayed)]
+    if len(delayeds) == 0:
+        return 0
+    return len(collections_to_dsk(delayeds, optimize_graph=False))
+
+
+def run_stage(trial, stage, make_graph):
+    """ Make and run the graph for a stage, timing both
+
+    The results are persisted so that the following stages start from computed data. Calling a stage
+    again adds to its timings.
+
+    :param trial: Trial dictionary, the timings are added to trial['stages'][stage]
+    :param stage: Name of stage
+    :param make_graph: Function returning a list of Delayed
+    :return: persisted graph
+    """
+    start = time.time()
+    graph = make_graph()
+    time_graph = time.time() - start
+    ntasks = graph_ntasks(graph)
+    graph = rsexecute.persist(graph)
+    if isinstance(rsexecute.client, Client):
+        wait(futures_of(graph))
+    elapsed = time.time() - start
+
+    timings = trial['stages'].setdefault(stage, {'time': 0.0, 'time graph': 0.0, 'ntasks': 0})
+    timings['time'] += elapsed
+    timings['time graph'] += time_graph
+    timings['ntasks'] += ntasks
+    log.info("Stage %s: %d tasks, graph %.3f (s), total %.3f (s)" % (stage, ntasks, time_graph, elapsed))
+    return graph
+
+
+def set_client(nworkers, args):
+    """ Start rsexecute as requested on the command line
+
+    :param nworkers: Number of workers
+    :param args: Command line arguments
+    :return: Description of the client
+    """
+    if args.use_dask != 'True':
+        rsexecute.set_client(use_dask=False)
+        return 'serial'
+    elif args.use_pool is not None:
+        rsexecute.set_client(use_pool=args.use_pool, n_workers=nworkers)
+        return 'pool %s' % args.use_pool
+
+    memory_limit = args.memory * 1024 * 1024 * 1024
+    scheduler = os.getenv('RASCIL_DASK_SCHEDULER', None)
+    if scheduler is not None:
+        client = get_dask_client(n_workers=nworkers, memory_limit=memory_limit,
+                                 threads_per_worker=args.nthreads)
+        rsexecute.set_client(client=client, locality=args.locality == 'True')
+    else:
+        rsexecute.set_client(n_workers=nworkers, threads_per_worker=args.nthreads,
+                             processes=args.nthreads == 1, memory_limit=memory_limit,
+                             locality=args.locality == 'True')
+    return 'dask'
+
+
+def create_truth_model(model, flux):
+    """ Model with a grid of point sources, as used in the unit tests
+
+    :param model: Template image
+    :param flux: Flux of each source [1, npol]
+    :return: Image
+    """
+    components = create_unittest_components(model, flux)
+    return insert_skycomponent(copy_image(model), components)
+
+
+def trial_case(parameters, args):
+    """ Single trial: simulate, weight, invert, deconvolve, predict and calibrate
+
+    The trial dictionary holds:
+
+    'parameters': the values of the swept parameters for this trial
+    'client': 'serial', 'pool threads', 'pool processes', or 'dask'
+    'stages': for each stage, 'time' (s) to make and run the graph, 'time graph' (s) to make the graph,
+        and 'ntasks' in the graph
+    'time overall': (s)
+    'npixel', 'cellsize', 'vis_slices', 'wprojection_planes': imaging parameters used
+    'threads per task': threads used by the nifty gridder in each task (ng only)
+    'qa': maximum and minimum of the dirty and deconvolved images (centre channel)
+
+    :param parameters: dictionary of the swept parameters: rmax, nfreqwin, npixel, context, algorithm, nworkers
+    :param args: Command line arguments
+    :return: trial dictionary
+    """
+    trial = {'parameters': parameters, 'stages': dict()}
+    rmax, nfreqwin, npixel, context, algorithm, nworkers = [parameters[p] for p in SWEEP]
+
+    if context == 'ng' and importlib.util.find_spec('nifty_gridder') is None:
+        raise ValueError("Context ng requires nifty_gridder, which is not installed")
+
+    numpy.random.seed(args.seed)
+    trial['client'] = set_client(nworkers, args)
+    if context == 'ng':
+        trial['threads per task'] = rsexecute.threads_per_task
+    start_all = time.time()
+
+    frequency = numpy.linspace(0.8e8, 1.2e8, nfreqwin)
+    centre = nfreqwin // 2
+    if nfreqwin > 1:
+        channel_bandwidth = numpy.array(nfreqwin * [frequency[1] - frequency[0]])
+    else:
+        channel_bandwidth = numpy.array([1e6])
+    times = numpy.linspace(-numpy.pi / 4.0, numpy.pi / 4.0, args.ntimes)
+    phasecentre = SkyCoord(ra=+0.0 * u.deg, dec=-40.0 * u.deg, frame='icrs', equinox='J2000')
+
+    def simulate():
+        bvis_list = simulate_list_rsexecute_workflow(args.configuration, frequency=frequency,
+                                                     channel_bandwidth=channel_bandwidth, times=times,
+                                                     phasecentre=phasecentre, order='frequency',
+                                                     format='blockvis', rmax=rmax)
+        # The nifty gridder works on BlockVisibility, the other contexts on Visibility
+        if context == 'ng':
+            return bvis_list
+        return [rsexecute.execute(convert_blockvisibility_to_visibility, partition=i)(bv)
+                for i, bv in enumerate(bvis_list)]
+
+    vis_list = run_stage(trial, 'simulate', simulate)
+
+    advice = rsexecute.execute(advise_wide_field)(vis_list[-1], guard_band_image=3.0, delA=0.1, facets=1,
+                                                  wprojection_planes=1, oversampling_synthesised_beam=4.0,
+                                                  verbose=False)
+    advice = rsexecute.compute(advice, sync=True)
+    if npixel is None:
+        npixel = advice['npixels2']
+    cellsize = args.cellsize or advice['cellsize']
+    trial['npixel'] = int(npixel)
+    trial['cellsize'] = float(cellsize)
+
+    if context == 'timeslice':
+        vis_slices = args.ntimes
+    elif context == 'wstack':
+        vis_slices = advice['vis_slices']
+    else:
+        vis_slices = 1
+    trial['vis_slices'] = int(vis_slices)
+
+    model_list = [rsexecute.execute(create_image, partition=f)(npixel=npixel, cellsize=cellsize,
+                                                               frequency=[frequency[f]],
+                                                               channel_bandwidth=[channel_bandwidth[f]],
+                                                               phasecentre=phasecentre,
+                                                               polarisation_frame=PolarisationFrame("stokesI"))
+                  for f, freq in enumerate(frequency)]
+    model_list = rsexecute.persist(model_list)
+
+    # The W and AW projection contexts use 2d imaging with the corresponding convolution function
+    imaging_context = '2d' if context in ['wprojection', 'awprojection'] else context
+    imaging_args = {'context': imaging_context, 'vis_slices': vis_slices, 'facets': args.facets}
+    if args.compact != 'False':
+        imaging_args['compact'] = True if args.compact == 'True' else int(args.compact)
+
+    if context in ['wprojection', 'awprojection']:
+        make_pb = None
+        if context == 'awprojection':
+            make_pb = functools.partial(create_pb_generic, diameter=35.0, blockage=0.0, use_local=False)
+
+        # Odd number of planes covering -maximum_w to +maximum_w
+        wstep = advice['wstep']
+        nw = 2 * int(numpy.ceil(advice['maximum_w'] / wstep)) + 1
+        support = max(8, advice['nwpixels'])
+        trial['wprojection_planes'] = nw
+
+        def kernel():
+            return [rsexecute.execute(create_awterm_convolutionfunction, nout=1)
+                    (model_list[centre], make_pb=make_pb, nw=nw, wstep=wstep, oversampling=4, support=support,
+                     use_aaf=True)]
+
+        gcfcf = run_stage(trial, 'kernel', kernel)
+        imaging_args['gcfcf'] = gcfcf
+
+    def corrupt():
+        flux = [numpy.array([[numpy.power(freq / 1e8, -0.7)]]) for freq in frequency]
+        truth_list = [rsexecute.execute(create_truth_model, partition=f)(model_list[f], flux[f])
+                      for f, freq in enumerate(frequency)]
+        predicted_list = predict_list_rsexecute_workflow(vis_list, truth_list, **imaging_args)
+        return corrupt_list_rsexecute_workflow(predicted_list, phase_error=args.phase_error, seed=args.seed)
+
+    vis_list = run_stage(trial, 'simulate', corrupt)
+
+    vis_list = run_stage(trial, 'weight',
+                         lambda: weight_list_rsexecute_workflow(vis_list, model_list, weighting=args.weighting))
+
+    def invert():
+        dirty_list = invert_list_rsexecute_workflow(vis_list, model_list, dopsf=False, **imaging_args)
+        psf_list = invert_list_rsexecute_workflow(vis_list, model_list, dopsf=True, **imaging_args)
+        return dirty_list + psf_list
+
+    dirty_psf_list = run_stage(trial, 'invert', invert)
+    dirty_list, psf_list = dirty_psf_list[:nfreqwin], dirty_psf_list[nfreqwin:]
+
+    deconvolve_args = {'algorithm': algorithm, 'niter': args.niter, 'fractional_threshold': 0.1,
+                       'threshold': 0.01, 'gain': 0.1, 'scales': [0, 3, 10], 'psf_support': min(64, npixel // 2)}
+    if algorithm == 'mmclean':
+        deconvolve_args['nmoment'] = min(3, (nfreqwin + 1) // 2)
+    deconvolved_list = run_stage(trial, 'deconvolve',
+                                 lambda: deconvolve_list_rsexecute_workflow(dirty_list, psf_list, model_list,
+                                                                            **deconvolve_args))
+
+    model_vis_list = run_stage(trial, 'predict',
+                               lambda: predict_list_rsexecute_workflow(vis_list, deconvolved_list, **imaging_args))
+
+    controls = create_calibration_controls()
+    controls['T']['first_selfcal'] = 0
+    controls['T']['timeslice'] = 'auto'
+
+    def calibrate():
+        calibrated_vis_list, gt_list = calibrate_list_rsexecute_workflow(vis_list, model_vis_list,
+                                                                         calibration_context='T',
+                                                                         controls=controls,
+                                                                         global_solution=True)
+        return calibrated_vis_list + gt_list
+
+    run_stage(trial, 'calibrate', calibrate)
+
+    trial['time overall'] = time.time() - start_all
+
+    dirty, sumwt = rsexecute.compute(dirty_list[centre], sync=True)
+    deconvolved = rsexecute.compute(deconvolved_list[centre], sync=True)
+    qa_dirty, qa_deconvolved = qa_image(dirty), qa_image(deconvolved)
+    trial['qa'] = {'dirty_max': float(qa_dirty.data['max']), 'dirty_min': float(qa_dirty.data['min']),
+                   'deconvolved_max': float(qa_deconvolved.data['max']),
+                   'deconvolved_min': float(qa_deconvolved.data['min'])}
+
+    rsexecute.close()
+    return trial
+
+
+def trial_key(trial):
+    """ Key identifying the parameters of a trial, for matching against the baseline
+
+    :param trial: trial dictionary
+    :return: str
+    """
+    return json.dumps(trial['parameters'], sort_keys=True)
+
+
+def compare_results(results, baseline, tolerance=0.2, min_time=0.5):
+    """ Compare the timings of the trials with those of the same parameters in the baseline
+
+    A stage has regressed if it takes more than (1 + tolerance) times as long as in the baseline, or if its
+    graph has more tasks. Stages taking less than min_time in the baseline are not compared, since their
+    timings are dominated by noise.
+
+    :param results: results dictionary
+    :param baseline: results dictionary from an earlier run
+    :param tolerance: Fractional increase in time allowed
+    :param min_time: Minimum time in the baseline for a stage to be compared (s)
+    :return: list of rows [parameters, stage, baseline time, time, ratio, baseline ntasks, ntasks, status]
+    """
+    baseline_trials = {trial_key(trial): trial for trial in baseline['trials']}
+    rows = list()
+    for trial in results['trials']:
+        key = trial_key(trial)
+        if key not in baseline_trials:
+            rows.append([key, '', None, None, None, None, None, 'no baseline'])
+            continue
+        base = baseline_trials[key]
+        if 'error' in trial or 'error' in base:
+            status = 'error' if 'error' in trial else 'fixed'
+            rows.append([key, '', None, None, None, None, None, status])
+            continue
+        for stage in STAGES + ['overall']:
+            if stage == 'overall':
+                timings = {'time': trial['time overall']}
+                base_timings = {'time': base['time overall']}
+            elif stage in trial['stages'] and stage in base['stages']:
+                timings, base_timings = trial['stages'][stage], base['stages'][stage]
+            else:
+                continue
+            ratio = timings['time'] / max(base_timings['time'], 1e-15)
+            ntasks, base_ntasks = timings.get('ntasks'), base_timings.get('ntasks')
+            if ntasks is not None and base_ntasks is not None and ntasks > base_ntasks:
+                status = 'REGRESSION (tasks)'
+            elif base_timings['time'] < min_time:
+                status = 'not compared'
+            elif ratio > 1.0 + tolerance:
+                status = 'REGRESSION'
+            elif ratio < 1.0 / (1.0 + tolerance):
+                status = 'faster'
+            else:
+                status = 'ok'
+            rows.append([key, stage, base_timings['time'], timings['time'], ratio, base_ntasks, ntasks, status])
+    return rows
+
+
+def scaling_report(results):
+    """ Tabulate the time of each stage against the number of workers
+
+    The speedup and parallel efficiency are relative to the trial with the fewest workers and otherwise
+    the same parameters.
+
+    :param results: results dictionary
+    :return: str
+    """
+    groups = dict()
+    for trial in results['trials']:
+        if 'error' in trial:
+            continue
+        fixed = {p: v for p, v in trial['parameters'].items() if p != 'nworkers'}
+        groups.setdefault(json.dumps(fixed, sort_keys=True), []).append(trial)
+
+    report = list()
+    for key, trials in groups.items():
+        trials = sorted(trials, key=lambda t: t['parameters']['nworkers'])
+        reference = trials[0]
+        nworkers0 = reference['parameters']['nworkers']
+        table = list()
+        for trial in trials:
+            nworkers = trial['parameters']['nworkers']
+            row = [nworkers] + ["%.3f" % trial['stages'][stage]['time'] if stage in trial['stages'] else ''
+                                for stage in STAGES]
+            speedup = reference['time overall'] / trial['time overall']
+            row += ["%.3f" % trial['time overall'], "%.2f" % speedup, "%.2f" % (speedup * nworkers0 / nworkers)]
+            table.append(row)
+        headers = ['nworkers'] + STAGES + ['overall', 'speedup', 'efficiency']
+        report.append(key + '\n' + tabulate(table, headers=headers))
+    return '\n\n'.join(report)
+
+
+def write_results(filename, results):
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def main(args):
+    logging.basicConfig(filename=args.log_file, filemode='w',
+                        format='%(asctime)s,%(msecs)d %(name)s %(levelname)s %(message)s',
+                        datefmt='%H:%M:%S', level=logging.INFO)
+
+    results = {'format': BENCHMARK_FORMAT,
+               'driver': 'pipelines_rsexecute_benchmark',
+               'environment': environment(),
+               'settings': {key: value for key, value in vars(args).items() if key not in SWEEP},
+               'trials': list()}
+
+    filename = args.results
+    if filename is None:
+        filename = 'pipelines_rsexecute_benchmark_%s_%s.json' % (socket.gethostname(),
+                                                                  time.strftime("%Y%m%d_%H%M%S"))
+
+    for values in itertools.product(*[getattr(args, p) for p in SWEEP]):
+        parameters = dict(zip(SWEEP, values))
+        print("Trial %s" % parameters)
+        try:
+            trial = trial_case(parameters, args)
+        except Exception as err:
+            log.error("Trial %s failed:\n%s" % (parameters, traceback.format_exc()))
+            print("Trial failed: %s" % err)
+            trial = {'parameters': parameters, 'error': str(err)}
+            rsexecute.close()
+        results['trials'].append(trial)
+        # Write after each trial so that a long run can be inspected, or survive a failure
+        write_results(filename, results)
+
+    print('Results saved to %s' % filename)
+    print(scaling_report(results))
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        ignored = ['results', 'baseline', 'tolerance', 'min_time', 'log_file']
+        for key in sorted(set(results['settings']) | set(baseline['settings'])):
+            value, base_value = results['settings'].get(key), baseline['settings'].get(key)
+            if key not in ignored and value != base_value:
+                print('Warning: setting %s is %s but was %s in the baseline' % (key, value, base_value))
+        rows = compare_results(results, baseline, tolerance=args.tolerance, min_time=args.min_time)
+        headers = ['parameters', 'stage', 'baseline (s)', 'time (s)', 'ratio', 'baseline ntasks', 'ntasks',
+                   'status']
+        print('Comparison with baseline %s' % args.baseline)
+        print(tabulate(rows, headers=headers, floatfmt='.3f'))
+        if any(row[-1].startswith('REGRESSION') or row[-1] == 'error' for row in rows):
+            print('Regressions found')
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+
+    def npixel_type(value):
+        return None if value == 'auto' else int(value)
+
+    parser = argparse.ArgumentParser(description='Benchmark the rsexecute pipelines on a single node')
+
+    # Parameters swept over: all combinations are run
+    parser.add_argument('--rmax', type=float, nargs='+', default=[750.0],
+                        help='Maximum distance of stations from the array centre (m)')
+    parser.add_argument('--nfreqwin', type=int, nargs='+', default=[8], help='Number of frequency windows')
+    parser.add_argument('--npixel', type=npixel_type, nargs='+', default=[512],
+                        help='Number of pixels on each axis, or auto')
+    parser.add_argument('--context', type=str, nargs='+', default=['2d'],
+                        help='Imaging context: 2d|wstack|timeslice|wprojection|awprojection|ng')
+    parser.add_argument('--algorithm', type=str, nargs='+', default=['hogbom'],
+                        help='Deconvolution algorithm: hogbom|msclean|mmclean')
+    parser.add_argument('--nworkers', type=int, nargs='+', default=[4], help='Number of workers')
+
+    # Fixed settings
+    parser.add_argument('--use_dask', type=str, default='True', help='Use Dask? (False is serial)')
+    parser.add_argument('--use_pool', type=str, default=None,
+                        help='Use a local pool of threads or processes instead of a Dask cluster')
+    parser.add_argument('--nthreads', type=int, default=1, help='Number of threads per Dask worker')
+    parser.add_argument('--memory', type=int, default=8, help='Memory per Dask worker (GB)')
+    parser.add_argument('--locality', type=str, default='False', help='Keep each partition on one Dask worker?')
+    parser.add_argument('--configuration', type=str, default='LOWBD2', help='Array configuration')
+    parser.add_argument('--ntimes', type=int, default=7, help='Number of hour angles')
+    parser.add_argument('--cellsize', type=float, default=None, help='Cellsize (rad), default from advice')
+    parser.add_argument('--facets', type=int, default=1, help='Number of facets in imaging')
+    parser.add_argument('--compact', type=str, default='False', help='Compact the imaging graphs: True|False|n')
+    parser.add_argument('--weighting', type=str, default='uniform', help='Weighting: natural|uniform|robust')
+    parser.add_argument('--niter', type=int, default=1000, help='Number of minor cycle iterations')
+    parser.add_argument('--phase_error', type=float, default=1.0, help='RMS phase error of simulated gains (rad)')
+    parser.add_argument('--seed', type=int, default=180555, help='Random number seed')
+
+    # Output and comparison
+    parser.add_argument('--results', type=str, default=None, help='Name of JSON results file')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fractional increase in time of a stage counted as a regression')
+    parser.add_argument('--min_time', type=float, default=0.5,
+                        help='Stages faster than this in the baseline are not compared (s)')
+    parser.add_argument('--log_file', type=str, default='pipelines_rsexecute_benchmark.log',
+                        help='Name of output log file')
+
+    exit(main(parser.parse_args()))
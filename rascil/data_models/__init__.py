@@ -1,8 +1,10 @@
 
-__all__ = ['memory_data_models', 'buffer_data_models', 'data_model_helpers', 'polarisation', 'parameters']
+__all__ = ['memory_data_models', 'buffer_data_models', 'data_model_helpers', 'dask_data_models', 'polarisation',
+           'parameters']
 
 from .memory_data_models import *
 from .buffer_data_models import *
 from .data_model_helpers import *
+from .dask_data_models import *
 from .polarisation import *
 from .parameters import *
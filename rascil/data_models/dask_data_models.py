@@ -0,0 +1,112 @@
+""" Dask serialization and memory accounting for the data models
+
+Registering serializers for Image, BlockVisibility, GridData and ConvolutionFunction means that Dask sends the
+numpy data of these models as separate frames, without copying, instead of pickling the whole object. The
+remaining attributes (WCS, phasecentre, Configuration, ...) are small and are pickled into a single frame.
+
+Registering sizeof means that the scheduler's memory accounting, and so its spilling to disk, sees the real
+size of these objects rather than a small default.
+
+Registering normalize_token means that dask.base.tokenize gives a hash of the contents of any data model, the
+same in every session. This is used for the keys of rsexecute's memoization cache.
+
+The registrations are made on import of rascil.data_models.
+"""
+
+__all__ = ['data_model_sizeof', 'data_model_normalize_token']
+
+import logging
+
+import numpy
+from astropy.coordinates import SkyCoord
+from astropy.wcs import WCS
+from dask.base import normalize_token
+from dask.sizeof import sizeof
+from distributed.protocol import dask_serialize, dask_deserialize, serialize, deserialize, pickle
+
+from rascil.data_models.memory_data_models import Configuration, GainTable, PointingTable, Image, GridData, \
+    ConvolutionFunction, Skycomponent, SkyModel, Visibility, BlockVisibility, BlockVisibilityTemplate, FlagTable
+from rascil.data_models.polarisation import PolarisationFrame, ReceptorFrame
+
+log = logging.getLogger('logger')
+
+# Allowance for the attributes other than data, such as WCS and phasecentre
+_METADATA_OVERHEAD = 4096
+
+
+def data_model_sizeof(dm):
+    """ Return the size of a data model in bytes, as used by Dask
+
+    This is the size of the data array and any other numpy arrays held by the model or its Configuration.
+
+    :param dm: Image, BlockVisibility, GridData or ConvolutionFunction
+    :return: size in bytes
+    """
+    size = _METADATA_OVERHEAD
+    for value in dm.__dict__.values():
+        if isinstance(value, numpy.ndarray):
+            size += value.nbytes
+    configuration = getattr(dm, 'configuration', None)
+    if configuration is not None and isinstance(configuration.data, numpy.ndarray):
+        size += configuration.data.nbytes
+    return int(size)
+
+
+def data_model_normalize_token(dm):
+    """ Return a deterministic token for the contents of a data model, as used by dask.base.tokenize
+
+    :param dm: Data model e.g. Image, BlockVisibility, SkyModel
+    :return: tuple of the class name and the normalized attributes
+    """
+    return (type(dm).__name__,) + tuple((key, normalize_token(value)) for key, value in sorted(dm.__dict__.items()))
+
+
+def _normalize_wcs(wcs):
+    return 'WCS', wcs.to_header_string()
+
+
+def _normalize_skycoord(sc):
+    return 'SkyCoord', sc.frame.name, normalize_token(sc.cartesian.xyz.value)
+
+
+def _normalize_frame(frame):
+    return type(frame).__name__, frame.type
+
+
+def _serialize_data_model(dm):
+    """ Serialize a data model: data as zero-copy frames, all else pickled into the first frame
+
+    :param dm: Data model
+    :return: header, frames
+    """
+    metadata = {key: value for key, value in dm.__dict__.items() if key != 'data'}
+    data_header, data_frames = serialize(dm.data)
+    header = {'data': data_header}
+    return header, [pickle.dumps(metadata)] + data_frames
+
+
+def _deserialize_data_model(cls, header, frames):
+    """ Reconstruct a data model from header and frames
+
+    :param cls: Class of the data model
+    :param header: Header from _serialize_data_model
+    :param frames: Frames from _serialize_data_model
+    :return: Data model
+    """
+    dm = cls.__new__(cls)
+    dm.__dict__.update(pickle.loads(frames[0]))
+    dm.data = deserialize(header['data'], frames[1:])
+    return dm
+
+
+for _cls in [Image, BlockVisibility, GridData, ConvolutionFunction]:
+    dask_serialize.register(_cls)(_serialize_data_model)
+    dask_deserialize.register(_cls)(lambda header, frames, cls=_cls: _deserialize_data_model(cls, header, frames))
+    sizeof.register(_cls)(data_model_sizeof)
+
+for _cls in [Configuration, GainTable, PointingTable, Image, GridData, ConvolutionFunction, Skycomponent, SkyModel,
+             Visibility, BlockVisibility, BlockVisibilityTemplate, FlagTable]:
+    normalize_token.register(_cls)(data_model_normalize_token)
+normalize_token.register(WCS)(_normalize_wcs)
+normalize_token.register(SkyCoord)(_normalize_skycoord)
+normalize_token.register((PolarisationFrame, ReceptorFrame))(_normalize_frame)
@@ -102,6 +102,7 @@ import ast
 import collections
 
 import astropy.units as u
+import dask.array
 import h5py
 import numpy
 from astropy.coordinates import SkyCoord, EarthLocation
@@ -269,10 +270,11 @@ def convert_blockvisibility_to_hdf(vis: BlockVisibility, f):
     return f
 
 
-def convert_hdf_to_blockvisibility(f):
+def convert_hdf_to_blockvisibility(f, rows=None):
     """ Convert HDF root to blockvisibility
 
     :param f:
+    :param rows: Slice of integrations to read (default is all)
     :return:
     """
     assert f.attrs['RASCIL_data_model'] == "BlockVisibility", "Not a BlockVisibility"
@@ -282,7 +284,10 @@ def convert_hdf_to_blockvisibility(f):
     polarisation_frame = PolarisationFrame(f.attrs['polarisation_frame'])
     frequency = f.attrs['frequency']
     channel_bandwidth = f.attrs['channel_bandwidth']
-    data = numpy.array(f['data'])
+    if rows is None:
+        data = numpy.array(f['data'])
+    else:
+        data = numpy.array(f['data'][rows])
     source = f.attrs['source']
     meta = ast.literal_eval(f.attrs['meta'])
     vis = BlockVisibility(data=data, polarisation_frame=polarisation_frame,
@@ -651,13 +656,19 @@ def import_skycomponent_from_hdf5(filename):
 def convert_image_to_hdf(im: Image, f):
     """ Convert Image to HDF
 
+    If the image data are a dask.array, they are computed and written a chunk at a time.
+
     :param im: Image
     :param f: HDF root
     :return:
     """
     if isinstance(im, Image):
         f.attrs['RASCIL_data_model'] = 'Image'
-        f['data'] = im.data
+        if isinstance(im.data, dask.array.Array):
+            dataset = f.create_dataset('data', shape=im.data.shape, dtype=im.data.dtype)
+            dask.array.store(im.data, dataset, lock=True, scheduler='threads')
+        else:
+            f['data'] = im.data
         f.attrs['wcs'] = numpy.string_(im.wcs.to_header_string())
         f.attrs['polarisation_frame'] = im.polarisation_frame.type
 
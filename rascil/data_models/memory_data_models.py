@@ -12,6 +12,7 @@ __all__ = ['Configuration',
            'SkyModel',
            'Visibility',
            'BlockVisibility',
+           'BlockVisibilityTemplate',
            'FlagTable',
            'QA',
            'ScienceDataModel',
@@ -890,9 +891,9 @@ class Visibility:
     algorithms.
 
     If a visibility is created by coalescence then the cindex column is filled with a pointer to the
-    row in the original block visibility that this row has a value for. The original blockvisibility
-    is also preserves as n attribute so that decoalescence is expedited. If you don't need that then
-    the storage can be released by setting self.blockvis to None
+    row in this visibility that each sample of the original block visibility has a value in (-1 for none).
+    The metadata of the original blockvisibility (uvw, times, frequencies, but not the data columns) are
+    also kept as an attribute so that decoalescence is expedited.
     
     There are two visibility formats:
 
@@ -932,8 +933,9 @@ class Visibility:
         :param imaging_weight: Imaging weight [:, npol]
         :param integration_time: Integration time, per row
         :param polarisation_frame: Polarisation Frame e.g. Polarisation_frame("linear")
-        :param cindex: Index of row into original block visibility
-        :param blockvis: original block visibility
+        :param cindex: Index of row for each sample of the original block visibility
+        :param blockvis: original block visibility, or its metadata (BlockVisibilityTemplate) as kept by
+            coalesce_visibility
         :param source: Source name
         :param meta: Meta info
         """
@@ -1193,12 +1195,19 @@ class BlockVisibility:
         :param polarisation_frame: Polarisation_Frame e.g. Polarisation_Frame("linear")
         :param source: Source name
         :param meta: Meta info
+
+        If vis is None but uvw is given, the vis and flags are zero, and weight and imaging_weight are one
+        unless given. The zero columns are not written, so the memory for them is only used when they are filled.
         """
         if meta is None:
             meta = dict()
-        if data is None and vis is not None:
-            ntimes, nants, _, nchan, npol = vis.shape
-            assert vis.shape == weight.shape
+        if data is None and (vis is not None or uvw is not None):
+            if vis is not None:
+                ntimes, nants, _, nchan, npol = vis.shape
+                assert vis.shape == weight.shape
+            else:
+                ntimes, nants = uvw.shape[:2]
+                nchan, npol = len(frequency), polarisation_frame.npol
             if isinstance(frequency, list):
                 frequency = numpy.array(frequency)
             assert len(frequency) == nchan
@@ -1218,10 +1227,16 @@ class BlockVisibility:
             data['uvw'] = uvw
             data['time'] = time  # MJD in seconds
             data['integration_time'] = integration_time  # seconds
-            data['vis'] = vis
-            data['flags'] = flags
-            data['weight'] = weight
-            data['imaging_weight'] = imaging_weight
+            if vis is not None:
+                data['vis'] = vis
+                data['flags'] = flags
+                data['weight'] = weight
+                data['imaging_weight'] = imaging_weight
+            else:
+                if flags is not None:
+                    data['flags'] = flags
+                data['weight'] = 1.0 if weight is None else weight
+                data['imaging_weight'] = 1.0 if imaging_weight is None else imaging_weight
         
         self.data = data  # numpy structured array
         self.frequency = frequency
@@ -1376,6 +1391,54 @@ class BlockVisibility:
         return self.data.size
 
 
+class BlockVisibilityTemplate:
+    """ The metadata of a BlockVisibility without its data columns
+
+    This is kept by a coalesced Visibility (as blockvis) so that it can be decoalesced without holding on to
+    the storage of the original BlockVisibility.
+    """
+    
+    def __init__(self, vis: BlockVisibility):
+        """BlockVisibilityTemplate
+
+        :param vis: BlockVisibility
+        """
+        # Copies so that no view into the original data is kept
+        self.uvw = numpy.copy(vis.uvw)
+        self.time = numpy.copy(vis.time)
+        self.integration_time = numpy.copy(vis.integration_time)
+        self.frequency = vis.frequency
+        self.channel_bandwidth = vis.channel_bandwidth
+        self.phasecentre = vis.phasecentre
+        self.configuration = vis.configuration
+        self.polarisation_frame = vis.polarisation_frame
+        self.source = vis.source
+        self.meta = vis.meta
+    
+    def __str__(self):
+        """Default printer for BlockVisibilityTemplate
+
+        """
+        s = "BlockVisibilityTemplate:\n"
+        s += "\tSource: %s\n" % self.source
+        s += "\tPhasecentre: %s\n" % self.phasecentre
+        s += "\tNumber of times: %d\n" % len(self.time)
+        s += "\tNumber of channels: %d\n" % len(self.frequency)
+        s += "\tPolarisation Frame: %s\n" % self.polarisation_frame.type
+        s += "\tuvw shape: %s\n" % str(self.uvw.shape)
+        return s
+    
+    def create_blockvisibility(self) -> BlockVisibility:
+        """ Create a BlockVisibility with this metadata. The data columns are not filled.
+
+        :return: BlockVisibility
+        """
+        return BlockVisibility(uvw=self.uvw, time=self.time, integration_time=self.integration_time,
+                               frequency=self.frequency, channel_bandwidth=self.channel_bandwidth,
+                               phasecentre=self.phasecentre, configuration=self.configuration,
+                               polarisation_frame=self.polarisation_frame, source=self.source, meta=self.meta)
+
+
 class FlagTable:
     """ Flag table class
 
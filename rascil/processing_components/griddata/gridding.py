@@ -35,6 +35,7 @@ from rascil.data_models.memory_data_models import BlockVisibility, Visibility, G
 from rascil.processing_components.fourier_transforms import ifft, fft
 from rascil.processing_components.griddata.operations import copy_griddata
 from rascil.processing_components.image.operations import create_image_from_array
+from rascil.processing_components.util.profiling import profile_function
 from rascil.processing_components.visibility.base import copy_visibility
 
 log = logging.getLogger('logger')
@@ -164,6 +165,7 @@ def spatial_mapping(cf, griddata, u, v, w):
     return pu_grid, pu_offset, pv_grid, pv_offset, pwc_fraction, pwc_grid, pwg_fraction, pwg_grid
 
 
+@profile_function
 def grid_blockvisibility_to_griddata(vis, griddata, cf):
     """Grid Visibility onto a GridData
 
@@ -220,6 +222,7 @@ def grid_blockvisibility_to_griddata(vis, griddata, cf):
     return griddata, sumwt
 
 
+@profile_function
 def grid_visibility_to_griddata(vis, griddata, cf):
     """Grid Visibility onto a GridData
 
@@ -478,6 +481,7 @@ def griddata_blockvisibility_reweight(vis, griddata, cf, weighting="uniform", ro
     return vis
 
 
+@profile_function
 def degrid_blockvisibility_from_griddata(vis, griddata, cf, **kwargs):
     """Degrid blockVisibility from a GridData
 
@@ -542,6 +546,7 @@ def degrid_blockvisibility_from_griddata(vis, griddata, cf, **kwargs):
     return newvis
 
 
+@profile_function
 def degrid_visibility_from_griddata(vis, griddata, cf, **kwargs):
     """Degrid Visibility from a GridData
 
@@ -582,6 +587,7 @@ def degrid_visibility_from_griddata(vis, griddata, cf, **kwargs):
     return newvis
 
 
+@profile_function
 def fft_griddata_to_image(griddata, gcf=None):
     """ FFT griddata after applying gcf
 
@@ -603,6 +609,7 @@ def fft_griddata_to_image(griddata, gcf=None):
     return create_image_from_array(im_data, griddata.projection_wcs, griddata.polarisation_frame)
 
 
+@profile_function
 def fft_image_to_griddata(im, griddata, gcf=None):
     """Fill griddata with transform of im
 
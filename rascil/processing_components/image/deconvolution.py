@@ -36,13 +36,15 @@ from photutils import fit_2dgaussian
 from rascil.data_models.memory_data_models import Image
 from rascil.data_models.parameters import get_parameter
 from rascil.processing_components.arrays.cleaners import hogbom, hogbom_complex, msclean, msmfsclean
-from rascil.processing_components.image.operations import create_image_from_array, copy_image
+from rascil.processing_components.image.operations import create_image_from_array, copy_image, image_is_dask
+from rascil.processing_components.util.profiling import profile_function
 from rascil.processing_components.image.operations import calculate_image_frequency_moments, \
     calculate_image_from_frequency_moments, image_is_canonical
 
 log = logging.getLogger('logger')
 
 
+@profile_function
 def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Image):
     """ Clean using a variety of algorithms
     
@@ -314,9 +316,13 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
     return comp_image, residual_image
 
 
+@profile_function
 def restore_cube(model: Image, psf: Image, residual=None, **kwargs) -> Image:
     """ Restore the model image to the residuals
 
+    If the model data are a dask.array, so are those of the restored image: each channel is restored only when
+    it is computed, so the cube is never held in memory.
+
     :params psf: Input PSF
     :return: restored image
 
@@ -329,8 +335,6 @@ def restore_cube(model: Image, psf: Image, residual=None, **kwargs) -> Image:
     assert residual is None or isinstance(residual, Image), residual
     assert image_is_canonical(residual)
     
-    restored = copy_image(model)
-    
     npixel = psf.data.shape[3]
     sl = slice(npixel // 2 - 7, npixel // 2 + 8)
     
@@ -340,7 +344,7 @@ def restore_cube(model: Image, psf: Image, residual=None, **kwargs) -> Image:
         # isotropic at the moment!
         from scipy.optimize import minpack
         try:
-            fit = fit_2dgaussian(psf.data[0, 0, sl, sl])
+            fit = fit_2dgaussian(numpy.asarray(psf.data[0, 0, sl, sl]))
             if fit.x_stddev <= 0.0 or fit.y_stddev <= 0.0:
                 log.debug('restore_cube: error in fitting to psf, using 1 pixel stddev')
                 size = 1.0
@@ -359,10 +363,25 @@ def restore_cube(model: Image, psf: Image, residual=None, **kwargs) -> Image:
     # By convention, we normalise the peak not the integral so this is the volume of the Gaussian
     norm = 2.0 * numpy.pi * size ** 2
     gk = Gaussian2DKernel(size)
-    for chan in range(model.shape[0]):
-        for pol in range(model.shape[1]):
-            restored.data[chan, pol, :, :] = norm * convolve_fft(model.data[chan, pol, :, :], gk,
-                                                                 normalize_kernel=False, allow_huge=True)
+    
+    def restore_planes(data, restored_data=None):
+        if restored_data is None:
+            restored_data = numpy.zeros_like(data)
+        for chan in range(data.shape[0]):
+            for pol in range(data.shape[1]):
+                restored_data[chan, pol, :, :] = norm * convolve_fft(data[chan, pol, :, :], gk,
+                                                                     normalize_kernel=False, allow_huge=True)
+        return restored_data
+    
+    if image_is_dask(model):
+        # Each block must hold whole planes
+        data = model.data.rechunk({2: -1, 3: -1}).map_blocks(restore_planes, dtype=model.data.dtype)
+        if residual is not None:
+            data = data + residual.data
+        return create_image_from_array(data, model.wcs, model.polarisation_frame)
+    
+    restored = copy_image(model)
+    restore_planes(model.data, restored.data)
     if residual is not None:
         restored.data += residual.data
     return restored
@@ -8,12 +8,13 @@ __all__ = ['image_gather_channels', 'image_scatter_channels', 'image_gather_face
 import logging
 from typing import List
 
+import dask.array
 import numpy
 
 from rascil.data_models.memory_data_models import Image
 
 from rascil.processing_components.image.operations import create_image_from_array, create_empty_image_like, \
-    image_is_canonical
+    image_is_canonical, image_is_dask
 from rascil.processing_components.image.iterators import image_raster_iter, image_channel_iter
 
 log = logging.getLogger('logger')
@@ -105,6 +106,8 @@ def image_gather_facets(image_list: List[Image], im: Image, facets=1, overlap=0,
 def image_scatter_channels(im: Image, subimages=None) -> List[Image]:
     """Scatter an image into a list of subimages using the channels
 
+    If the image data are a dask.array, so are those of the subimages: nothing is computed.
+
     :param im: Image
     :param subimages: Number of channels
     :return: list of subimages
@@ -133,12 +136,23 @@ def image_gather_channels(image_list: List[Image], im: Image = None, subimages=0
     If the template image is not given then it will be formed assuming that the list has
     been generated by image_scatter_channels with subimages = number of channels
 
+    If the template or any of the subimages has data in a dask.array, the output data are the concatenation
+    of the subimages as a dask.array, so the cube is never held in memory. If the template data are a
+    numpy.memmap, the subimages are written to that file.
+
     :param image_list: List of subimages
     :param im: Output image
     :param subimages: Number of image partitions on each axis (2)
     :return: list of subimages
     """
     
+    if (im is not None and image_is_dask(im)) or any(image_is_dask(sub) for sub in image_list):
+        data = dask.array.concatenate([dask.array.asarray(sub.data) for sub in image_list], axis=0)
+        if im is None:
+            return create_image_from_array(data, image_list[0].wcs, image_list[0].polarisation_frame)
+        assert data.shape == im.shape, "Subimages %s do not match image %s" % (data.shape, im.shape)
+        return create_image_from_array(data.astype(im.data.dtype), im.wcs, im.polarisation_frame)
+    
     if im is None:
         nchan = len(image_list)
         _, npol, ny, nx = image_list[0].shape
@@ -5,6 +5,8 @@
 __all__ = ['add_image',
            'calculate_image_frequency_moments',
            'calculate_image_from_frequency_moments',
+           'convert_image_to_dask',
+           'convert_image_to_numpy',
            'convert_polimage_to_stokes',
            'convert_stokes_to_polimage',
            'copy_image',
@@ -16,12 +18,14 @@ __all__ = ['add_image',
            'export_image_to_fits',
            'fft_image',
            'image_is_canonical',
+           'image_is_dask',
            'import_image_from_fits',
            'pad_image',
            'polarisation_frame_from_wcs',
            'qa_image',
            'remove_continuum_image',
            'reproject_image',
+           'reproject_image_obliquity',
            'show_components',
            'show_image',
            'smooth_image',
@@ -30,8 +34,11 @@ __all__ = ['add_image',
 
 import copy
 import logging
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
+import dask.array
 import numpy
 from astropy import units as u
 from astropy.coordinates import SkyCoord
@@ -40,6 +47,7 @@ from astropy.wcs import FITSFixedWarning
 from astropy.wcs import WCS
 from astropy.wcs.utils import skycoord_to_pixel
 from reproject import reproject_interp
+from scipy.ndimage import map_coordinates
 
 from rascil.data_models.memory_data_models import Image, QA
 from rascil.data_models.parameters import get_parameter
@@ -73,9 +81,74 @@ def image_is_canonical(im: Image):
     return canonical
 
 
+def image_is_dask(im: Image):
+    """ Is the image data a dask.array, computed only when needed?
+
+    :param im: Image
+    :return: bool
+    """
+    return isinstance(im.data, dask.array.Array)
+
+
+def convert_image_to_dask(im: Image, chunks=None) -> Image:
+    """ Convert an image to one whose data is a dask.array
+
+    The data are not copied: for an image read from FITS with chunks set, or one whose data is a
+    numpy.memmap, the data remain on disk and each chunk is read only when needed. By default there
+    is one chunk for each channel.
+
+    :param im: Image
+    :param chunks: Chunks as for dask.array.from_array (default is (1, npol, ny, nx))
+    :return: Image
+    """
+    if image_is_dask(im):
+        if chunks is None:
+            return im
+        return create_image_from_array(im.data.rechunk(chunks), im.wcs, im.polarisation_frame)
+    if chunks is None:
+        chunks = (1,) + im.shape[1:]
+    return create_image_from_array(dask.array.from_array(im.data, chunks=chunks), im.wcs, im.polarisation_frame)
+
+
+def convert_image_to_numpy(im: Image) -> Image:
+    """ Convert an image whose data is a dask.array to one held in memory
+
+    :param im: Image
+    :return: Image (the input if it is already in memory)
+    """
+    if not image_is_dask(im):
+        return im
+    return create_image_from_array(im.data.compute(), im.wcs, im.polarisation_frame)
+
+
+def _export_image_to_fits_by_channel(im: Image, fitsfile):
+    """ Write an image to fits a channel at a time, so that a dask.array is never held in memory
+
+    :param im: Image
+    :param fitsfile: Name of output fits file in storage
+    """
+    dtype = numpy.float64 if numpy.issubdtype(im.data.dtype, numpy.complexfloating) else im.data.dtype
+    header = fits.PrimaryHDU(data=numpy.zeros([1] * len(im.shape), dtype=dtype)).header
+    for axis, length in enumerate(reversed(im.shape)):
+        header['NAXIS%d' % (axis + 1)] = length
+    header.update(im.wcs.to_header())
+    if os.path.exists(fitsfile):
+        os.remove(fitsfile)
+    hdu = fits.StreamingHDU(fitsfile, header)
+    try:
+        for chan in range(im.nchan):
+            data = im.data[chan:chan + 1].compute(scheduler='threads')
+            hdu.write(numpy.real(data).astype(dtype))
+    finally:
+        hdu.close()
+
+
 def export_image_to_fits(im: Image, fitsfile: str = 'imaging.fits'):
     """ Write an image to fits
     
+    If the image data are a dask.array (see convert_image_to_dask), the image is computed and written a
+    channel at a time.
+
     :param im: Image
     :param fitsfile: Name of output fits file in storage
     :returns: None
@@ -85,6 +158,8 @@ def export_image_to_fits(im: Image, fitsfile: str = 'imaging.fits'):
 
     """
     assert isinstance(im, Image), im
+    if image_is_dask(im):
+        return _export_image_to_fits_by_channel(im, fitsfile)
     if im.data.dtype == "complex":
         return fits.writeto(filename=fitsfile, data=numpy.real(im.data), header=im.wcs.to_header(), overwrite=True)
     else:
@@ -92,10 +167,15 @@ def export_image_to_fits(im: Image, fitsfile: str = 'imaging.fits'):
 
 
 
-def import_image_from_fits(fitsfile: str) -> Image:
+def import_image_from_fits(fitsfile: str, chunks=None) -> Image:
     """ Read an Image from fits
     
+    If chunks is set, the file is memory mapped and the image data are a dask.array with those chunks
+    (see convert_image_to_dask), so that only the chunks used are read. This is suitable for cubes
+    larger than memory.
+
     :param fitsfile: FITS file in storage
+    :param chunks: Chunks for a dask.array e.g. (1, npol, ny, nx) (default is to read all data into memory)
     :return: Image
 
     See also
@@ -105,10 +185,13 @@ def import_image_from_fits(fitsfile: str) -> Image:
     """
     fim = Image()
     warnings.simplefilter('ignore', FITSFixedWarning)
-    hdulist = fits.open(fitsfile)
+    hdulist = fits.open(fitsfile, memmap=True if chunks is not None else None)
     fim.data = hdulist[0].data
     fim.wcs = WCS(fitsfile)
     hdulist.close()
+    if chunks is not None:
+        # The memory map remains open while the data are used
+        fim.data = dask.array.from_array(fim.data, chunks=chunks)
     
     if len(fim.data) == 2:
         fim.polarisation_frame = PolarisationFrame('stokesI')
@@ -116,18 +199,24 @@ def import_image_from_fits(fitsfile: str) -> Image:
         try:
             fim.polarisation_frame = polarisation_frame_from_wcs(fim.wcs, fim.data.shape)
             # FITS and RASCIL polarisation conventions differ
-            new_data = fim.data.copy()
-            new_data[:, 3] = fim.data[:, 1]
-            new_data[:, 1] = fim.data[:, 2]
-            new_data[:, 2] = fim.data[:, 3]
-            fim.data = new_data
+            if fim.data.shape[1] == 4:
+                if chunks is not None:
+                    fim.data = fim.data[:, [0, 2, 3, 1]]
+                else:
+                    new_data = fim.data.copy()
+                    new_data[:, 3] = fim.data[:, 1]
+                    new_data[:, 1] = fim.data[:, 2]
+                    new_data[:, 2] = fim.data[:, 3]
+                    fim.data = new_data
         
         except ValueError:
             fim.polarisation_frame = PolarisationFrame('stokesI')
     
     log.debug("import_image_from_fits: created %s image of shape %s, size %.3f (GB)" %
               (fim.data.dtype, str(fim.shape), image_sizeof(fim)))
-    log.debug("import_image_from_fits: Max, min in %s = %.6f, %.6f" % (fitsfile, fim.data.max(), fim.data.min()))
+    if chunks is None:
+        log.debug("import_image_from_fits: Max, min in %s = %.6f, %.6f" % (fitsfile, fim.data.max(),
+                                                                            fim.data.min()))
     
     assert isinstance(fim, Image)
     return fim
@@ -185,6 +274,135 @@ def reproject_image(im: Image, newwcs: WCS, shape=None) -> (Image, Image):
                                                                                                 im.polarisation_frame)
 
 
+def reproject_image_obliquity(im: Image, newwcs: WCS, shape=None, nthreads=1) -> (Image, Image):
+    """ Re-project an image to a coordinate system differing only in the obliquity of the SIN projection
+
+    This is the distortion used in timeslice imaging: the obliquity parameters (PV2_1, PV2_2) of the SIN
+    projection differ, everything else is the same. The pixel coordinate map is then calculated directly
+    once and shared by all channel and polarisation planes, which are interpolated (bicubic, as in
+    reproject_image) in a thread pool. If the WCS's differ in any other way, reproject_image is used.
+
+    :param im: Image to be reprojected
+    :param newwcs: New WCS
+    :param shape: Desired shape (default is the shape of im)
+    :param nthreads: Number of threads used for the planes (1). In the rsexecute workflows, this is set from
+        the cores available to each task, see rsexecute.threads_per_task
+    :return: Reprojected Image, Footprint Image
+    """
+    assert isinstance(im, Image), im
+
+    if shape is None:
+        shape = im.shape
+    shape = tuple(shape)
+    if len(im.shape) != 4 or shape[:2] != im.shape[:2]:
+        return reproject_image(im, newwcs, shape)
+
+    coords = _obliquity_pixel_map(im.wcs, newwcs, shape[2:])
+    if coords is None:
+        return reproject_image(im, newwcs, shape)
+
+    # As reproject_interp: pad by one pixel so that the outer half of the edge pixels is interpolated,
+    # and mark the points beyond that (or not on the sphere) as missing
+    ny, nx = im.shape[2:]
+    valid = numpy.isfinite(coords[0]) & numpy.isfinite(coords[1]) & \
+            (coords[0] >= -0.5) & (coords[0] <= ny - 0.5) & (coords[1] >= -0.5) & (coords[1] <= nx - 0.5)
+    coords = numpy.where(valid, coords, -2.0) + 1.0
+
+    if im.data.dtype == 'complex':
+        planes = [(chan, pol, part) for chan in range(shape[0]) for pol in range(shape[1])
+                  for part in ['real', 'imag']]
+    else:
+        planes = [(chan, pol, None) for chan in range(shape[0]) for pol in range(shape[1])]
+    rep = numpy.zeros(shape, dtype=im.data.dtype)
+
+    def interpolate(plane):
+        chan, pol, part = plane
+        data = im.data[chan, pol] if part is None else getattr(im.data[chan, pol], part)
+        result = map_coordinates(numpy.pad(data, 1, mode='edge'), coords, order=3, mode='constant',
+                                 cval=numpy.nan)
+        result[~valid] = numpy.nan
+        if part == 'imag':
+            rep[chan, pol].imag = result
+        elif part == 'real':
+            rep[chan, pol].real = result
+        else:
+            rep[chan, pol] = result
+
+    nthreads = min(nthreads, len(planes))
+    if nthreads > 1:
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            list(executor.map(interpolate, planes))
+    else:
+        for plane in planes:
+            interpolate(plane)
+
+    foot = numpy.zeros(shape)
+    foot[...] = valid.astype('float')
+    if numpy.sum(foot) < 1e-12:
+        log.warning("reproject_image_obliquity: no valid points in reprojection")
+
+    return create_image_from_array(rep, newwcs, im.polarisation_frame), create_image_from_array(foot, newwcs,
+                                                                                                im.polarisation_frame)
+
+
+def _obliquity_parameters(wcs: WCS):
+    """ Obliquity parameters (xi, eta) of a SIN projection, or None if the WCS is not a plain SIN projection
+
+    :param wcs: WCS
+    :return: (xi, eta) or None
+    """
+    w = wcs.wcs
+    if w.ctype[0] != 'RA---SIN' or w.ctype[1] != 'DEC--SIN' or w.has_cd() or \
+            not numpy.array_equal(w.get_pc()[:2, :2], numpy.identity(2)):
+        return None
+    xi_eta = [0.0, 0.0]
+    for i, m, value in w.get_pv():
+        if i not in [0, 2] or m not in [1, 2]:
+            return None
+        xi_eta[m - 1] = value
+    return tuple(xi_eta)
+
+
+def _obliquity_pixel_map(wcs: WCS, newwcs: WCS, shape):
+    """ Pixel coordinates in wcs of the pixels of an image with newwcs, where the two differ only in obliquity
+
+    With obliquity parameters (xi, eta) the SIN projection has intermediate coordinates (radians)
+    x = l + xi (1 - n), y = m + eta (1 - n). For the new pixels, (l, m) is found by solving the quadratic for
+    t = 1 - n, then projected with the obliquity of wcs.
+
+    :param wcs: WCS of the image to be reprojected
+    :param newwcs: WCS of the reprojected image
+    :param shape: Shape [ny, nx] of the reprojected image
+    :return: Coordinates [2, ny, nx] (y, x) in pixels of wcs (NaN if not in the projection), or None if the
+        two WCS's differ in other ways
+    """
+    obliquity = _obliquity_parameters(wcs)
+    newobliquity = _obliquity_parameters(newwcs)
+    if obliquity is None or newobliquity is None:
+        return None
+    for attr in ['crval', 'crpix', 'cdelt']:
+        if not numpy.array_equal(getattr(wcs.wcs, attr)[:2], getattr(newwcs.wcs, attr)[:2]):
+            return None
+
+    crpix, cdelt = wcs.wcs.crpix[:2], numpy.deg2rad(wcs.wcs.cdelt[:2])
+    x = (numpy.arange(shape[1]) + 1.0 - crpix[0]) * cdelt[0]
+    y = (numpy.arange(shape[0]) + 1.0 - crpix[1]) * cdelt[1]
+    x, y = numpy.meshgrid(x, y)
+
+    xi, eta = newobliquity
+    a = xi ** 2 + eta ** 2 + 1.0
+    b = x * xi + y * eta + 1.0
+    c = x ** 2 + y ** 2
+    with numpy.errstate(invalid='ignore'):
+        t = c / (b + numpy.sqrt(b ** 2 - a * c))
+        t[t > 1.0] = numpy.nan
+    l = x - xi * t
+    m = y - eta * t
+
+    xi, eta = obliquity
+    return numpy.array([(m + eta * t) / cdelt[1] + crpix[1] - 1.0, (l + xi * t) / cdelt[0] + crpix[0] - 1.0])
+
+
 def add_image(im1: Image, im2: Image) -> Image:
     """ Add two images
     
@@ -769,7 +987,11 @@ def copy_image(im: Image):
     assert isinstance(im, Image), im
     fim = Image()
     fim.polarisation_frame = im.polarisation_frame
-    fim.data = copy.deepcopy(im.data)
+    if image_is_dask(im):
+        # This copies the graph, not the data
+        fim.data = im.data.copy()
+    else:
+        fim.data = copy.deepcopy(im.data)
     if im.wcs is None:
         fim.wcs = None
     else:
@@ -17,6 +17,14 @@ If installed, the nifty gridder (https://gitlab.mpcdf.mpg.de/ift/nifty_gridder)
 
     dirty, sumwt = invert_ng(vis, model, verbosity=2)
 
+Image domain gridding, which needs no convolution function and so suits time-varying A terms, is also available::
+
+    dirty, sumwt = invert_idg(vis, model, make_aterm=make_aterm, aterm_interval=600.0)
+
+All facets of an image can be made in one pass over the visibility::
+
+    dirty, sumwt = invert_facets(vis, model, facets=4, threads=4)
+
 These functions can be used directly. For distribution, these functions can be orchestrated by the rsexecute/Dask framework. This allows w stacking, timeslicing, and a wprojection/w stacking hybrid. See
 
     :py:mod:`rascil.workflows.rsexecute.imaging`
@@ -33,5 +41,7 @@ from .imaging_params import *
 from .timeslice_single import *
 from .weighting import *
 from .wstack_single import *
+from .idg import *
+from .facets import *
 from .dft import *
 
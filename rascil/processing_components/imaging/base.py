@@ -42,6 +42,7 @@ from rascil.processing_components.griddata.operations import create_griddata_fro
 from rascil.processing_components.image import create_image_from_array, convert_polimage_to_stokes, \
     convert_stokes_to_polimage
 from rascil.processing_components.visibility.base import copy_visibility, phaserotate_visibility
+from rascil.processing_components.util.profiling import profile_function
 
 log = logging.getLogger('logger')
 
@@ -103,6 +104,7 @@ def normalize_sumwt(im: Image, sumwt) -> Image:
     return im
 
 
+@profile_function
 def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image, gcfcf=None,
                **kwargs) -> Union[BlockVisibility, Visibility]:
     """ Predict using convolutional degridding.
@@ -144,6 +146,7 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image, gcfcf=None
     return svis
 
 
+@profile_function
 def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True,
               gcfcf=None, **kwargs) -> (Image, numpy.ndarray):
     """ Invert using 2D convolution function, using the specified convolution function
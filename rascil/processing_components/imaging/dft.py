@@ -61,14 +61,14 @@ def dft_skycomponent_visibility(vis: Union[Visibility, BlockVisibility], sc: Uni
         if isinstance(vis, Visibility):
 
             _, im_nchan = list(get_frequency_map(vis, None))
-            phasor = calculate_visibility_phasor(comp.direction, vis)
+            phasor = calculate_visibility_phasor(comp.direction, vis, cache=False)
             for row in range(vis.nvis):
                 ic = im_nchan[row]
                 vis.data['vis'][row, :] += flux[ic, :] * phasor[row]
 
         elif isinstance(vis, BlockVisibility):
 
-            phasor = calculate_blockvisibility_phasor(comp.direction, vis)
+            phasor = calculate_blockvisibility_phasor(comp.direction, vis, cache=False)
             vis.data['vis'] += flux * phasor
 
     return vis
@@ -102,7 +102,7 @@ def idft_visibility_skycomponent(vis: Union[Visibility, BlockVisibility],
             flux = numpy.zeros_like(comp.flux, dtype='complex')
             weight = numpy.zeros_like(comp.flux, dtype='float')
             _, im_nchan = list(get_frequency_map(vis, None))
-            phasor = numpy.conjugate(calculate_visibility_phasor(comp.direction, vis))
+            phasor = numpy.conjugate(calculate_visibility_phasor(comp.direction, vis, cache=False))
             fvwp = vis.flagged_weight * vis.flagged_vis * phasor
             fw = vis.flagged_weight
             for row in range(vis.nvis):
@@ -112,7 +112,7 @@ def idft_visibility_skycomponent(vis: Union[Visibility, BlockVisibility],
 
         elif isinstance(vis, BlockVisibility):
 
-            phasor = numpy.conjugate(calculate_blockvisibility_phasor(comp.direction, vis))
+            phasor = numpy.conjugate(calculate_blockvisibility_phasor(comp.direction, vis, cache=False))
             flux = numpy.sum(vis.flagged_weight * vis.flagged_vis * phasor, axis=(0, 1, 2))
             weight = numpy.sum(vis.flagged_weight, axis=(0, 1, 2))
 
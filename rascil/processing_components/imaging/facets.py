@@ -0,0 +1,252 @@
+"""
+Functions that implement faceted prediction of and imaging from visibilities in one pass over the visibility.
+
+Faceted imaging divides the image into facets, each with its own phase centre on the tangent plane. Done
+facet by facet, e.g. by invert_2d on each facet in turn, every facet phase rotates and grids the whole of the
+visibility. Since the facets stay on the same tangent plane, the uvw and hence the convolution mapping are
+the same for every facet, only the phase rotation differs. Here the visibilities are processed in blocks: each
+block is phase rotated to all facet centres in one matrix product and gridded into (or degridded from) all
+facets in one sparse matrix product with the convolution mapping of the block.
+
+The blocks may be processed in a pool of threads (argument threads), each thread working through a
+contiguous range of rows.
+
+In the imaging and pipeline workflows, these may be invoked using context='facets_batched'.
+"""
+
+__all__ = ['predict_facets', 'invert_facets']
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+import scipy.sparse
+from astropy.wcs.utils import pixel_to_skycoord
+
+from rascil.data_models.memory_data_models import Visibility, Image
+from rascil.data_models.parameters import get_parameter
+from rascil.processing_components.fourier_transforms import fft, ifft
+from rascil.processing_components.griddata import create_griddata_from_image, convolution_mapping_visibility, \
+    create_pswf_convolutionfunction
+from rascil.processing_components.image.gather_scatter import image_scatter_facets, image_gather_facets
+from rascil.processing_components.image.operations import create_image_from_array, create_empty_image_like, \
+    convert_stokes_to_polimage, convert_polimage_to_stokes
+from rascil.processing_components.imaging.base import normalize_sumwt, fill_vis_for_psf
+from rascil.processing_components.util.coordinate_support import skycoord_to_lmn
+from rascil.processing_components.visibility.base import copy_visibility
+
+log = logging.getLogger('logger')
+
+# Number of visibility rows phase rotated and gridded together
+_facet_block_size = 2 ** 14
+
+
+def _facet_offsets(facet_list, vis):
+    """ The direction cosines of the facet phase centres relative to the visibility phase centre
+
+    :param facet_list: list of facet Images
+    :param vis: Visibility
+    :return: array [nfacets, 3] of (l, m, n - 1)
+    """
+    offsets = numpy.zeros([len(facet_list), 3])
+    for i, facet in enumerate(facet_list):
+        _, _, ny, nx = facet.shape
+        # As in shift_vis_to_image
+        centre = pixel_to_skycoord(nx // 2 + 1, ny // 2 + 1, facet.wcs, origin=1)
+        offsets[i] = skycoord_to_lmn(centre, vis.phasecentre)
+    return offsets
+
+
+class _FacetMapping:
+    """ The convolution mapping of a Visibility, shared by all facets
+    """
+
+    def __init__(self, vis, griddata, cf):
+        """
+
+        :param vis: Visibility
+        :param griddata: GridData of one facet
+        :param cf: Convolution function
+        """
+        self.cf = cf
+        self.shape = griddata.shape
+        self.pu_grid, self.pu_offset, self.pv_grid, self.pv_offset, self.pwg_grid, _, self.pwc_grid, _, \
+            self.pfreq_grid = convolution_mapping_visibility(vis, griddata, vis.frequency, cf)
+
+    @property
+    def ngrid(self):
+        nchan, npol, nz, ny, nx = self.shape
+        return nchan * nz * ny * nx
+
+    def matrices(self, rows):
+        """ The sparse matrices mapping the rows onto the grid, one per polarisation
+
+        The matrices have shape [nchan * nz * ny * nx, len(rows)]. For gridding they are applied with the
+        conjugate of the convolution function, for degridding the transpose is applied without.
+
+        :param rows: Indices of rows
+        :return: list of scipy.sparse.csr_matrix
+        """
+        nchan, npol, nz, ny, nx = self.shape
+        _, _, _, _, _, gv, gu = self.cf.shape
+        chan, zzg, zzc = self.pfreq_grid[rows], self.pwg_grid[rows], self.pwc_grid[rows]
+        vvf, uuf = self.pv_offset[rows], self.pu_offset[rows]
+        yy = self.pv_grid[rows, numpy.newaxis] - gv // 2 + numpy.arange(gv)
+        xx = self.pu_grid[rows, numpy.newaxis] - gu // 2 + numpy.arange(gu)
+        index = (((chan * nz + zzg) * ny)[:, numpy.newaxis, numpy.newaxis] + yy[:, :, numpy.newaxis]) * nx + \
+                xx[:, numpy.newaxis, :]
+        column = numpy.repeat(numpy.arange(len(rows)), gv * gu)
+        return [scipy.sparse.csr_matrix((self.cf.data[chan, pol, zzc, vvf, uuf].ravel(),
+                                         (index.ravel(), column)), shape=(self.ngrid, len(rows)))
+                for pol in range(npol)]
+
+
+def _row_ranges(nvis, threads):
+    """ Split the rows into contiguous ranges, one per thread, each worked through in blocks
+
+    :param nvis: Number of rows
+    :param threads: Number of threads
+    :return: list of lists of row ranges
+    """
+    ranges = numpy.array_split(numpy.arange(nvis), max(1, min(threads, nvis)))
+    return [[r[i:i + _facet_block_size] for i in range(0, len(r), _facet_block_size)] for r in ranges]
+
+
+def _map_rows(function, nvis, threads):
+    """ Apply function to the blocks of rows of each range, in a pool of threads if threads > 1
+
+    :param function: Function taking a list of blocks of rows
+    :param nvis: Number of rows
+    :param threads: Number of threads
+    :return: list of results, one per range
+    """
+    ranges = _row_ranges(nvis, threads)
+    if len(ranges) > 1:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            return list(executor.map(function, ranges))
+    return [function(blocks) for blocks in ranges]
+
+
+def _facet_setup(vis, im, facets, overlap, taper, gcfcf, **kwargs):
+    """ The facet templates, convolution function and mapping shared by all facets
+
+    :return: facet templates, offsets, gcf, mapping
+    """
+    facet_list = image_scatter_facets(im, facets=facets, overlap=overlap, taper=taper)
+    template = facet_list[0]
+    if gcfcf is None or facets > 1:
+        gcf, cf = create_pswf_convolutionfunction(template,
+                                                  support=get_parameter(kwargs, "support", 8),
+                                                  oversampling=get_parameter(kwargs, "oversampling", 127))
+    else:
+        gcf, cf = gcfcf
+    griddata = create_griddata_from_image(template, vis)
+    mapping = _FacetMapping(vis, griddata, cf)
+    log.debug("facets: %d facets of shape %s, %d rows" % (len(facet_list), str(template.shape), vis.nvis))
+    return facet_list, _facet_offsets(facet_list, vis), gcf, mapping, griddata.polarisation_frame
+
+
+def predict_facets(vis: Visibility, model: Image, facets=1, overlap=0, taper=None, gcfcf=None,
+                   **kwargs) -> Visibility:
+    """ Predict from all facets of a model in one pass over the visibility
+
+    This gives the same result as predicting from each facet with predict_2d and summing, but the
+    visibility is phase rotated to all facets together, and the degridding mapping is shared.
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param facets: Number of facets on each axis
+    :param overlap: Overlap between facets in pixels
+    :param taper: Taper at edges of facets
+    :param gcfcf: (Grid correction function, convolution function) for the facets, used only if facets == 1
+    :param kwargs: threads: Number of threads (1), support (8), oversampling (127)
+    :return: resulting visibility (in place works)
+    """
+    if model is None:
+        return vis
+
+    assert isinstance(vis, Visibility), vis
+
+    facet_list, offsets, gcf, mapping, _ = _facet_setup(vis, model, facets, overlap, taper, gcfcf, **kwargs)
+    nchan, npol, nz, ny, nx = mapping.shape
+
+    # The grids of all facets, with the grid pixel first and facet last for the sparse product
+    grids = numpy.zeros([npol, mapping.ngrid, len(facet_list)], dtype='complex')
+    for i, facet in enumerate(facet_list):
+        polmodel = convert_stokes_to_polimage(facet, vis.polarisation_frame)
+        grid = numpy.repeat(fft(polmodel.data * gcf.data)[:, :, numpy.newaxis, ...], nz, axis=2)
+        grids[..., i] = numpy.moveaxis(grid, 1, 0).reshape([npol, mapping.ngrid])
+
+    newvis = copy_visibility(vis, zero=True)
+
+    def degrid(blocks):
+        for rows in blocks:
+            phasor = numpy.exp(-2j * numpy.pi * numpy.dot(vis.uvw[rows], offsets.T))
+            for pol, matrix in enumerate(mapping.matrices(rows)):
+                newvis.data['vis'][rows, pol] = numpy.sum(matrix.T.dot(grids[pol]) * phasor, axis=1)
+
+    _map_rows(degrid, vis.nvis, get_parameter(kwargs, "threads", 1))
+
+    return newvis
+
+
+def invert_facets(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True, facets=1, overlap=0,
+                  taper=None, gcfcf=None, **kwargs) -> (Image, numpy.ndarray):
+    """ Invert into all facets of an image in one pass over the visibility
+
+    This gives the same result as inverting into each facet with invert_2d, but the visibility is phase
+    rotated to all facets together, and the gridding mapping is shared.
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param facets: Number of facets on each axis
+    :param overlap: Overlap between facets in pixels
+    :param taper: Taper at edges of facets
+    :param gcfcf: (Grid correction function, convolution function) for the facets, used only if facets == 1
+    :param kwargs: threads: Number of threads (1), support (8), oversampling (127)
+    :return: resulting image, sum of weights
+    """
+    assert isinstance(vis, Visibility), vis
+
+    svis = vis
+    if dopsf:
+        svis = fill_vis_for_psf(copy_visibility(vis))
+
+    facet_list, offsets, gcf, mapping, polarisation_frame = _facet_setup(svis, im, facets, overlap, taper,
+                                                                         gcfcf, **kwargs)
+    nchan, npol, nz, ny, nx = mapping.shape
+    wvis = svis.vis * svis.flagged_imaging_weight
+
+    def grid(blocks):
+        grids = numpy.zeros([npol, mapping.ngrid, len(facet_list)], dtype='complex')
+        sumwt = numpy.zeros([nchan, npol])
+        for rows in blocks:
+            phasor = numpy.exp(2j * numpy.pi * numpy.dot(svis.uvw[rows], offsets.T))
+            for pol, matrix in enumerate(mapping.matrices(rows)):
+                grids[pol] += matrix.conjugate().dot(wvis[rows, pol, numpy.newaxis] * phasor)
+                sumwt[:, pol] += numpy.bincount(mapping.pfreq_grid[rows],
+                                                weights=svis.flagged_imaging_weight[rows, pol], minlength=nchan)
+        return grids, sumwt
+
+    results = _map_rows(grid, svis.nvis, get_parameter(kwargs, "threads", 1))
+    grids = sum(r[0] for r in results)
+    sumwt = sum(r[1] for r in results)
+
+    result = create_image_from_array(numpy.zeros(im.shape, dtype='complex'), im.wcs, polarisation_frame)
+    for i, dpatch in enumerate(image_scatter_facets(result, facets=facets, overlap=overlap, taper=taper)):
+        grid = numpy.moveaxis(grids[..., i].reshape([npol, nchan, nz, ny, nx]), 0, 1)
+        dpatch.data[...] += ifft(numpy.sum(grid, axis=2)) * gcf.data * float(nx) * float(ny)
+    if overlap > 0:
+        flat = image_gather_facets(facet_list, create_empty_image_like(im), facets=facets, overlap=overlap,
+                                   taper=taper, return_flat=True)
+        result.data[flat.data > 0.5] /= flat.data[flat.data > 0.5]
+        result.data[flat.data <= 0.5] = 0.0
+
+    if normalize:
+        result = normalize_sumwt(result, sumwt)
+
+    result = convert_polimage_to_stokes(result, **kwargs)
+
+    return result, sumwt
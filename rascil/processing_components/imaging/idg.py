@@ -0,0 +1,353 @@
+"""
+Functions that implement prediction of and imaging from visibilities using image domain gridding (IDG).
+
+In IDG the visibilities are gridded onto small subgrids, one for each patch of the uv plane (and channel and
+A term interval). Each subgrid is formed as a coarsely sampled image of the whole field of view: the phase
+of each visibility, including the w term, is evaluated directly on the pixels of the coarse image, which is
+multiplied by the A term and an anti-aliasing taper before being Fourier transformed and added to the grid.
+There is no precomputed convolution function, so the w and A terms cost no kernel memory and time-varying
+A terms only need to be evaluated on the coarse image. See van der Tol, Veenboer and Offringa, A&A 616, A27 (2018).
+
+The w term spreads each visibility over the subgrid by an amount that grows with w and the field of view. To
+keep this within the subgrid, the visibilities are divided into w layers, as in w stacking: the w term relative
+to the w of the layer is evaluated in the subgrids, and that of the layer is applied to the image of the layer.
+
+In the imaging and pipeline workflows, these may be invoked using context='idg'.
+"""
+
+__all__ = ['predict_idg', 'invert_idg']
+
+import logging
+
+import numpy
+
+from rascil.data_models.memory_data_models import Visibility, Image
+from rascil.data_models.parameters import get_parameter
+from rascil.processing_components.fourier_transforms import fft, ifft, grdsf, coordinates
+from rascil.processing_components.griddata import create_griddata_from_image
+from rascil.processing_components.image.operations import copy_image, create_image_from_array, image_is_canonical, \
+    convert_stokes_to_polimage, convert_polimage_to_stokes
+from rascil.processing_components.imaging.base import shift_vis_to_image, normalize_sumwt, fill_vis_for_psf
+from rascil.processing_components.imaging.wstack_single import _w_screens
+from rascil.processing_components.visibility.base import copy_visibility
+
+log = logging.getLogger('logger')
+
+# Maximum number of elements in the phasor array of one batch of visibilities
+_max_phasor_size = 2 ** 22
+
+
+class _IDGLayout:
+    """ The assignment of the visibility rows to subgrids
+
+    The rows are sorted by channel, A term interval, and subgrid. Each subgrid is placed in a grid padded
+    by the subgrid size on each side, so that subgrids at the edge of the grid need no special treatment.
+    """
+
+    def __init__(self, vis, im, subgrid_size=32, kernel_support=8, w_support=4, aterm_interval=None):
+        """ Find the subgrid of each row
+
+        :param vis: Visibility
+        :param im: Image template
+        :param subgrid_size: Size of the subgrids in pixels (even)
+        :param kernel_support: Support of the anti-aliasing kernel in pixels
+        :param w_support: Half width in pixels allowed for the spread by the w term within a w layer
+        :param aterm_interval: Interval in time between updates of the A term (s), None for one A term
+        """
+        assert subgrid_size % 2 == 0, "Subgrid size must be even"
+        assert kernel_support + 2 * w_support < subgrid_size, \
+            "Subgrid size must be larger than the kernel and w supports"
+        nchan, npol, ny, nx = im.shape
+        self.subgrid_size = subgrid_size
+        self.pad = subgrid_size
+        d2r = numpy.pi / 180.0
+
+        # The w layers: the w term for a difference in w of dw spreads a visibility over about
+        # dw * lmax * fov pixels, where lmax is the largest distance from the phase centre in the field of view
+        fov = max(nx * numpy.abs(im.wcs.wcs.cdelt[0]), ny * numpy.abs(im.wcs.wcs.cdelt[1])) * d2r
+        max_dw = w_support / (fov * fov / numpy.sqrt(2.0))
+        wmaxabs = numpy.max(numpy.abs(vis.w)) if vis.nvis > 0 else 0.0
+        if wmaxabs <= max_dw:
+            self.w0, self.wstep, self.nlayers = 0.0, 0.0, 1
+            layer = numpy.zeros(vis.nvis, dtype='int')
+        else:
+            self.nlayers = int(numpy.ceil(wmaxabs / max_dw)) + 1
+            self.w0, self.wstep = -wmaxabs, 2.0 * wmaxabs / (self.nlayers - 1)
+            layer = numpy.round((vis.w - self.w0) / self.wstep).astype('int')
+
+        # Position of each row on the grid in pixels, with the centre of the grid at pixel (nx // 2, ny // 2)
+        pu = nx // 2 + vis.u * nx * d2r * im.wcs.wcs.cdelt[0]
+        pv = ny // 2 + vis.v * ny * d2r * im.wcs.wcs.cdelt[1]
+        if vis.nvis > 0:
+            assert numpy.min(pu) >= 0, "image sampling wrong: U axis underflows: %f" % numpy.min(pu)
+            assert numpy.max(pu) < nx, "image sampling wrong: U axis overflows: %f" % numpy.max(pu)
+            assert numpy.min(pv) >= 0, "image sampling wrong: V axis underflows: %f" % numpy.min(pv)
+            assert numpy.max(pv) < ny, "image sampling wrong: V axis overflows: %f" % numpy.max(pv)
+
+        # Each subgrid takes the rows in a tile of the grid, with room for the kernel on each side
+        tile = subgrid_size - kernel_support - 2 * w_support
+        margin = kernel_support // 2 + w_support
+        tu = numpy.floor(pu / tile).astype('int')
+        tv = numpy.floor(pv / tile).astype('int')
+
+        griddata = create_griddata_from_image(im, vis)
+        chan = numpy.round(griddata.grid_wcs.sub([5]).wcs_world2pix(vis.frequency, 0)[0]).astype('int')
+        assert numpy.min(chan) >= 0 and numpy.max(chan) < nchan, "Visibility frequencies outside image channels"
+
+        if aterm_interval is None or vis.nvis == 0:
+            interval = numpy.zeros(vis.nvis, dtype='int')
+        else:
+            interval = numpy.floor((vis.time - numpy.min(vis.time)) / aterm_interval).astype('int')
+        self.row_interval = interval
+
+        self.order = numpy.lexsort((tu, tv, interval, chan, layer))
+        keys = numpy.stack([layer, chan, interval, tv, tu])[:, self.order]
+        starts = numpy.flatnonzero(numpy.any(keys[:, 1:] != keys[:, :-1], axis=0)) + 1
+        self.bounds = numpy.concatenate([[0], starts, [vis.nvis]]) if vis.nvis > 0 else numpy.zeros(1, dtype='int')
+        first = self.order[self.bounds[:-1]]
+        self.layer = layer[first]
+        self.chan = chan[first]
+        self.interval = interval[first]
+        # Corner of each subgrid in the padded grid
+        self.u0 = tu[first] * tile - margin + self.pad
+        self.v0 = tv[first] * tile - margin + self.pad
+        # Position of each row relative to the centre of its subgrid in pixels, and w relative to its layer
+        self.du = pu - (tu * tile - margin + subgrid_size // 2)
+        self.dv = pv - (tv * tile - margin + subgrid_size // 2)
+        self.dw = vis.w - (self.w0 + layer * self.wstep)
+        self.time = vis.time
+
+        # Coordinates of the pixels of the coarse image of a subgrid
+        self.x = numpy.arange(subgrid_size) - subgrid_size // 2
+        l = self.x * nx * d2r * numpy.abs(im.wcs.wcs.cdelt[0]) / subgrid_size
+        m = self.x * ny * d2r * numpy.abs(im.wcs.wcs.cdelt[1]) / subgrid_size
+        r2 = m[:, numpy.newaxis] ** 2 + l[numpy.newaxis, :] ** 2
+        self.nm1 = numpy.sqrt(numpy.maximum(1.0 - r2, 0.0)) - 1.0
+
+        self.taper = _taper(subgrid_size, subgrid_size)
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def rows(self, isg):
+        """ The rows of a subgrid
+        """
+        return self.order[self.bounds[isg]:self.bounds[isg + 1]]
+
+    def layers(self):
+        """ The subgrids of each w layer
+
+        :return: generator of (layer, range of subgrids)
+        """
+        bounds = numpy.searchsorted(self.layer, numpy.arange(self.nlayers + 1))
+        for layer in range(self.nlayers):
+            yield layer, range(bounds[layer], bounds[layer + 1])
+
+    def phasors(self, rows):
+        """ Phasors of the rows on the pixels of the coarse image, in batches
+
+        :param rows: Rows of one subgrid
+        :return: generator of (rows of batch, [nrows, ny, nx] phasor exp(2 pi j (u l + v m + dw (n - 1))))
+        """
+        s = self.subgrid_size
+        batch = max(1, _max_phasor_size // (s * s))
+        for start in range(0, len(rows), batch):
+            brows = rows[start:start + batch]
+            phase = self.du[brows, numpy.newaxis, numpy.newaxis] * self.x[numpy.newaxis, numpy.newaxis, :] / s \
+                    + self.dv[brows, numpy.newaxis, numpy.newaxis] * self.x[numpy.newaxis, :, numpy.newaxis] / s \
+                    + self.dw[brows, numpy.newaxis, numpy.newaxis] * self.nm1[numpy.newaxis, ...]
+            yield brows, numpy.exp(2j * numpy.pi * phase)
+
+
+def _taper(ny, nx):
+    """ The anti-aliasing taper, normalised as the inverse of the grid correction of create_pswf_convolutionfunction
+
+    :param ny: Number of pixels on the y axis
+    :param nx: Number of pixels on the x axis
+    :return: [ny, nx] array
+    """
+    gy = grdsf(numpy.abs(2.0 * coordinates(ny)))[0]
+    gx = grdsf(numpy.abs(2.0 * coordinates(nx)))[0]
+    g0 = grdsf(numpy.zeros(1))[0][0]
+    return numpy.outer(gy, gx) / g0 ** 2
+
+
+def _grid_correction(ny, nx):
+    """ The grid correction for the taper: its inverse where it is non-zero
+
+    :param ny: Number of pixels on the y axis
+    :param nx: Number of pixels on the x axis
+    :return: [ny, nx] array
+    """
+    taper = _taper(ny, nx)
+    gcf = numpy.zeros_like(taper)
+    gcf[taper > 0.0] = 1.0 / taper[taper > 0.0]
+    return gcf
+
+
+def _aterm_template(im, subgrid_size):
+    """ Template image with the field of view of im sampled by the subgrid size
+
+    :param im: Image
+    :param subgrid_size: Number of pixels on each axis
+    :return: Image
+    """
+    nchan, npol, ny, nx = im.shape
+    template = copy_image(im)
+    template.data = numpy.zeros([nchan, npol, subgrid_size, subgrid_size])
+    template.wcs.wcs.cdelt[0] = im.wcs.wcs.cdelt[0] * nx / subgrid_size
+    template.wcs.wcs.cdelt[1] = im.wcs.wcs.cdelt[1] * ny / subgrid_size
+    template.wcs.wcs.crpix[0] = subgrid_size // 2 + 1.0
+    template.wcs.wcs.crpix[1] = subgrid_size // 2 + 1.0
+    return template
+
+
+def _aterms(layout, im, make_aterm=None):
+    """ The A term times the taper for each A term interval, on the coarse image of the subgrids
+
+    :param layout: _IDGLayout
+    :param im: Image template
+    :param make_aterm: Function (template, time) returning the A term as an Image on the template, or None
+    :return: dict from interval to [nchan, ny, nx] array
+    """
+    if make_aterm is None:
+        taper = numpy.repeat(layout.taper[numpy.newaxis, ...], im.shape[0], axis=0)
+        return {interval: taper for interval in numpy.unique(layout.interval)}
+    template = _aterm_template(im, layout.subgrid_size)
+    aterms = dict()
+    for interval in numpy.unique(layout.interval):
+        time = numpy.average(layout.time[layout.row_interval == interval])
+        aterm = make_aterm(template, time)
+        aterms[interval] = aterm.data[:, 0, ...] * layout.taper[numpy.newaxis, ...]
+    return aterms
+
+
+def _idg_setup(vis, im, **kwargs):
+    """ The layout of the subgrids and the A terms
+
+    :param vis: Visibility
+    :param im: Image template
+    :return: _IDGLayout, A terms
+    """
+    layout = _IDGLayout(vis, im,
+                        subgrid_size=get_parameter(kwargs, "idg_subgrid_size", 32),
+                        kernel_support=get_parameter(kwargs, "idg_kernel_support", 8),
+                        w_support=get_parameter(kwargs, "idg_w_support", 4),
+                        aterm_interval=get_parameter(kwargs, "aterm_interval", None))
+    log.debug("idg: %d subgrids in %d w layers" % (len(layout), layout.nlayers))
+    return layout, _aterms(layout, im, get_parameter(kwargs, "make_aterm", None))
+
+
+def predict_idg(vis: Visibility, model: Image, gcfcf=None, **kwargs) -> Visibility:
+    """ Predict using image domain gridding
+
+    For each w layer the model, with the w term of the layer applied, is transformed to the uv plane. The
+    visibilities of each subgrid are then evaluated directly on the coarse image of the subgrid, including the
+    remaining w term and the A term. No convolution function is needed, so gcfcf is ignored.
+
+    In the imaging and pipeline workflows, this may be invoked using context='idg'.
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param kwargs: idg_subgrid_size (32), idg_kernel_support (8), idg_w_support (4), make_aterm: function
+        (template, time) returning the A term as an Image (None), aterm_interval: time between A term updates in s
+    :return: resulting visibility
+    """
+    if model is None:
+        return vis
+
+    assert isinstance(vis, Visibility), "idg requires Visibility format not BlockVisibility"
+    assert image_is_canonical(model)
+
+    vis = copy_visibility(vis, zero=True)
+    vis = shift_vis_to_image(vis, model, tangent=True, inverse=False)
+
+    layout, aterms = _idg_setup(vis, model, **kwargs)
+
+    _, _, ny, nx = model.shape
+    polmodel = convert_stokes_to_polimage(model, vis.polarisation_frame)
+    workdata = polmodel.data * _grid_correction(ny, nx)
+    pad = layout.pad
+    s = layout.subgrid_size
+
+    screens = _w_screens(model, layout.w0, layout.wstep, layout.nlayers)
+    for (layer, subgrids), screen in zip(layout.layers(), screens):
+        if len(subgrids) == 0:
+            continue
+        grid = numpy.pad(fft(numpy.conjugate(screen) * workdata), ((0, 0), (0, 0), (pad, pad), (pad, pad)))
+        for isg in subgrids:
+            chan, u0, v0 = layout.chan[isg], layout.u0[isg], layout.v0[isg]
+            subgrid = grid[chan, numpy.newaxis, :, v0:v0 + s, u0:u0 + s]
+            subimage = ifft(subgrid)[0] * aterms[layout.interval[isg]][chan]
+            for rows, phasor in layout.phasors(layout.rows(isg)):
+                vis.data['vis'][rows] = numpy.einsum('pyx,kyx->kp', subimage, numpy.conjugate(phasor))
+
+    return shift_vis_to_image(vis, model, tangent=True, inverse=True)
+
+
+def invert_idg(vis: Visibility, im: Image, dopsf=False, normalize=True, gcfcf=None,
+               **kwargs) -> (Image, numpy.ndarray):
+    """ Invert using image domain gridding
+
+    The visibilities of each subgrid are summed directly on the coarse image of the subgrid, including the w term
+    relative to the w layer and the A term. The subgrid is then transformed and added to the grid of the layer.
+    The image of each layer has the w term of the layer applied before summing. No convolution function is needed,
+    so gcfcf is ignored.
+
+    In the imaging and pipeline workflows, this may be invoked using context='idg'.
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param kwargs: idg_subgrid_size (32), idg_kernel_support (8), idg_w_support (4), make_aterm: function
+        (template, time) returning the A term as an Image (None), aterm_interval: time between A term updates in s
+    :return: image, sum of weights
+    """
+    assert isinstance(vis, Visibility), "idg requires Visibility format not BlockVisibility"
+    assert image_is_canonical(im)
+
+    svis = copy_visibility(vis)
+    if dopsf:
+        svis = fill_vis_for_psf(svis)
+    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+
+    layout, aterms = _idg_setup(svis, im, **kwargs)
+
+    griddata = create_griddata_from_image(im, svis)
+    nchan, npol, _, ny, nx = griddata.shape
+    pad = layout.pad
+    s = layout.subgrid_size
+    grid = numpy.zeros([nchan, npol, ny + 2 * pad, nx + 2 * pad], dtype='complex')
+    stack = numpy.zeros([nchan, npol, ny, nx], dtype='complex')
+
+    wvis = svis.vis * svis.flagged_imaging_weight
+    sumwt = numpy.zeros([nchan, npol])
+
+    screens = _w_screens(im, layout.w0, layout.wstep, layout.nlayers)
+    for (layer, subgrids), screen in zip(layout.layers(), screens):
+        if len(subgrids) == 0:
+            continue
+        grid[...] = 0.0
+        for isg in subgrids:
+            chan, u0, v0 = layout.chan[isg], layout.u0[isg], layout.v0[isg]
+            rows = layout.rows(isg)
+            subimage = numpy.zeros([npol, s, s], dtype='complex')
+            for brows, phasor in layout.phasors(rows):
+                subimage += numpy.einsum('kp,kyx->pyx', wvis[brows], phasor)
+            subimage *= numpy.conjugate(aterms[layout.interval[isg]][chan])
+            grid[chan, :, v0:v0 + s, u0:u0 + s] += fft(subimage[numpy.newaxis, ...])[0] / (s * s)
+            sumwt[chan] += numpy.sum(svis.flagged_imaging_weight[rows], axis=0)
+        # The rows all lie in the grid. Only the edges of the subgrids, beyond the edge of the grid, fall in the
+        # padding, which is not used
+        stack += screen * ifft(grid[..., pad:pad + ny, pad:pad + nx])
+
+    result = stack * _grid_correction(ny, nx) * float(nx) * float(ny)
+    result = create_image_from_array(result, griddata.projection_wcs, griddata.polarisation_frame)
+
+    if normalize:
+        result = normalize_sumwt(result, sumwt)
+
+    result = convert_polimage_to_stokes(result, **kwargs)
+
+    return result, sumwt
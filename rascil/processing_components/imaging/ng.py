@@ -5,11 +5,17 @@ https://gitlab.mpcdf.mpg.de/ift/nifty_gridder
 
 This performs all necessary w term corrections, to high precision.
 
+All the visibility channels contributing to an image channel are gridded (or degridded) in one call of the
+gridder, which is threaded. By default all cores are used; in the rsexecute workflows the number of threads is
+set from the cores available to each task (see rsexecute.threads_per_task), so that the Dask workers do not
+oversubscribe the cores.
+
 """
 
 __all__ = ['predict_ng', 'invert_ng']
 
 import logging
+import os
 from typing import Union
 
 import numpy
@@ -18,15 +24,56 @@ from rascil.data_models.memory_data_models import BlockVisibility, \
     Image
 from rascil.data_models.parameters import get_parameter
 from rascil.data_models.polarisation import convert_pol_frame
-from rascil.processing_components.image.operations import copy_image, \
+from rascil.processing_components.image.operations import create_empty_image_like, \
     image_is_canonical
 from rascil.processing_components.imaging.base import shift_vis_to_image, \
-    normalize_sumwt, fill_vis_for_psf
+    normalize_sumwt
 from rascil.processing_components.visibility.base import copy_visibility
 
 
 log = logging.getLogger('logger')
 
+
+def _ng_threads(**kwargs):
+    """ Number of threads for the nifty gridder
+
+    In the rsexecute workflows, this is set from the cores available to each task, see
+    rsexecute.threads_per_task. Otherwise all cores are used.
+
+    :param kwargs: threads: Number of threads (None)
+    :return: Number of threads
+    """
+    return get_parameter(kwargs, "threads", None) or os.cpu_count() or 1
+
+
+def _flip_uvw(uvw):
+    """ The uvw as needed by the nifty gridder
+
+    We need to flip the u and w axes. The flip in w is equivalent to the conjugation of the
+    convolution function grid_visibility to griddata
+
+    :param uvw: uvw [nvis, 3]
+    :return: flipped uvw [nvis, 3] (float64 copy)
+    """
+    fuvw = uvw.astype(numpy.float64)
+    fuvw[:, 0] *= -1.0
+    fuvw[:, 2] *= -1.0
+    return fuvw
+
+
+def _channel_batches(model, frequency):
+    """ The visibility channels gridded onto each image channel, batched into one call of the gridder
+
+    :param model: Image
+    :param frequency: Visibility channel frequencies (Hz)
+    :return: list of (image channel, array of visibility channels)
+    """
+    if model.nchan == 1:
+        return [(0, numpy.arange(len(frequency)))]
+    vis_to_im = numpy.round(model.wcs.sub([4]).wcs_world2pix(frequency, 0)[0]).astype('int')
+    return [(ichan, numpy.nonzero(vis_to_im == ichan)[0]) for ichan in numpy.unique(vis_to_im)]
+
+
 try:
     import nifty_gridder as ng
     
@@ -40,16 +87,18 @@ try:
 
         :param bvis: BlockVisibility to be predicted
         :param model: model image
+        :param kwargs: threads: Number of threads (default is the number of cores), epsilon (1e-12),
+            do_wstacking (True), verbosity (0)
         :return: resulting BlockVisibility (in place works)
         """
         
-        assert isinstance(bvis, BlockVisibility), bvis
-        assert image_is_canonical(model)
-        
         if model is None:
             return bvis
         
-        nthreads = get_parameter(kwargs, "threads", 4)
+        assert isinstance(bvis, BlockVisibility), bvis
+        assert image_is_canonical(model)
+        
+        nthreads = _ng_threads(**kwargs)
         epsilon = get_parameter(kwargs, "epsilon", 1e-12)
         do_wstacking = get_parameter(kwargs, "do_wstacking", True)
         verbosity = get_parameter(kwargs, "verbosity", 0)
@@ -57,61 +106,35 @@ try:
         newbvis = copy_visibility(bvis, zero=True)
         
         # Extracting data from BlockVisibility
-        freq = bvis.frequency  # frequency, Hz
+        freq = bvis.frequency.astype(numpy.float64)  # frequency, Hz
         nrows, nants, _, vnchan, vnpol = bvis.vis.shape
         
-        uvw = newbvis.data['uvw'].reshape([nrows * nants * nants, 3])
-        vist = numpy.zeros([vnpol, vnchan, nants * nants * nrows], dtype='complex')
-        
         # Get the image properties
         m_nchan, m_npol, ny, nx = model.data.shape
-        # Check if the number of frequency channels matches in bvis and a model
-        #        assert (m_nchan == v_nchan)
         assert (m_npol == vnpol)
         
-        fuvw = uvw.copy()
-        # We need to flip the u and w axes. The flip in w is equivalent to the conjugation of the
-        # convolution function grid_visibility to griddata
-        fuvw[:, 0] *= -1.0
-        fuvw[:, 2] *= -1.0
+        fuvw = _flip_uvw(bvis.uvw.reshape([nrows * nants * nants, 3]))
         
         # Find out the image size/resolution
         pixsize = numpy.abs(numpy.radians(model.wcs.wcs.cdelt[0]))
         
-        # Make de-gridding over a frequency range and pol fields
-        vis_to_im = numpy.round(model.wcs.sub([4]).wcs_world2pix(freq, 0)[0]).astype('int')
-        
-        mfs = m_nchan == 1
-
-        if mfs:
+        # Make de-gridding over a frequency range and pol fields. All the visibility channels
+        # of an image channel are done in one call.
+        vist = numpy.zeros([nrows * nants * nants, vnchan, vnpol], dtype='complex')
+        for imchan, vchans in _channel_batches(model, freq):
             for vpol in range(vnpol):
-                vist[vpol, : , :] = ng.dirty2ms(fuvw.astype(numpy.float64),
-                                               bvis.frequency.astype(numpy.float64),
-                                               model.data[0, vpol, :, :].T.astype(numpy.float64),
-                                               pixsize_x=pixsize,
-                                               pixsize_y=pixsize,
-                                               epsilon=epsilon,
-                                               do_wstacking=do_wstacking,
-                                               nthreads=nthreads,
-                                               verbosity=verbosity).T
-
-        else:
-            for vpol in range(vnpol):
-                for vchan in range(vnchan):
-                    imchan = vis_to_im[vchan]
-                    vist[vpol, vchan, :] = ng.dirty2ms(fuvw.astype(numpy.float64),
-                                                       numpy.array(freq[vchan:vchan + 1]).astype(numpy.float64),
-                                                       model.data[imchan, vpol, :, :].T.astype(numpy.float64),
-                                                       pixsize_x=pixsize,
-                                                       pixsize_y=pixsize,
-                                                       epsilon=epsilon,
-                                                       do_wstacking=do_wstacking,
-                                                       nthreads=nthreads,
-                                                       verbosity=verbosity)[:, 0]
+                vist[:, vchans, vpol] = ng.dirty2ms(fuvw, freq[vchans],
+                                                    model.data[imchan, vpol, :, :].T.astype(numpy.float64),
+                                                    pixsize_x=pixsize,
+                                                    pixsize_y=pixsize,
+                                                    epsilon=epsilon,
+                                                    do_wstacking=do_wstacking,
+                                                    nthreads=nthreads,
+                                                    verbosity=verbosity)
         
-        vis = convert_pol_frame(vist.T, model.polarisation_frame, bvis.polarisation_frame, polaxis=2)
+        vis = convert_pol_frame(vist, model.polarisation_frame, bvis.polarisation_frame, polaxis=2)
 
-        newbvis.data['vis'] = vis.reshape([nrows, nants, nants, vnchan, vnpol])
+        newbvis.data['vis'][...] = vis.reshape([nrows, nants, nants, vnchan, vnpol])
     
         # Now we can shift the visibility from the image frame to the original visibility frame
         return shift_vis_to_image(newbvis, model, tangent=True, inverse=True)
@@ -132,6 +155,8 @@ try:
         :param bvis: BlockVisibility to be inverted
         :param im: image template (not changed)
         :param normalize: Normalize by the sum of weights (True)
+        :param kwargs: threads: Number of threads (default is the number of cores), epsilon (1e-12),
+            do_wstacking (True), verbosity (0)
         :return: (resulting image, sum of the weights for each frequency and polarization)
     
         """
@@ -139,27 +164,27 @@ try:
         
         assert isinstance(bvis, BlockVisibility), bvis
         
-        im = copy_image(model)
+        im = create_empty_image_like(model)
         
-        nthreads = get_parameter(kwargs, "threads", 4)
+        nthreads = _ng_threads(**kwargs)
         epsilon = get_parameter(kwargs, "epsilon", 1e-12)
         do_wstacking = get_parameter(kwargs, "do_wstacking", True)
         verbosity = get_parameter(kwargs, "verbosity", 0)
         
-        sbvis = copy_visibility(bvis)
-        sbvis = shift_vis_to_image(sbvis, im, tangent=True, inverse=False)
+        # The shift returns a new BlockVisibility if a phase rotation is needed, bvis is not changed
+        sbvis = shift_vis_to_image(bvis, im, tangent=True, inverse=False)
         
-        freq = sbvis.frequency  # frequency, Hz
+        freq = sbvis.frequency.astype(numpy.float64)  # frequency, Hz
         
         nrows, nants, _, vnchan, vnpol = sbvis.vis.shape
-        # if dopsf:
-        #     sbvis = fill_vis_for_psf(sbvis)
-
-        ms = sbvis.vis.reshape([nrows * nants * nants, vnchan, vnpol])
-        ms = convert_pol_frame(ms, bvis.polarisation_frame, im.polarisation_frame, polaxis=2)
-
-        uvw = sbvis.uvw.reshape([nrows * nants * nants, 3])
+        
         wgt = sbvis.flagged_imaging_weight.reshape([nrows * nants * nants, vnchan, vnpol])
+        if dopsf:
+            # Only the first polarisation is gridded, with unit visibility
+            ms = numpy.ones([nrows * nants * nants, vnchan, 1], dtype='complex')
+        else:
+            ms = sbvis.vis.reshape([nrows * nants * nants, vnchan, vnpol])
+            ms = convert_pol_frame(ms, bvis.polarisation_frame, im.polarisation_frame, polaxis=2)
 
         if epsilon > 5.0e-6:
             ms = ms.astype("c8")
@@ -169,83 +194,31 @@ try:
         npixdirty = im.nwidth
         pixsize = numpy.abs(numpy.radians(im.wcs.wcs.cdelt[0]))
         
-        fuvw = uvw.copy()
-        # We need to flip the u and w axes.
-        fuvw[:, 0] *= -1.0
-        fuvw[:, 2] *= -1.0
+        fuvw = _flip_uvw(sbvis.uvw.reshape([nrows * nants * nants, 3]))
         
         nchan, npol, ny, nx = im.shape
-        im.data[...] = 0.0
         sumwt = numpy.zeros([nchan, npol])
         
         # There's a latent problem here with the weights.
         # wgt = numpy.real(convert_pol_frame(wgt, bvis.polarisation_frame, im.polarisation_frame, polaxis=2))
         
-        # Set up the conversion from visibility channels to image channels
-        vis_to_im = numpy.round(model.wcs.sub([4]).wcs_world2pix(freq, 0)[0]).astype('int')
-        
-       # Nifty gridder likes to receive contiguous arrays so we transpose
-        # at the beginning
-        
-        mfs = nchan == 1
-        if dopsf:
-            
-            mst = ms.T
-            mst[...] = 0.0
-            mst[0, ...] = 1.0
-            wgtt = wgt.T
-
-            if mfs:
-                dirty = ng.ms2dirty(fuvw.astype(numpy.float64),
-                                    bvis.frequency.astype(numpy.float64),
-                                    numpy.ascontiguousarray(mst[0, :, :].T),
-                                    numpy.ascontiguousarray(wgtt[0, :, :].T),
+        # All the visibility channels of an image channel are gridded in one call. Nifty gridder
+        # likes to receive contiguous arrays.
+        for ichan, vchans in _channel_batches(model, freq):
+            for pol in range(ms.shape[2]):
+                dirty = ng.ms2dirty(fuvw, freq[vchans],
+                                    numpy.ascontiguousarray(ms[:, vchans, pol]),
+                                    numpy.ascontiguousarray(wgt[:, vchans, pol]),
                                     npixdirty, npixdirty, pixsize, pixsize, epsilon,
                                     do_wstacking=do_wstacking,
                                     nthreads=nthreads, verbosity=verbosity)
-                sumwt[0, :] += numpy.sum(wgtt[0, 0, :].T, axis=0)
-                im.data[0, :] += dirty.T
-            else:
-                for vchan in range(vnchan):
-                    ichan = vis_to_im[vchan]
-                    frequency = numpy.array(freq[vchan:vchan + 1]).astype(numpy.float64)
-                    dirty = ng.ms2dirty(fuvw.astype(numpy.float64),
-                                        frequency.astype(numpy.float64),
-                                        numpy.ascontiguousarray(mst[0, vchan, :][..., numpy.newaxis]),
-                                        numpy.ascontiguousarray(wgtt[0, vchan, :][..., numpy.newaxis]),
-                                        npixdirty, npixdirty, pixsize, pixsize, epsilon,
-                                        do_wstacking=do_wstacking,
-                                        nthreads=nthreads, verbosity=verbosity)
-                    sumwt[ichan, :] += numpy.sum(wgtt[0, ichan, :].T, axis=0)
+                if dopsf:
+                    # The PSF is the same for all polarisations
+                    sumwt[ichan, :] += numpy.sum(wgt[:, vchans, pol])
                     im.data[ichan, :] += dirty.T
-        else:
-            mst = ms.T
-            wgtt = wgt.T
-            for pol in range(npol):
-                if mfs:
-                    dirty = ng.ms2dirty(fuvw.astype(numpy.float64),
-                                        bvis.frequency.astype(numpy.float64),
-                                        numpy.ascontiguousarray(mst[pol, :, :].T),
-                                        numpy.ascontiguousarray(wgtt[pol, :, :].T),
-                                        npixdirty, npixdirty, pixsize, pixsize, epsilon,
-                                        do_wstacking=do_wstacking,
-                                        nthreads=nthreads, verbosity=verbosity)
-                    sumwt[0, pol] += numpy.sum(wgtt[pol, 0, :].T, axis=0)
-                    im.data[0, pol] += dirty.T
                 else:
-                    for vchan in range(vnchan):
-                        ichan = vis_to_im[vchan]
-                        frequency = numpy.array(freq[vchan:vchan + 1]).astype(numpy.float64)
-                        dirty = ng.ms2dirty(fuvw.astype(numpy.float64),
-                                            frequency.astype(numpy.float64),
-                                            numpy.ascontiguousarray(mst[pol, vchan, :][..., numpy.newaxis]),
-                                            numpy.ascontiguousarray(wgtt[pol, vchan, :][..., numpy.newaxis]),
-                                            npixdirty, npixdirty, pixsize, pixsize, epsilon,
-                                            do_wstacking=do_wstacking,
-                                            nthreads=nthreads, verbosity=verbosity)
-                        sumwt[ichan, pol] += numpy.sum(wgtt[pol, ichan, :].T, axis=0)
-                        im.data[ichan, pol] += dirty.T
-
+                    sumwt[ichan, pol] += numpy.sum(wgt[:, vchans, pol])
+                    im.data[ichan, pol] += dirty.T
         
         if normalize:
             im = normalize_sumwt(im, sumwt)
@@ -61,8 +61,10 @@ from typing import Union
 import numpy
 
 from rascil.data_models.memory_data_models import Visibility, Image, BlockVisibility
-from rascil.processing_components.image.operations import reproject_image
+from rascil.data_models.parameters import get_parameter
+from rascil.processing_components.image.operations import reproject_image_obliquity
 from rascil.processing_components.imaging.base import predict_2d, invert_2d
+from rascil.processing_components.visibility.base import copy_visibility
 
 
 def fit_uvwplane_only(vis: Union[Visibility, BlockVisibility]) -> (float, float):
@@ -137,16 +139,18 @@ def predict_timeslice_single(vis: Union[Visibility, BlockVisibility], model: Ima
     :param predict:
     :param remove: Remove fitted w (so that wprojection will do the right thing)
     :param gcfcf: (Grid correction function, convolution function)
-    :return: resulting visibility (in place works)
+    :param kwargs: threads: Number of threads for the reprojection (1)
+    :return: resulting visibility
     """
     assert image_is_canonical(model)
 
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
     
-    vis.data['vis'][...] = 0.0
+    # The input may be a view of a larger visibility (see visibility_scatter) so work on a copy
+    uvw = vis.uvw
+    vis = copy_visibility(vis, zero=True)
     
     # Fit and remove best fitting plane for this slice
-    uvw = vis.uvw
     avis, p, q = fit_uvwplane(vis, remove=remove)
     
     # We want to describe work image as distorted. We describe the distortion by putting
@@ -157,7 +161,8 @@ def predict_timeslice_single(vis: Union[Visibility, BlockVisibility], model: Ima
 
         newwcs = model.wcs.deepcopy()
         newwcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
-        workimage, footprintimage = reproject_image(model, newwcs, shape=model.shape)
+        workimage, footprintimage = reproject_image_obliquity(model, newwcs, shape=model.shape,
+                                                              nthreads=get_parameter(kwargs, "threads", 1))
         workimage.data[footprintimage.data <= 0.0] = 0.0
         workimage.wcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
     
@@ -167,7 +172,7 @@ def predict_timeslice_single(vis: Union[Visibility, BlockVisibility], model: Ima
         vis = predict(avis, model, gcfcf=gcfcf, **kwargs)
     
     if remove:
-        avis.data['uvw'][...] = uvw
+        vis.data['uvw'][...] = uvw
 
     return vis
 
@@ -205,12 +210,15 @@ def invert_timeslice_single(vis: Union[Visibility, BlockVisibility], im: Image,
     :param dopsf: Make the psf instead of the dirty image
     :param gcfcf: (Grid correction function, convolution function)
     :param normalize: Normalize by the sum of weights (True)
+    :param kwargs: threads: Number of threads for the reprojection (1)
     :returns: image, sum of weights
     """
     assert isinstance(vis, Visibility) or isinstance(vis, BlockVisibility), vis
     assert image_is_canonical(im)
     
-    uvw = vis.uvw
+    # The input may be a view of a larger visibility (see visibility_scatter) so work on a copy
+    if remove:
+        vis = copy_visibility(vis)
     vis, p, q = fit_uvwplane(vis, remove=remove)
     
     workimage, sumwt = invert_2d(vis, im, dopsf, normalize=normalize, gcfcf=gcfcf, **kwargs)
@@ -221,16 +229,11 @@ def invert_timeslice_single(vis: Union[Visibility, BlockVisibility], im: Image,
         # Note that this has to be zero relative in first element, one relative in second!!!!
         workimage.wcs.wcs.set_pv([(0, 1, -p), (0, 2, -q)])
     
-        finalimage, footprint = reproject_image(workimage, im.wcs, im.shape)
+        finalimage, footprint = reproject_image_obliquity(workimage, im.wcs, im.shape,
+                                                       nthreads=get_parameter(kwargs, "threads", 1))
         finalimage.data[footprint.data <= 0.0] = 0.0
         finalimage.wcs.wcs.set_pv([(0, 1, 0.0), (0, 2, 0.0)])
 
-        if remove:
-            vis.data['uvw'][...] = uvw
-
         return finalimage, sumwt
     else:
-        if remove:
-            vis.data['uvw'][...] = uvw
-    
         return workimage, sumwt
@@ -7,22 +7,32 @@ approximated as:
     V(u,v,w) =\\sum_i \\int \\frac{ I(l,m) e^{-2 \\pi j (w_i(\\sqrt{1-l^2-m^2}-1))})}{\\sqrt{1-l^2-m^2}} e^{-2 \\pi j (ul+vm)} dl dm
 
 If images constructed from slices in w are added after applying a w-dependent image plane correction, the w term will be corrected.
+
+The functions predict_wstack_single and invert_wstack_single process one slice, the slices being made and
+distributed by the workflows. predict_wstack and invert_wstack process all the slices of a visibility in one
+call: the rows are sorted by w once, the planes share one grid and the w screens are generated by recurrence.
 """
 
-__all__ = ['predict_wstack_single', 'invert_wstack_single']
+__all__ = ['predict_wstack_single', 'invert_wstack_single', 'predict_wstack', 'invert_wstack']
 
+import collections
 import logging
+import threading
 
 import numpy
 
 from rascil.data_models.memory_data_models import Visibility, Image
-from rascil.processing_components.image import copy_image, create_w_term_like, \
+from rascil.processing_components.image import copy_image, create_w_term_like, create_image_from_array, \
     image_is_canonical, convert_stokes_to_polimage, convert_polimage_to_stokes
 from rascil.processing_components.griddata import grid_visibility_to_griddata, \
     degrid_visibility_from_griddata, fft_griddata_to_image, fft_image_to_griddata, \
     create_griddata_from_image
+from rascil.processing_components.fourier_transforms import fft, ifft, w_beam
+from rascil.processing_components.griddata.kernels import create_pswf_convolutionfunction
 from rascil.processing_components.visibility.base import copy_visibility
+from rascil.processing_components.visibility.gather_scatter import visibility_sort_order, visibility_rows_view
 from rascil.processing_components.imaging import normalize_sumwt, fill_vis_for_psf
+from rascil.data_models.parameters import get_parameter
 
 log = logging.getLogger('logger')
 
@@ -43,13 +53,14 @@ def predict_wstack_single(vis, model, remove=True, gcfcf=None, **kwargs) -> Visi
 
     :param vis: Visibility to be predicted
     :param model: model image
-    :return: resulting visibility (in place works)
+    :return: resulting visibility
     """
 
     assert isinstance(vis, Visibility), "wstack requires Visibility format not BlockVisibility"
     assert image_is_canonical(model)
 
-    vis.data['vis'][...] = 0.0
+    # The input may be a view of a larger visibility (see visibility_scatter) so work on a copy
+    vis = copy_visibility(vis, zero=True)
 
     log.debug("predict_wstack_single: predicting using single w slice")
 
@@ -57,7 +68,6 @@ def predict_wstack_single(vis, model, remove=True, gcfcf=None, **kwargs) -> Visi
     w_average = numpy.average(vis.w)
     if remove:
         vis.data['uvw'][..., 2] -= w_average
-    tempvis = copy_visibility(vis)
 
     # Calculate w beam and apply to the model. The imaginary part is not needed
     workimage = convert_stokes_to_polimage(model, vis.polarisation_frame)
@@ -103,6 +113,10 @@ def invert_wstack_single(vis: Visibility, im: Image, dopsf, normalize=True, remo
     
     assert isinstance(vis, Visibility), "wstack requires Visibility format not BlockVisibility"
     
+    # The input may be a view of a larger visibility (see visibility_scatter) so work on a copy
+    if dopsf or remove:
+        vis = copy_visibility(vis)
+    
     if dopsf:
         vis = fill_vis_for_psf(vis)
     
@@ -118,9 +132,6 @@ def invert_wstack_single(vis: Visibility, im: Image, dopsf, normalize=True, remo
     cim = fft_griddata_to_image(griddata, gcf)
     cim = normalize_sumwt(cim, sumwt)
 
-    if remove:
-        vis.data['uvw'][..., 2] += w_average
-
     # Calculate w beam and apply to the model. The imaginary part is not needed
     w_beam = create_w_term_like(im, w_average, vis.phasecentre)
     cworkimage = copy_image(cim)
@@ -129,3 +140,236 @@ def invert_wstack_single(vis: Visibility, im: Image, dopsf, normalize=True, remo
     workimage = convert_polimage_to_stokes(cworkimage)
 
     return workimage, sumwt
+
+
+# Number of w screens generated by recurrence before recomputing one directly
+_screen_reseed = 64
+
+# Maximum total size of the cached w screen factors (bytes)
+_screen_cache_maxbytes = 2 ** 28
+
+# The cached w screen factors, least recently used first
+_screen_cache = collections.OrderedDict()
+_screen_cache_lock = threading.Lock()
+
+
+def _wstack_planes(w, vis_slices=1):
+    """ Assign the rows, sorted by w, to w planes
+
+    The planes are the boxes of vis_wslice_iter, equally spaced in w between -max(abs(w)) and +max(abs(w)). Each
+    row goes to the nearest plane. A single plane is placed at the average w.
+
+    :param w: w of the rows, in increasing order
+    :param vis_slices: Number of w planes
+    :return: w of the first plane, increment in w, list of (start, stop) ranges of rows per plane
+    """
+    if vis_slices == 1 or len(w) == 0:
+        return numpy.average(w) if len(w) > 0 else 0.0, 0.0, [(0, len(w))]
+    wmaxabs = numpy.max(numpy.abs(w))
+    wstep = 2.0 * wmaxabs / (vis_slices - 1)
+    if wstep == 0.0:
+        return 0.0, 0.0, [(0, len(w))]
+    plane = numpy.clip(numpy.round((w + wmaxabs) / wstep), 0, vis_slices - 1).astype('int')
+    bounds = numpy.searchsorted(plane, numpy.arange(vis_slices + 1))
+    return -wmaxabs, wstep, [(bounds[k], bounds[k + 1]) for k in range(vis_slices)]
+
+
+def _w_screen_factors(npixel, field_of_view, cx, cy, w0, wstep, dtype='complex128'):
+    """ The w screen of the first plane and the factor from one plane to the next
+
+    The screens for a given image and set of planes are the same in every major cycle so they are cached,
+    up to a total of _screen_cache_maxbytes. Larger screens are not cached.
+
+    :return: (screen for w0, screen for wstep), read only
+    """
+    key = (npixel, field_of_view, cx, cy, w0, wstep, numpy.dtype(dtype).str)
+    with _screen_cache_lock:
+        factors = _screen_cache.get(key)
+        if factors is not None:
+            _screen_cache.move_to_end(key)
+            return factors
+
+    screen = w_beam(npixel, field_of_view, w=w0, cx=cx, cy=cy).astype(dtype)
+    step = w_beam(npixel, field_of_view, w=wstep, cx=cx, cy=cy).astype(dtype)
+    screen.flags.writeable = False
+    step.flags.writeable = False
+    factors = (screen, step)
+
+    with _screen_cache_lock:
+        if screen.nbytes + step.nbytes <= _screen_cache_maxbytes:
+            _screen_cache[key] = factors
+            while sum(a.nbytes + b.nbytes for a, b in _screen_cache.values()) > _screen_cache_maxbytes:
+                _screen_cache.popitem(last=False)
+    return factors
+
+
+def _w_screens(im, w0, wstep, nplanes, dtype='complex128'):
+    """ Generate the w screens for equally spaced w planes
+
+    The screen for plane k is exp(-2 pi j (w0 + k wstep) (n - 1)). This is the screen of the previous plane
+    times the screen for wstep, recomputed directly every _screen_reseed planes to limit the rounding error.
+
+    :param im: Template image
+    :param w0: w of the first plane
+    :param wstep: Increment in w
+    :param nplanes: Number of planes
+    :param dtype: Type of the screens
+    :return: generator of [ny, nx] arrays
+    """
+    npixel = im.shape[3]
+    field_of_view = npixel * abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+    cx, cy = im.wcs.wcs.crpix[0] - 1.0, im.wcs.wcs.crpix[1] - 1.0
+    screen, step = _w_screen_factors(npixel, field_of_view, cx, cy, w0, wstep, dtype)
+    current = screen.copy()
+    for k in range(nplanes):
+        if k > 0:
+            if k % _screen_reseed == 0:
+                current = w_beam(npixel, field_of_view, w=w0 + k * wstep, cx=cx, cy=cy).astype(dtype)
+            else:
+                current *= step
+        yield current
+
+
+def _sorted_by_w(vis, copy=False, zero=False):
+    """ The visibility with rows sorted by w
+
+    The sort order is cached for vis (see gather_scatter) so it is found once for all major cycles.
+
+    :param vis: Visibility
+    :param copy: Always return a copy
+    :param zero: Return a copy with zero vis
+    :return: Visibility, order of the rows (None if already sorted)
+    """
+    order = visibility_sort_order(vis, 'w')
+    if order is not None:
+        # Indexing by the order makes a copy
+        svis = visibility_rows_view(vis, order)
+        if zero:
+            svis.data['vis'][...] = 0.0
+        return svis, order
+    if copy or zero:
+        return copy_visibility(vis, zero=zero), None
+    return vis, None
+
+
+def predict_wstack(vis: Visibility, model: Image, vis_slices=1, remove=True, gcfcf=None,
+                   **kwargs) -> Visibility:
+    """ Predict using w stacking, processing all w slices in one call
+
+    This gives the same result as predicting each slice of vis_wslice_iter with predict_wstack_single, except that
+    the w screen is that of the centre of each slice rather than the average w. The rows are sorted by w once
+    and the slices are views of the sorted copy. One grid is reused for all planes and the w screens are
+    generated by recurrence (see _w_screens).
+
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param vis_slices: Number of w slices
+    :param remove: Remove the w of the plane before degridding
+    :param gcfcf: (Grid correction function, convolution function)
+    :param kwargs: wstack_dtype: Type of the w screens and screened model e.g. 'complex64' ('complex128'). The
+        grid and the FFTs remain complex128.
+    :return: resulting visibility
+    """
+    assert isinstance(vis, Visibility), "wstack requires Visibility format not BlockVisibility"
+    assert image_is_canonical(model)
+
+    dtype = get_parameter(kwargs, "wstack_dtype", 'complex128')
+
+    svis, order = _sorted_by_w(vis, zero=True)
+    w = svis.w.copy()
+    w0, wstep, ranges = _wstack_planes(w, vis_slices)
+
+    log.debug("predict_wstack: predicting using %d w planes" % len(ranges))
+
+    if gcfcf is None:
+        gcf, cf = create_pswf_convolutionfunction(model,
+                                                  support=get_parameter(kwargs, "support", 8),
+                                                  oversampling=get_parameter(kwargs, "oversampling", 127))
+    else:
+        gcf, cf = gcfcf
+
+    workimage = convert_stokes_to_polimage(model, vis.polarisation_frame)
+    workdata = (workimage.data * gcf.data).astype(dtype)
+    griddata = create_griddata_from_image(model, svis)
+
+    for k, screen in enumerate(_w_screens(model, w0, wstep, len(ranges), dtype)):
+        start, stop = ranges[k]
+        if stop == start:
+            continue
+        griddata.data[...] = fft(numpy.conjugate(screen) * workdata)[:, :, numpy.newaxis, ...]
+        pvis = visibility_rows_view(svis, slice(start, stop))
+        if remove:
+            pvis.data['uvw'][..., 2] -= w0 + k * wstep
+        pvis = degrid_visibility_from_griddata(pvis, griddata=griddata, cf=cf)
+        svis.data['vis'][start:stop] = pvis.data['vis']
+
+    if order is None:
+        svis.data['uvw'][..., 2] = w
+        return svis
+
+    vis = copy_visibility(vis, zero=True)
+    vis.data['vis'][order] = svis.data['vis']
+    return vis
+
+
+def invert_wstack(vis: Visibility, im: Image, dopsf=False, normalize=True, vis_slices=1, remove=True,
+                  gcfcf=None, **kwargs) -> (Image, numpy.ndarray):
+    """ Invert using w stacking, processing all w slices in one call
+
+    This gives the same result as inverting each slice of vis_wslice_iter with invert_wstack_single and summing
+    with sum_invert_results, except that the w screen is that of the centre of each slice rather than the
+    average w. The rows are sorted by w once and gridded plane by plane onto one grid. Since the grid correction
+    is the same for all planes, it is applied once to the sum of the screened planes.
+
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param vis_slices: Number of w slices
+    :param remove: Remove the w of the plane before gridding
+    :param gcfcf: (Grid correction function, convolution function)
+    :param kwargs: wstack_dtype: Type of the w screens and accumulated image e.g. 'complex64' ('complex128'). The
+        grid and the FFTs remain complex128.
+    :return: image, sum of weights
+    """
+    assert isinstance(vis, Visibility), "wstack requires Visibility format not BlockVisibility"
+    assert image_is_canonical(im)
+
+    dtype = get_parameter(kwargs, "wstack_dtype", 'complex128')
+
+    svis, _ = _sorted_by_w(vis, copy=dopsf or remove)
+    if dopsf:
+        svis = fill_vis_for_psf(svis)
+    w0, wstep, ranges = _wstack_planes(svis.w, vis_slices)
+
+    log.debug("invert_wstack: inverting using %d w planes" % len(ranges))
+
+    if gcfcf is None:
+        gcf, cf = create_pswf_convolutionfunction(im,
+                                                  support=get_parameter(kwargs, "support", 8),
+                                                  oversampling=get_parameter(kwargs, "oversampling", 127))
+    else:
+        gcf, cf = gcfcf
+
+    griddata = create_griddata_from_image(im, svis)
+    nchan, npol, _, ny, nx = griddata.shape
+    sumwt = numpy.zeros([nchan, npol])
+    stack = numpy.zeros([nchan, npol, ny, nx], dtype=dtype)
+
+    for k, screen in enumerate(_w_screens(im, w0, wstep, len(ranges), dtype)):
+        start, stop = ranges[k]
+        if stop == start:
+            continue
+        pvis = visibility_rows_view(svis, slice(start, stop))
+        if remove:
+            pvis.data['uvw'][..., 2] -= w0 + k * wstep
+        griddata, plane_sumwt = grid_visibility_to_griddata(pvis, griddata=griddata, cf=cf)
+        sumwt += plane_sumwt
+        stack += screen * ifft(numpy.sum(griddata.data, axis=2))
+
+    cim = create_image_from_array(stack.astype('complex') * gcf.data * float(nx) * float(ny),
+                                  griddata.projection_wcs, griddata.polarisation_frame)
+    if normalize:
+        cim = normalize_sumwt(cim, sumwt)
+
+    return convert_polimage_to_stokes(cim), sumwt
@@ -3,3 +3,4 @@ from .array_functions import *
 from .compass_bearing import *
 from .coordinate_support import *
 from .sizeof import *
+from .profiling import *
@@ -0,0 +1,270 @@
+""" Per-task profiling of processing components
+
+Functions decorated with profile_function, and blocks of code in profile_block, record their wall clock time,
+CPU time, bytes in and out (as measured by Dask sizeof) and resident memory. Nothing is recorded until profiling
+is started, so the cost when off is one test per call.
+
+The CPU time is that of the calling thread (time.thread_time), so that tasks running concurrently in the threads
+of one worker are not charged for each other. It therefore misses work done in threads started by the task, such
+as the gridding threads of ng or multithreaded FFTs: for those the wall time is the better measure.
+
+The operating system only gives the peak resident memory over the lifetime of a process, so two values are kept:
+process_peak_rss is that lifetime peak at the end of the task, and peak_rss_increase is how much the task raised
+it. The latter is a lower bound on the memory used by the task, and is zero for a task that stays below an earlier
+peak. Tasks running concurrently in one process share both.
+
+Each process appends its records to its own file in a profiling directory. Processes started after
+start_profiling (process pools, LocalCluster workers) inherit the directory through the environment variable
+RASCIL_PROFILE_DIR, so the records from all workers can be read back together::
+
+    start_profiling()
+    ... run a workflow
+    records = get_profile_records()
+    export_profile_to_chrome_trace(records, 'trace.json')
+
+rsexecute.start_profiling and rsexecute.save_profile do this for all backends.
+"""
+
+__all__ = ['start_profiling', 'stop_profiling', 'profiling_enabled', 'profile_function', 'profile_block',
+           'get_profile_records', 'clear_profile_records', 'summarise_profile',
+           'export_profile_to_json', 'export_profile_to_csv', 'export_profile_to_chrome_trace']
+
+import contextlib
+import csv
+import functools
+import glob
+import json
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from dask.sizeof import sizeof
+
+log = logging.getLogger('logger')
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+_PROFILE_DIR_ENV = 'RASCIL_PROFILE_DIR'
+
+_profile_dir = os.getenv(_PROFILE_DIR_ENV, None)
+_profile_lock = threading.Lock()
+
+_RECORD_FIELDS = ['name', 'start', 'wall_time', 'cpu_time', 'bytes_in', 'bytes_out', 'process_peak_rss',
+                  'peak_rss_increase', 'host', 'pid', 'thread']
+
+
+def start_profiling(directory=None):
+    """ Start recording profiles in this process and in processes started from it
+
+    :param directory: Directory for the records (default is a new temporary directory)
+    :return: Directory used
+    """
+    global _profile_dir
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='rascil_profile_')
+    os.makedirs(directory, exist_ok=True)
+    _profile_dir = directory
+    os.environ[_PROFILE_DIR_ENV] = directory
+    return directory
+
+
+def stop_profiling():
+    """ Stop recording profiles in this process
+
+    The records already written are kept.
+    """
+    global _profile_dir
+    _profile_dir = None
+    os.environ.pop(_PROFILE_DIR_ENV, None)
+
+
+def profiling_enabled():
+    """ Is profiling being recorded?
+
+    :return: True or False
+    """
+    return _profile_dir is not None
+
+
+def _process_peak_rss():
+    """ Peak resident memory over the lifetime of this process in bytes, or None if unknown
+    """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxrss if os.uname().sysname == 'Darwin' else 1024 * maxrss
+
+
+def _record(name, start, wall_time, cpu_time, bytes_in, bytes_out, peak_rss_start):
+    """ Append one record to this process's file in the profiling directory
+
+    :param peak_rss_start: _process_peak_rss at the start of the task
+    """
+    directory = _profile_dir
+    if directory is None:
+        return
+    process_peak_rss = _process_peak_rss()
+    peak_rss_increase = None if process_peak_rss is None else process_peak_rss - peak_rss_start
+    record = {'name': name, 'start': start, 'wall_time': wall_time, 'cpu_time': cpu_time,
+              'bytes_in': bytes_in, 'bytes_out': bytes_out, 'process_peak_rss': process_peak_rss,
+              'peak_rss_increase': peak_rss_increase,
+              'host': socket.gethostname(), 'pid': os.getpid(), 'thread': threading.get_ident()}
+    filename = os.path.join(directory, 'profile_%s_%d.jsonl' % (record['host'], record['pid']))
+    with _profile_lock:
+        with open(filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+@contextlib.contextmanager
+def profile_block(name, bytes_in=0):
+    """ Context manager to profile a block of code
+
+    For example::
+
+        with profile_block('fft'):
+            image = fft(grid)
+
+    :param name: Name for the record
+    :param bytes_in: Size of the inputs, if known
+    """
+    if _profile_dir is None:
+        yield
+        return
+    start = time.time()
+    peak_rss = _process_peak_rss()
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        _record(name, start, time.perf_counter() - wall, time.thread_time() - cpu, bytes_in, 0, peak_rss)
+
+
+def profile_function(func):
+    """ Decorator to profile each call of a function
+
+    The bytes in and out are the Dask sizeof of the arguments and result, so for the data models
+    these are the sizes of their numpy arrays.
+
+    :param func: Function to profile
+    :return: Wrapped function
+    """
+    name = func.__name__
+
+    @functools.wraps(func)
+    def profiled(*args, **kwargs):
+        if _profile_dir is None:
+            return func(*args, **kwargs)
+        start = time.time()
+        peak_rss = _process_peak_rss()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        result = func(*args, **kwargs)
+        wall_time = time.perf_counter() - wall
+        cpu_time = time.thread_time() - cpu
+        _record(name, start, wall_time, cpu_time, sizeof(args) + sizeof(kwargs), sizeof(result), peak_rss)
+        return result
+
+    return profiled
+
+
+def get_profile_records(directory=None):
+    """ Read the profile records of all processes
+
+    :param directory: Profiling directory (default is the current one)
+    :return: list of records (dict), sorted by start time
+    """
+    directory = directory or _profile_dir
+    if directory is None:
+        return []
+    records = list()
+    for filename in glob.glob(os.path.join(directory, 'profile_*.jsonl')):
+        with open(filename) as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda r: r['start'])
+
+
+def clear_profile_records(directory=None):
+    """ Remove the profile records of all processes
+
+    :param directory: Profiling directory (default is the current one)
+    """
+    directory = directory or _profile_dir
+    if directory is None:
+        return
+    with _profile_lock:
+        for filename in glob.glob(os.path.join(directory, 'profile_*.jsonl')):
+            os.remove(filename)
+
+
+def summarise_profile(records):
+    """ Summarise records by name
+
+    :param records: list of records from get_profile_records
+    :return: list of dict with name, number of calls, total wall and CPU time, total bytes in and out,
+        and maximum process_peak_rss and peak_rss_increase, sorted by decreasing wall time
+    """
+    summary = dict()
+    for r in records:
+        s = summary.setdefault(r['name'], {'name': r['name'], 'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                           'bytes_in': 0, 'bytes_out': 0, 'process_peak_rss': 0,
+                                           'peak_rss_increase': 0})
+        s['calls'] += 1
+        s['wall_time'] += r['wall_time']
+        s['cpu_time'] += r['cpu_time']
+        s['bytes_in'] += r['bytes_in']
+        s['bytes_out'] += r['bytes_out']
+        s['process_peak_rss'] = max(s['process_peak_rss'], r['process_peak_rss'] or 0)
+        s['peak_rss_increase'] = max(s['peak_rss_increase'], r['peak_rss_increase'] or 0)
+    return sorted(summary.values(), key=lambda s: s['wall_time'], reverse=True)
+
+
+def export_profile_to_json(records, filename):
+    """ Write records to a JSON file
+
+    :param records: list of records from get_profile_records
+    :param filename: Name of file
+    """
+    with open(filename, 'w') as f:
+        json.dump(records, f, indent=1)
+
+
+def export_profile_to_csv(records, filename):
+    """ Write records to a CSV file, one row per record
+
+    :param records: list of records from get_profile_records
+    :param filename: Name of file
+    """
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=_RECORD_FIELDS)
+        writer.writeheader()
+        for r in records:
+            writer.writerow(r)
+
+
+def export_profile_to_chrome_trace(records, filename):
+    """ Write records in the Chrome trace event format
+
+    The file can be viewed in chrome://tracing or https://ui.perfetto.dev. Each process is shown with its
+    threads, and each record as a complete event.
+
+    :param records: list of records from get_profile_records
+    :param filename: Name of file
+    """
+    events = list()
+    for r in records:
+        events.append({'name': r['name'], 'cat': 'rascil', 'ph': 'X',
+                       'ts': 1e6 * r['start'], 'dur': 1e6 * r['wall_time'],
+                       'pid': '%s:%d' % (r['host'], r['pid']), 'tid': r['thread'],
+                       'args': {'cpu_time': r['cpu_time'], 'bytes_in': r['bytes_in'],
+                                'bytes_out': r['bytes_out'], 'process_peak_rss': r['process_peak_rss'],
+                                'peak_rss_increase': r['peak_rss_increase']}})
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
@@ -2,14 +2,33 @@
 
 """
 
-__all__ = ['get_size']
+__all__ = ['get_size', 'get_sizeof']
 
+from dask.sizeof import sizeof
 from distributed.protocol import pickle
 
+# Registers sizeof for the data models
+import rascil.data_models
+
+
 def get_size(obj):
     """ Return size of object in bytes
 
+    This is the length of the pickled object, so for graphs it includes the data held by the tasks.
+
     :param obj:
     :return:
     """
     return len(pickle.dumps(obj))
+
+
+def get_sizeof(obj):
+    """ Return size of object in bytes as seen by Dask
+
+    This uses the Dask sizeof registrations, so that the data models are measured by their numpy arrays
+    rather than by pickling.
+
+    :param obj:
+    :return:
+    """
+    return sizeof(obj)
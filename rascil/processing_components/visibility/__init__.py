@@ -7,6 +7,7 @@ from .coalesce import *
 from .gather_scatter import *
 from .iterators import *
 from .operations import *
+from .oskar import *
 from .visibility_fitting import *
 from .visibility_geometry import *
 from .vis_select import *
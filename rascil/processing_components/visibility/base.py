@@ -5,14 +5,23 @@ Base simple visibility operations, placed here to avoid circular dependencies
 __all__ = ['vis_summary', 'copy_visibility', 'create_visibility',
            'create_visibility_from_rows',
            'create_blockvisibility_from_ms', 'create_blockvisibility_from_uvfits',
+           'create_blockvisibility_iterator_from_uvfits',
+           'create_blockvisibility_iterator_from_ms', 'create_blockvisibility_iterator_from_hdf5',
+           'export_blockvisibility_iterator_to_ms',
            'create_blockvisibility', 'phaserotate_visibility',
            'export_blockvisibility_to_ms',
            'create_visibility_from_ms', 'create_visibility_from_uvfits',
-           'list_ms']
+           'list_ms', 'set_phasor_cache_size']
 
+import collections
 import copy
+import functools
+import hashlib
 import logging
+import queue
 import re
+import threading
+import weakref
 from typing import Union
 
 import numpy
@@ -241,18 +250,14 @@ def create_blockvisibility(config: Configuration,
     ants_xyz = config.data['xyz']
     nants = len(config.data['names'])
     
-    ntimes = 0
-    n_flagged = 0
-    
-    for iha, ha in enumerate(times):
-        
-        # Calculate the positions of the antennas as seen for this hour angle
-        # and declination
-        _, elevation = hadec_to_azel(ha, phasecentre.dec.rad, latitude)
-        if elevation_limit is None or (elevation > elevation_limit):
-            ntimes += 1
-        else:
-            n_flagged += 1
+    # Keep only the hour angles above the elevation limit
+    times = numpy.array(times, dtype='float')
+    if elevation_limit is not None:
+        _, elevation = hadec_to_azel(times, phasecentre.dec.rad, latitude)
+        above = elevation > elevation_limit
+        n_flagged = numpy.sum(~above)
+        times = times[above]
+    ntimes = len(times)
     
     assert ntimes > 0, "No unflagged points"
     if elevation_limit is not None:
@@ -261,58 +266,38 @@ def create_blockvisibility(config: Configuration,
     else:
         log.debug('create_blockvisibility: created %d times' % (ntimes))
     
-    npol = polarisation_frame.npol
-    nchan = len(frequency)
-    visshape = [ntimes, nants, nants, nchan, npol]
-    rvis = numpy.zeros(visshape, dtype='complex')
-    rflags = numpy.zeros(visshape, dtype='int')
-    rweight = numpy.ones(visshape)
-    rimaging_weight = numpy.ones(visshape)
-    rtimes = numpy.zeros([ntimes])
-    rintegrationtime = numpy.zeros([ntimes])
-    ruvw = numpy.zeros([ntimes, nants, nants, 3])
-    
-    # Do each hour angle in turn
-    itime = 0
     stime = calculate_transit_time(config.location, utc_time, phasecentre)
     if stime.masked:
         stime = utc_time
+    rtimes = stime.mjd * 86400.0 + times * 86164.1 / (2.0 * numpy.pi)
     
-    for iha, ha in enumerate(times):
-        
-        # Calculate the positions of the antennas as seen for this hour angle
-        # and declination
-        ant_pos = xyz_to_uvw(ants_xyz, ha, phasecentre.dec.rad)
-        _, elevation = hadec_to_azel(ha, phasecentre.dec.rad, latitude)
-        if elevation_limit is None or (elevation > elevation_limit):
-            rtimes[itime] = stime.mjd * 86400.0 + ha * 86164.1 / (2.0 * numpy.pi)
-            rweight[itime, ...] = 1.0
-            rflags[itime, ...] = 0
-            
-            # Loop over all pairs of antennas. Note that a2>a1
-            for a1 in range(nants):
-                rweight[itime, a1, a1, ...] = 0.0
-                rflags[itime, a1, a1, ...] = 1.0
-                for a2 in range(a1 + 1, nants):
-                    ruvw[itime, a2, a1, :] = (ant_pos[a2, :] - ant_pos[a1, :])
-                    ruvw[itime, a1, a2, :] = (ant_pos[a1, :] - ant_pos[a2, :])
-            if itime > 0:
-                rintegrationtime[itime] = rtimes[itime] - rtimes[itime - 1]
-            itime += 1
-    
-    if itime > 1:
+    rintegrationtime = numpy.zeros([ntimes])
+    if ntimes > 1:
+        rintegrationtime[1:] = numpy.diff(rtimes)
         rintegrationtime[0] = rintegrationtime[1]
     else:
         rintegrationtime[0] = integration_time
-    rchannel_bandwidth = channel_bandwidth
+    
+    # Calculate the positions of the antennas as seen for all hour angles at once: uvw[itime, a2, a1]
+    # is ant_pos[itime, a2] - ant_pos[itime, a1]
+    ant_pos = xyz_to_uvw(numpy.tile(ants_xyz, (ntimes, 1)), numpy.repeat(times, nants)[:, numpy.newaxis],
+                         phasecentre.dec.rad).reshape([ntimes, nants, 3])
+    ruvw = ant_pos[:, :, numpy.newaxis, :] - ant_pos[:, numpy.newaxis, :, :]
     if zerow:
         ruvw[..., 2] = 0.0
-    vis = BlockVisibility(uvw=ruvw, time=rtimes, frequency=frequency, vis=rvis,
-                          weight=rweight,
-                          imaging_weight=rimaging_weight, flags=rflags,
+    
+    # The vis and flags are left as zero, and so are not written
+    rchannel_bandwidth = channel_bandwidth
+    vis = BlockVisibility(uvw=ruvw, time=rtimes, frequency=frequency,
                           integration_time=rintegrationtime,
                           channel_bandwidth=rchannel_bandwidth,
                           polarisation_frame=polarisation_frame, source=source, meta=meta)
+    
+    # The autocorrelations are flagged
+    diagonal = numpy.arange(nants)
+    vis.data['weight'][:, diagonal, diagonal, ...] = 0.0
+    vis.data['flags'][:, diagonal, diagonal, ...] = 1
+    
     vis.phasecentre = phasecentre
     vis.configuration = config
     log.debug("create_blockvisibility: %s" % (vis_summary(vis)))
@@ -340,14 +325,15 @@ def create_visibility_from_rows(vis: Union[Visibility, BlockVisibility],
     if isinstance(vis, Visibility):
         
         if makecopy:
-            newvis = copy_visibility(vis)
+            # Selecting by a boolean array copies the rows, so only a shallow copy of vis is needed
+            newvis = copy.copy(vis)
             if vis.cindex is not None and len(rows) == len(vis.cindex):
                 newvis.cindex = vis.cindex[rows]
             else:
                 newvis.cindex = None
             if vis.blockvis is not None:
                 newvis.blockvis = vis.blockvis
-            newvis.data = copy.deepcopy(vis.data[rows])
+            newvis.data = vis.data[rows]
             return newvis
         else:
             vis.data = copy.deepcopy(vis.data[rows])
@@ -357,8 +343,8 @@ def create_visibility_from_rows(vis: Union[Visibility, BlockVisibility],
     else:
         
         if makecopy:
-            newvis = copy_visibility(vis)
-            newvis.data = copy.deepcopy(vis.data[rows])
+            newvis = copy.copy(vis)
+            newvis.data = vis.data[rows]
             return newvis
         else:
             vis.data = copy.deepcopy(vis.data[rows])
@@ -390,7 +376,8 @@ def phaserotate_visibility(vis: Union[Visibility, BlockVisibility],
     newvis = copy_visibility(vis)
     
     if isinstance(vis, Visibility):
-        phasor = calculate_visibility_phasor(newphasecentre, newvis)
+        # The phasor is calculated for the input vis so that it is cached across calls, e.g. for each facet
+        phasor = calculate_visibility_phasor(newphasecentre, vis)
         
         if inverse:
             newvis.data['vis'] *= phasor
@@ -402,25 +389,13 @@ def phaserotate_visibility(vis: Union[Visibility, BlockVisibility],
         # join smoothly at the edges. If we change the tangent then we will have to reproject to get
         # the results on the same image, in which case overlaps or gaps are difficult to deal with.
         if not tangent:
-            if inverse:
-                xyz = uvw_to_xyz(vis.data['uvw'], ha=-newvis.phasecentre.ra.rad,
-                                 dec=newvis.phasecentre.dec.rad)
-                newvis.data['uvw'][...] = \
-                    xyz_to_uvw(xyz, ha=-newphasecentre.ra.rad,
-                               dec=newphasecentre.dec.rad)[...]
-            else:
-                # This is the original (non-inverse) code
-                xyz = uvw_to_xyz(newvis.data['uvw'], ha=-newvis.phasecentre.ra.rad,
-                                 dec=newvis.phasecentre.dec.rad)
-                newvis.data['uvw'][...] = \
-                    xyz_to_uvw(xyz, ha=-newphasecentre.ra.rad,
-                               dec=newphasecentre.dec.rad)[...]
+            newvis.data['uvw'][...] = numpy.dot(vis.data['uvw'], _uvw_rotation(vis.phasecentre, newphasecentre))
             newvis.phasecentre = newphasecentre
         return newvis
     
     elif isinstance(vis, BlockVisibility):
         
-        phasor = calculate_blockvisibility_phasor(newphasecentre, newvis)
+        phasor = _blockvisibility_phasor(newphasecentre, vis)[..., numpy.newaxis]
         
         if inverse:
             newvis.data['vis'] *= phasor
@@ -432,24 +407,9 @@ def phaserotate_visibility(vis: Union[Visibility, BlockVisibility],
         # join smoothly at the edges. If we change the tangent then we will have to reproject to get
         # the results on the same image, in which case overlaps or gaps are difficult to deal with.
         if not tangent:
-            # UVW is shape [nants, nants, 3], we want [nants * nants, 3]
-            nrows, nants, _, _ = vis.uvw.shape
-            uvw_linear = vis.uvw.reshape([nrows * nants * nants, 3])
-            if inverse:
-                xyz = uvw_to_xyz(uvw_linear, ha=-newvis.phasecentre.ra.rad,
-                                 dec=newvis.phasecentre.dec.rad)
-                uvw_linear = \
-                    xyz_to_uvw(xyz, ha=-newphasecentre.ra.rad,
-                               dec=newphasecentre.dec.rad)[...]
-            else:
-                # This is the original (non-inverse) code
-                xyz = uvw_to_xyz(uvw_linear, ha=-newvis.phasecentre.ra.rad,
-                                 dec=newvis.phasecentre.dec.rad)
-                uvw_linear = \
-                    xyz_to_uvw(xyz, ha=-newphasecentre.ra.rad,
-                               dec=newphasecentre.dec.rad)[...]
+            # UVW is shape [nrows, nants, nants, 3]: the rotation applies to the last axis
+            newvis.data['uvw'][...] = numpy.dot(vis.uvw, _uvw_rotation(vis.phasecentre, newphasecentre))
             newvis.phasecentre = newphasecentre
-            newvis.data['uvw'][...] = uvw_linear.reshape([nrows, nants, nants, 3])
         return newvis
     else:
         raise ValueError("vis argument neither Visibility or BlockVisibility")
@@ -466,111 +426,111 @@ def export_blockvisibility_to_ms(msname, vis_list, source_name=None):
     :param msname: File name of MS
     :param vis_list: list of BlockVisibility
     :param source_name: Source name to use
-    :param ack: Ask casacore to acknowledge each table operation
     :return:
     """
-    try:
-        import casacore.tables.tableutil as pt
-        from casacore.tables import (makescacoldesc, makearrcoldesc, table, maketabdesc,
-                                     tableexists, tableiswritable,
-                                     tableinfo, tablefromascii, tabledelete, makecoldesc,
-                                     msconcat, removeDerivedMSCal,
-                                     taql, tablerename, tablecopy, tablecolumn,
-                                     addDerivedMSCal, removeImagingColumns,
-                                     addImagingColumns, required_ms_desc,
-                                     tabledefinehypercolumn, default_ms,
-                                     makedminfo,
-                                     default_ms_subtable)
-        from rascil.processing_components.visibility.msv2fund import Antenna, Stand
-    except ModuleNotFoundError:
-        raise ModuleNotFoundError("casacore is not installed")
-    
+    export_blockvisibility_iterator_to_ms(msname, vis_list, source_name=source_name)
+
+
+def export_blockvisibility_iterator_to_ms(msname, vis_iter, source_name=None, max_rows=2 ** 20):
+    """ Write BlockVisibility's from an iterable to a MS file
+
+    The main table rows are written in bulk as each BlockVisibility arrives, so that the iterable
+    may be e.g. create_blockvisibility_iterator_from_ms and the whole observation need never be held in memory.
+    BlockVisibility's with the same frequencies share a spectral window. All must have the same configuration
+    and polarisation frame.
+
+    :param msname: File name of MS
+    :param vis_iter: Iterable of BlockVisibility
+    :param source_name: Source name to use (default is the source of each BlockVisibility)
+    :param max_rows: Maximum number of MS rows to write in one operation
+    :return:
+    """
     try:
         from rascil.processing_components.visibility import msv2
     except ModuleNotFoundError:
         raise ModuleNotFoundError("cannot import msv2")
-    
-    # log.debug("create_blockvisibility_from_ms: %s" % str(tab.info()))
-    # Start the table
+
     tbl = msv2.Ms(msname, ref_time=0, source_name=source_name, if_delete=True)
-    for vis in vis_list:
-        if source_name is None:
-            source_name = vis.source
-        # Check polarisation
-        npol = vis.npol
-        nchan = vis.nchan
-        if vis.polarisation_frame.type == 'linear':
-            polarization = ['XX', 'XY', 'YX', 'YY']
-        elif vis.polarisation_frame.type == 'linearnp':
-            polarization = ['XX', 'YY']
-        elif vis.polarisation_frame.type == 'stokesI':
-            polarization = ['XX']
-        elif vis.polarisation_frame.type == 'circular':
-            polarization = ['RR', 'RL', 'LR', 'LL']
-        elif vis.polarisation_frame.type == 'circularnp':
-            polarization = ['RR', 'LL']
-        elif vis.polarisation_frame.type == 'stokesIQUV':
-            polarization = ['I', 'Q', 'U', 'V']
-        elif vis.polarisation_frame.type == 'stokesIQ':
-            polarization = ['I', 'Q']
-        elif vis.polarisation_frame.type == 'stokesIV':
-            polarization = ['I', 'V']
-        else:
-            raise ValueError(
-                "Unknown visibility polarisation %s" % (vis.polarisation_frame.type))
+    bands = list()
+    for vis in vis_iter:
+        _add_blockvisibility_to_ms(tbl, vis, bands, source_name=source_name, max_rows=max_rows)
+    tbl.write()
+
+
+def _add_blockvisibility_to_ms(tbl, vis, bands, source_name=None, max_rows=2 ** 20):
+    """ Write one BlockVisibility to the main table of an open MS
 
+    :param tbl: msv2.Ms
+    :param vis: BlockVisibility
+    :param bands: List of frequencies of the spectral windows already defined, updated in place
+    :param source_name: Source name to use
+    :param max_rows: Maximum number of MS rows to write in one operation
+    """
+    from rascil.processing_components.visibility.msv2fund import Antenna, Stand
+
+    if source_name is None:
+        source_name = vis.source
+
+    if vis.polarisation_frame.type == 'linear':
+        polarization = ['XX', 'XY', 'YX', 'YY']
+    elif vis.polarisation_frame.type == 'linearnp':
+        polarization = ['XX', 'YY']
+    elif vis.polarisation_frame.type == 'stokesI':
+        polarization = ['XX']
+    elif vis.polarisation_frame.type == 'circular':
+        polarization = ['RR', 'RL', 'LR', 'LL']
+    elif vis.polarisation_frame.type == 'circularnp':
+        polarization = ['RR', 'LL']
+    elif vis.polarisation_frame.type == 'stokesIQUV':
+        polarization = ['I', 'Q', 'U', 'V']
+    elif vis.polarisation_frame.type == 'stokesIQ':
+        polarization = ['I', 'Q']
+    elif vis.polarisation_frame.type == 'stokesIV':
+        polarization = ['I', 'V']
+    else:
+        raise ValueError(
+            "Unknown visibility polarisation %s" % (vis.polarisation_frame.type))
+
+    if len(tbl.stokes) == 0:
         tbl.set_stokes(polarization)
+    codes = [tbl._STOKES_CODES[pol] for pol in polarization]
+    if sorted(codes) != sorted(tbl.stokes):
+        raise ValueError("All BlockVisibility's must have the same polarisation frame")
+    # Position of each MS polarisation in the BlockVisibility
+    pol_order = [codes.index(code) for code in tbl.stokes]
+
+    frequency = tuple(vis.frequency)
+    if frequency not in bands:
         tbl.set_frequency(vis.frequency, vis.channel_bandwidth)
-        n_ant = len(vis.configuration.xyz)
-        
-        antennas = []
+        bands.append(frequency)
+    band = bands.index(frequency)
+
+    n_ant = len(vis.configuration.xyz)
+    if tbl.nant == 0:
         names = vis.configuration.names
         xyz = vis.configuration.xyz
-        for i in range(len(names)):
-            antennas.append(Antenna(i, Stand(names[i], xyz[i, 0], xyz[i, 1], xyz[i, 2])))
-        
-        # Set baselines and data
-        bl_list = []
-        
-        antennas2 = antennas
-        
-        for i in range(0, n_ant - 1):
-            for j in range(i + 1, n_ant):
-                bl_list.append((antennas[i], antennas2[j]))
-        
+        antennas = [Antenna(i, Stand(names[i], xyz[i, 0], xyz[i, 1], xyz[i, 2])) for i in range(n_ant)]
         tbl.set_geometry(vis.configuration, antennas)
-        nbaseline = len(bl_list)
-        ntimes = len(vis.data['time'])
-        
-        ms_vis = numpy.zeros([ntimes, nbaseline, nchan, npol]).astype('complex')
-        ms_uvw = numpy.zeros([ntimes, nbaseline, 3])
-        time = vis.data['time']
-        int_time = vis.data['integration_time']
-        bv_vis = vis.data['vis']
-        bv_uvw = vis.data['uvw']
-        
-        for row, _ in enumerate(time):
-            # MS has shape [row, npol, nchan]
-            # BV has shape [ntimes, nants, nants, nchan, npol]
-            bl = 0
-            for i in range(0, n_ant - 1):
-                for j in range(i + 1, n_ant):
-                    ms_vis[row, bl, ...] = bv_vis[row, j, i, ...]
-                    ms_uvw[row, bl, :] = bv_uvw[row, j, i, :]
-                    bl += 1
-        
-        for ntime, time in enumerate(vis.data['time']):
-            for ipol, pol in enumerate(polarization):
-                if int_time[ntime] is not None:
-                    tbl.add_data_set(time, int_time[ntime], bl_list,
-                                     ms_vis[ntime, ..., ipol], pol=pol,
-                                     source=source_name,
-                                     phasecentre=vis.phasecentre, uvw=ms_uvw[ntime, :, :])
-                else:
-                    tbl.add_data_set(time, 0, bl_list, ms_vis[ntime, ..., ipol], pol=pol,
-                                     source=source_name, phasecentre=vis.phasecentre,
-                                     uvw=ms_uvw[ntime, :, :])
-    tbl.write()
+    elif tbl.nant != n_ant:
+        raise ValueError("All BlockVisibility's must have the same configuration")
+
+    # MS baselines are (i, j) with i < j, BlockVisibility holds them at [j, i]
+    antenna1, antenna2 = numpy.triu_indices(n_ant, k=1)
+    nbaseline = len(antenna1)
+    ntimes = len(vis.data)
+    step = max(1, max_rows // max(1, nbaseline))
+    for start in range(0, ntimes, step):
+        rows = slice(start, min(start + step, ntimes))
+        data = vis.data[rows]
+        ms_vis = data['vis'][:, antenna2, antenna1, ...][..., pol_order]
+        ms_flags = data['flags'][:, antenna2, antenna1, ...][..., pol_order] > 0
+        ms_weights = numpy.mean(data['weight'][:, antenna2, antenna1, ...], axis=2)[..., pol_order]
+        ms_uvw = data['uvw'][:, antenna2, antenna1, :]
+        int_time = data['integration_time']
+        int_time = numpy.where(numpy.isfinite(int_time), int_time, 0.0)
+        tbl.add_data_block(data['time'], int_time, antenna1, antenna2, ms_uvw, ms_vis,
+                           flags=ms_flags, weights=ms_weights, band=band,
+                           source=source_name, phasecentre=vis.phasecentre)
 
 
 def list_ms(msname, ack=False):
@@ -654,6 +614,203 @@ def create_blockvisibility_from_ms(msname, channum=None, start_chan=None, end_ch
     tab = table(msname, ack=ack)
     log.debug("create_blockvisibility_from_ms: %s" % str(tab.info()))
     
+    fields, dds = _select_ms_fields_dds(msname, tab, selected_sources, selected_dds)
+    
+    log.debug(
+        "create_blockvisibility_from_ms: Reading unique fields %s, unique data descriptions %s" % (
+            str(fields), str(dds)))
+    vis_list = list()
+    for field in fields:
+        ftab = table(msname, ack=ack).query('FIELD_ID==%d' % field, style='')
+        assert ftab.nrows() > 0, "Empty selection for FIELD_ID=%d" % (field)
+        for dd in dds:
+            ms = ftab.query('DATA_DESC_ID==%d' % dd, style='')
+            assert ms.nrows() > 0, "Empty selection for FIELD_ID=%d and DATA_DESC_ID=%d" % (field, dd)
+            log.debug("create_blockvisibility_from_ms: Found %d rows" % (ms.nrows()))
+            vis_list.append(_convert_ms_rows_to_blockvisibility(msname, ms, field, dd, channum=channum,
+                                                                start_chan=start_chan, end_chan=end_chan,
+                                                                datacolumn=datacolumn,
+                                                                average_channels=average_channels))
+        tab.close()
+    return vis_list
+
+
+def create_blockvisibility_iterator_from_ms(msname, nintegrations=1, readahead=1, channum=None, start_chan=None,
+                                            end_chan=None, ack=False, datacolumn='DATA', selected_sources=None,
+                                            selected_dds=None, average_channels=False):
+    """ Iterate through a MeasurementSet, yielding BlockVisibility's of nintegrations integrations
+
+    This is the streaming counterpart of create_blockvisibility_from_ms: only the rows for the current chunk
+    are read from the MS so that the whole observation need not be held in memory. The reading is done in a
+    background thread that keeps up to readahead chunks ready while the caller processes the current one.
+    The chunks are in order of field, data descriptor, and then time. The selection arguments are as for
+    create_blockvisibility_from_ms.
+
+    For example::
+
+        bvis_iter = create_blockvisibility_iterator_from_ms('../../data/vis/ASKAP_example.ms', nintegrations=10)
+        for gt in rcal(bvis_iter, components, phase_only=True):
+            ...
+
+    :param msname: File name of MS
+    :param nintegrations: Number of integrations per BlockVisibility
+    :param readahead: Number of chunks to read ahead in a background thread (0 means read in the caller's thread)
+    :param channum: range of channels e.g. range(17,32), default is None meaning all
+    :param start_chan: Starting channel to read
+    :param end_chan: End channel to read
+    :param ack: Ask casacore to acknowledge each table operation
+    :param datacolumn: MS data column to read DATA, CORRECTED_DATA, or MODEL_DATA
+    :param selected_sources: Sources to select
+    :param selected_dds: Data descriptors to select
+    :param average_channels: Average all channels read
+    :return: Iterator of BlockVisibility
+    """
+    try:
+        from casacore.tables import table  # pylint: disable=import-error
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError("casacore is not installed")
+    
+    assert nintegrations > 0, "Number of integrations per chunk must be positive"
+    
+    def ms_chunks():
+        # The tables are closed in finally clauses, so also when the consumer stops iterating early
+        tab = table(msname, ack=ack)
+        try:
+            fields, dds = _select_ms_fields_dds(msname, tab, selected_sources, selected_dds)
+            for field in fields:
+                ftab = tab.query('FIELD_ID==%d' % field, style='')
+                try:
+                    assert ftab.nrows() > 0, "Empty selection for FIELD_ID=%d" % (field)
+                    for dd in dds:
+                        ms = ftab.query('DATA_DESC_ID==%d' % dd, style='')
+                        try:
+                            assert ms.nrows() > 0, \
+                                "Empty selection for FIELD_ID=%d and DATA_DESC_ID=%d" % (field, dd)
+                            yield from ms_chunks_selection(ms, field, dd)
+                        finally:
+                            ms.close()
+                finally:
+                    ftab.close()
+        finally:
+            tab.close()
+    
+    def ms_chunks_selection(ms, field, dd):
+        # Only the TIME and INTERVAL columns are read in full, to find the first row of each integration
+        # with the same rule as _convert_ms_rows_to_blockvisibility
+        otime = ms.getcol('TIME')
+        assert numpy.all(numpy.diff(otime) >= 0.0), "MS is not time-sorted - cannot convert"
+        integration_time = ms.getcol('INTERVAL')
+        slot = _ms_time_slots(otime - integration_time / 2.0, integration_time)
+        ntimes = slot[-1] + 1
+        log.debug("create_blockvisibility_iterator_from_ms: Found %d integrations for FIELD_ID=%d, "
+                  "DATA_DESC_ID=%d" % (ntimes, field, dd))
+        time_starts = numpy.searchsorted(slot, numpy.arange(0, ntimes, nintegrations))
+        time_starts = numpy.append(time_starts, len(otime))
+        for startrow, endrow in zip(time_starts[:-1], time_starts[1:]):
+            yield _convert_ms_rows_to_blockvisibility(msname, ms, field, dd, channum=channum,
+                                                      start_chan=start_chan, end_chan=end_chan,
+                                                      datacolumn=datacolumn,
+                                                      average_channels=average_channels,
+                                                      startrow=startrow, nrow=endrow - startrow)
+    
+    return _readahead_iterator(ms_chunks(), readahead=readahead)
+
+
+def create_blockvisibility_iterator_from_hdf5(filename, nintegrations=1, readahead=1):
+    """ Iterate through a BlockVisibility HDF5 file, yielding BlockVisibility's of nintegrations integrations
+
+    Only the integrations for the current chunk are read from the file. The reading is done in a background
+    thread that keeps up to readahead chunks ready while the caller processes the current one. If the file holds
+    more than one BlockVisibility then each is iterated through in turn.
+
+    :param filename: File name of HDF5 file as written by export_blockvisibility_to_hdf5
+    :param nintegrations: Number of integrations per BlockVisibility
+    :param readahead: Number of chunks to read ahead in a background thread (0 means read in the caller's thread)
+    :return: Iterator of BlockVisibility
+    """
+    import h5py
+    from rascil.data_models.data_model_helpers import convert_hdf_to_blockvisibility
+    
+    assert nintegrations > 0, "Number of integrations per chunk must be positive"
+    
+    def hdf5_chunks():
+        with h5py.File(filename, 'r') as f:
+            for i in range(f.attrs['number_data_models']):
+                vf = f['BlockVisibility%d' % i]
+                ntimes = vf['data'].shape[0]
+                for itime in range(0, ntimes, nintegrations):
+                    yield convert_hdf_to_blockvisibility(vf, rows=slice(itime, itime + nintegrations))
+    
+    return _readahead_iterator(hdf5_chunks(), readahead=readahead)
+
+
+def _readahead_iterator(chunks, readahead=1):
+    """ Iterate through chunks, producing them in a background thread
+
+    Up to readahead chunks are kept waiting in a queue. Any exception raised in the background thread is
+    re-raised in the caller's thread.
+
+    :param chunks: Iterator to be read ahead
+    :param readahead: Maximum number of chunks waiting (0 means no background thread)
+    :return: Iterator
+    """
+    if readahead < 1:
+        yield from chunks
+        return
+    
+    chunk_queue = queue.Queue(maxsize=readahead)
+    finished = threading.Event()
+    end_of_chunks = object()
+    
+    def put(item):
+        # Give up if the consumer has stopped iterating, otherwise the thread would block forever
+        while not finished.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put((chunk, None)):
+                    return
+        except Exception as err:
+            put((None, err))
+        finally:
+            # Release whatever the chunks hold, e.g. open tables, if the consumer stopped early
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            put((end_of_chunks, None))
+    
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while True:
+            chunk, err = chunk_queue.get()
+            if err is not None:
+                raise err
+            if chunk is end_of_chunks:
+                break
+            yield chunk
+    finally:
+        finished.set()
+        producer.join()
+
+
+def _select_ms_fields_dds(msname, tab, selected_sources=None, selected_dds=None):
+    """ Find the fields and data descriptors to be read from a MeasurementSet
+
+    :param msname: File name of MS
+    :param tab: casacore table of the main table
+    :param selected_sources: Sources to select
+    :param selected_dds: Data descriptors to select
+    :return: fields, dds
+    """
+    from casacore.tables import table  # pylint: disable=import-error
+    
     if selected_sources is None:
         fields = numpy.unique(tab.getcol('FIELD_ID'))
     else:
@@ -668,235 +825,255 @@ def create_blockvisibility_from_ms(msname, channum=None, start_chan=None, end_ch
         dds = numpy.unique(tab.getcol('DATA_DESC_ID'))
     else:
         dds = selected_dds
-    
-    log.debug(
-        "create_blockvisibility_from_ms: Reading unique fields %s, unique data descriptions %s" % (
-            str(fields), str(dds)))
-    vis_list = list()
-    for field in fields:
-        ftab = table(msname, ack=ack).query('FIELD_ID==%d' % field, style='')
-        assert ftab.nrows() > 0, "Empty selection for FIELD_ID=%d" % (field)
-        for dd in dds:
-            # Now get info from the subtables
-            ddtab = table('%s/DATA_DESCRIPTION' % msname, ack=False)
-            spwid = ddtab.getcol('SPECTRAL_WINDOW_ID')[dd]
-            polid = ddtab.getcol('POLARIZATION_ID')[dd]
-            ddtab.close()
-            
-            meta = {'MSV2': {'FIELD_ID': field, 'DATA_DESC_ID': dd}}
-            ms = ftab.query('DATA_DESC_ID==%d' % dd, style='')
-            assert ms.nrows() > 0, "Empty selection for FIELD_ID=%d and DATA_DESC_ID=%d" % (field, dd)
-            log.debug("create_blockvisibility_from_ms: Found %d rows" % (ms.nrows()))
-            # The TIME column has descriptor:
-            # {'valueType': 'double', 'dataManagerType': 'IncrementalStMan', 'dataManagerGroup': 'TIME',
-            # 'option': 0, 'maxlen': 0, 'comment': 'Modified Julian Day',
-            # 'keywords': {'QuantumUnits': ['s'], 'MEASINFO': {'type': 'epoch', 'Ref': 'UTC'}}}
-            otime = ms.getcol('TIME')
-            datacol = ms.getcol(datacolumn, nrow=1)
-            datacol_shape = list(datacol.shape)
-            channels = datacol.shape[-2]
-            log.debug("create_blockvisibility_from_ms: Found %d channels" % (channels))
-            if channum is None:
-                if start_chan is not None and end_chan is not None:
-                    try:
-                        log.debug(
-                            "create_blockvisibility_from_ms: Reading channels from %d to %d" %
-                            (start_chan, end_chan))
-                        blc = [start_chan, 0]
-                        trc = [end_chan, datacol_shape[-1] - 1]
-                        channum = range(start_chan, end_chan + 1)
-                        ms_vis = ms.getcolslice(datacolumn, blc=blc, trc=trc)
-                        ms_flags = ms.getcolslice('FLAG', blc=blc, trc=trc)
-                        ms_weight = ms.getcol('WEIGHT')
-
-                    except IndexError:
-                        raise IndexError("channel number exceeds max. within ms")
-                
-                else:
-                    log.debug(
-                        "create_blockvisibility_from_ms: Reading all %d channels" % (
-                            channels))
-                    try:
-                        channum = range(channels)
-                        ms_vis = ms.getcol(datacolumn)[:, channum, :]
-                        ms_weight = ms.getcol('WEIGHT')
-                        ms_flags = ms.getcol('FLAG')
-                        channum = range(channels)
-                    except IndexError:
-                        raise IndexError("channel number exceeds max. within ms")
-            else:
-                log.debug(
-                    "create_blockvisibility_from_ms: Reading channels %s " % (channum))
-                channum = range(channels)
-                try:
-                    ms_vis = ms.getcol(datacolumn)[:, channum, :]
-                    ms_flags = ms.getcol('FLAG')[:, channum, :]
-                    ms_weight = ms.getcol('WEIGHT')[:, :]
-                except IndexError:
-                    raise IndexError("channel number exceeds max. within ms")
-
-            if average_channels:
-                weight = ms_weight[:, numpy.newaxis, :] * (1.0 - ms_flags)
-                ms_vis = numpy.sum(weight * ms_vis, axis=-2)[..., numpy.newaxis, :]
-                sumwt = numpy.sum(weight, axis=-2)[..., numpy.newaxis, :]
-                ms_vis[sumwt > 0.0] = ms_vis[sumwt > 0] / sumwt[sumwt > 0.0]
-                ms_vis[sumwt <= 0.0] = 0.0 + 0.0j
-                ms_flags = sumwt
-                ms_flags[ms_flags <= 0.0] = 1.0
-                ms_flags[ms_flags > 0.0] = 0.0
-
-            uvw = -1 * ms.getcol('UVW')
-            antenna1 = ms.getcol('ANTENNA1')
-            antenna2 = ms.getcol('ANTENNA2')
-            integration_time = ms.getcol('INTERVAL')
-            
-            time = (otime - integration_time / 2.0)
+    return fields, dds
 
-            start_time = numpy.min(time) / 86400.0
-            end_time = numpy.max(time) / 86400.0
-            
-            log.debug("create_blockvisibility_from_ms: Observation from %s to %s" %
-                      (Time(start_time, format='mjd').iso,
-                       Time(end_time, format='mjd').iso))
-            
-            spwtab = table('%s/SPECTRAL_WINDOW' % msname, ack=False)
-            cfrequency = numpy.array(spwtab.getcol('CHAN_FREQ')[spwid][channum])
-            cchannel_bandwidth = numpy.array(spwtab.getcol('CHAN_WIDTH')[spwid][channum])
-            nchan = cfrequency.shape[0]
-            if average_channels:
-                cfrequency = numpy.array([numpy.average(cfrequency)])
-                cchannel_bandwidth = numpy.array([numpy.sum(cchannel_bandwidth)])
-                nchan = cfrequency.shape[0]
-
-            # Get polarisation info
-            poltab = table('%s/POLARIZATION' % msname, ack=False)
-            corr_type = poltab.getcol('CORR_TYPE')[polid]
-            corr_type = sorted(corr_type)
-            # These correspond to the CASA Stokes enumerations
-            if numpy.array_equal(corr_type, [1, 2, 3, 4]):
-                polarisation_frame = PolarisationFrame('stokesIQUV')
-                npol = 4
-            elif numpy.array_equal(corr_type, [1, 2]):
-                polarisation_frame = PolarisationFrame('stokesIQ')
-                npol = 2
-            elif numpy.array_equal(corr_type, [1, 4]):
-                polarisation_frame = PolarisationFrame('stokesIV')
-                npol = 2
-            elif numpy.array_equal(corr_type, [5, 6, 7, 8]):
-                polarisation_frame = PolarisationFrame('circular')
-                npol = 4
-            elif numpy.array_equal(corr_type, [5, 8]):
-                polarisation_frame = PolarisationFrame('circularnp')
-                npol = 2
-            elif numpy.array_equal(corr_type, [9, 10, 11, 12]):
-                polarisation_frame = PolarisationFrame('linear')
-                npol = 4
-            elif numpy.array_equal(corr_type, [9, 12]):
-                polarisation_frame = PolarisationFrame('linearnp')
-                npol = 2
-            elif numpy.array_equal(corr_type, [9]):
-                npol = 1
-                polarisation_frame = PolarisationFrame('stokesI')
-            else:
-                raise KeyError("Polarisation not understood: %s" % str(corr_type))
-            
-            # Get configuration
-            anttab = table('%s/ANTENNA' % msname, ack=False)
-            names = numpy.array(anttab.getcol('NAME'))
-            
-            ant_map = list()
-            actual = 0
-            # This assumes that the names are actually filled in!
-            for i, name in enumerate(names):
-                if name != "":
-                    ant_map.append(actual)
-                    actual += 1
-                else:
-                    ant_map.append(-1)
-            #assert actual > 0, "Dish/station names are all blank - cannot load"
-            if actual == 0:
-                ant_map = list(range(len(names)))
-                names = numpy.repeat("No name", len(names))
-            
-            mount = numpy.array(anttab.getcol('MOUNT'))[names != '']
-            # log.info("mount is: %s" % (mount))
-            diameter = numpy.array(anttab.getcol('DISH_DIAMETER'))[names != '']
-            xyz = numpy.array(anttab.getcol('POSITION'))[names != '']
-            offset = numpy.array(anttab.getcol('OFFSET'))[names != '']
-            stations = numpy.array(anttab.getcol('STATION'))[names != '']
-            names = numpy.array(anttab.getcol('NAME'))[names != '']
-            nants = len(names)
 
-            
-            antenna1 = list(map(lambda i: ant_map[i], antenna1))
-            antenna2 = list(map(lambda i: ant_map[i], antenna2))
+def _ms_time_slots(time, integration_time):
+    """ Find the time slot of each row of a MeasurementSet selection
 
+    A new slot starts when the time is more than half an integration after the start of the current slot.
+
+    :param time: Start times of rows (s)
+    :param integration_time: Integration times of rows (s)
+    :return: slot index of each row
+    """
+    time_index_row = numpy.zeros_like(time, dtype='int')
+    time_last = time[0]
+    time_index = 0
+    for row, _ in enumerate(time):
+        if time[row] > time_last + 0.5 * integration_time[row]:
+            assert time[row] > time_last, "MS is not time-sorted - cannot convert"
+            time_index += 1
+            time_last = time[row]
+        time_index_row[row] = time_index
+    return time_index_row
+
+
+def _convert_ms_rows_to_blockvisibility(msname, ms, field, dd, channum=None, start_chan=None, end_chan=None,
+                                        datacolumn='DATA', average_channels=False, startrow=0, nrow=-1):
+    """ Convert a range of rows of a MS selection (one field and data descriptor) to a BlockVisibility
+
+    :param msname: File name of MS
+    :param ms: casacore table selected on field and data descriptor
+    :param field: Field id
+    :param dd: Data descriptor id
+    :param channum: range of channels e.g. range(17,32), default is None meaning all
+    :param start_chan: Starting channel to read
+    :param end_chan: End channel to read
+    :param datacolumn: MS data column to read DATA, CORRECTED_DATA, or MODEL_DATA
+    :param average_channels: Average all channels read
+    :param startrow: First row of ms to convert
+    :param nrow: Number of rows to convert (-1 means to the end)
+    :return: BlockVisibility
+    """
+    from casacore.tables import table  # pylint: disable=import-error
+    
+    # Now get info from the subtables
+    ddtab = table('%s/DATA_DESCRIPTION' % msname, ack=False)
+    spwid = ddtab.getcol('SPECTRAL_WINDOW_ID')[dd]
+    polid = ddtab.getcol('POLARIZATION_ID')[dd]
+    ddtab.close()
+    
+    meta = {'MSV2': {'FIELD_ID': field, 'DATA_DESC_ID': dd}}
+    # The TIME column has descriptor:
+    # {'valueType': 'double', 'dataManagerType': 'IncrementalStMan', 'dataManagerGroup': 'TIME',
+    # 'option': 0, 'maxlen': 0, 'comment': 'Modified Julian Day',
+    # 'keywords': {'QuantumUnits': ['s'], 'MEASINFO': {'type': 'epoch', 'Ref': 'UTC'}}}
+    otime = ms.getcol('TIME', startrow=startrow, nrow=nrow)
+    datacol = ms.getcol(datacolumn, startrow=startrow, nrow=1)
+    datacol_shape = list(datacol.shape)
+    channels = datacol.shape[-2]
+    log.debug("create_blockvisibility_from_ms: Found %d channels" % (channels))
+    if channum is None:
+        if start_chan is not None and end_chan is not None:
+            try:
+                log.debug(
+                    "create_blockvisibility_from_ms: Reading channels from %d to %d" %
+                    (start_chan, end_chan))
+                blc = [start_chan, 0]
+                trc = [end_chan, datacol_shape[-1] - 1]
+                channum = range(start_chan, end_chan + 1)
+                ms_vis = ms.getcolslice(datacolumn, blc=blc, trc=trc, startrow=startrow, nrow=nrow)
+                ms_flags = ms.getcolslice('FLAG', blc=blc, trc=trc, startrow=startrow, nrow=nrow)
+                ms_weight = ms.getcol('WEIGHT', startrow=startrow, nrow=nrow)
             
-            location = EarthLocation(x=Quantity(xyz[0][0], 'm'),
-                                     y=Quantity(xyz[0][1], 'm'),
-                                     z=Quantity(xyz[0][2], 'm'))
-
-            configuration = Configuration(name='', data=None, location=location,
-                                          names=names, xyz=xyz, mount=mount, frame="geocentric",
-                                          receptor_frame=ReceptorFrame("linear"),
-                                          diameter=diameter, offset=offset, stations=stations)
-            # Get phasecentres
-            fieldtab = table('%s/FIELD' % msname, ack=False)
-            pc = fieldtab.getcol('PHASE_DIR')[field, 0, :]
-            source = fieldtab.getcol('NAME')[field]
-            phasecentre = SkyCoord(ra=pc[0] * u.rad, dec=pc[1] * u.rad, frame='icrs',
-                                   equinox='J2000')
-            
-            time_index_row = numpy.zeros_like(time, dtype='int')
-            time_last = time[0]
-            time_index = 0
-            for row, _ in enumerate(time):
-                if time[row] > time_last + 0.5 * integration_time[row]:
-                    assert time[row] > time_last, "MS is not time-sorted - cannot convert"
-                    time_index += 1
-                    time_last = time[row]
-                time_index_row[row] = time_index
-            
-            ntimes = time_index + 1
-            
-            assert ntimes == len(numpy.unique(ms.getcol("TIME"))), "Error in finding data times"
-            
-            bv_times = numpy.zeros([ntimes])
-            bv_vis = numpy.zeros([ntimes, nants, nants, nchan, npol]).astype('complex')
-            bv_flags = numpy.zeros([ntimes, nants, nants, nchan, npol]).astype('int')
-            bv_weight = numpy.zeros([ntimes, nants, nants, nchan, npol])
-            bv_imaging_weight = numpy.zeros([ntimes, nants, nants, nchan, npol])
-            bv_uvw = numpy.zeros([ntimes, nants, nants, 3])
-            bv_integration_time = numpy.zeros([ntimes])
-            
-            for row, _ in enumerate(time):
-                time_index = time_index_row[row]
-                bv_times[time_index] = time[row]
-                bv_vis[time_index, antenna2[row], antenna1[row], ...] = ms_vis[row, ...]
-                bv_flags[time_index, antenna2[row], antenna1[row], ...] = ms_flags[
-                    row, ...]
-                bv_weight[time_index, antenna2[row], antenna1[row], :, ...] = ms_weight[
-                    row, numpy.newaxis, ...]
-                bv_imaging_weight[time_index, antenna2[row], antenna1[row], :, ...] = \
-                    ms_weight[row, numpy.newaxis, ...]
-                bv_uvw[time_index, antenna2[row], antenna1[row], :] = uvw[row, :]
-                bv_integration_time[time_index] = integration_time[row]
-            
-            vis_list.append(BlockVisibility(uvw=bv_uvw,
-                                            time=bv_times,
-                                            frequency=cfrequency,
-                                            channel_bandwidth=cchannel_bandwidth,
-                                            vis=bv_vis,
-                                            flags=bv_flags,
-                                            weight=bv_weight,
-                                            integration_time=bv_integration_time,
-                                            imaging_weight=bv_imaging_weight,
-                                            configuration=configuration,
-                                            phasecentre=phasecentre,
-                                            polarisation_frame=polarisation_frame,
-                                            source=source, meta=meta))
-        tab.close()
-    return vis_list
+            except IndexError:
+                raise IndexError("channel number exceeds max. within ms")
+        
+        else:
+            log.debug(
+                "create_blockvisibility_from_ms: Reading all %d channels" % (
+                    channels))
+            try:
+                channum = range(channels)
+                ms_vis = ms.getcol(datacolumn, startrow=startrow, nrow=nrow)[:, channum, :]
+                ms_weight = ms.getcol('WEIGHT', startrow=startrow, nrow=nrow)
+                ms_flags = ms.getcol('FLAG', startrow=startrow, nrow=nrow)
+                channum = range(channels)
+            except IndexError:
+                raise IndexError("channel number exceeds max. within ms")
+    else:
+        log.debug(
+            "create_blockvisibility_from_ms: Reading channels %s " % (channum))
+        channum = range(channels)
+        try:
+            ms_vis = ms.getcol(datacolumn, startrow=startrow, nrow=nrow)[:, channum, :]
+            ms_flags = ms.getcol('FLAG', startrow=startrow, nrow=nrow)[:, channum, :]
+            ms_weight = ms.getcol('WEIGHT', startrow=startrow, nrow=nrow)[:, :]
+        except IndexError:
+            raise IndexError("channel number exceeds max. within ms")
+    
+    if average_channels:
+        weight = ms_weight[:, numpy.newaxis, :] * (1.0 - ms_flags)
+        ms_vis = numpy.sum(weight * ms_vis, axis=-2)[..., numpy.newaxis, :]
+        sumwt = numpy.sum(weight, axis=-2)[..., numpy.newaxis, :]
+        ms_vis[sumwt > 0.0] = ms_vis[sumwt > 0] / sumwt[sumwt > 0.0]
+        ms_vis[sumwt <= 0.0] = 0.0 + 0.0j
+        ms_flags = sumwt
+        ms_flags[ms_flags <= 0.0] = 1.0
+        ms_flags[ms_flags > 0.0] = 0.0
+    
+    uvw = -1 * ms.getcol('UVW', startrow=startrow, nrow=nrow)
+    antenna1 = ms.getcol('ANTENNA1', startrow=startrow, nrow=nrow)
+    antenna2 = ms.getcol('ANTENNA2', startrow=startrow, nrow=nrow)
+    integration_time = ms.getcol('INTERVAL', startrow=startrow, nrow=nrow)
+    
+    time = (otime - integration_time / 2.0)
+    
+    start_time = numpy.min(time) / 86400.0
+    end_time = numpy.max(time) / 86400.0
+    
+    log.debug("create_blockvisibility_from_ms: Observation from %s to %s" %
+              (Time(start_time, format='mjd').iso,
+               Time(end_time, format='mjd').iso))
+    
+    spwtab = table('%s/SPECTRAL_WINDOW' % msname, ack=False)
+    cfrequency = numpy.array(spwtab.getcol('CHAN_FREQ')[spwid][channum])
+    cchannel_bandwidth = numpy.array(spwtab.getcol('CHAN_WIDTH')[spwid][channum])
+    nchan = cfrequency.shape[0]
+    if average_channels:
+        cfrequency = numpy.array([numpy.average(cfrequency)])
+        cchannel_bandwidth = numpy.array([numpy.sum(cchannel_bandwidth)])
+        nchan = cfrequency.shape[0]
+    
+    # Get polarisation info
+    poltab = table('%s/POLARIZATION' % msname, ack=False)
+    corr_type = poltab.getcol('CORR_TYPE')[polid]
+    corr_type = sorted(corr_type)
+    # These correspond to the CASA Stokes enumerations
+    if numpy.array_equal(corr_type, [1, 2, 3, 4]):
+        polarisation_frame = PolarisationFrame('stokesIQUV')
+        npol = 4
+    elif numpy.array_equal(corr_type, [1, 2]):
+        polarisation_frame = PolarisationFrame('stokesIQ')
+        npol = 2
+    elif numpy.array_equal(corr_type, [1, 4]):
+        polarisation_frame = PolarisationFrame('stokesIV')
+        npol = 2
+    elif numpy.array_equal(corr_type, [5, 6, 7, 8]):
+        polarisation_frame = PolarisationFrame('circular')
+        npol = 4
+    elif numpy.array_equal(corr_type, [5, 8]):
+        polarisation_frame = PolarisationFrame('circularnp')
+        npol = 2
+    elif numpy.array_equal(corr_type, [9, 10, 11, 12]):
+        polarisation_frame = PolarisationFrame('linear')
+        npol = 4
+    elif numpy.array_equal(corr_type, [9, 12]):
+        polarisation_frame = PolarisationFrame('linearnp')
+        npol = 2
+    elif numpy.array_equal(corr_type, [9]):
+        npol = 1
+        polarisation_frame = PolarisationFrame('stokesI')
+    else:
+        raise KeyError("Polarisation not understood: %s" % str(corr_type))
+    
+    # Get configuration
+    anttab = table('%s/ANTENNA' % msname, ack=False)
+    names = numpy.array(anttab.getcol('NAME'))
+    
+    ant_map = list()
+    actual = 0
+    # This assumes that the names are actually filled in!
+    for i, name in enumerate(names):
+        if name != "":
+            ant_map.append(actual)
+            actual += 1
+        else:
+            ant_map.append(-1)
+    #assert actual > 0, "Dish/station names are all blank - cannot load"
+    if actual == 0:
+        ant_map = list(range(len(names)))
+        names = numpy.repeat("No name", len(names))
+    
+    mount = numpy.array(anttab.getcol('MOUNT'))[names != '']
+    # log.info("mount is: %s" % (mount))
+    diameter = numpy.array(anttab.getcol('DISH_DIAMETER'))[names != '']
+    xyz = numpy.array(anttab.getcol('POSITION'))[names != '']
+    offset = numpy.array(anttab.getcol('OFFSET'))[names != '']
+    stations = numpy.array(anttab.getcol('STATION'))[names != '']
+    names = numpy.array(anttab.getcol('NAME'))[names != '']
+    nants = len(names)
+    
+    
+    antenna1 = list(map(lambda i: ant_map[i], antenna1))
+    antenna2 = list(map(lambda i: ant_map[i], antenna2))
+    
+    
+    location = EarthLocation(x=Quantity(xyz[0][0], 'm'),
+                             y=Quantity(xyz[0][1], 'm'),
+                             z=Quantity(xyz[0][2], 'm'))
+    
+    configuration = Configuration(name='', data=None, location=location,
+                                  names=names, xyz=xyz, mount=mount, frame="geocentric",
+                                  receptor_frame=ReceptorFrame("linear"),
+                                  diameter=diameter, offset=offset, stations=stations)
+    # Get phasecentres
+    fieldtab = table('%s/FIELD' % msname, ack=False)
+    pc = fieldtab.getcol('PHASE_DIR')[field, 0, :]
+    source = fieldtab.getcol('NAME')[field]
+    phasecentre = SkyCoord(ra=pc[0] * u.rad, dec=pc[1] * u.rad, frame='icrs',
+                           equinox='J2000')
+    
+    time_index_row = _ms_time_slots(time, integration_time)
+    ntimes = time_index_row[-1] + 1
+    
+    assert ntimes == len(numpy.unique(otime)), "Error in finding data times"
+    
+    bv_times = numpy.zeros([ntimes])
+    bv_vis = numpy.zeros([ntimes, nants, nants, nchan, npol]).astype('complex')
+    bv_flags = numpy.zeros([ntimes, nants, nants, nchan, npol]).astype('int')
+    bv_weight = numpy.zeros([ntimes, nants, nants, nchan, npol])
+    bv_imaging_weight = numpy.zeros([ntimes, nants, nants, nchan, npol])
+    bv_uvw = numpy.zeros([ntimes, nants, nants, 3])
+    bv_integration_time = numpy.zeros([ntimes])
+    
+    for row, _ in enumerate(time):
+        time_index = time_index_row[row]
+        bv_times[time_index] = time[row]
+        bv_vis[time_index, antenna2[row], antenna1[row], ...] = ms_vis[row, ...]
+        bv_flags[time_index, antenna2[row], antenna1[row], ...] = ms_flags[
+            row, ...]
+        bv_weight[time_index, antenna2[row], antenna1[row], :, ...] = ms_weight[
+            row, numpy.newaxis, ...]
+        bv_imaging_weight[time_index, antenna2[row], antenna1[row], :, ...] = \
+            ms_weight[row, numpy.newaxis, ...]
+        bv_uvw[time_index, antenna2[row], antenna1[row], :] = uvw[row, :]
+        bv_integration_time[time_index] = integration_time[row]
+    
+    return BlockVisibility(uvw=bv_uvw,
+                           time=bv_times,
+                           frequency=cfrequency,
+                           channel_bandwidth=cchannel_bandwidth,
+                           vis=bv_vis,
+                           flags=bv_flags,
+                           weight=bv_weight,
+                           integration_time=bv_integration_time,
+                           imaging_weight=bv_imaging_weight,
+                           configuration=configuration,
+                           phasecentre=phasecentre,
+                           polarisation_frame=polarisation_frame,
+                           source=source, meta=meta)
 
 
 def create_visibility_from_ms(msname, channum=None, start_chan=None, end_chan=None, average_channels=False,
@@ -929,225 +1106,309 @@ def create_visibility_from_ms(msname, channum=None, start_chan=None, end_chan=No
                                                     ack=ack)]
 
 
-def create_blockvisibility_from_uvfits(fitsname, channum=None, ack=False, antnum=None):
+def create_blockvisibility_from_uvfits(fitsname, channum=None, ack=False, antnum=None, startrow=0, nrow=None):
     """ Minimal UVFIT to BlockVisibility converter
 
     The UVFITS format is much more general than the RASCIL BlockVisibility so we cut many corners.
     
-    Creates a list of BlockVisibility's, split by field and spectral window
+    Creates a list of BlockVisibility's, split by field and spectral window. The baselines and
+    times of the random groups are decoded with array operations and all spectral windows (IFs) are
+    filled from a single read of the data. A range of rows can be selected to read part of a large
+    file, see also create_blockvisibility_iterator_from_uvfits.
     
     :param fitsname: File name of UVFITS
     :param channum: range of channels e.g. range(17,32), default is None meaning all
     :param antnum: the number of antenna
+    :param startrow: First row (random group) to read
+    :param nrow: Number of rows to read, default is None meaning all remaining rows
     :return:
     """
+    with fits.open(fitsname, memmap=True) as hdul:
+        meta = _uvfits_metadata(hdul, antnum=antnum)
+        times = _uvfits_times(hdul)
+        if nrow is None:
+            nrow = len(times) - startrow
+        _, _, integration_time = _uvfits_time_slots(times)
+        return _convert_uvfits_rows_to_blockvisibility(hdul, meta, times, integration_time, channum=channum,
+                                                       startrow=startrow, nrow=nrow)
+
+
+def create_blockvisibility_iterator_from_uvfits(fitsname, nintegrations=1, readahead=1, channum=None,
+                                                antnum=None):
+    """ Iterate through a UVFITS file, yielding BlockVisibility's of nintegrations integrations
+
+    This is the streaming counterpart of create_blockvisibility_from_uvfits: the file is memory-mapped and only
+    the rows for the current chunk are read. The reading is done in a background thread that keeps up to
+    readahead chunks ready while the caller processes the current one. For each chunk of integrations, one
+    BlockVisibility is yielded per spectral window. The rows must be time-sorted.
+
+    :param fitsname: File name of UVFITS
+    :param nintegrations: Number of integrations per BlockVisibility
+    :param readahead: Number of chunks to read ahead in a background thread (0 means read in the caller's thread)
+    :param channum: range of channels e.g. range(17,32), default is None meaning all
+    :param antnum: the number of antenna
+    :return: Iterator of BlockVisibility
+    """
+    assert nintegrations > 0, "Number of integrations per chunk must be positive"
     
-    def find_time_slots(times):
-        """ Find the time slots
-        
-        :param times:
-        :return:
-        """
-        intervals = times[1:] - times[0:-1]
-        integration_time = numpy.median(intervals[intervals > 0.0])
-        last_time = times[0]
-        time_slots = list()
-        for t in times:
-            if t > last_time + integration_time:
-                last_time = t
-                time_slots.append(last_time)
-        
-        time_slots = numpy.array(time_slots)
-        
-        return time_slots
+    def uvfits_chunks():
+        with fits.open(fitsname, memmap=True) as hdul:
+            meta = _uvfits_metadata(hdul, antnum=antnum)
+            # Only the time parameters are read in full, to find the first row of each integration
+            times = _uvfits_times(hdul)
+            slot, _, integration_time = _uvfits_time_slots(times)
+            assert numpy.all(numpy.diff(slot) >= 0), "UVFITS is not time-sorted - cannot convert"
+            ntimes = slot[-1] + 1
+            time_starts = numpy.searchsorted(slot, numpy.arange(0, ntimes, nintegrations))
+            time_starts = numpy.append(time_starts, len(times))
+            for startrow, endrow in zip(time_starts[:-1], time_starts[1:]):
+                for vis in _convert_uvfits_rows_to_blockvisibility(hdul, meta, times, integration_time,
+                                                                   channum=channum, startrow=startrow,
+                                                                   nrow=endrow - startrow):
+                    yield vis
     
-    def param_dict(hdul):
-        "Return the dictionary of the random parameters"
-        
-        """
-        The keys of the dictionary are the parameter names uppercased for
-        consistency. The values are the column numbers.
+    return _readahead_iterator(uvfits_chunks(), readahead=readahead)
 
-        If multiple parameters have the same name (e.g., DATE) their
-        columns are entered as a list.
-        """
-        
-        pre = re.compile(r"PTYPE(?P<i>\d+)")
-        res = {}
-        for k, v in hdul.header.items():
-            m = pre.match(k)
-            if m:
-                vu = v.upper()
-                if vu in res:
-                    res[vu] = [res[vu], int(m.group("i"))]
-                else:
-                    res[vu] = int(m.group("i"))
-        return res
-    
-    # Open the file
-    with fits.open(fitsname) as hdul:
-        
-        # Read Spectral Window
-        nspw = hdul[0].header['NAXIS5']
-        # Read Channel and Frequency Interval
-        freq_ref = hdul[0].header['CRVAL4']
-        delt_freq = hdul[0].header['CDELT4']
-        # Real the number of channels in one spectral window
-        channels = hdul[0].header['NAXIS4']
-        freq = numpy.zeros([nspw, channels])
-        # Read Frequency or IF
-        freqhdulname = "AIPS FQ"
-        sdhu = hdul.index_of(freqhdulname)
-        if_freq = hdul[sdhu].data['IF FREQ'].ravel()
-        for i in range(nspw):
-            temp = numpy.array(
-                [if_freq[i] + freq_ref + delt_freq * ff for ff in range(channels)])
-            freq[i, :] = temp[:]
-        freq_delt = numpy.ones(channels) * delt_freq
-        if channum is None:
-            channum = range(channels)
-        
-        # Read time. We are trying to find a discrete set of times to use in
-        # BlockVisibility.
-        bvtimes = Time(hdul[0].data['DATE'], hdul[0].data['_DATE'], format='jd')
-        bv_times = find_time_slots(bvtimes.jd)
-        
-        ntimes = len(bv_times)
-        
-        # # Get Antenna
-        # blin = hdul[0].data['BASELINE']
-        antennahdulname = "AIPS AN"
-        adhu = hdul.index_of(antennahdulname)
-        try:
-            antenna_name = hdul[adhu].data['ANNAME']
-            antenna_name = antenna_name.encode('ascii', 'ignore')
-        except ValueError:
-            antenna_name = None
-        
-        antenna_xyz = hdul[adhu].data['STABXYZ']
-        antenna_mount = hdul[adhu].data['MNTSTA']
-        antenna_offset = hdul[adhu].data['STAXOF']
-        try:
-            antenna_diameter = hdul[adhu].data['DIAMETER']
-        except (ValueError, KeyError):
-            antenna_diameter = None
-        # To reading some UVFITS with wrong numbers of antenna
-        if antnum is not None and antenna_name is not None:
-            antenna_name = antenna_name[:antnum]
-            antenna_xyz = antenna_xyz[:antnum]
-            antenna_mount = antenna_mount[:antnum]
-            antenna_offset = antenna_offset[:antnum]
-            if antenna_diameter is not None:
-                antenna_diameter = antenna_diameter[:antnum]
-        
-        nants = len(antenna_xyz)
 
-        # Put offset into same shape as for MS
-        antenna_offset = numpy.c_[antenna_offset, numpy.zeros(nants), numpy.zeros(nants)]
-        
-        # Get polarisation info
-        npol = hdul[0].header['NAXIS3']
-        corr_type = numpy.arange(hdul[0].header['NAXIS3']) - (
-                hdul[0].header['CRPIX3'] - 1)
-        corr_type *= hdul[0].header['CDELT3']
-        corr_type += hdul[0].header['CRVAL3']
-        # xx yy xy yx
-        # These correspond to the CASA Stokes enumerations
-        if numpy.array_equal(corr_type, [1, 2, 3, 4]):
-            polarisation_frame = PolarisationFrame('stokesIQUV')
-        elif numpy.array_equal(corr_type, [1, 4]):
-            polarisation_frame = PolarisationFrame('stokesIV')
-        elif numpy.array_equal(corr_type, [1, 2]):
-            polarisation_frame = PolarisationFrame('stokesIQ')
-        elif numpy.array_equal(corr_type, [-1, -2, -3, -4]):
-            polarisation_frame = PolarisationFrame('circular')
-        elif numpy.array_equal(corr_type, [-1, -4]):
-            polarisation_frame = PolarisationFrame('circularnp')
-        elif numpy.array_equal(corr_type, [-5, -6, -7, -8]):
-            polarisation_frame = PolarisationFrame('linear')
-        elif numpy.array_equal(corr_type, [-5, -8]):
-            polarisation_frame = PolarisationFrame('linearnp')
-        else:
-            raise KeyError("Polarisation not understood: %s" % str(corr_type))
-        
-        configuration = Configuration(name='', data=None, location=None,
-                                      names=antenna_name, xyz=antenna_xyz,
-                                      mount=antenna_mount, frame=None,
-                                      receptor_frame=polarisation_frame,
-                                      diameter=antenna_diameter,
-                                      offset=antenna_offset, stations=antenna_name)
-        
-        # Get RA and DEC
-        phase_center_ra_degrees = numpy.float(hdul[0].header['CRVAL6'])
-        phase_center_dec_degrees = numpy.float(hdul[0].header['CRVAL7'])
+def _uvfits_param_dict(hdu):
+    """Return the dictionary of the random parameters
+
+    The keys of the dictionary are the parameter names uppercased for
+    consistency. The values are the column numbers.
+
+    If multiple parameters have the same name (e.g., DATE) their
+    columns are entered as a list.
+    """
+    pre = re.compile(r"PTYPE(?P<i>\d+)")
+    res = {}
+    for k, v in hdu.header.items():
+        m = pre.match(k)
+        if m:
+            vu = v.upper()
+            if vu in res:
+                res[vu] = [res[vu], int(m.group("i"))]
+            else:
+                res[vu] = int(m.group("i"))
+    return res
+
+
+def _uvfits_times(hdul):
+    """ Read the times of all rows of a UVFITS file as MJD in seconds
+
+    The two DATE parameters are combined after removing the MJD offset, to preserve precision.
+
+    :param hdul: FITS HDU list
+    :return: numpy array of times
+    """
+    d = _uvfits_param_dict(hdul[0])
+    times = (numpy.asarray(hdul[0].data['DATE'], dtype='float') - 2400000.5)
+    if isinstance(d['DATE'], list):
+        times += numpy.asarray(hdul[0].data['_DATE'], dtype='float')
+    return 86400.0 * times
+
+
+def _uvfits_time_slots(times):
+    """ Find the time slot of each row
+
+    A new slot starts when the time increases by more than half the integration time, which is taken to be
+    the median of the positive time steps between rows.
+
+    :param times: Times of rows (s)
+    :return: slot index of each row, start time of each slot, integration time
+    """
+    intervals = numpy.diff(times)
+    intervals = intervals[intervals > 0.0]
+    integration_time = numpy.median(intervals) if len(intervals) > 0 else 0.0
+    new_slot = numpy.diff(times) > 0.5 * integration_time
+    slot = numpy.concatenate([[0], numpy.cumsum(new_slot)])
+    slot_times = times[numpy.concatenate([[0], numpy.flatnonzero(new_slot) + 1])]
+    return slot, slot_times, integration_time
+
+
+def _uvfits_metadata(hdul, antnum=None):
+    """ Read the frequencies, antennas, polarisation and phasecentre of a UVFITS file
+
+    :param hdul: FITS HDU list
+    :param antnum: the number of antenna
+    :return: dictionary
+    """
+    # Read Spectral Window
+    nspw = hdul[0].header['NAXIS5']
+    # Read Channel and Frequency Interval
+    freq_ref = hdul[0].header['CRVAL4']
+    delt_freq = hdul[0].header['CDELT4']
+    # Real the number of channels in one spectral window
+    channels = hdul[0].header['NAXIS4']
+    # Read Frequency or IF
+    freqhdulname = "AIPS FQ"
+    sdhu = hdul.index_of(freqhdulname)
+    if_freq = hdul[sdhu].data['IF FREQ'].ravel()
+    freq = if_freq[:nspw, numpy.newaxis] + freq_ref + delt_freq * numpy.arange(channels)[numpy.newaxis, :]
+    freq_delt = numpy.ones(channels) * delt_freq
+    
+    antennahdulname = "AIPS AN"
+    adhu = hdul.index_of(antennahdulname)
+    try:
+        antenna_name = hdul[adhu].data['ANNAME']
+        antenna_name = antenna_name.encode('ascii', 'ignore')
+    except ValueError:
+        antenna_name = None
+    
+    antenna_xyz = hdul[adhu].data['STABXYZ']
+    antenna_mount = hdul[adhu].data['MNTSTA']
+    antenna_offset = hdul[adhu].data['STAXOF']
+    try:
+        antenna_diameter = hdul[adhu].data['DIAMETER']
+    except (ValueError, KeyError):
+        antenna_diameter = None
+    # To reading some UVFITS with wrong numbers of antenna
+    if antnum is not None and antenna_name is not None:
+        antenna_name = antenna_name[:antnum]
+        antenna_xyz = antenna_xyz[:antnum]
+        antenna_mount = antenna_mount[:antnum]
+        antenna_offset = antenna_offset[:antnum]
+        if antenna_diameter is not None:
+            antenna_diameter = antenna_diameter[:antnum]
+    
+    nants = len(antenna_xyz)
+    
+    # Put offset into same shape as for MS
+    antenna_offset = numpy.c_[antenna_offset, numpy.zeros(nants), numpy.zeros(nants)]
+    
+    # Get polarisation info
+    npol = hdul[0].header['NAXIS3']
+    corr_type = numpy.arange(hdul[0].header['NAXIS3']) - (
+            hdul[0].header['CRPIX3'] - 1)
+    corr_type *= hdul[0].header['CDELT3']
+    corr_type += hdul[0].header['CRVAL3']
+    # xx yy xy yx
+    # These correspond to the CASA Stokes enumerations
+    if numpy.array_equal(corr_type, [1, 2, 3, 4]):
+        polarisation_frame = PolarisationFrame('stokesIQUV')
+    elif numpy.array_equal(corr_type, [1, 4]):
+        polarisation_frame = PolarisationFrame('stokesIV')
+    elif numpy.array_equal(corr_type, [1, 2]):
+        polarisation_frame = PolarisationFrame('stokesIQ')
+    elif numpy.array_equal(corr_type, [-1, -2, -3, -4]):
+        polarisation_frame = PolarisationFrame('circular')
+    elif numpy.array_equal(corr_type, [-1, -4]):
+        polarisation_frame = PolarisationFrame('circularnp')
+    elif numpy.array_equal(corr_type, [-5, -6, -7, -8]):
+        polarisation_frame = PolarisationFrame('linear')
+    elif numpy.array_equal(corr_type, [-5, -8]):
+        polarisation_frame = PolarisationFrame('linearnp')
+    else:
+        raise KeyError("Polarisation not understood: %s" % str(corr_type))
+    
+    configuration = Configuration(name='', data=None, location=None,
+                                  names=antenna_name, xyz=antenna_xyz,
+                                  mount=antenna_mount, frame=None,
+                                  receptor_frame=polarisation_frame,
+                                  diameter=antenna_diameter,
+                                  offset=antenna_offset, stations=antenna_name)
+    
+    # Get RA and DEC
+    phase_center_ra_degrees = float(hdul[0].header['CRVAL6'])
+    phase_center_dec_degrees = float(hdul[0].header['CRVAL7'])
+    
+    # Get phasecentres
+    phasecentre = SkyCoord(ra=phase_center_ra_degrees * u.deg,
+                           dec=phase_center_dec_degrees * u.deg, frame='icrs',
+                           equinox='J2000')
+    
+    return {'nspw': nspw, 'channels': channels, 'freq': freq, 'freq_delt': freq_delt, 'nants': nants,
+            'npol': npol, 'configuration': configuration, 'polarisation_frame': polarisation_frame,
+            'phasecentre': phasecentre}
+
+
+def _convert_uvfits_rows_to_blockvisibility(hdul, meta, times, integration_time, channum=None, startrow=0,
+                                            nrow=None):
+    """ Convert a range of rows of a UVFITS file to a list of BlockVisibility's, one per spectral window
+
+    :param hdul: FITS HDU list
+    :param meta: dictionary from _uvfits_metadata
+    :param times: Times of all rows (s) from _uvfits_times
+    :param integration_time: Integration time (s)
+    :param channum: range of channels e.g. range(17,32), default is None meaning all
+    :param startrow: First row
+    :param nrow: Number of rows
+    :return: list of BlockVisibility
+    """
+    if channum is None:
+        channum = range(meta['channels'])
+    channum = numpy.array(channum)
+    if nrow is None:
+        nrow = len(times) - startrow
+    rows = slice(startrow, startrow + nrow)
+    nspw, nants, npol = meta['nspw'], meta['nants'], meta['npol']
+    nchan = len(channum)
+    
+    # Find the time slot of each row
+    times = times[rows]
+    new_slot = numpy.diff(times) > 0.5 * integration_time
+    time_index = numpy.concatenate([[0], numpy.cumsum(new_slot)])
+    bv_times = times[numpy.concatenate([[0], numpy.flatnonzero(new_slot) + 1])]
+    ntimes = len(bv_times)
+    
+    # Decode the baseline numbers, 256 * ant1 + ant2 or 2048 * ant1 + ant2 + 65536 for more than 255 antennas
+    d = _uvfits_param_dict(hdul[0])
+    baseline = numpy.round(numpy.asarray(hdul[0].data['BASELINE'][rows])).astype('int')
+    large = baseline >= 65536
+    antenna1 = numpy.where(large, (baseline - 65536) // 2048, baseline // 256) - 1
+    antenna2 = numpy.where(large, (baseline - 65536) % 2048, baseline % 256) - 1
+    
+    if "UU" in d:
+        uvw = numpy.stack([hdul[0].data[key][rows] for key in ['UU', 'VV', 'WW']], axis=-1)
+    else:
+        uvw = numpy.stack([hdul[0].data[key][rows] for key in ['UU---SIN', 'VV---SIN', 'WW---SIN']], axis=-1)
+    uvw = constants.c.value * numpy.asarray(uvw, dtype='float')
+    
+    # DATA has axes [row, (ra), (dec), spw, channel, pol, complex]
+    _vis = numpy.asarray(hdul[0].data['DATA'][rows])
+    _vis = _vis.reshape([nrow, nspw, meta['channels'], npol, _vis.shape[-1]])[:, :, channum, ...]
+    
+    # Only cross-correlations between the selected antennas are kept. BlockVisibility holds a baseline at
+    # [antenna2, antenna1] with antenna2 > antenna1, so baselines given the other way round are conjugated
+    keep = (antenna1 != antenna2) & (antenna1 < nants) & (antenna2 < nants)
+    swap = antenna1 > antenna2
+    ant_lo = numpy.where(swap, antenna2, antenna1)[keep]
+    ant_hi = numpy.where(swap, antenna1, antenna2)[keep]
+    time_index = time_index[keep]
+    sign = numpy.where(swap, -1.0, 1.0)[keep]
+    uvw = uvw[keep] * sign[:, numpy.newaxis]
+    _vis = _vis[keep]
+    
+    bv_uvw = numpy.zeros([ntimes, nants, nants, 3])
+    bv_uvw[time_index, ant_hi, ant_lo, :] = uvw
+    bv_integration_time = numpy.repeat(integration_time, ntimes)
+    
+    vis_list = list()
+    for spw_index in range(nspw):
+        bv_vis = numpy.zeros([ntimes, nants, nants, nchan, npol]).astype('complex')
+        bv_flags = numpy.zeros([ntimes, nants, nants, nchan, npol]).astype('int')
+        bv_weight = numpy.zeros([ntimes, nants, nants, nchan, npol])
         
-        # Get phasecentres
-        phasecentre = SkyCoord(ra=phase_center_ra_degrees * u.deg,
-                               dec=phase_center_dec_degrees * u.deg, frame='icrs',
-                               equinox='J2000')
+        spw_vis = _vis[:, spw_index, ...]
+        values = spw_vis[..., 0] + 1j * spw_vis[..., 1]
+        values[swap[keep]] = numpy.conj(values[swap[keep]])
+        bv_vis[time_index, ant_hi, ant_lo, ...] = values
+        bv_weight[time_index, ant_hi, ant_lo, ...] = spw_vis[..., 2]
         
-        # Get UVW
-        d = param_dict(hdul[0])
-        if "UU" in d:
-            uu = hdul[0].data['UU']
-            vv = hdul[0].data['VV']
-            ww = hdul[0].data['WW']
-        else:
-            uu = hdul[0].data['UU---SIN']
-            vv = hdul[0].data['VV---SIN']
-            ww = hdul[0].data['WW---SIN']
-        _vis = hdul[0].data['DATA']
+        # Convert negative weights to flags
+        bv_flags[bv_weight < 0.0] = 1
+        bv_weight[bv_weight < 0.0] = 0.0
         
-        row = 0
-        nchan = len(channum)
-        vis_list = list()
-        for spw_index in range(nspw):
-            bv_vis = numpy.zeros([ntimes, nants, nants, nchan, npol]).astype('complex')
-            bv_flags = numpy.zeros([ntimes, nants, nants, nchan, npol]).astype('int')
-            bv_weight = numpy.zeros([ntimes, nants, nants, nchan, npol])
-            bv_uvw = numpy.zeros([ntimes, nants, nants, 3])
-            for time_index, time in enumerate(bv_times):
-                for antenna1 in range(nants - 1):
-                    for antenna2 in range(antenna1 + 1, nants):
-                        for channel_no, channel_index in enumerate(channum):
-                            for pol_index in range(npol):
-                                bv_vis[
-                                    time_index, antenna2, antenna1, channel_no, pol_index] = complex(
-                                    _vis[row, :, :, spw_index, channel_index, pol_index,
-                                    0],
-                                    _vis[row, :, :, spw_index, channel_index, pol_index,
-                                    1])
-                                bv_weight[
-                                    time_index, antenna2, antenna1, channel_no, pol_index] = _vis[
-                                                                                             row,
-                                                                                             :,
-                                                                                             :,
-                                                                                             spw_index,
-                                                                                             channel_index,
-                                                                                             pol_index,
-                                                                                             2]
-                        bv_uvw[time_index, antenna2, antenna1, 0] = uu[
-                                                                        row] * constants.c.value
-                        bv_uvw[time_index, antenna2, antenna1, 1] = vv[
-                                                                        row] * constants.c.value
-                        bv_uvw[time_index, antenna2, antenna1, 2] = ww[
-                                                                        row] * constants.c.value
-                        row += 1
-            
-            # Convert negative weights to flags
-            bv_flags[bv_weight < 0.0] = 1
-            bv_weight[bv_weight < 0.0] = 0.0
-            
-            vis_list.append(BlockVisibility(uvw=bv_uvw,
-                                            time=bv_times,
-                                            frequency=freq[spw_index][channum],
-                                            channel_bandwidth=freq_delt[channum],
-                                            vis=bv_vis, flags=bv_flags,
-                                            weight=bv_weight,
-                                            imaging_weight=bv_weight,
-                                            configuration=configuration,
-                                            phasecentre=phasecentre,
-                                            polarisation_frame=polarisation_frame))
+        vis_list.append(BlockVisibility(uvw=bv_uvw.copy(),
+                                        time=bv_times,
+                                        frequency=meta['freq'][spw_index][channum],
+                                        channel_bandwidth=meta['freq_delt'][channum],
+                                        vis=bv_vis, flags=bv_flags,
+                                        weight=bv_weight,
+                                        imaging_weight=bv_weight,
+                                        integration_time=bv_integration_time,
+                                        configuration=meta['configuration'],
+                                        phasecentre=meta['phasecentre'],
+                                        polarisation_frame=meta['polarisation_frame']))
     return vis_list
 
 
@@ -1169,30 +1430,186 @@ def create_visibility_from_uvfits(fitsname, channum=None, ack=False, antnum=None
                                                ack=ack, antnum=antnum)]
 
 
-def calculate_visibility_phasor(direction, vis):
+def calculate_visibility_phasor(direction, vis, cache=True):
     """ Calculate the phasor for a direction for a Visibility
 
-    :param direction:
-    :param vis:
-    :return:
+    If cache is True, the phasor is cached while vis exists, see set_phasor_cache_size. It must not be modified.
+
+    :param direction: SkyCoord of direction
+    :param vis: Visibility
+    :param cache: Use the phasor cache (True)
+    :return: phasor [nvis, 1]
     """
     l, m, n = skycoord_to_lmn(direction, vis.phasecentre)
-    phasor = simulate_point(vis.uvw, l, m)[..., numpy.newaxis]
-    return phasor
+
+    def calculate():
+        return simulate_point(vis.uvw, l, m)[..., numpy.newaxis]
+
+    if not cache:
+        return calculate()
+    return _phasor_cache.get(vis, ('vis',) + _phasor_key(l, m, vis), calculate)
 
 
-def calculate_blockvisibility_phasor(direction, vis):
+def calculate_blockvisibility_phasor(direction, vis, cache=True):
     """ Calculate the phasor for a component for a BlockVisibility
 
-    :param comp:
-    :param vis:
-    :return:
+    If cache is True, the phasor is cached while vis exists, see set_phasor_cache_size. It must not be modified.
+
+    :param direction: SkyCoord of direction
+    :param vis: BlockVisibility
+    :param cache: Use the phasor cache (True)
+    :return: phasor [ntimes, nant, nant, nchan, npol] (a read-only view)
+    """
+    return numpy.broadcast_to(_blockvisibility_phasor(direction, vis, cache=cache)[..., numpy.newaxis],
+                              vis.vis.shape)
+
+
+def _blockvisibility_phasor(direction, vis, cache=True):
+    """ Calculate the phasor for a direction for a BlockVisibility, without the polarisation axis
+
+    The phase is calculated once per baseline and time as a path length. For equally spaced channels, the
+    phasor for each channel is then the previous one times a constant step (an exp recurrence) rather than
+    an exp for each element.
+
+    :param direction: SkyCoord of direction
+    :param vis: BlockVisibility
+    :param cache: Use the phasor cache (True)
+    :return: phasor [ntimes, nant, nant, nchan]
     """
-    ntimes, nant, _, nchan, npol = vis.vis.shape
     k = numpy.array(vis.frequency) / constants.c.to('m s^-1').value
     l, m, n = skycoord_to_lmn(direction, vis.phasecentre)
-    uvw = vis.uvw[..., numpy.newaxis] * k
-    phasor = numpy.ones([ntimes, nant, nant, nchan, npol], dtype='complex')
-    for chan in range(nchan):
-        phasor[:, :, :, chan, :] = simulate_point(uvw[..., chan], l, m)[..., numpy.newaxis]
-    return phasor
+
+    def calculate():
+        s = numpy.array([l, m, numpy.sqrt(1 - l ** 2 - m ** 2) - 1.0])
+        phase = -2.0 * numpy.pi * numpy.dot(vis.uvw, s)
+        nchan = len(k)
+        phasor = numpy.empty(phase.shape + (nchan,), dtype='complex')
+        dk = (k[-1] - k[0]) / (nchan - 1) if nchan > 1 else 0.0
+        if nchan > 2 and numpy.allclose(k, k[0] + dk * numpy.arange(nchan), rtol=1e-14, atol=0.0):
+            step = numpy.exp(1j * phase * dk)
+            current = numpy.exp(1j * phase * k[0])
+            for chan in range(nchan):
+                # Restart from an exact value now and then to limit the accumulation of rounding errors
+                if chan > 0 and chan % 64 == 0:
+                    current = numpy.exp(1j * phase * k[chan])
+                phasor[..., chan] = current
+                current *= step
+        else:
+            for chan in range(nchan):
+                phasor[..., chan] = numpy.exp(1j * phase * k[chan])
+        return phasor
+
+    if not cache:
+        return calculate()
+    return _phasor_cache.get(vis, ('blockvis', k.tobytes()) + _phasor_key(l, m, vis), calculate)
+
+
+def _phasor_key(l, m, vis):
+    """ Key of the phasor for a direction: the direction cosines and a hash of the contents of the uvw
+
+    The hash ensures that a phasor is not reused after the uvw have been changed in place.
+
+    :param l: Direction cosine relative to the phase centre
+    :param m: Direction cosine relative to the phase centre
+    :param vis: Visibility or BlockVisibility
+    :return: tuple
+    """
+    uvw = numpy.ascontiguousarray(vis.uvw)
+    return float(l), float(m), uvw.shape, hashlib.blake2b(uvw, digest_size=16).digest()
+
+
+class _PhasorCache:
+    """ Least recently used cache of phasors, bounded in total size
+
+    An entry is only used for the same visibility object it was calculated for, and not after that has
+    been deleted. Entries for deleted visibilities are dropped when space is needed.
+    """
+
+    def __init__(self, maxbytes=2 ** 28):
+        """
+
+        :param maxbytes: Maximum total size of the cached phasors (bytes)
+        """
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, vis, key, calculate):
+        """ Get the phasor for key, calling calculate() if it is not cached
+
+        :param vis: Visibility or BlockVisibility the phasor is for
+        :param key: Key of the phasor
+        :param calculate: Function returning the phasor
+        :return: phasor (read-only)
+        """
+        key = (id(vis),) + key
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0]() is vis:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        phasor = calculate()
+        phasor.flags.writeable = False
+        with self.lock:
+            self._remove(key)
+            if phasor.nbytes <= self.maxbytes:
+                self.entries[key] = (weakref.ref(vis), phasor)
+                self.nbytes += phasor.nbytes
+                self.evict(self.maxbytes)
+        return phasor
+
+    def evict(self, maxbytes):
+        """ Remove the entries of deleted visibilities, then least recently used entries down to maxbytes
+
+        :param maxbytes: Maximum total size to keep (bytes)
+        """
+        for key in [key for key, entry in self.entries.items() if entry[0]() is None]:
+            self._remove(key)
+        while self.nbytes > maxbytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1].nbytes
+
+
+_phasor_cache = _PhasorCache()
+
+
+def set_phasor_cache_size(maxbytes):
+    """ Set the maximum total size of the cached phase rotation phasors
+
+    Phasors calculated by phaserotate_visibility are cached while the visibility exists, so that e.g. the
+    shift to each facet centre is calculated once per visibility. The cache is per process.
+
+    :param maxbytes: Maximum size (bytes), 0 disables the cache
+    """
+    with _phasor_cache.lock:
+        _phasor_cache.maxbytes = maxbytes
+        _phasor_cache.evict(maxbytes)
+
+
+@functools.lru_cache(maxsize=128)
+def _uvw_rotation_matrix(ra, dec, newra, newdec):
+    """ Matrix rotating uvw (as row vectors) from one phase centre to another via the global XYZ coordinates
+
+    :return: 3 x 3 matrix
+    """
+    xyz = uvw_to_xyz(numpy.identity(3), ha=-ra, dec=dec)
+    rotation = xyz_to_uvw(xyz, ha=-newra, dec=newdec)
+    rotation.flags.writeable = False
+    return rotation
+
+
+def _uvw_rotation(phasecentre, newphasecentre):
+    """ Matrix rotating uvw (as row vectors) from phasecentre to newphasecentre
+
+    :param phasecentre: SkyCoord of current phase centre
+    :param newphasecentre: SkyCoord of new phase centre
+    :return: 3 x 3 matrix
+    """
+    return _uvw_rotation_matrix(phasecentre.ra.rad, phasecentre.dec.rad, newphasecentre.ra.rad,
+                                newphasecentre.dec.rad)
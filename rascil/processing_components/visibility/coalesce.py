@@ -21,6 +21,7 @@ A typical use might be::
 __all__ = ['convert_visibility_to_blockvisibility',
            'convert_blockvisibility_to_visibility',
            'coalesce_visibility',
+           'coalesce_visibility_iterator',
            'decoalesce_visibility']
 
 import logging
@@ -28,15 +29,14 @@ import logging
 import numpy
 from astropy import constants
 
-from rascil.data_models.memory_data_models import Visibility, BlockVisibility
-from rascil.processing_components.util.array_functions import average_chunks, average_chunks2
-from rascil.processing_components.visibility.base import vis_summary, copy_visibility
+from rascil.data_models.memory_data_models import Visibility, BlockVisibility, BlockVisibilityTemplate
+from rascil.processing_components.visibility.base import vis_summary
 
 log = logging.getLogger('logger')
 
 
 def coalesce_visibility(vis: BlockVisibility, time_coal=0.0, frequency_coal=0.0, max_time_coal=100,
-                        max_frequency_coal=100, **kwargs) -> Visibility:
+                        max_frequency_coal=100, uvmax=None, **kwargs) -> Visibility:
     """ Coalesce the BlockVisibility data_models. The output format is a Visibility, as needed for imaging
 
     Coalesce by baseline-dependent averaging (optional). The number of integrations averaged goes as the ratio of the
@@ -52,6 +52,7 @@ def coalesce_visibility(vis: BlockVisibility, time_coal=0.0, frequency_coal=0.0,
     :param frequency_coal: Number of frequencies to coalesce
     :param max_time_coal: Maximum number of integrations to coalesce
     :param max_frequency_coal: Maximum number of frequency channels to coalesce
+    :param uvmax: Reference uv distance (metres) for the averaging factors (default: maximum in vis)
     :return: Coalesced visibility with  cindex and blockvis filled in
     """
 
@@ -64,14 +65,14 @@ def coalesce_visibility(vis: BlockVisibility, time_coal=0.0, frequency_coal=0.0,
         = average_in_blocks(vis.data['vis'], vis.data['flags'], vis.data['uvw'], vis.data['weight'], vis.data['imaging_weight'],
                             vis.time, vis.integration_time,
                             vis.frequency, vis.channel_bandwidth, time_coal, max_time_coal,
-                            frequency_coal, max_frequency_coal)
+                            frequency_coal, max_frequency_coal, uvmax=uvmax)
     coalesced_vis = Visibility(uvw=cuvw, flags=cflags, time=ctime, frequency=cfrequency,
                                channel_bandwidth=cchannel_bandwidth,
                                phasecentre=vis.phasecentre, antenna1=ca1, antenna2=ca2, vis=cvis,
                                weight=cwts, imaging_weight=cimwt,
                                configuration=vis.configuration, integration_time=cintegration_time,
                                polarisation_frame=vis.polarisation_frame, cindex=cindex,
-                               blockvis=vis, meta=vis.meta)
+                               blockvis=BlockVisibilityTemplate(vis), meta=vis.meta)
 
     log.debug(
         'coalesce_visibility: Created new Visibility for coalesced data_models, coalescence factors (t,f) = (%.3f,%.3f)'
@@ -83,6 +84,31 @@ def coalesce_visibility(vis: BlockVisibility, time_coal=0.0, frequency_coal=0.0,
     return coalesced_vis
 
 
+def coalesce_visibility_iterator(vis_iter, time_coal=0.0, frequency_coal=0.0, max_time_coal=100,
+                                 max_frequency_coal=100, uvmax=None, **kwargs):
+    """ Coalesce a stream of BlockVisibility's, such as the time chunks read by
+    create_blockvisibility_iterator_from_ms, yielding a coalesced Visibility for each
+
+    Only one chunk is held in memory at a time. Averaging does not cross chunk boundaries, so the chunks
+    should hold several times max_time_coal integrations. So that all chunks are averaged alike, the averaging
+    factors are scaled to the same uvmax: if not given, the maximum uv distance of the first chunk is used.
+
+    :param vis_iter: Iterator of BlockVisibility
+    :param time_coal: Number of times to coalesce
+    :param frequency_coal: Number of frequencies to coalesce
+    :param max_time_coal: Maximum number of integrations to coalesce
+    :param max_frequency_coal: Maximum number of frequency channels to coalesce
+    :param uvmax: Reference uv distance (metres) for the averaging factors
+    :return: Iterator of coalesced Visibility
+    """
+    for vis in vis_iter:
+        if uvmax is None:
+            uvmax = numpy.sqrt(numpy.max(numpy.sum(vis.uvw[..., 0:2] ** 2, axis=-1)))
+        yield coalesce_visibility(vis, time_coal=time_coal, frequency_coal=frequency_coal,
+                                  max_time_coal=max_time_coal, max_frequency_coal=max_frequency_coal, uvmax=uvmax,
+                                  **kwargs)
+
+
 def convert_blockvisibility_to_visibility(vis: BlockVisibility) -> Visibility:
     """ Convert the BlockVisibility data to Visibility with no coalescence
 
@@ -102,7 +128,7 @@ def convert_blockvisibility_to_visibility(vis: BlockVisibility) -> Visibility:
                                weight=cwts, imaging_weight=cimaging_wts,
                                configuration=vis.configuration, integration_time=cintegration_time,
                                polarisation_frame=vis.polarisation_frame, cindex=cindex,
-                               blockvis=vis, meta=vis.meta)
+                               blockvis=BlockVisibilityTemplate(vis), meta=vis.meta)
 
     log.debug('convert_visibility: Original %s, converted %s' % (vis_summary(vis),
                                                                  vis_summary(converted_vis)))
@@ -113,30 +139,52 @@ def convert_blockvisibility_to_visibility(vis: BlockVisibility) -> Visibility:
 def decoalesce_visibility(vis: Visibility, **kwargs) -> BlockVisibility:
     """ Decoalesce the visibilities to the original values (opposite of coalesce_visibility)
 
-    This relies upon the block vis and the index being part of the vis. Needs the index generated by coalesce_visibility
+    This relies upon the block template and the index being part of the vis. Needs the index generated by
+    coalesce_visibility. Each sample of the BlockVisibility is filled from the row it was coalesced into. Samples
+    with no row (e.g. the upper triangle of baselines after convert_blockvisibility_to_visibility) are filled
+    from the conjugate baseline if that has a row, and are otherwise flagged.
 
     :param vis: (Coalesced visibility)
     :return: BlockVisibility with vis and weight columns overwritten
     """
 
     assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
-    assert isinstance(vis.blockvis, BlockVisibility), "No blockvisibility in vis %r" % vis
+    assert vis.blockvis is not None, "No blockvisibility in vis %r" % vis
     assert vis.cindex is not None, "No reverse index in Visibility %r" % vis
 
+    template = vis.blockvis
+    if isinstance(template, BlockVisibility):
+        template = BlockVisibilityTemplate(template)
+
     log.debug('decoalesce_visibility: Created new Visibility for decoalesced data_models')
-    decomp_vis = copy_visibility(vis.blockvis)
+    decomp_vis = template.create_blockvisibility()
 
     vshape = decomp_vis.data['vis'].shape
-
-    npol = vshape[-1]
-    dvis = numpy.zeros(vshape, dtype='complex')
-    assert numpy.max(vis.cindex) < dvis.size
+    assert vis.cindex.size * vshape[-1] == decomp_vis.data['vis'].size, "Incorrect template used in decoalescing"
     assert numpy.max(vis.cindex) < vis.vis.shape[0], "Incorrect template used in decoalescing"
-    for i in range(dvis.size // npol):
-        decomp_vis.data['vis'].flat[i:i + npol] = vis.data['vis'][vis.cindex[i]]
-        decomp_vis.data['flags'].flat[i:i + npol] = vis.data['flags'][vis.cindex[i]]
-        decomp_vis.data['weight'].flat[i:i + npol] = vis.data['weight'][vis.cindex[i]]
-        decomp_vis.data['imaging_weight'].flat[i:i + npol] = vis.data['imaging_weight'][vis.cindex[i]]
+
+    # Original: loop over the samples, copying one row at a time
+    # Optimized: scatter all the rows at once
+    cindex = vis.cindex.reshape(vshape[:-1])
+    rows = cindex >= 0
+    # Samples with no row of their own take the conjugate of the baseline (a1, a2) if it has one
+    cindex_conj = numpy.swapaxes(cindex, 1, 2)
+    rows_conj = ~rows & (cindex_conj >= 0)
+    pol_conj = numpy.arange(vshape[-1])
+    if template.polarisation_frame.type in ['linear', 'circular']:
+        pol_conj = pol_conj[[0, 2, 1, 3]]
+
+    for col in ['vis', 'flags', 'weight', 'imaging_weight']:
+        decomp_vis.data[col][rows] = vis.data[col][cindex[rows]]
+        if col == 'vis':
+            decomp_vis.data[col][rows_conj] = numpy.conjugate(vis.data[col][cindex_conj[rows_conj]][:, pol_conj])
+        else:
+            decomp_vis.data[col][rows_conj] = vis.data[col][cindex_conj[rows_conj]][:, pol_conj]
+
+    missing = ~rows & ~rows_conj
+    decomp_vis.data['flags'][missing] = 1
+    decomp_vis.data['weight'][missing] = 0.0
+    decomp_vis.data['imaging_weight'][missing] = 0.0
 
     log.debug('decoalesce_visibility: Coalesced %s, decoalesced %s' % (vis_summary(vis),
                                                                        vis_summary(
@@ -146,23 +194,34 @@ def decoalesce_visibility(vis: Visibility, **kwargs) -> BlockVisibility:
 
 
 def average_in_blocks(vis, flags, uvw, wts, imaging_wts, times, integration_time, frequency, channel_bandwidth,
-                      time_coal=1.0, max_time_coal=100, frequency_coal=1.0, max_frequency_coal=100):
+                      time_coal=1.0, max_time_coal=100, frequency_coal=1.0, max_frequency_coal=100, uvmax=None):
     """ Average visibility in blocks
-    
-    :param vis:
-    :param flags:
-    :param uvw:
-    :param wts:
-    :param imaging_wts:
-    :param times:
-    :param integration_time:
-    :param frequency:
-    :param channel_bandwidth:
-    :param time_coal:
-    :param max_time_coal:
-    :param frequency_coal:
-    :param max_frequency_coal:
-    :return:
+
+    Baseline-dependent averaging: the averaging factors in time and frequency are calculated for each baseline,
+    and the baselines sharing the same factors are then averaged together by segmented reductions
+    (numpy.add.reduceat) over contiguous blocks of times and channels. The inputs are not modified.
+
+    The output rows are ordered by baseline (a2 outer, a1 inner) and then by [time chunk, frequency chunk].
+    Visibility, weight and imaging weight are averaged per polarisation using the flagged weights; time, frequency
+    and uvw are averaged using the polarisation-summed weights. Fully flagged chunks are zero. Integration time
+    and channel bandwidth are summed over the chunk.
+
+    :param vis: Visibility [ntimes, nant, nant, nchan, npol]
+    :param flags: Flags [ntimes, nant, nant, nchan, npol]
+    :param uvw: UVW in metres [ntimes, nant, nant, 3]
+    :param wts: Weights [ntimes, nant, nant, nchan, npol]
+    :param imaging_wts: Imaging weights [ntimes, nant, nant, nchan, npol]
+    :param times: Times [ntimes]
+    :param integration_time: Integration times [ntimes]
+    :param frequency: Frequencies [nchan]
+    :param channel_bandwidth: Channel bandwidths [nchan]
+    :param time_coal: Time coalescence factor
+    :param max_time_coal: Maximum number of integrations to coalesce
+    :param frequency_coal: Frequency coalescence factor
+    :param max_frequency_coal: Maximum number of channels to coalesce
+    :param uvmax: Reference uv distance for the averaging factors (default: maximum in uvw)
+    :return: cvis, cflags, cuvw, cwts, cimwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time,
+        cindex
     """
     # Calculate the averaging factors for time and frequency making them the same for all times
     # for this baseline
@@ -172,188 +231,151 @@ def average_in_blocks(vis, flags, uvw, wts, imaging_wts, times, integration_time
     # into rows like vis[npol] and with additional columns antenna1, antenna2, frequency
 
     ntimes, nant, _, nchan, npol = vis.shape
-
-    times.dtype = numpy.float64
-
-    # Original
-    # Pol independent weighting
-    # allpwtsgrid = numpy.sum(wts, axis=4)
-    # # Pol and frequency independent weighting
-    # allcpwtsgrid = numpy.sum(allpwtsgrid, axis=3)
-    # # Pol and time independent weighting
-    # alltpwtsgrid = numpy.sum(allpwtsgrid, axis=0)
-
-    # Optimized
     assert wts.shape == flags.shape
-    flagwts = wts
-    flagwts[flags > 0] = 0.0
+
+    # Flagged data carry no weight. The flagged weights are a copy so that the input is left alone.
+    flagwts = numpy.where(flags > 0, 0.0, wts)
     allpwtsgrid = numpy.einsum('ijklm->ijkl', flagwts, optimize=True)
-    allcpwtsgrid = numpy.einsum('ijkl->ijk', allpwtsgrid, optimize=True)
-    alltpwtsgrid = numpy.einsum('ijkl->jkl', allpwtsgrid, optimize=True)
 
     # Now calculate on a baseline basis the time and frequency averaging. We do this by looking at
-    # the maximum uv distance for all data and for a given baseline. The integration time and
-    # channel bandwidth are scale appropriately.
-    time_average = numpy.ones([nant, nant], dtype='int')
-    frequency_average = numpy.ones([nant, nant], dtype='int')
-    ua = numpy.arange(nant)
-
-    # Original
-    # uvmax = numpy.sqrt(numpy.max(uvw[..., 0] ** 2 + uvw[..., 1] ** 2 + uvw[..., 2] ** 2))
-    # for a2 in ua:
-    #     for a1 in ua:
-    #         if allpwtsgrid[:, a2, a1, :].any() > 0.0:
-    #             uvdist = numpy.max(numpy.sqrt(uvw[:, a2, a1, 0] ** 2 + uvw[:, a2, a1, 1] ** 2), axis=0)
-    #             if uvdist > 0.0:
-    #                 time_average[a2, a1] = min(max_time_coal,
-    #                                            max(1, int(round((time_coal * uvmax / uvdist)))))
-    #                 frequency_average[a2, a1] = min(max_frequency_coal,
-    #                                                 max(1, int(round(frequency_coal * uvmax / uvdist))))
-    #             else:
-    #                 time_average[a2, a1] = max_time_coal
-    #                 frequency_average[a2, a1] = max_frequency_coal
-
-    # Optimized
-    # Calculate uvdist instead of uvwdist
+    # the maximum uv distance for all data and for a given baseline.
     uvwd = uvw[..., 0:2]
     uvdist = numpy.einsum('ijkm,ijkm->ijk', uvwd, uvwd, optimize=True)
-    uvmax = numpy.sqrt(numpy.max(uvdist))
-
-    # uvdist = numpy.sqrt(numpy.einsum('ijkm,ijkm->ijk', uvw, uvw, optimize=True))
+    if uvmax is None:
+        uvmax = numpy.sqrt(numpy.max(uvdist))
     uvdist_max = numpy.sqrt(numpy.max(uvdist, axis=0))
+    baseline_wts = numpy.einsum('ijkl->jk', allpwtsgrid, optimize=True)
+
+    def averaging_factor(coal, max_coal):
+        average = numpy.full([nant, nant], max_coal, dtype='int')
+        mask = uvdist_max > 0.0
+        average[mask] = numpy.round(coal * uvmax / uvdist_max[mask])
+        average[baseline_wts == 0.0] = 1
+        return numpy.clip(average, 1, max_coal)
+
+    time_average = averaging_factor(time_coal, max_time_coal).flatten()
+    frequency_average = averaging_factor(frequency_coal, max_frequency_coal).flatten()
+
+    # The number of time and frequency chunks for each baseline determines the layout of the output:
+    # successive baselines each with [time_chunk_len, frequency_chunk_len] rows.
+    time_chunk_len = (ntimes + time_average - 1) // time_average
+    frequency_chunk_len = (nchan + frequency_average - 1) // frequency_average
+    nrows = time_chunk_len * frequency_chunk_len
+    rowstart = numpy.cumsum(nrows) - nrows
+    cnvis = int(numpy.sum(nrows))
 
-    allpwtsgrid_bool = numpy.einsum('ijklm->jk', flagwts, optimize=True)
-    mask = numpy.where(uvdist_max > 0.)
-    mask0 = numpy.where(uvdist_max <= 0.)
-    time_average[mask] = numpy.round((time_coal * uvmax / uvdist_max[mask]))
-    time_average.dtype = numpy.int64
-    time_average[mask0] = max_time_coal
-    numpy.putmask(time_average, allpwtsgrid_bool == 0, 0)
-    numpy.putmask(time_average, time_average < 1, 1)
-    numpy.putmask(time_average, time_average > max_time_coal, max_time_coal)
-    frequency_average[mask] = numpy.round((frequency_coal * uvmax / uvdist_max[mask]))
-    frequency_average.dtype = numpy.int64
-    frequency_average[mask0] = max_frequency_coal
-    numpy.putmask(frequency_average, allpwtsgrid_bool == 0, 0)
-    numpy.putmask(frequency_average, frequency_average < 1, 1)
-    numpy.putmask(frequency_average, frequency_average > max_frequency_coal, max_frequency_coal)
-
-    # See how many time chunks and frequency we need for each baseline. To do this we use the same averaging that
-    # we will use later for the actual data_models. This tells us the number of chunks required for each baseline.
-    frequency_grid, time_grid = numpy.meshgrid(frequency, times)
-    channel_bandwidth_grid, integration_time_grid = numpy.meshgrid(channel_bandwidth, integration_time)
-    cnvis = 0
-    time_chunk_len = numpy.ones([nant, nant], dtype='int')
-    frequency_chunk_len = numpy.ones([nant, nant], dtype='int')
-
-    for a2 in ua:
-        for a1 in ua:
-            if (time_average[a2, a1] > 0) & (frequency_average[a2, a1] > 0 & (allpwtsgrid[:, a2, a1, ...].any() > 0.0)):
-                time_chunks, _ = average_chunks(times, allcpwtsgrid[:, a2, a1], time_average[a2, a1])
-                time_chunk_len[a2, a1] = time_chunks.shape[0]
-                frequency_chunks, _ = average_chunks(frequency, alltpwtsgrid[a2, a1, :], frequency_average[a2, a1])
-                frequency_chunk_len[a2, a1] = frequency_chunks.shape[0]
-                nrows = time_chunk_len[a2, a1] * frequency_chunk_len[a2, a1]
-                cnvis += nrows
-
-    # Now we know enough to define the output coalesced arrays. The output will be
-    # successive a1, a2: [len_time_chunks[a2,a1], a2, a1, len_frequency_chunks[a2,a1]]
     ctime = numpy.zeros([cnvis])
     cfrequency = numpy.zeros([cnvis])
     cchannel_bandwidth = numpy.zeros([cnvis])
     cvis = numpy.zeros([cnvis, npol], dtype='complex')
-    cflags = numpy.zeros([cnvis, npol], dtype='int')
     cwts = numpy.zeros([cnvis, npol])
     cimwts = numpy.zeros([cnvis, npol])
     cuvw = numpy.zeros([cnvis, 3])
-    ca1 = numpy.zeros([cnvis], dtype='int')
-    ca2 = numpy.zeros([cnvis], dtype='int')
     cintegration_time = numpy.zeros([cnvis])
 
-    # For decoalescence we keep an index to map back to the original BlockVisibility
-    rowgrid = numpy.zeros([ntimes, nant, nant, nchan], dtype='int')
-    rowgrid.flat = range(rowgrid.size)
-
-    cindex = numpy.zeros([rowgrid.size], dtype='int')
-
-    # Now go through, chunking up the various arrays. Everything is converted into an array with
-    # axes [time, channel] and then it is averaged over time and frequency chunks for
-    # this baseline.
-    # To aid decoalescence we will need an index of which output elements a given input element
-    # contributes to. This is a many to one. The decoalescence will then just consist of using
-    # this index to extract the coalesced value that a given input element contributes towards.
-
-    visstart = 0
-    nrows = 0
-    for a2 in ua:
-        for a1 in ua:
-            nrows = time_chunk_len[a2, a1] * frequency_chunk_len[a2, a1]
-            rows = slice(visstart, visstart + nrows)
-
-            cindex.flat[rowgrid[:, a2, a1, :]] = numpy.array(range(visstart, visstart + nrows))
-
-            ca1[rows] = a1
-            ca2[rows] = a2
-
-            # Average over time and frequency for case where polarisation isn't an issue
-            def average_from_grid(arr):
-                return average_chunks2(arr, allpwtsgrid[:, a2, a1, :],
-                                       (time_average[a2, a1], frequency_average[a2, a1]))[0]
-
-            ctime[rows] = average_from_grid(time_grid).flatten()
-            cfrequency[rows] = average_from_grid(frequency_grid).flatten()
-
-            for axis in range(3):
-                uvwgrid = numpy.outer(uvw[:, a2, a1, axis], frequency / constants.c.value)
-                cuvw[rows, axis] = average_from_grid(uvwgrid).flatten()
-
-            # For some variables, we need the sum not the average
-            def sum_from_grid(arr):
-                result = average_chunks2(arr, allpwtsgrid[:, a2, a1, :],
-                                         (time_average[a2, a1], frequency_average[a2, a1]))
-                return result[0] * result[0].size
-
-            cintegration_time[rows] = sum_from_grid(integration_time_grid).flatten()
-            cchannel_bandwidth[rows] = sum_from_grid(channel_bandwidth_grid).flatten()
-
-            # For the polarisations we have to perform the time-frequency average separately for each polarisation
-            for pol in range(npol):
-                result = average_chunks2(vis[:, a2, a1, :, pol], wts[:, a2, a1, :, pol],
-                                         (time_average[a2, a1], frequency_average[a2, a1]))
-                cvis[rows, pol], cwts[rows, pol] = result[0].flatten(), result[1].flatten()
-
-            for pol in range(npol):
-                result = average_chunks2(wts[:, a2, a1, :, pol], wts[:, a2, a1, :, pol],
-                                         (time_average[a2, a1], frequency_average[a2, a1]))
-                cwts[rows, pol] = result[0].flatten()
-                cflags[rows, pol][cwts[rows, pol] <= 0.0] = 1
-
-            for pol in range(npol):
-                result = average_chunks2(imaging_wts[:, a2, a1, :, pol], wts[:, a2, a1, :, pol],
-                                         (time_average[a2, a1], frequency_average[a2, a1]))
-                cimwts[rows, pol] = result[0].flatten()
-
-            visstart += nrows
+    nbaselines = nant * nant
+    ca2, ca1 = numpy.divmod(numpy.arange(nbaselines), nant)
+    ca1 = numpy.repeat(ca1, nrows)
+    ca2 = numpy.repeat(ca2, nrows)
+
+    # For decoalescence we keep an index to map each input element [time, a2, a1, chan] back to
+    # the output row to which it contributes. This is a many to one.
+    cindex = numpy.zeros([ntimes, nbaselines, nchan], dtype='int')
+
+    # View the inputs with the two antenna axes as a single baseline axis
+    def baselines(arr):
+        return arr.reshape((ntimes, nbaselines) + arr.shape[3:])
+
+    vis, uvw, flagwts, imaging_wts, allpwtsgrid = \
+        baselines(vis), baselines(uvw), baselines(flagwts), baselines(imaging_wts), baselines(allpwtsgrid)
+    uvw_scale = frequency / constants.c.value
+
+    # All baselines with the same averaging factors are processed together
+    factors, group = numpy.unique(numpy.stack([time_average, frequency_average]), axis=1, return_inverse=True)
+    for ig, (tav, fav) in enumerate(factors.T):
+        bl = numpy.flatnonzero(group.flatten() == ig)
+        tstarts = numpy.arange(0, ntimes, tav)
+        fstarts = numpy.arange(0, nchan, fav)
+        ntc, nfc = len(tstarts), len(fstarts)
+
+        cindex[:, bl, :] = rowstart[bl][numpy.newaxis, :, numpy.newaxis] \
+                           + nfc * (numpy.arange(ntimes) // tav)[:, numpy.newaxis, numpy.newaxis] \
+                           + (numpy.arange(nchan) // fav)[numpy.newaxis, numpy.newaxis, :]
+        rows = (rowstart[bl][:, numpy.newaxis] + numpy.arange(ntc * nfc)[numpy.newaxis, :]).flatten()
+
+        # Block results have axes [time chunk, baseline, frequency chunk, ...]: reorder to the output rows
+        def to_rows(arr):
+            arr = numpy.broadcast_to(arr, (ntc, len(bl), nfc) + arr.shape[3:])
+            return numpy.swapaxes(arr, 0, 1).reshape((len(rows),) + arr.shape[3:])
+
+        cintegration_time[rows] = to_rows(numpy.add.reduceat(integration_time, tstarts)[:, numpy.newaxis,
+                                          numpy.newaxis])
+        cchannel_bandwidth[rows] = to_rows(numpy.add.reduceat(channel_bandwidth, fstarts)[numpy.newaxis,
+                                           numpy.newaxis, :])
+
+        bluvw = uvw[:, bl, numpy.newaxis, :] * uvw_scale[numpy.newaxis, numpy.newaxis, :, numpy.newaxis]
+        blwts = flagwts[:, bl, ...]
+        if tav == 1 and fav == 1:
+            # No averaging: this is just a reordering
+            ctime[rows] = to_rows(times[:, numpy.newaxis, numpy.newaxis])
+            cfrequency[rows] = to_rows(frequency[numpy.newaxis, numpy.newaxis, :])
+            cuvw[rows] = to_rows(bluvw)
+            cvis[rows] = to_rows(vis[:, bl, ...])
+            cwts[rows] = to_rows(blwts)
+            cimwts[rows] = to_rows(imaging_wts[:, bl, ...])
+        else:
+            # Time, frequency and uvw are averaged with the polarisation independent weights
+            blpwts = allpwtsgrid[:, bl, :]
+            ctime[rows] = to_rows(_average_blocks(times[:, numpy.newaxis, numpy.newaxis], blpwts, tstarts, fstarts))
+            cfrequency[rows] = to_rows(_average_blocks(frequency[numpy.newaxis, numpy.newaxis, :], blpwts,
+                                                       tstarts, fstarts))
+            cuvw[rows] = to_rows(_average_blocks(bluvw, blpwts[..., numpy.newaxis], tstarts, fstarts))
+            # Each polarisation is averaged with its own weights
+            cvis[rows] = to_rows(_average_blocks(vis[:, bl, ...], blwts, tstarts, fstarts))
+            cwts[rows] = to_rows(_average_blocks(blwts, blwts, tstarts, fstarts))
+            cimwts[rows] = to_rows(_average_blocks(imaging_wts[:, bl, ...], blwts, tstarts, fstarts))
+
+    cflags = numpy.where(cwts <= 0.0, 1, 0)
+
+    return cvis, cflags, cuvw, cwts, cimwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, \
+           cindex.flatten()
+
+
+def _average_blocks(arr, wts, tstarts, fstarts):
+    """ Weighted average of arr over contiguous blocks of times and channels
+
+    :param arr: Array [ntimes, nbaselines, nchan, ...] (or broadcastable to the shape of wts)
+    :param wts: Weights [ntimes, nbaselines, nchan, ...]
+    :param tstarts: Start index of each time block
+    :param fstarts: Start index of each channel block
+    :return: Averages [ntime_blocks, nbaselines, nchan_blocks, ...], zero where the weights sum to zero
+    """
 
-    assert cnvis == visstart, "Mismatch between number of rows in coalesced visibility %d and index %d" % \
-                              (cnvis, visstart)
+    def block_sum(a):
+        return numpy.add.reduceat(numpy.add.reduceat(a, tstarts, axis=0), fstarts, axis=2)
 
-    return cvis, cflags, cuvw, cwts, cimwts, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, cintegration_time, cindex
+    sumwts = block_sum(wts)
+    sumarr = block_sum(wts * arr)
+    return numpy.divide(sumarr, sumwts, out=numpy.zeros_like(sumarr), where=sumwts > 0.0)
 
 
 def convert_blocks(vis, flags, uvw, wts, imaging_wts, times, integration_time, frequency, channel_bandwidth):
     """ Convert with no averaging
-    
-    :param vis:
-    :param flags:
-    :param uvw:
-    :param wts:
-    :param imaging_wts:
-    :param times:
-    :param integration_time:
-    :param frequency:
-    :param channel_bandwidth:
-    :return:
+
+    The rows are ordered [time, baseline, channel] with the baselines a2 > a1 in the order (a2, a1) of
+    numpy.tril_indices.
+
+    :param vis: Visibility [ntimes, nant, nant, nchan, npol]
+    :param flags: Flags [ntimes, nant, nant, nchan, npol]
+    :param uvw: UVW in metres [ntimes, nant, nant, 3]
+    :param wts: Weights [ntimes, nant, nant, nchan, npol]
+    :param imaging_wts: Imaging weights [ntimes, nant, nant, nchan, npol]
+    :param times: Times [ntimes]
+    :param integration_time: Integration times [ntimes]
+    :param frequency: Frequencies [nchan]
+    :param channel_bandwidth: Channel bandwidths [nchan]
+    :return: cvis, cflags, cuvw, cwts, cimaging_weights, ctime, cfrequency, cchannel_bandwidth, ca1, ca2,
+        cintegration_time, cindex
     """
     # The input visibility is a block of shape [ntimes, nant, nant, nchan, npol]. We will map this
     # into rows like vis[npol] and with additional columns antenna1, antenna2, frequency
@@ -361,104 +383,38 @@ def convert_blocks(vis, flags, uvw, wts, imaging_wts, times, integration_time, f
     ntimes, nant, _, nchan, npol = vis.shape
     assert nchan == len(frequency)
 
-    cnvis = ntimes * nant * (nant - 1) * nchan // 2
-
-    # Now we know enough to define the output coalesced arrays. The shape will be
-    # succesive a1, a2: [len_time_chunks[a2,a1], a2, a1, len_frequency_chunks[a2,a1]]
-    # ctime1 = numpy.zeros([cnvis])
-    # cfrequency1 = numpy.zeros([cnvis])
-    # cchannel_bandwidth1 = numpy.zeros([cnvis])
-    # cvis1 = numpy.zeros([cnvis, npol], dtype='complex')
-    # cwts1 = numpy.zeros([cnvis, npol])
-    # cimaging_weights1 = numpy.ones([cnvis, npol])
-    # cuvw1 = numpy.zeros([cnvis, 3])
-    # cintegration_time1 = numpy.zeros([cnvis])
-
-    ca1 = numpy.zeros([cnvis], dtype='int')
-    ca2 = numpy.zeros([cnvis], dtype='int')
-
-    # ctime = numpy.zeros([cnvis])
-    # cfrequency = numpy.zeros([cnvis])
-    # cchannel_bandwidth = numpy.zeros([cnvis])
-    # cvis = numpy.zeros([cnvis, npol], dtype='complex')
-    # cwts = numpy.zeros([cnvis, npol])
-    # cimaging_weights = numpy.ones([cnvis, npol])
-    # cuvw = numpy.zeros([cnvis, 3])
-    # cintegration_time = numpy.zeros([cnvis])
-
-    # For decoalescence we keep an index to map back to the original BlockVisibility
-    rowgrid = numpy.zeros([ntimes, nant, nant, nchan], dtype='int')
-
-    rowgrid.flat = range(rowgrid.size)
-
-    cindex = numpy.zeros([rowgrid.size], dtype='int')
-
-    mask_rowgrid = numpy.zeros_like(rowgrid, dtype='bool')
-    mask_uvw = numpy.zeros_like(uvw, dtype='bool')
-    mask_vis = numpy.zeros_like(vis, dtype='bool')
-    mask_flags = numpy.zeros_like(flags, dtype='bool')
-    mask_wts = numpy.zeros_like(wts, dtype='bool')
-    mask_imaging_wts = numpy.zeros_like(imaging_wts, dtype='bool')
-    # Now go through, chunking up the various arrays. Everything is converted into an array with
-    # axes [time, channel] and then it is averaged over time and frequency chunks for
-    # this baseline.
-    # To aid decoalescence we will need an index of which output elements a given input element
-    # contributes to. This is a many to one. The decoalescence will then just consist of using
-    # this index to extract the coalesced value that a given input element contributes towards.
-    # row = 0
-    # for itime in range(ntimes):
-    #     for a1 in range(nant):
-    #         for a2 in range(a1 + 1, nant):
-    #             for chan in range(nchan):
-    #                 ca1[row] = a1
-    #                 ca2[row] = a2
-    #                 cfrequency[row] = frequency[chan]
-    #                 ctime[row] = times[itime]
-    #
-    #                 cuvw[row, :] = uvw[itime, a2, a1, :] * frequency[chan] / constants.c.value
-    #
-    #                 cindex.flat[rowgrid[itime, a2, a1, chan]] = row
-    #                 cintegration_time[row] = integration_time[itime]
-    #                 cchannel_bandwidth[row] = channel_bandwidth[chan]
-    #                 cvis[row, :] = vis[itime, a2, a1, chan, :]
-    #                 cwts[row, :] = wts[itime, a2, a1, chan, :]
-    #                 cimaging_weights[row, :] = imaging_wts[itime, a2, a1, chan, :]
-    #                 row += 1
-
-    for a1 in range(nant):
-        for a2 in range(a1 + 1, nant):
-            mask_uvw[:, a2, a1, :] = True
-            mask_vis[:, a2, a1, :, :] = True
-            mask_flags[:, a2, a1, :, :] = True
-            mask_wts[:, a2, a1, :, :] = True
-            mask_imaging_wts[:, a2, a1, :, :] = True
-            mask_rowgrid[:, a2, a1, :] = True
-
-    rowgrid_mask = numpy.argwhere(mask_rowgrid == True)
-    # uvw_mask.flat = range(len(uvw_mask))
-    ca2 = rowgrid_mask[:, 1]
-    ca1 = rowgrid_mask[:, 2]
-
-    # Recalcute the position
-    cindex.flat[rowgrid[rowgrid_mask[:, 0], rowgrid_mask[:, 1], rowgrid_mask[:, 2], rowgrid_mask[:, 3]]] = range(cnvis)
-
-    cfrequency = numpy.tile(frequency, ntimes * nant * (nant - 1) // 2)
-    cchannel_bandwidth = numpy.tile(channel_bandwidth, ntimes * nant * (nant - 1) // 2)
-
-    ctime = numpy.repeat(times, nchan * nant * (nant - 1) // 2)
-    cintegration_time = numpy.repeat(integration_time, nchan * nant * (nant - 1) // 2)
-
-    cuvw = (numpy.tile(uvw[mask_uvw].reshape(-1, 3), nchan)).reshape(-1, 3)
-    freq = numpy.repeat(cfrequency, 3).reshape(-1, 3)
-    cuvw[..., :] *= freq[:] / constants.c.value
-
-    cvis = vis[mask_vis].reshape(-1, npol)
-    cwts = wts[mask_wts].reshape(-1, npol)
-    cflags = flags[mask_flags].reshape(-1, npol)
-    cimaging_weights = imaging_wts[mask_imaging_wts].reshape(-1, npol)
+    # Original: build boolean masks the size of each input array selecting the baselines a2 > a1
+    # and extract the rows with them.
+    # Optimized: index the antenna axes directly with the lower triangle of baselines
+    a2, a1 = numpy.tril_indices(nant, -1)
+    nbaselines = len(a1)
+    cnvis = ntimes * nbaselines * nchan
+
+    ca1 = numpy.tile(numpy.repeat(a1, nchan), ntimes)
+    ca2 = numpy.tile(numpy.repeat(a2, nchan), ntimes)
+
+    # For decoalescence we keep an index to map back to the original BlockVisibility. The samples that do
+    # not have a row (upper triangle and autocorrelations) are marked -1.
+    cindex = numpy.full([ntimes, nant, nant, nchan], -1, dtype='int')
+    cindex[:, a2, a1, :] = numpy.arange(cnvis).reshape([ntimes, nbaselines, nchan])
+
+    cfrequency = numpy.tile(frequency, ntimes * nbaselines)
+    cchannel_bandwidth = numpy.tile(channel_bandwidth, ntimes * nbaselines)
+
+    ctime = numpy.repeat(times, nchan * nbaselines)
+    cintegration_time = numpy.repeat(integration_time, nchan * nbaselines)
+
+    cuvw = (uvw[:, a2, a1, numpy.newaxis, :] *
+            (frequency / constants.c.value)[numpy.newaxis, numpy.newaxis, :, numpy.newaxis]).reshape(-1, 3)
+
+    cvis = vis[:, a2, a1, ...].reshape(-1, npol)
+    cwts = wts[:, a2, a1, ...].reshape(-1, npol)
+    cflags = flags[:, a2, a1, ...].reshape(-1, npol)
+    cimaging_weights = imaging_wts[:, a2, a1, ...].reshape(-1, npol)
 
     return cvis, cflags, cuvw, cwts, cimaging_weights, ctime, cfrequency, cchannel_bandwidth, ca1, ca2, \
-           cintegration_time, cindex
+           cintegration_time, cindex.flatten()
+
 
 def convert_visibility_to_blockvisibility(vis: Visibility) -> BlockVisibility:
     """ Convert a Visibility to BlockVisibility format
@@ -13,9 +13,12 @@ A typical use would be to make a sequence of snapshot visibilitys::
 __all__ = ['visibility_gather', 'visibility_scatter',
            'visibility_gather_channel', 'visibility_scatter_channel',
            'visibility_gather_time', 'visibility_scatter_time',
-           'visibility_gather_w', 'visibility_scatter_w']
+           'visibility_gather_w', 'visibility_scatter_w',
+           'visibility_sort_order', 'visibility_rows_view']
 
+import copy
 import logging
+import weakref
 from typing import List
 
 import numpy
@@ -26,6 +29,103 @@ from rascil.processing_components.visibility.iterators import vis_timeslice_iter
 
 log = logging.getLogger('logger')
 
+# Column whose order makes the slices of an iterator contiguous
+_iterator_keys = {vis_timeslice_iter: 'time', vis_wslice_iter: 'w'}
+
+# Sort order of the rows of each visibility, kept while the visibility exists
+_sort_orders = weakref.WeakKeyDictionary()
+
+
+def visibility_sort_order(vis, key):
+    """ Order that sorts the rows of a visibility by time or w, or None if already sorted
+
+    The order is cached for the visibility, and checked before use since the data may have changed.
+
+    :param vis: Visibility
+    :param key: 'time' or 'w'
+    :return: index array or None
+    """
+    values = vis.time if key == 'time' else vis.w
+    if numpy.all(values[1:] >= values[:-1]):
+        return None
+    cached = _sort_orders.get(vis)
+    if cached is not None and cached[0] == key and len(cached[1]) == len(values):
+        order = cached[1]
+        sorted_values = values[order]
+        if numpy.all(sorted_values[1:] >= sorted_values[:-1]):
+            return order
+    order = numpy.argsort(values, kind='stable')
+    _sort_orders[vis] = (key, order)
+    return order
+
+
+def _slice_ranges(rowses, order=None):
+    """ Express the row selections as disjoint ranges of rows in increasing order
+
+    :param rowses: List of boolean row selections
+    :param order: Order of the rows (default is the current order)
+    :return: list of (start, stop) or None for empty slices, or None if the selections are not such ranges
+    """
+    ranges = list()
+    last = 0
+    for rows in rowses:
+        if order is not None:
+            rows = rows[order]
+        nrows = numpy.count_nonzero(rows)
+        if nrows == 0:
+            ranges.append(None)
+            continue
+        start = int(numpy.argmax(rows))
+        stop = start + nrows
+        if start < last or not numpy.all(rows[start:stop]):
+            return None
+        ranges.append((start, stop))
+        last = stop
+    return ranges
+
+
+def _scatter_layout(vis, vis_iter, vis_slices):
+    """ Find the rows of each slice, and if possible the ranges of rows in the original or sorted visibility
+
+    :param vis: Visibility
+    :param vis_iter: visibility iterator
+    :param vis_slices: Number of slices
+    :return: row selections, order of rows (None if unsorted), ranges (None if not possible)
+    """
+    rowses = list(vis_iter(vis, vis_slices=vis_slices))
+    ranges = _slice_ranges(rowses)
+    if ranges is not None or vis_iter not in _iterator_keys:
+        return rowses, None, ranges
+    order = visibility_sort_order(vis, _iterator_keys[vis_iter])
+    if order is None:
+        return rowses, None, None
+    return rowses, order, _slice_ranges(rowses, order)
+
+
+def visibility_rows_view(vis, rows):
+    """ Shallow copy of a visibility holding selected rows of the data
+
+    :param vis: Visibility or BlockVisibility
+    :param rows: slice (giving a view of the data) or index array (giving a copy)
+    :return: Visibility or BlockVisibility
+    """
+    newvis = copy.copy(vis)
+    newvis.data = vis.data[rows]
+    if isinstance(vis, Visibility):
+        newvis.blockvis = vis.blockvis
+        if vis.cindex is not None and len(vis.cindex) == vis.nvis:
+            newvis.cindex = vis.cindex[rows]
+        else:
+            newvis.cindex = None
+    return newvis
+
+
+def _same_data(a, b):
+    """ Are two arrays the same memory?
+    """
+    return a.__array_interface__['data'][0] == b.__array_interface__['data'][0] and a.shape == b.shape \
+        and a.strides == b.strides
+
 
 def visibility_scatter(vis: Visibility, vis_iter, vis_slices=1) -> List[Visibility]:
     """Scatter a visibility into a list of subvisibilities
@@ -33,6 +133,11 @@ def visibility_scatter(vis: Visibility, vis_iter, vis_slices=1) -> List[Visibili
     If vis_iter is over time then the type of the output visibilities will be the same as input
     If vis_iter is over w then the type of the output visibilities will always be Visibility
 
+    Where the slices are ranges of rows, the subvisibilities are views of the data of vis, so no data are
+    copied and changes to the subvisibilities (e.g. by predict) are seen in vis. For vis_wslice_iter and
+    vis_timeslice_iter the rows are sorted by w or time if needed: the subvisibilities are then views of one
+    sorted copy. Otherwise the rows of each slice are copied.
+
     :param vis: Visibility
     :param vis_iter: visibility iterator
     :param vis_slices: Number of slices to be made
@@ -44,18 +149,20 @@ def visibility_scatter(vis: Visibility, vis_iter, vis_slices=1) -> List[Visibili
     if vis_slices == 1:
         return [vis]
     
-    visibility_list = list()
-    for i, rows in enumerate(vis_iter(vis, vis_slices=vis_slices)):
-        subvis = create_visibility_from_rows(vis, rows)
-        visibility_list.append(subvis)
+    rowses, order, ranges = _scatter_layout(vis, vis_iter, vis_slices)
+    if ranges is None:
+        return [create_visibility_from_rows(vis, rows) for rows in rowses]
     
-    return visibility_list
+    if order is not None:
+        vis = visibility_rows_view(vis, order)
+    return [None if r is None else visibility_rows_view(vis, slice(*r)) for r in ranges]
 
 
 def visibility_gather(visibility_list: List[Visibility], vis: Visibility, vis_iter, vis_slices=None) -> Visibility:
     """Gather a list of subvisibilities back into a visibility
     
-    The iterator setup must be the same as used in the scatter.
+    The iterator setup must be the same as used in the scatter. Subvisibilities that are still views of
+    vis are not copied.
 
     :param visibility_list: List of subvisibilities
     :param vis: Output visibility
@@ -70,18 +177,24 @@ def visibility_gather(visibility_list: List[Visibility], vis: Visibility, vis_it
     if vis_slices is None:
         vis_slices = len(visibility_list)
     
-    rowses = []
-    for i, rows in enumerate(vis_iter(vis, vis_slices=vis_slices)):
-        rowses.append(rows)
+    rowses, order, ranges = _scatter_layout(vis, vis_iter, vis_slices)
 
     for i, rows in enumerate(rowses):
         assert i < len(visibility_list), "Gather not consistent with scatter for slice %d" % i
-        sum_rows = numpy.sum(numpy.array(rows)).astype('int')
+        sum_rows = numpy.count_nonzero(rows)
         if visibility_list[i] is not None and sum_rows > 0:
             assert sum_rows == visibility_list[i].nvis, \
                 "Mismatch in number of rows (%d, %d) in gather for slice %d" % \
             (int(sum_rows), visibility_list[i].nvis, i)
-            vis.data[rows] = visibility_list[i].data[...]
+            if ranges is None:
+                vis.data[rows] = visibility_list[i].data[...]
+            elif order is None:
+                start, stop = ranges[i]
+                if not _same_data(visibility_list[i].data, vis.data[start:stop]):
+                    vis.data[start:stop] = visibility_list[i].data[...]
+            else:
+                start, stop = ranges[i]
+                vis.data[order[start:stop]] = visibility_list[i].data[...]
     
     return vis
 
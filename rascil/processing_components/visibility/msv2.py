@@ -56,6 +56,13 @@ try:
             super(WriteMs, self).__init__(filename, ref_time=ref_time, source_name=source_name, frame=frame,
                                           verbose=verbose)
 
+            # State for main table rows written in bulk by add_data_block
+            self._main_table = None
+            self._block_row = 0
+            self._block_scan = 1
+            self._block_sources = []
+            self._block_time_range = None
+
         def set_geometry(self, site_config, antennas, bits=8):
             """
             Given a station and an array of stands, set the relevant common observation
@@ -123,6 +130,91 @@ try:
                 MS_UVData(obstime, inttime, baselines, visibilities, pol=numericPol, source=source,
                           phasecentre=phasecentre,uvw=uvw))
 
+        def add_data_block(self, time, inttime, antenna1, antenna2, uvw, visibilities, flags=None, weights=None,
+                           band=0, source=None, phasecentre=None):
+            """
+            Append a block of integrations to the main table.
+
+            Unlike add_data_set, the rows are written straight away with one putcol per column, so an
+            observation can be written in chunks without holding all of it in memory. The rows are time
+            major and then baseline. Polarisations must be in the order set by set_stokes.
+
+            :param time: Start times of the integrations (s) [ntimes]
+            :param inttime: Integration times (s) [ntimes]
+            :param antenna1: First antenna of each baseline [nbaselines]
+            :param antenna2: Second antenna of each baseline [nbaselines]
+            :param uvw: uvw coordinates (m) [ntimes, nbaselines, 3], negated on writing as for add_data_set
+            :param visibilities: Visibilities [ntimes, nbaselines, nchan, nstokes]
+            :param flags: Flags, same shape as visibilities (default is unflagged)
+            :param weights: Weights [ntimes, nbaselines, nstokes] (default is unity)
+            :param band: Index of the spectral window, in the order of calls to set_frequency
+            :param source: Source name
+            :param phasecentre: Phasecentre of source (SkyCoord)
+            """
+            if len(self.data) > 0:
+                raise RuntimeError("Cannot mix add_data_set and add_data_block")
+            assert phasecentre is not None, "Must specify phase centre"
+
+            ntimes, nBL = visibilities.shape[:2]
+            nrow = ntimes * nBL
+            if flags is None:
+                flags = numpy.zeros(visibilities.shape, dtype='bool')
+            if weights is None:
+                weights = numpy.ones((ntimes, nBL, self.nStokes))
+
+            if self._main_table is None:
+                self._main_table = table("%s" % self.basename, self._main_table_desc(), nrow=0, ack=False)
+
+            names = [name for name, _ in self._block_sources]
+            if source in names:
+                sourceID = names.index(source)
+            else:
+                sourceID = len(names)
+                self._block_sources.append((source, [phasecentre.ra.rad, phasecentre.dec.rad]))
+
+            # Time range is kept in days for the OBSERVATION, SOURCE, and FIELD tables
+            tStart, tStop = numpy.min(time) / 86400.0, numpy.max(time) / 86400.0
+            if self._block_time_range is None:
+                self._block_time_range = [tStart, tStop]
+            else:
+                self._block_time_range = [min(self._block_time_range[0], tStart),
+                                          max(self._block_time_range[1], tStop)]
+
+            inttimeList = numpy.repeat(inttime, nBL)
+            timeList = numpy.repeat(time + inttime / 2.0, nBL)
+            scanList = numpy.repeat(self._block_scan + numpy.arange(ntimes), nBL)
+
+            tb = self._main_table
+            i = self._block_row
+            tb.addrows(nrow)
+            tb.putcol('UVW', -uvw.reshape([nrow, 3]), i, nrow)
+            tb.putcol('FLAG', flags.reshape([nrow] + list(visibilities.shape[2:])).astype('bool'), i, nrow)
+            tb.putcol('FLAG_CATEGORY', numpy.zeros((nrow, 1) + visibilities.shape[2:], dtype='bool'), i, nrow)
+            tb.putcol('WEIGHT', weights.reshape([nrow, self.nStokes]), i, nrow)
+            tb.putcol('SIGMA', numpy.full((nrow, self.nStokes), 9999.0), i, nrow)
+            tb.putcol('ANTENNA1', numpy.tile(antenna1, ntimes), i, nrow)
+            tb.putcol('ANTENNA2', numpy.tile(antenna2, ntimes), i, nrow)
+            tb.putcol('ARRAY_ID', numpy.zeros(nrow, dtype='int'), i, nrow)
+            tb.putcol('DATA_DESC_ID', numpy.full(nrow, band, dtype='int'), i, nrow)
+            tb.putcol('EXPOSURE', inttimeList, i, nrow)
+            tb.putcol('FEED1', numpy.zeros(nrow, dtype='int'), i, nrow)
+            tb.putcol('FEED2', numpy.zeros(nrow, dtype='int'), i, nrow)
+            tb.putcol('FIELD_ID', numpy.full(nrow, sourceID, dtype='int'), i, nrow)
+            tb.putcol('FLAG_ROW', numpy.zeros(nrow, dtype='bool'), i, nrow)
+            tb.putcol('INTERVAL', inttimeList, i, nrow)
+            tb.putcol('OBSERVATION_ID', numpy.zeros(nrow, dtype='int'), i, nrow)
+            tb.putcol('PROCESSOR_ID', numpy.full(nrow, -1, dtype='int'), i, nrow)
+            tb.putcol('SCAN_NUMBER', scanList, i, nrow)
+            tb.putcol('STATE_ID', numpy.full(nrow, -1, dtype='int'), i, nrow)
+            tb.putcol('TIME', timeList, i, nrow)
+            tb.putcol('TIME_CENTROID', timeList, i, nrow)
+            tb.putcol('DATA', visibilities.reshape([nrow] + list(visibilities.shape[2:])).astype('complex64'),
+                      i, nrow)
+            tb.flush()
+
+            self._block_row += nrow
+            self._block_scan += ntimes
+
         def write(self):
             """
             Fill in the Measurement Sets file with correct order.
@@ -135,15 +227,19 @@ try:
                 raise RuntimeError("No frequency setups defined")
             if self.nant == 0:
                 raise RuntimeError("No array geometry defined")
-            if len(self.data) == 0:
+            if len(self.data) == 0 and self._main_table is None:
                 raise RuntimeError("No visibility data defined")
 
-            # Sort the data set
-
-            self.data.sort()
-
             # Write the tables
-            self._write_main_table()
+            if self._main_table is not None:
+                # The rows have already been written by add_data_block
+                self._main_table.close()
+                self._main_table = None
+                self._write_data_description_table()
+            else:
+                # Sort the data set
+                self.data.sort()
+                self._write_main_table()
             self._write_antenna_table()
             self._write_polarization_table()
             self._write_observation_table()
@@ -385,10 +481,13 @@ try:
             tb = table("%s/OBSERVATION" % self.basename, desc, nrow=1, ack=False)
 
             # from astropy.time import Time
-            utcStart = Time(self.data[0].obstime, format='mjd',scale='utc')
-            tStart = utcStart.mjd
-            utcStop = Time(self.data[-1].obstime, format='mjd', scale='utc')
-            tStop = utcStop.mjd
+            if self._block_time_range is not None:
+                tStart, tStop = self._block_time_range
+            else:
+                utcStart = Time(self.data[0].obstime, format='mjd',scale='utc')
+                tStart = utcStart.mjd
+                utcStop = Time(self.data[-1].obstime, format='mjd', scale='utc')
+                tStop = utcStop.mjd
 
             tb.putcell('TIME_RANGE', 0, [tStart * 86400, tStop * 86400])
             tb.putcell('LOG', 0, 'Not provided')
@@ -447,6 +546,10 @@ try:
                         # name
                         nameList.append(name)
 
+            for name, pos in self._block_sources:
+                nameList.append(name)
+                posList.append(pos)
+
             nSource = len(nameList)
 
             # Save these for later since we might need them
@@ -650,22 +753,11 @@ try:
             tb.flush()
             tb.close()
 
-        def _write_main_table(self):
+        def _main_table_desc(self):
             """
-            Write the main table.
+            Table description of the main table.
             """
 
-            # Main
-
-            nBand = len(self.freq)
-
-            if self.site_config.location is not None:
-                longitude = self.site_config.location.geodetic[0].to('deg').value
-                latitude = self.site_config.location.geodetic[1].to('deg').value
-                altitude = self.site_config.location.height.to('meter').value
-
-            mapper = self.array[0]['mapper']
-
             col1 = tableutil.makearrcoldesc('UVW', 0.0, 1,
                                             comment='Vector with uvw coordinates (in meters)',
                                             keywords={'QuantumUnits': ['m', 'm', 'm'],
@@ -729,6 +821,25 @@ try:
             desc = tableutil.maketabdesc([col1, col2, col3, col4, col5, col6, col7, col8, col9,
                                           col10, col11, col12, col13, col14, col15, col16,
                                           col17, col18, col19, col20, col21, col22])
+            return desc
+
+        def _write_main_table(self):
+            """
+            Write the main table.
+            """
+
+            # Main
+
+            nBand = len(self.freq)
+
+            if self.site_config.location is not None:
+                longitude = self.site_config.location.geodetic[0].to('deg').value
+                latitude = self.site_config.location.geodetic[1].to('deg').value
+                altitude = self.site_config.location.height.to('meter').value
+
+            mapper = self.array[0]['mapper']
+
+            desc = self._main_table_desc()
             tb = table("%s" % self.basename, desc, nrow=0, ack=False)
 
             i = 0
@@ -834,8 +945,8 @@ try:
                     matrix.shape = (len(order), self.nStokes, nBand, self.nchan)
 
                     for j in range(nBand):
-                        fg = numpy.zeros((nBL, self.nStokes, self.nchan), dtype=numpy.bool)
-                        fc = numpy.zeros((nBL, self.nStokes, self.nchan, 1), dtype=numpy.bool)
+                        fg = numpy.zeros((nBL, self.nStokes, self.nchan), dtype=bool)
+                        fc = numpy.zeros((nBL, self.nStokes, self.nchan, 1), dtype=bool)
                         wg = numpy.ones((nBL, self.nStokes))
                         sg = numpy.ones((nBL, self.nStokes)) * 9999
 
@@ -867,6 +978,15 @@ try:
             tb.flush()
             tb.close()
 
+            self._write_data_description_table()
+
+        def _write_data_description_table(self):
+            """
+            Write the data description table.
+            """
+
+            nBand = len(self.freq)
+
             # Data description
 
             col1 = tableutil.makescacoldesc('FLAG_ROW', False,
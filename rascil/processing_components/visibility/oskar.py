@@ -0,0 +1,369 @@
+"""
+Native reader for OSKAR binary visibility files (format version 2)
+
+The file is memory-mapped and indexed once by hopping over the tag headers. Each visibility block is then
+decoded as a numpy view of the mapped file, so selecting a range of blocks reads only those blocks. The file
+is unmapped once the blocks have been read. See
+https://github.com/OxfordSKA/OSKAR for the definition of the format.
+"""
+
+__all__ = ['create_blockvisibility_from_oskar', 'create_blockvisibility_iterator_from_oskar',
+           'list_oskar_blocks']
+
+import contextlib
+import logging
+import mmap
+import os
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord, EarthLocation
+
+from rascil.data_models.memory_data_models import BlockVisibility, Configuration
+from rascil.data_models.polarisation import PolarisationFrame, ReceptorFrame
+
+log = logging.getLogger('logger')
+
+# Groups and tags used in visibility files
+_GROUP_VIS_HEADER = 11
+_GROUP_VIS_BLOCK = 12
+
+_TAG_TELESCOPE_PATH = 1
+_TAG_FLAG_CROSS_CORRELATION = 4
+_TAG_MAX_TIMES_PER_BLOCK = 7
+_TAG_NUM_TIMES = 8
+_TAG_NUM_CHANNELS = 10
+_TAG_NUM_STATIONS = 11
+_TAG_POLARISATION_TYPE = 12
+_TAG_PHASE_CENTRE_TYPE = 21
+_TAG_PHASE_CENTRE = 22
+_TAG_START_FREQUENCY = 23
+_TAG_FREQUENCY_INCREMENT = 24
+_TAG_CHANNEL_BANDWIDTH = 25
+_TAG_START_TIME = 26
+_TAG_TIME_INTERVAL = 27
+_TAG_TIME_INTEGRATION = 28
+_TAG_TELESCOPE_LON = 29
+_TAG_TELESCOPE_LAT = 30
+_TAG_TELESCOPE_ALT = 31
+_TAG_STATION_X = 32
+_TAG_STATION_Y = 33
+_TAG_STATION_Z = 34
+
+_TAG_BLOCK_DIMS = 1
+_TAG_BLOCK_CROSS_CORRELATION = 3
+_TAG_BLOCK_UU = 4
+_TAG_BLOCK_VV = 5
+_TAG_BLOCK_WW = 6
+
+# Bits of the data type byte
+_TYPE_CHAR, _TYPE_INT, _TYPE_SINGLE, _TYPE_DOUBLE, _TYPE_COMPLEX, _TYPE_MATRIX = 0, 1, 2, 3, 5, 6
+
+# Bits of the chunk flags byte
+_FLAG_BIG_ENDIAN, _FLAG_CRC, _FLAG_EXTENDED = 5, 6, 7
+
+_FILE_HEADER_SIZE = 64
+
+_TAG_HEADER_DTYPE = numpy.dtype([('magic', 'S3'), ('element_size', 'u1'), ('chunk_flags', 'u1'),
+                                 ('data_type', 'u1'), ('group', 'u1'), ('tag', 'u1'),
+                                 ('index', '<i4'), ('block_size', '<i8')])
+
+# OSKAR polarisation types that have a RASCIL equivalent
+_OSKAR_POLARISATION_FRAMES = {0: 'stokesIQUV', 1: 'stokesI', 10: 'linear'}
+
+
+def _tag_dtype(data_type, chunk_flags):
+    """ Numpy dtype of the elements of a tag payload
+
+    :param data_type: OSKAR data type byte
+    :param chunk_flags: OSKAR chunk flags byte
+    :return: numpy.dtype
+    """
+
+    def is_set(x, n):
+        return x & 2 ** n != 0
+
+    if is_set(data_type, _TYPE_CHAR):
+        return numpy.dtype('u1')
+    elif is_set(data_type, _TYPE_INT):
+        base = 'i4'
+    elif is_set(data_type, _TYPE_SINGLE):
+        base = 'c8' if is_set(data_type, _TYPE_COMPLEX) else 'f4'
+    elif is_set(data_type, _TYPE_DOUBLE):
+        base = 'c16' if is_set(data_type, _TYPE_COMPLEX) else 'f8'
+    else:
+        raise ValueError("Unknown OSKAR binary data type %d" % data_type)
+
+    byteorder = '>' if is_set(chunk_flags, _FLAG_BIG_ENDIAN) else '<'
+    return numpy.dtype(byteorder + base)
+
+
+@contextlib.contextmanager
+def _open_oskar_file(oskar_file):
+    """ Memory-map an OSKAR binary file and index its tags, unmapping the file on exit
+
+    Only the 20 byte tag headers are read, the payloads are left in the mapped file. The payloads must not be
+    used after exit: anything kept must be copied.
+
+    :param oskar_file: Name of OSKAR binary file
+    :return: context manager giving a dictionary of (group, tag, index): payload as numpy view
+    """
+    if not os.path.exists(oskar_file):
+        raise ValueError("OSKAR visibility file %s not found" % oskar_file)
+
+    with open(oskar_file, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    tags = dict()
+    try:
+        _index_oskar_tags(buffer, oskar_file, tags)
+        yield tags
+    finally:
+        tags.clear()
+        try:
+            buffer.close()
+        except BufferError:
+            # A view is still held, e.g. by a traceback: the mapping is released when that goes
+            log.debug("_open_oskar_file: %s is still in use, not closed" % oskar_file)
+
+
+def _index_oskar_tags(buffer, oskar_file, tags):
+    """ Index the tags of a mapped OSKAR binary file
+
+    :param buffer: Mapped file
+    :param oskar_file: Name of OSKAR binary file
+    :param tags: Dictionary to fill with (group, tag, index): payload as numpy view
+    """
+    if buffer[0:8] != b'OSKARBIN':
+        raise ValueError("%s is not an OSKAR binary file" % oskar_file)
+    if buffer[9] != 2:
+        raise ValueError("Only OSKAR binary format version 2 can be read: %s has version %d"
+                         % (oskar_file, buffer[9]))
+
+    offset = _FILE_HEADER_SIZE
+    header_size = _TAG_HEADER_DTYPE.itemsize
+    while offset + header_size <= len(buffer):
+        header = numpy.frombuffer(buffer, dtype=_TAG_HEADER_DTYPE, count=1, offset=offset)[0]
+        if header['magic'] != b'TBG':
+            break
+        if header['chunk_flags'] & 2 ** _FLAG_EXTENDED:
+            raise ValueError("Extended OSKAR tags are not supported")
+
+        data_size = int(header['block_size'])
+        if header['chunk_flags'] & 2 ** _FLAG_CRC:
+            data_size -= 4
+
+        dtype = _tag_dtype(header['data_type'], header['chunk_flags'])
+        payload = numpy.frombuffer(buffer, dtype=dtype, count=data_size // dtype.itemsize,
+                                   offset=offset + header_size)
+        tags[(int(header['group']), int(header['tag']), int(header['index']))] = payload
+        offset += header_size + int(header['block_size'])
+
+
+def _oskar_header(tags):
+    """ Decode the visibility header of an indexed OSKAR file
+
+    :param tags: Tag dictionary from _open_oskar_file
+    :return: dictionary of header values
+    """
+
+    def value(tag):
+        return tags[(_GROUP_VIS_HEADER, tag, 0)]
+
+    header = dict()
+    header['telescope_path'] = value(_TAG_TELESCOPE_PATH).tobytes().decode().rstrip('\x00')
+    header['cross_correlation'] = bool(value(_TAG_FLAG_CROSS_CORRELATION)[0])
+    header['max_times_per_block'] = int(value(_TAG_MAX_TIMES_PER_BLOCK)[0])
+    header['num_times'] = int(value(_TAG_NUM_TIMES)[0])
+    header['num_channels'] = int(value(_TAG_NUM_CHANNELS)[0])
+    header['num_stations'] = int(value(_TAG_NUM_STATIONS)[0])
+    header['polarisation_type'] = int(value(_TAG_POLARISATION_TYPE)[0])
+    header['phase_centre_type'] = int(value(_TAG_PHASE_CENTRE_TYPE)[0])
+    header['phase_centre'] = numpy.array(value(_TAG_PHASE_CENTRE), dtype='float')
+    header['start_frequency'] = float(value(_TAG_START_FREQUENCY)[0])
+    header['frequency_increment'] = float(value(_TAG_FREQUENCY_INCREMENT)[0])
+    header['channel_bandwidth'] = float(value(_TAG_CHANNEL_BANDWIDTH)[0])
+    header['start_time'] = float(value(_TAG_START_TIME)[0])
+    header['time_interval'] = float(value(_TAG_TIME_INTERVAL)[0])
+    header['time_integration'] = float(value(_TAG_TIME_INTEGRATION)[0])
+    header['telescope_lon'] = float(value(_TAG_TELESCOPE_LON)[0])
+    header['telescope_lat'] = float(value(_TAG_TELESCOPE_LAT)[0])
+    header['telescope_alt'] = float(value(_TAG_TELESCOPE_ALT)[0])
+    header['station_xyz'] = numpy.stack([value(_TAG_STATION_X), value(_TAG_STATION_Y),
+                                         value(_TAG_STATION_Z)], axis=1).astype('float')
+    header['num_blocks'] = (header['num_times'] + header['max_times_per_block'] - 1) \
+                           // header['max_times_per_block']
+    return header
+
+
+def list_oskar_blocks(oskar_file):
+    """ List the visibility blocks in an OSKAR visibility file
+
+    :param oskar_file: Name of OSKAR visibility file
+    :return: list of (start time index, number of times) for each block
+    """
+    blocks = list()
+    with _open_oskar_file(oskar_file) as tags:
+        header = _oskar_header(tags)
+        for block in range(header['num_blocks']):
+            key = (_GROUP_VIS_BLOCK, _TAG_BLOCK_DIMS, block)
+            blocks.append((int(tags[key][0]), int(tags[key][2])))
+    return blocks
+
+
+def _oskar_configuration(header):
+    """ Create a Configuration from the OSKAR header
+
+    The station coordinates are stored as offsets in the ECEF frame from the telescope position.
+
+    :param header: dictionary from _oskar_header
+    :return: Configuration
+    """
+    location = EarthLocation.from_geodetic(lon=header['telescope_lon'] * u.deg,
+                                           lat=header['telescope_lat'] * u.deg,
+                                           height=header['telescope_alt'] * u.m)
+    centre = numpy.array([location.x.to('m').value, location.y.to('m').value, location.z.to('m').value])
+    nants = header['num_stations']
+    names = numpy.array(['%s_%d' % (os.path.basename(header['telescope_path']), i) for i in range(nants)])
+    return Configuration(name=header['telescope_path'], location=location, names=names,
+                         xyz=header['station_xyz'] + centre, mount=numpy.repeat('XY', nants),
+                         frame='geocentric', receptor_frame=ReceptorFrame('linear'),
+                         diameter=numpy.zeros(nants), stations=numpy.arange(nants).astype('str'))
+
+
+def _read_oskar_blocks(tags, nants, nchan, npol, start_block, end_block):
+    """ Copy a range of OSKAR visibility blocks out of the mapped file
+
+    No views of the mapped file are left once this returns, so the file can be unmapped.
+
+    :param tags: Tag dictionary from _open_oskar_file
+    :param nants: Number of stations
+    :param nchan: Number of channels
+    :param npol: Number of polarisations
+    :param start_block: First block
+    :param end_block: One beyond the last block
+    :return: first time index, vis [time, ant, ant, chan, pol], uvw [time, ant, ant, 3]
+    """
+    # Baselines are ordered 0-1, 0-2, ... 1-2, ... and BlockVisibility holds them at [j, i]
+    antenna1, antenna2 = numpy.triu_indices(nants, k=1)
+    nbaselines = len(antenna1)
+
+    dims = [tags[(_GROUP_VIS_BLOCK, _TAG_BLOCK_DIMS, block)] for block in range(start_block, end_block)]
+    time_start = int(dims[0][0])
+    ntimes = int(sum(d[2] for d in dims))
+
+    bv_vis = numpy.zeros([ntimes, nants, nants, nchan, npol], dtype='complex')
+    bv_uvw = numpy.zeros([ntimes, nants, nants, 3])
+
+    for block, d in zip(range(start_block, end_block), dims):
+        block_start, block_chan_start, block_times, block_chans, block_baselines = [int(x) for x in d[:5]]
+        assert block_baselines == nbaselines, "Number of baselines in block %d is inconsistent" % block
+        assert block_chan_start == 0 and block_chans == nchan, "Channel blocking is not supported"
+        rows = slice(block_start - time_start, block_start - time_start + block_times)
+
+        # Cross-correlations are ordered [time, channel, baseline, polarisation]
+        cross = tags[(_GROUP_VIS_BLOCK, _TAG_BLOCK_CROSS_CORRELATION, block)]
+        cross = cross[:block_times * nchan * nbaselines * npol].reshape([block_times, nchan, nbaselines, npol])
+        bv_vis[rows, antenna2, antenna1, ...] = cross.transpose(0, 2, 1, 3)
+
+        # The sign convention for uvw is the same as the MS
+        for axis, tag in enumerate([_TAG_BLOCK_UU, _TAG_BLOCK_VV, _TAG_BLOCK_WW]):
+            coord = tags[(_GROUP_VIS_BLOCK, tag, block)][:block_times * nbaselines]
+            bv_uvw[rows, antenna2, antenna1, axis] = -coord.reshape([block_times, nbaselines])
+
+    return time_start, bv_vis, bv_uvw
+
+
+def _oskar_blocks_to_blockvisibility(tags, header, configuration, start_block, end_block):
+    """ Convert a range of OSKAR visibility blocks into a BlockVisibility
+
+    :param tags: Tag dictionary from _open_oskar_file
+    :param header: dictionary from _oskar_header
+    :param configuration: Configuration
+    :param start_block: First block
+    :param end_block: One beyond the last block
+    :return: BlockVisibility
+    """
+    if not header['cross_correlation']:
+        raise ValueError("OSKAR file does not contain cross-correlations")
+    if header['polarisation_type'] not in _OSKAR_POLARISATION_FRAMES:
+        raise ValueError("Unsupported OSKAR polarisation type %d" % header['polarisation_type'])
+    if header['phase_centre_type'] != 0:
+        raise ValueError("Unsupported OSKAR phase centre type %d" % header['phase_centre_type'])
+
+    polarisation_frame = PolarisationFrame(_OSKAR_POLARISATION_FRAMES[header['polarisation_type']])
+    npol = polarisation_frame.npol
+    nants = header['num_stations']
+    nchan = header['num_channels']
+
+    time_start, bv_vis, bv_uvw = _read_oskar_blocks(tags, nants, nchan, npol, start_block, end_block)
+    ntimes = bv_vis.shape[0]
+
+    antenna1, antenna2 = numpy.triu_indices(nants, k=1)
+    bv_weight = numpy.zeros([ntimes, nants, nants, nchan, npol])
+    bv_weight[:, antenna2, antenna1, ...] = 1.0
+    bv_flags = numpy.ones([ntimes, nants, nants, nchan, npol], dtype='int')
+    bv_flags[:, antenna2, antenna1, ...] = 0
+
+    # Times are the start of each integration, in seconds, as for create_blockvisibility_from_ms
+    bv_times = 86400.0 * header['start_time'] + header['time_interval'] * (time_start + numpy.arange(ntimes))
+    bv_integration_time = numpy.repeat(header['time_integration'], ntimes)
+
+    frequency = header['start_frequency'] + header['frequency_increment'] * numpy.arange(nchan)
+    channel_bandwidth = numpy.repeat(header['channel_bandwidth'], nchan)
+
+    ra, dec = header['phase_centre'][0:2]
+    phasecentre = SkyCoord(ra=ra * u.deg, dec=dec * u.deg, frame='icrs', equinox='J2000')
+
+    return BlockVisibility(uvw=bv_uvw,
+                           time=bv_times,
+                           frequency=frequency,
+                           channel_bandwidth=channel_bandwidth,
+                           vis=bv_vis,
+                           flags=bv_flags,
+                           weight=bv_weight,
+                           integration_time=bv_integration_time,
+                           imaging_weight=bv_weight.copy(),
+                           configuration=configuration,
+                           phasecentre=phasecentre,
+                           polarisation_frame=polarisation_frame,
+                           source=os.path.basename(header['telescope_path']))
+
+
+def create_blockvisibility_from_oskar(oskar_file, start_block=0, end_block=None) -> BlockVisibility:
+    """ Create a BlockVisibility from an OSKAR visibility file
+
+    The file is memory-mapped so only the selected blocks are read. Cross-correlations in Stokes IQUV, Stokes I or
+    linear polarisation are supported. Stations are named from the telescope model.
+
+    :param oskar_file: Name of OSKAR visibility file
+    :param start_block: First visibility block to read
+    :param end_block: One beyond the last block to read (default is all remaining blocks)
+    :return: BlockVisibility
+    """
+    with _open_oskar_file(oskar_file) as tags:
+        header = _oskar_header(tags)
+        if end_block is None:
+            end_block = header['num_blocks']
+        assert 0 <= start_block < end_block <= header['num_blocks'], \
+            "Invalid range of blocks %d to %d: file has %d blocks" % (start_block, end_block, header['num_blocks'])
+
+        configuration = _oskar_configuration(header)
+        return _oskar_blocks_to_blockvisibility(tags, header, configuration, start_block, end_block)
+
+
+def create_blockvisibility_iterator_from_oskar(oskar_file, nblocks=1):
+    """ Iterate through an OSKAR visibility file, yielding a BlockVisibility for every nblocks blocks
+
+    The file is indexed once and memory-mapped until the iterator is exhausted or closed.
+
+    :param oskar_file: Name of OSKAR visibility file
+    :param nblocks: Number of visibility blocks in each BlockVisibility
+    :return: Generator of BlockVisibility
+    """
+    assert nblocks > 0, "Number of blocks must be positive"
+    with _open_oskar_file(oskar_file) as tags:
+        header = _oskar_header(tags)
+        configuration = _oskar_configuration(header)
+        for start_block in range(0, header['num_blocks'], nblocks):
+            end_block = min(start_block + nblocks, header['num_blocks'])
+            yield _oskar_blocks_to_blockvisibility(tags, header, configuration, start_block, end_block)
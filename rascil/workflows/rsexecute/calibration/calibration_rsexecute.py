@@ -40,10 +40,12 @@ def calibrate_list_rsexecute_workflow(vis_list, model_vislist, gt_list=None,
     
     if global_solution and (len(vis_list) > 1):
         # The conversion is a no op if it's actually a blockvis
-        point_vislist = [rsexecute.execute(convert_visibility_to_blockvisibility, nout=1)(v) for v in vis_list]
-        point_modelvislist = [rsexecute.execute(convert_visibility_to_blockvisibility, nout=1)(mv)
-                              for mv in model_vislist]
-        point_vislist = [rsexecute.execute(divide_visibility, nout=1)(point_vislist[i], point_modelvislist[i])
+        point_vislist = [rsexecute.execute(convert_visibility_to_blockvisibility, nout=1, partition=i)(v)
+                         for i, v in enumerate(vis_list)]
+        point_modelvislist = [rsexecute.execute(convert_visibility_to_blockvisibility, nout=1, partition=i)(mv)
+                              for i, mv in enumerate(model_vislist)]
+        point_vislist = [rsexecute.execute(divide_visibility, nout=1, partition=i)(point_vislist[i],
+                                                                                   point_modelvislist[i])
                          for i, _ in enumerate(point_vislist)]
    
         global_point_vis_list = rsexecute.execute(visibility_gather_channel, nout=1)(point_vislist)
@@ -55,12 +57,13 @@ def calibrate_list_rsexecute_workflow(vis_list, model_vislist, gt_list=None,
             gt_list = [rsexecute.execute(solve, pure=True, nout=1)(global_point_vis_list,
                                                                    gt=gt_list[0])]
 
-        return [rsexecute.execute(apply, nout=1)(v, gt_list[0]) for v in vis_list], gt_list
+        return [rsexecute.execute(apply, nout=1, partition=i)(v, gt_list[0]) for i, v in enumerate(vis_list)], \
+               gt_list
     else:
         if gt_list is not None and len(gt_list) > 0:
-            gt_list = [rsexecute.execute(solve, pure=True, nout=1)(v, model_vislist[i], gt_list[i])
+            gt_list = [rsexecute.execute(solve, pure=True, nout=1, partition=i)(v, model_vislist[i], gt_list[i])
                        for i, v in enumerate(vis_list)]
         else:
-            gt_list = [rsexecute.execute(solve, pure=True, nout=1)(v, model_vislist[i])
+            gt_list = [rsexecute.execute(solve, pure=True, nout=1, partition=i)(v, model_vislist[i])
                        for i, v in enumerate(vis_list)]
-        return [rsexecute.execute(apply)(v, gt_list[i]) for i, v in enumerate(vis_list)], gt_list
+        return [rsexecute.execute(apply, partition=i)(v, gt_list[i]) for i, v in enumerate(vis_list)], gt_list
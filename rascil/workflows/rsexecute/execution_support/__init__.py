@@ -1 +1,3 @@
+from .local_pool import *
+from .memoize import *
 from .rsexecute import *
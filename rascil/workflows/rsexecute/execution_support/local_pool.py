@@ -0,0 +1,253 @@
+""" Lightweight thread or process pool backends for rsexecute
+
+These run the Dask.delayed graphs built by the rsexecute workflows on a concurrent.futures pool in this process,
+without a Dask distributed scheduler. A thread pool suits graphs dominated by numpy, numba or FFT kernels that
+release the GIL. A process pool suits pure python work: large arrays are passed to and from the worker processes
+through shared memory files rather than through the pool's pipes.
+
+Usually these are selected via rsexecute.set_client::
+
+    rsexecute.set_client(use_pool='processes', n_workers=8)
+
+"""
+
+__all__ = ['LocalPoolClient']
+
+import logging
+import mmap
+import os
+import pickle
+import tempfile
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+
+import cloudpickle
+import dask
+from dask import delayed
+from dask.delayed import Delayed
+import dask.multiprocessing
+import dask.threaded
+
+log = logging.getLogger('logger')
+
+# Buffers (e.g. numpy arrays) at least this large go through shared memory between processes
+SHARED_MEMORY_THRESHOLD = 2 ** 20
+
+# Where the shared memory files are placed
+_SHARED_MEMORY_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+# Alignment of buffers within a shared memory file
+_ALIGNMENT = 64
+
+
+def _shared_memory_dumps(obj):
+    """ Serialize for a process pool, placing large buffers in a shared memory file
+
+    The object is pickled with protocol 5 so that large contiguous buffers are handed out-of-band. These are
+    copied once into a new shared memory file, which is unlinked by the process that loads it.
+
+    :param obj: Object to serialize
+    :return: bytes
+    """
+    buffers = list()
+
+    def buffer_callback(buffer):
+        if buffer.raw().nbytes < SHARED_MEMORY_THRESHOLD:
+            return True
+        buffers.append(buffer)
+        return False
+
+    payload = cloudpickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    if len(buffers) == 0:
+        return pickle.dumps((payload, None, None), protocol=5)
+
+    layout = list()
+    offset = 0
+    for buffer in buffers:
+        nbytes = buffer.raw().nbytes
+        layout.append((offset, nbytes))
+        offset += _ALIGNMENT * ((nbytes + _ALIGNMENT - 1) // _ALIGNMENT)
+
+    fd, path = tempfile.mkstemp(prefix='rascil_', dir=_SHARED_MEMORY_DIR)
+    try:
+        os.ftruncate(fd, offset)
+        with mmap.mmap(fd, offset) as shm:
+            for buffer, (start, nbytes) in zip(buffers, layout):
+                shm[start:start + nbytes] = buffer.raw()
+    finally:
+        os.close(fd)
+    return pickle.dumps((payload, path, layout), protocol=5)
+
+
+def _shared_memory_loads(data):
+    """ Deserialize from _shared_memory_dumps
+
+    The arrays are reconstructed as writeable views of the mapped shared memory file, which is unlinked
+    immediately: the memory is released when the last array using it is deleted.
+
+    :param data: bytes
+    :return: Object
+    """
+    payload, path, layout = pickle.loads(data)
+    if path is None:
+        return cloudpickle.loads(payload)
+
+    fd = os.open(path, os.O_RDWR)
+    try:
+        shm = mmap.mmap(fd, 0)
+    finally:
+        os.close(fd)
+        os.unlink(path)
+    view = memoryview(shm)
+    return pickle.loads(payload, buffers=[view[start:start + nbytes] for start, nbytes in layout])
+
+
+def _leaves(graph):
+    """ List the Delayed objects in a graph held in (nested) lists and tuples
+
+    :param graph:
+    :return: list of Delayed
+    """
+    if isinstance(graph, Delayed):
+        return [graph]
+    elif isinstance(graph, (list, tuple)):
+        return [leaf for g in graph for leaf in _leaves(g)]
+    else:
+        return []
+
+
+def _replace_leaves(graph, values):
+    """ Replace the Delayed objects in a graph by the next of values
+
+    :param graph: (nested) lists and tuples of Delayed
+    :param values: iterator
+    :return: graph with the same structure
+    """
+    if isinstance(graph, Delayed):
+        return next(values)
+    elif isinstance(graph, (list, tuple)):
+        return type(graph)(_replace_leaves(g, values) for g in graph)
+    else:
+        return graph
+
+
+class LocalPoolClient():
+    """ Run Dask.delayed graphs on a local thread or process pool
+
+    This mimics the parts of the Dask distributed Client used by rsexecute: compute, persist, scatter, gather,
+    run, and close. Persisted and scattered data are held in this process.
+
+    :param processes: Use a process pool (False means a thread pool)
+    :param n_workers: Number of workers (default is the number of cores)
+    """
+
+    def __init__(self, processes=False, n_workers=None):
+        self.processes = processes
+        self.n_workers = n_workers or os.cpu_count()
+        self._pool = self._create_pool()
+        # Runs the schedulers for asynchronous compute
+        self._driver = ThreadPoolExecutor(1)
+
+    def _create_pool(self):
+        if self.processes:
+            return ProcessPoolExecutor(self.n_workers, mp_context=dask.multiprocessing.get_context())
+        else:
+            return ThreadPoolExecutor(self.n_workers)
+
+    def restart(self):
+        """ Replace the pool by a new one
+
+        New worker processes pick up the current environment, e.g. RASCIL_PROFILE_DIR.
+        """
+        self._pool.shutdown()
+        self._pool = self._create_pool()
+
+    def __repr__(self):
+        return "LocalPoolClient(%s, n_workers=%d)" % ('processes' if self.processes else 'threads', self.n_workers)
+
+    def get(self, dsk, keys, **kwargs):
+        """ Dask scheduler get function using the pool
+
+        :param dsk: Dask graph
+        :param keys: Keys to compute
+        :return: Values
+        """
+        if self.processes:
+            return dask.multiprocessing.get(dsk, keys, pool=self._pool, func_dumps=_shared_memory_dumps,
+                                            func_loads=_shared_memory_loads, **kwargs)
+        else:
+            return dask.threaded.get(dsk, keys, pool=self._pool, **kwargs)
+
+    def compute(self, graph, sync=False):
+        """ Compute a graph
+
+        :param graph: Delayed or (nested) lists of Delayed
+        :param sync: Return the values (True) or concurrent.futures Futures for them (False)
+        :return: Values or Futures, in the same structure as graph
+        """
+        if sync:
+            return dask.compute(graph, scheduler=self.get)[0]
+
+        whole = self._driver.submit(self.compute, graph, True)
+        if not isinstance(graph, (list, tuple)):
+            return whole
+
+        futures = [Future() for _ in graph]
+
+        def split(f):
+            if f.exception() is not None:
+                for future in futures:
+                    future.set_exception(f.exception())
+            else:
+                for future, value in zip(futures, f.result()):
+                    future.set_result(value)
+
+        whole.add_done_callback(split)
+        return type(graph)(futures)
+
+    def persist(self, graph, **kwargs):
+        """ Compute a graph, keeping the results as Delayed for use in further graphs
+
+        :param graph: Delayed or (nested) lists of Delayed
+        :param kwargs: Ignored (for compatibility with Client.persist)
+        :return: graph with the same structure, each Delayed now holding its value
+        """
+        leaves = _leaves(graph)
+        values = dask.compute(*leaves, scheduler=self.get)
+        persisted = [delayed(value, name=leaf.key, traverse=False) for leaf, value in zip(leaves, values)]
+        return _replace_leaves(graph, iter(persisted))
+
+    def scatter(self, data, **kwargs):
+        """ Scatter data: a no-op since the pool reads data from this process
+
+        :param data:
+        :param kwargs: Ignored (for compatibility with Client.scatter)
+        :return: data
+        """
+        return data
+
+    def gather(self, futures):
+        """ Gather the results of asynchronous compute
+
+        :param futures: Future or (nested) lists of Futures, other values are passed through
+        :return: values
+        """
+        if isinstance(futures, Future):
+            return futures.result()
+        elif isinstance(futures, (list, tuple)):
+            return type(futures)(self.gather(f) for f in futures)
+        else:
+            return futures
+
+    def run(self, func, *args, **kwargs):
+        """ Run a function once in this process
+
+        :param func: Function
+        :return: dictionary of result, keyed as for Client.run
+        """
+        return {'local': func(*args, **kwargs)}
+
+    def close(self):
+        """ Shut down the pools
+        """
+        self._driver.shutdown()
+        self._pool.shutdown()
@@ -0,0 +1,314 @@
+""" Memoization of rsexecute tasks in an on-disk HDF5 cache
+
+A memoized function looks up the hash of its function and arguments in a directory of HDF5 files before
+running. If found, the stored result is read instead of recomputing it. This is useful when reprocessing
+the same data with different settings: products such as the convolution functions, the PSF, and the weighting
+grids are computed once.
+
+The hash is made by dask.base.tokenize from the contents of the arguments, so identical data give a hit even in a
+new session. A function is identified by its module and name and, for closures, by the values it captures: if the
+code of a function changes, the old results must be removed with invalidate.
+
+The cache is usually set up via rsexecute::
+
+    rsexecute.set_cache('cache_dir', max_size=2e10)
+    gcfcf = rsexecute.execute(create_pswf_convolutionfunction, memoize=True)(model)
+
+The results are stored using the HDF5 helpers in rascil.data_models.data_model_helpers. The total size of the
+files is limited to max_size by removing the least recently used.
+"""
+
+__all__ = ['MemoizeCache']
+
+import dataclasses
+import functools
+import glob
+import logging
+import os
+import pickle
+import re
+import tempfile
+
+import h5py
+import numpy
+from dask.base import tokenize, normalize_token, normalize_object
+
+from rascil.data_models.dask_data_models import data_model_normalize_token
+from rascil.data_models.data_model_helpers import convert_image_to_hdf, convert_hdf_to_image, \
+    convert_griddata_to_hdf, convert_hdf_to_griddata, convert_convolutionfunction_to_hdf, \
+    convert_hdf_to_convolutionfunction, convert_blockvisibility_to_hdf, convert_hdf_to_blockvisibility, \
+    convert_visibility_to_hdf, convert_hdf_to_visibility, convert_gaintable_to_hdf, convert_hdf_to_gaintable, \
+    convert_skycomponent_to_hdf, convert_hdf_to_skycomponent, convert_skymodel_to_hdf, convert_hdf_to_skymodel
+from rascil.data_models.memory_data_models import Image, GridData, ConvolutionFunction, BlockVisibility, \
+    Visibility, GainTable, Skycomponent, SkyModel
+
+log = logging.getLogger('logger')
+
+_converters = {Image: convert_image_to_hdf,
+               GridData: convert_griddata_to_hdf,
+               ConvolutionFunction: convert_convolutionfunction_to_hdf,
+               BlockVisibility: convert_blockvisibility_to_hdf,
+               Visibility: convert_visibility_to_hdf,
+               GainTable: convert_gaintable_to_hdf,
+               Skycomponent: convert_skycomponent_to_hdf,
+               SkyModel: convert_skymodel_to_hdf}
+
+_readers = {'Image': convert_hdf_to_image,
+            'GridData': convert_hdf_to_griddata,
+            'ConvolutionFunction': convert_hdf_to_convolutionfunction,
+            'BlockVisibility': convert_hdf_to_blockvisibility,
+            'Visibility': convert_hdf_to_visibility,
+            'GainTable': convert_hdf_to_gaintable,
+            'Skycomponent': convert_hdf_to_skycomponent,
+            'SkyModel': convert_hdf_to_skymodel}
+
+
+def _convert_result_to_hdf(result, f):
+    """ Write a result to an HDF group
+
+    Data models are written using the data_model_helpers, tuples and lists as subgroups, numpy arrays as
+    datasets, and anything else is pickled.
+
+    :param result: Result of a function
+    :param f: HDF group
+    """
+    if type(result) in _converters:
+        _converters[type(result)](result, f)
+    elif isinstance(result, (tuple, list)):
+        f.attrs['RASCIL_cache_type'] = type(result).__name__
+        f.attrs['length'] = len(result)
+        for i, r in enumerate(result):
+            _convert_result_to_hdf(r, f.create_group('item%d' % i))
+    elif isinstance(result, numpy.ndarray) and result.dtype != object:
+        f.attrs['RASCIL_cache_type'] = 'ndarray'
+        f['data'] = result
+    else:
+        f.attrs['RASCIL_cache_type'] = 'pickle'
+        f['data'] = numpy.void(pickle.dumps(result))
+
+
+def _convert_hdf_to_result(f):
+    """ Read a result written by _convert_result_to_hdf
+
+    :param f: HDF group
+    :return: result
+    """
+    if 'RASCIL_data_model' in f.attrs:
+        return _readers[f.attrs['RASCIL_data_model']](f)
+    cache_type = f.attrs['RASCIL_cache_type']
+    if cache_type in ['tuple', 'list']:
+        items = [_convert_hdf_to_result(f['item%d' % i]) for i in range(f.attrs['length'])]
+        return tuple(items) if cache_type == 'tuple' else items
+    elif cache_type == 'ndarray':
+        return numpy.array(f['data'])
+    else:
+        return pickle.loads(f['data'][()].tobytes())
+
+
+class _NotDeterministic(Exception):
+    pass
+
+
+def _token(obj):
+    """ Deterministic token for the contents of an object
+
+    Containers and data models are traversed here so that any object without a deterministic dask
+    normalize_token is detected, rather than silently given a random token.
+
+    :param obj: Object
+    :return: token
+    """
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        return obj
+    elif isinstance(obj, (tuple, list)):
+        return type(obj).__name__, tuple(_token(o) for o in obj)
+    elif isinstance(obj, dict):
+        return 'dict', tuple((_token(k), _token(v)) for k, v in sorted(obj.items(), key=lambda kv: str(kv[0])))
+    elif callable(obj) and not isinstance(obj, type):
+        return _function_token(obj)
+    normalizer = normalize_token.dispatch(type(obj))
+    if normalizer is data_model_normalize_token:
+        return (type(obj).__name__,) + tuple((key, _token(value)) for key, value in sorted(obj.__dict__.items()))
+    elif normalizer is normalize_object and getattr(obj, '__dask_tokenize__', None) is None \
+            and not dataclasses.is_dataclass(obj):
+        raise _NotDeterministic("cannot hash %s" % type(obj).__name__)
+    return normalize_token(obj)
+
+
+def _function_token(func):
+    """ Deterministic token for a function
+
+    Functions defined at module level are identified by their module and name. Closures, such as the inner
+    functions of the rsexecute workflows, are identified additionally by their code and the values they capture.
+
+    :param func: Function
+    :return: token
+    """
+    if isinstance(func, functools.partial):
+        return 'partial', _function_token(func.func), _token(func.args), _token(func.keywords)
+    qualname = getattr(func, '__qualname__', None)
+    if qualname is None:
+        raise _NotDeterministic("cannot hash %s" % type(func).__name__)
+    code = getattr(func, '__code__', None)
+    if code is None or '<locals>' not in qualname:
+        return getattr(func, '__module__', None), qualname
+    cells = [_token(cell.cell_contents) for cell in func.__closure__ or []]
+    consts = [_token(c) for c in code.co_consts if not hasattr(c, 'co_code')]
+    return (func.__module__, func.__qualname__, code.co_code, consts, cells, _token(func.__defaults__),
+            _token(func.__kwdefaults__))
+
+
+def _function_name(func):
+    """ Name of a function suitable for use in a file name
+
+    :param func: Function or name
+    :return: str
+    """
+    name = func if isinstance(func, str) else getattr(func, '__name__', type(func).__name__)
+    return re.sub(r'[^A-Za-z0-9_]', '_', name)
+
+
+class MemoizeCache():
+    """ Directory of HDF5 files holding the results of memoized functions
+
+    The cache holds only its directory and size limit, so it can be sent to Dask workers. For Dask
+    clusters spanning several nodes, the directory must be on a shared file system.
+
+    :param directory: Directory for the cache files (default is a new temporary directory)
+    :param max_size: Maximum total size of the cache files in bytes (1e10)
+    """
+
+    def __init__(self, directory=None, max_size=1e10):
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix='rascil_cache_')
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_size = max_size
+
+    def __repr__(self):
+        return "MemoizeCache(%s, max_size=%g)" % (self.directory, self.max_size)
+
+    def key(self, func, *args, **kwargs):
+        """ Content hash of a function call
+
+        :param func: Function
+        :return: key (str), or None if the arguments cannot be hashed deterministically
+        """
+        try:
+            return tokenize(_function_token(func), _token(args), _token(kwargs))
+        except (_NotDeterministic, RecursionError) as err:
+            log.debug("MemoizeCache: not memoizing %s: %s" % (_function_name(func), err))
+            return None
+
+    def _filename(self, func, key):
+        return os.path.join(self.directory, '%s-%s.hdf5' % (_function_name(func), key))
+
+    def get(self, func, key):
+        """ Read a result from the cache
+
+        :param func: Function
+        :param key: key from MemoizeCache.key
+        :return: (True, result) if found, else (False, None)
+        """
+        filename = self._filename(func, key)
+        try:
+            with h5py.File(filename, 'r') as f:
+                result = _convert_hdf_to_result(f)
+        except (OSError, KeyError):
+            return False, None
+        # Mark as recently used
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+        return True, result
+
+    def put(self, func, key, result):
+        """ Write a result to the cache, then evict the least recently used files if over max_size
+
+        The file is written under a temporary name and then renamed so that concurrent readers
+        never see a partial file.
+
+        :param func: Function
+        :param key: key from MemoizeCache.key
+        :param result: Result of the function
+        """
+        filename = self._filename(func, key)
+        tmpname = None
+        try:
+            fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            os.close(fd)
+            with h5py.File(tmpname, 'w') as f:
+                _convert_result_to_hdf(result, f)
+            os.replace(tmpname, filename)
+        except Exception as err:
+            log.warning("MemoizeCache: cannot cache result of %s: %s" % (_function_name(func), err))
+            if tmpname is not None and os.path.exists(tmpname):
+                os.remove(tmpname)
+            return
+        self.evict()
+
+    def size(self):
+        """ Total size of the cache files in bytes
+
+        :return: int
+        """
+        return sum(os.path.getsize(f) for f in glob.glob(os.path.join(self.directory, '*.hdf5')))
+
+    def evict(self, max_size=None):
+        """ Remove the least recently used files until the total size is at most max_size
+
+        :param max_size: Size to reduce to (default is self.max_size)
+        """
+        max_size = self.max_size if max_size is None else max_size
+        files = list()
+        for filename in glob.glob(os.path.join(self.directory, '*.hdf5')):
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, filename))
+        total = sum(f[1] for f in files)
+        for mtime, size, filename in sorted(files):
+            if total <= max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def invalidate(self, func=None):
+        """ Remove the cached results of a function, or all results
+
+        :param func: Function or its name (default is all functions)
+        """
+        pattern = '*.hdf5' if func is None else '%s-*.hdf5' % _function_name(func)
+        for filename in glob.glob(os.path.join(self.directory, pattern)):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def memoize(self, func):
+        """ Wrap a function so that its results are looked up in and saved to the cache
+
+        :param func: Function
+        :return: Wrapped function
+        """
+        cache = self
+
+        @functools.wraps(func)
+        def memoized(*args, **kwargs):
+            key = cache.key(func, *args, **kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+            found, result = cache.get(func, key)
+            if found:
+                log.debug("MemoizeCache: using cached result of %s" % _function_name(func))
+                return result
+            result = func(*args, **kwargs)
+            cache.put(func, key, result)
+            return result
+
+        return memoized
@@ -10,10 +10,16 @@ import time
 
 from tabulate import tabulate
 
+import dask
 from dask import delayed, optimize
+from dask.delayed import Delayed
 from dask.distributed import wait
 from distributed import Client, LocalCluster
 
+from rascil.processing_components.util import profiling
+from rascil.workflows.rsexecute.execution_support.local_pool import LocalPoolClient
+from rascil.workflows.rsexecute.execution_support.memoize import MemoizeCache
+
 log = logging.getLogger("logger")
 
 # Support daliuge's delayed function, make it fail if not available but used
@@ -123,6 +129,23 @@ def findNodes(c):
     return [c.scheduler_info()['workers'][name]['host'] for name in c.scheduler_info()['workers'].keys()]
 
 
+class _PinnedDelayed(Delayed):
+    """ Delayed whose outputs are selected on the worker preferred for it
+
+    Without this, the getitem tasks created by indexing a Delayed with nout > 1 could run on any worker, and
+    so move all the outputs there.
+    """
+    __slots__ = ('_worker',)
+
+    def __init__(self, value, worker):
+        super().__init__(value.key, value.dask, length=value._length, layer=value._layer)
+        self._worker = worker
+
+    def __getitem__(self, index):
+        with dask.annotate(workers=[self._worker], allow_other_workers=True):
+            return super().__getitem__(index)
+
+
 class _rsexecutebase():
     """ Initialise rsexecute framework
 
@@ -174,17 +197,43 @@ class _rsexecutebase():
         self._client = client
         self._verbose = verbose
         self._optimize = optimize
-
-    def execute(self, func, *args, **kwargs):
+        if not hasattr(self, '_cache'):
+            self._cache = None
+        self._locality = False
+        self._partition_workers = dict()
+        self._workers = None
+        self._threads_per_task = None
+
+    def execute(self, func, *args, memoize=False, partition=None, **kwargs):
         """ Wrap for immediate or deferred execution
 
         Passes through if dask is not being used
 
+        If memoize is True and a cache has been set with set_cache, the result is looked up in the cache
+        using a hash of the function and the contents of its arguments, and computed only if not found.
+
+        If partition is set and locality is enabled (see set_client), the task is run on the worker holding
+        that partition of the data, e.g. the index in vis_list. All the tasks for one partition then run on the
+        same worker so that only their (small) results, such as images, need to be moved.
+
         :param args:
+        :param memoize: Memoize the results of func (False)
+        :param partition: Index of the data partition used by this task (None)
         :param kwargs:
         :return: delayed func or func
         """
+        if memoize and self._cache is not None:
+            func = self._cache.memoize(func)
         if self._using_dask:
+            worker = self.partition_worker(partition)
+            if worker is not None:
+                delayed_func = delayed(func, *args, **kwargs)
+
+                def pinned(*fargs, **fkwargs):
+                    with dask.annotate(workers=[worker], allow_other_workers=True):
+                        return _PinnedDelayed(delayed_func(*fargs, **fkwargs), worker)
+
+                return pinned
             return delayed(func, *args, **kwargs)
         elif self._using_dlg:
             return dlg_delayed(func, *args, **kwargs)
@@ -203,30 +252,47 @@ class _rsexecutebase():
         else:
             return 'function'
 
-    def set_client(self, client=None, use_dask=True, use_dlg=False, verbose=False, optim=True, **kwargs):
+    def set_client(self, client=None, use_dask=True, use_dlg=False, verbose=False, optim=True, use_pool=None,
+                   locality=False, **kwargs):
         """Set the Dask/DALiuGE client to be used
 
         If you want to customise the Client or use an externally defined Scheduler use get_dask_client and pass it in.
 
+        On a single node, the Dask.delayed graphs can instead be run on a local pool, without a Dask scheduler::
+
+            rsexecute.set_client(use_pool='threads', n_workers=16)
+
         :param use_dask: Use Dask?
         :param client: If None and use_dask is True, a client will be created otherwise the client is None
         :param use_dlg: Use Daliuge to execute graphs?
         :param verbose: Be verbose in output
         :param optim: Use dask.optimize via rsexecute.optimize function.
+        :param use_pool: Run Dask graphs on a local pool of 'threads' or 'processes' (None)
+        :param locality: Keep the tasks for each data partition on one Dask worker (False)
+        :param kwargs: For Client, or n_workers for the local pool
         :return:
         """
         if bool(use_dask) and bool(use_dlg):
             raise ValueError('use_dask and use_dlg cannot be specified together')
+        if use_pool is not None and use_pool not in ['threads', 'processes']:
+            raise ValueError("use_pool must be 'threads' or 'processes': %s" % use_pool)
+        if use_pool is not None and bool(use_dlg):
+            raise ValueError('use_pool and use_dlg cannot be specified together')
 
-        if isinstance(self._client, Client):
+        if isinstance(self._client, (Client, LocalPoolClient)):
             if self._verbose:
                 print("Removing existing client")
             self.client.close()
 
-        if use_dask:
+        if use_pool is not None:
+            client = LocalPoolClient(processes=(use_pool == 'processes'), n_workers=kwargs.get('n_workers', None))
+            self._set_state(True, False, client, verbose, optim)
+            self.start_time = time.time()
+        elif use_dask:
             client = client or Client(**kwargs)
             assert isinstance(client, Client)
             self._set_state(True, False, client, verbose, optim)
+            self._locality = locality
             self._client.profile()
             self._client.get_task_stream()
             self.start_time = time.time()
@@ -236,7 +302,7 @@ class _rsexecutebase():
         else:
             self._set_state(False, False, None, verbose, optim)
         if self._verbose:
-            print('rsexecute.set_client: defined Dask Client')
+            print('rsexecute.set_client: defined client %s' % self._client)
 
     def compute(self, value, sync=False):
         """Get the actual value
@@ -255,7 +321,10 @@ class _rsexecutebase():
                 return value.compute()
             else:
                 future = self.client.compute(value, sync=sync)
-                wait(future)
+                if isinstance(self.client, LocalPoolClient):
+                    self.client.gather(future)
+                else:
+                    wait(future)
                 if self._verbose:
                     duration = time.time() - start
                     log.debug("rsexecute.compute: Execution using Dask took %.3f seconds" % duration)
@@ -272,12 +341,19 @@ class _rsexecutebase():
 
         The graphs are placed on the workers but not computed
 
+        If locality is enabled, each element of a list is persisted on the worker for its partition
+        (see partition_worker).
+
         No-op if not using_dask
 
         :param graph:
         :return:
         """
         if self.using_dask and self.client is not None:
+            if self._locality and isinstance(graph, list) and 'workers' not in kwargs:
+                return [self.client.persist(g, workers=[self.partition_worker(i)], allow_other_workers=True,
+                                            **kwargs)
+                        for i, g in enumerate(graph)]
             return self.client.persist(graph, **kwargs)
         else:
             return graph
@@ -340,13 +416,19 @@ class _rsexecutebase():
         """ Close the client
 
         """
-        if self._using_dask and isinstance(self._client, Client):
+        if self._using_dask and isinstance(self._client, LocalPoolClient):
+            self._client.close()
+            self._client = None
+        elif self._using_dask and isinstance(self._client, Client):
             if self._verbose:
                 print('rsexcute.close: closed down Dask Client')
             if self._client.cluster is not None:
                 self._client.cluster.close()
             self._client.close()
             self._client = None
+        self._partition_workers = dict()
+        self._workers = None
+        self._threads_per_task = None
 
     def init_statistics(self):
         """ Initialise the profile and task stream info
@@ -356,7 +438,7 @@ class _rsexecutebase():
         :return:
         """
         self.start_time = time.time()
-        if self._using_dask:
+        if self._using_dask and isinstance(self._client, Client):
             self._client.profile()
             self._client.get_task_stream()
 
@@ -369,7 +451,7 @@ class _rsexecutebase():
         :param name: prefix to name e.g. dask
         """
 
-        if self._using_dask:
+        if self._using_dask and isinstance(self._client, Client):
             task_stream, graph = self.client.get_task_stream(plot='save',
                                                              filename="%s_task_stream.html" % name)
             self.client.profile(plot='save', filename="%s_profile.html" % name)
@@ -406,6 +488,158 @@ class _rsexecutebase():
             except  ValueError:
                 log.warning("Dask task stream is unintelligible")
 
+    def partition_worker(self, partition):
+        """ Worker on which the tasks for a data partition are run
+
+        Partitions are assigned in turn to the workers present when first used, which are looked up once per
+        client. The worker is a preference rather than a restriction, so if it is lost the scheduler runs the
+        tasks on another worker.
+
+        :param partition: Index of partition e.g. in vis_list
+        :return: Worker address, or None if locality is not enabled
+        """
+        if partition is None or not self._locality or not isinstance(self._client, Client):
+            return None
+        if self._workers is None:
+            self._workers = sorted(self._client.scheduler_info()['workers'].keys())
+        workers = self._workers
+        if len(workers) == 0:
+            return None
+        worker = self._partition_workers.get(partition, None)
+        if worker not in workers:
+            worker = workers[partition % len(workers)]
+            self._partition_workers[partition] = worker
+        return worker
+
+    @property
+    def n_workers(self):
+        """ Number of workers available to run tasks
+
+        :return: Number of Dask workers or pool workers, or 1 if running immediately
+        """
+        if self._using_dask and isinstance(self._client, Client):
+            return max(1, len(self._client.scheduler_info()['workers']))
+        elif self._using_dask and isinstance(self._client, LocalPoolClient):
+            return self._client.n_workers
+        return 1
+
+    @property
+    def threads_per_task(self):
+        """ Number of threads that each task may use without oversubscribing the cores
+
+        For a Dask client, the cores of each host are shared between the threads of the workers on that host,
+        e.g. a host with 16 cores and 4 workers of 1 thread gives 4 threads per task. The smallest value over
+        the hosts is returned. For the local pool, the cores are shared between the pool workers. If running
+        immediately, all the cores are available.
+
+        Functions that run threaded code, such as the nifty gridder, can use this for their number of threads.
+
+        The value is found once per client, on first use.
+
+        :return: Number of threads
+        """
+        if self._threads_per_task is None:
+            self._threads_per_task = self._find_threads_per_task()
+        return self._threads_per_task
+
+    def _find_threads_per_task(self):
+        """ Find the number of threads per task for the current client, see threads_per_task
+
+        :return: Number of threads
+        """
+        if self._using_dask and isinstance(self._client, Client):
+            workers = self._client.scheduler_info()['workers']
+            if len(workers) == 0:
+                return 1
+            cores = self._client.run(os.cpu_count)
+            hosts = dict()
+            for address, worker in workers.items():
+                host_cores, host_threads = hosts.get(worker['host'], (0, 0))
+                hosts[worker['host']] = (max(host_cores, cores.get(address, None) or 1),
+                                         host_threads + worker['nthreads'])
+            return min(max(1, host_cores // host_threads) for host_cores, host_threads in hosts.values())
+        elif self._using_dask and isinstance(self._client, LocalPoolClient):
+            return max(1, (os.cpu_count() or 1) // self._client.n_workers)
+        return os.cpu_count() or 1
+
+    @property
+    def locality(self):
+        """ Are tasks for each data partition kept on one worker?
+
+        :return:
+        """
+        return self._locality
+
+    def set_cache(self, directory=None, max_size=1e10):
+        """ Set the on-disk cache used for functions executed with memoize=True
+
+        For example, reprocessing with the same data will then read the PSF and convolution functions
+        from the cache instead of recomputing them. The cache persists between sessions. For a Dask
+        cluster the directory must be visible to all workers.
+
+        :param directory: Directory for the cache (default is a new temporary directory)
+        :param max_size: Maximum size of the cache in bytes, above which the least recently used results
+            are removed (1e10)
+        :return: MemoizeCache
+        """
+        self._cache = MemoizeCache(directory, max_size=max_size)
+        return self._cache
+
+    def unset_cache(self):
+        """ Stop memoizing: functions executed with memoize=True are always computed
+
+        The cache files are kept.
+        """
+        self._cache = None
+
+    def invalidate_cache(self, func=None):
+        """ Remove cached results
+
+        :param func: Function (or name of function) whose results are to be removed (default is all)
+        """
+        if self._cache is not None:
+            self._cache.invalidate(func)
+
+    def start_profiling(self, directory=None):
+        """ Start recording per-task profiles in this process and in all workers
+
+        The functions decorated with profile_function (gridding, FFTs, imaging, deconvolution) record their wall
+        and CPU time, bytes in and out, and resident memory. See rascil.processing_components.util.profiling.
+
+        :param directory: Directory for the records, shared by all workers (default is a new temporary directory)
+        :return: Directory used
+        """
+        directory = profiling.start_profiling(directory)
+        if self._using_dask and isinstance(self._client, Client):
+            self._client.run(profiling.start_profiling, directory)
+        elif self._using_dask and isinstance(self._client, LocalPoolClient) and self._client.processes:
+            # Worker processes inherit the profiling directory when they are started
+            self._client.restart()
+        return directory
+
+    def save_profile(self, name='rascil_profile'):
+        """ Save the per-task profiles to JSON, CSV and Chrome trace files, and log a summary
+
+        The files are name.json, name.csv, and name_trace.json. The last can be viewed in chrome://tracing.
+
+        :param name: prefix to file names
+        :return: list of records
+        """
+        records = profiling.get_profile_records()
+        profiling.export_profile_to_json(records, "%s.json" % name)
+        profiling.export_profile_to_csv(records, "%s.csv" % name)
+        profiling.export_profile_to_chrome_trace(records, "%s_trace.json" % name)
+
+        table = []
+        headers = ["Function", "Number calls", "Wall time (s)", "CPU time (s)", "Bytes in", "Bytes out",
+                   "Process peak RSS (MB)", "Peak RSS increase (MB)"]
+        for s in profiling.summarise_profile(records):
+            table.append([s['name'], s['calls'], "{0:.3f}".format(s['wall_time']), "{0:.3f}".format(s['cpu_time']),
+                          s['bytes_in'], s['bytes_out'], "{0:.1f}".format(s['process_peak_rss'] / 2 ** 20),
+                          "{0:.1f}".format(s['peak_rss_increase'] / 2 ** 20)])
+        log.info("Profile of decorated functions\n" + tabulate(table, headers=headers))
+        return records
+
     @property
     def client(self):
         """ Client being used
@@ -414,6 +648,14 @@ class _rsexecutebase():
         """
         return self._client
 
+    @property
+    def cache(self):
+        """ Cache used for memoization, or None
+
+        :return: MemoizeCache
+        """
+        return self._cache
+
     @property
     def using_dask(self):
         """ Is dask being used?
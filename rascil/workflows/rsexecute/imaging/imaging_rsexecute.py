@@ -6,9 +6,10 @@ __all__ = ['predict_list_rsexecute_workflow', 'invert_list_rsexecute_workflow',
            'restore_list_rsexecute_workflow', 'deconvolve_list_rsexecute_workflow',
            'deconvolve_list_channel_rsexecute_workflow', 'weight_list_rsexecute_workflow',
            'taper_list_rsexecute_workflow', 'zero_list_rsexecute_workflow', 'subtract_list_rsexecute_workflow',
-           'sum_invert_results_rsexecute', 'sum_predict_results_rsexecute']
+           'sum_invert_results_rsexecute', 'sum_predict_results_rsexecute', 'imaging_threads_rsexecute']
 
 import collections
+import functools
 import logging
 
 import numpy
@@ -24,8 +25,9 @@ from rascil.processing_components.image import calculate_image_frequency_moments
 from rascil.processing_components.image import deconvolve_cube, restore_cube
 from rascil.processing_components.image import image_scatter_facets, image_gather_facets, \
     image_scatter_channels, image_gather_channels
-from rascil.processing_components.image.operations import copy_image, create_empty_image_like
-from rascil.processing_components.imaging import taper_visibility_gaussian
+from rascil.processing_components.image.operations import copy_image, create_empty_image_like, \
+    convert_image_to_numpy
+from rascil.processing_components.imaging import taper_visibility_gaussian, normalize_sumwt
 from rascil.processing_components.visibility import convert_blockvisibility_to_visibility, \
     convert_visibility_to_blockvisibility
 from rascil.processing_components.visibility import copy_visibility
@@ -37,6 +39,50 @@ from rascil.workflows.shared.imaging import imaging_context, remove_sumwt, sum_p
 log = logging.getLogger('logger')
 
 
+def imaging_threads_rsexecute(context, **kwargs):
+    """ Number of threads for the predict and invert functions of a context, run in rsexecute tasks
+
+    For a threaded context, e.g. ng, this is the number of cores available to each task (see
+    rsexecute.threads_per_task) unless threads is given explicitly.
+
+    :param context: Imaging context
+    :param kwargs: threads: Number of threads (None)
+    :return: Number of threads, or None if the context is not threaded
+    """
+    threads = get_parameter(kwargs, "threads", None)
+    if threads is None and imaging_context(context).get('threaded', False):
+        threads = rsexecute.threads_per_task
+    return threads
+
+
+def _compact_chunks(vis_slices, facets, **kwargs):
+    """ Number of tasks for the slices of each vis when compacting the graph
+
+    :param vis_slices: Number of slices
+    :param facets: Number of facets (per axis)
+    :param kwargs: compact: Number of tasks, or True for one per worker (False)
+    :return: Number of tasks, or 0 if not compacting
+    """
+    compact = get_parameter(kwargs, "compact", False)
+    if compact is True:
+        compact = rsexecute.n_workers
+    if not compact or (vis_slices == 1 and facets == 1):
+        return 0
+    return max(1, min(int(compact), vis_slices))
+
+
+def _chunk_list(items, nchunks):
+    """ Divide items into nchunks contiguous chunks of nearly equal length
+
+    :param items: Iterable e.g. the outputs of a task
+    :param nchunks: Number of chunks
+    :return: list of lists
+    """
+    items = list(items)
+    bounds = [(i * len(items)) // nchunks for i in range(nchunks + 1)]
+    return [items[bounds[i]:bounds[i + 1]] for i in range(nchunks) if bounds[i + 1] > bounds[i]]
+
+
 def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=1, facets=1,
                                     gcfcf=None, **kwargs):
     """Predict, iterating over both the scattered vis_list and image
@@ -47,6 +93,10 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
     Note that this call can be converted to a set of rsexecute calls to the serial
     version, using argument use_serial_predict=True
 
+    The graph has a task for each slice and facet of each vis. For many slices and facets it can be compacted
+    using argument compact: the slices of each vis are then predicted in that many tasks (or one per worker if
+    compact=True), each working through its slices and facets in turn.
+
     :param vis_list: list of vis (or graph)
     :param model_imagelist: list of models (or graph)
     :param vis_slices: Number of vis slices (w stack or timeslice)
@@ -70,9 +120,14 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
         predicted_vis_list = rsexecute.compute(predicted_vis_list , sync=True)
 
    """
+    # Threaded functions share the cores available to each task
+    threads = imaging_threads_rsexecute(context, **kwargs)
+    if threads is not None:
+        kwargs['threads'] = threads
+    
     if get_parameter(kwargs, "use_serial_predict", False):
         from rascil.workflows.serial.imaging.imaging_serial import predict_list_serial_workflow
-        return [rsexecute.execute(predict_list_serial_workflow, nout=1) \
+        return [rsexecute.execute(predict_list_serial_workflow, nout=1, partition=i) \
                     (vis_list=[vis_list[i]],
                      model_imagelist=[model_imagelist[i]], vis_slices=vis_slices,
                      facets=facets, context=context, gcfcf=gcfcf, **kwargs)[0]
@@ -84,6 +139,14 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
     predict = c['predict']
+    if c.get('batched', False):
+        # The predict function works through the slices itself
+        predict = functools.partial(predict, vis_slices=vis_slices)
+        vis_slices = 1
+    if c.get('faceted', False):
+        # The predict function works through the facets itself
+        predict = functools.partial(predict, facets=facets)
+        facets = 1
     
     if facets % 2 == 0 or facets == 1:
         actual_number_facets = facets
@@ -98,8 +161,18 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
         else:
             return None
     
+    def predict_chunk(sub_vis_chunk, model, g):
+        return [predict_ignore_none(sub_vis, model, g) for sub_vis in sub_vis_chunk]
+    
+    def predict_facets_chunk(sub_vis_chunk, facet_list):
+        return [sum_predict_results([predict_ignore_none(sub_vis, facet, None) for facet in facet_list])
+                for sub_vis in sub_vis_chunk]
+    
+    nchunks = _compact_chunks(vis_slices, facets, **kwargs)
+    
     if gcfcf is None:
-        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(m) for m in model_imagelist]
+        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction, memoize=True, partition=i)(m)
+                 for i, m in enumerate(model_imagelist)]
     
     # Loop over all frequency windows
     if facets == 1:
@@ -110,18 +183,25 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
             else:
                 g = gcfcf[0]
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices)(subvis,
-                                                                                   vis_iter, vis_slices)
+            sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices, partition=ivis)(subvis,
+                                                                                                   vis_iter,
+                                                                                                   vis_slices)
             
             image_vis_lists = list()
-            # Loop over sub visibility
-            for sub_vis_list in sub_vis_lists:
-                # Predict visibility for this sub-visibility from this image
-                image_vis_list = rsexecute.execute(predict_ignore_none, pure=True, nout=1) \
-                    (sub_vis_list, model_imagelist[ivis], g)
-                # Sum all sub-visibilities
-                image_vis_lists.append(image_vis_list)
-            image_results_list.append(rsexecute.execute(visibility_gather, nout=1)
+            if nchunks > 0:
+                # Predict a chunk of sub-visibilities in each task
+                for chunk in _chunk_list(sub_vis_lists, nchunks):
+                    image_vis_lists.extend(rsexecute.execute(predict_chunk, nout=len(chunk), partition=ivis)
+                                           (chunk, model_imagelist[ivis], g))
+            else:
+                # Loop over sub visibility
+                for sub_vis_list in sub_vis_lists:
+                    # Predict visibility for this sub-visibility from this image
+                    image_vis_list = rsexecute.execute(predict_ignore_none, pure=True, nout=1, partition=ivis) \
+                        (sub_vis_list, model_imagelist[ivis], g)
+                    # Sum all sub-visibilities
+                    image_vis_lists.append(image_vis_list)
+            image_results_list.append(rsexecute.execute(visibility_gather, nout=1, partition=ivis)
                                       (image_vis_lists, subvis, vis_iter))
         
         result = image_results_list
@@ -133,24 +213,30 @@ def predict_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slic
                 model_imagelist[ivis],
                 facets=facets)
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices) \
+            sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices, partition=ivis) \
                 (subvis, vis_iter, vis_slices)
             
             facet_vis_lists = list()
-            # Loop over sub visibility
-            for sub_vis_list in sub_vis_lists:
-                facet_vis_results = list()
-                # Loop over facets
-                for facet_list in facet_lists:
-                    # Predict visibility for this subvisibility from this facet
-                    facet_vis_list = rsexecute.execute(predict_ignore_none, pure=True, nout=1) \
-                        (sub_vis_list, facet_list, None)
-                    facet_vis_results.append(facet_vis_list)
-                # Sum the current sub-visibility over all facets
-                facet_vis_lists.append(rsexecute.execute(sum_predict_results)(facet_vis_results))
+            if nchunks > 0:
+                # Predict a chunk of sub-visibilities, summed over all facets, in each task
+                for chunk in _chunk_list(sub_vis_lists, nchunks):
+                    facet_vis_lists.extend(rsexecute.execute(predict_facets_chunk, nout=len(chunk), partition=ivis)
+                                           (chunk, facet_lists))
+            else:
+                # Loop over sub visibility
+                for sub_vis_list in sub_vis_lists:
+                    facet_vis_results = list()
+                    # Loop over facets
+                    for facet_list in facet_lists:
+                        # Predict visibility for this subvisibility from this facet
+                        facet_vis_list = rsexecute.execute(predict_ignore_none, pure=True, nout=1, partition=ivis) \
+                            (sub_vis_list, facet_list, None)
+                        facet_vis_results.append(facet_vis_list)
+                    # Sum the current sub-visibility over all facets
+                    facet_vis_lists.append(rsexecute.execute(sum_predict_results, partition=ivis)(facet_vis_results))
             # Sum all sub-visibilities
             image_results_list_list.append(
-                rsexecute.execute(visibility_gather, nout=1)(facet_vis_lists, subvis, vis_iter))
+                rsexecute.execute(visibility_gather, nout=1, partition=ivis)(facet_vis_lists, subvis, vis_iter))
         
         result = image_results_list_list
     return rsexecute.optimize(result)
@@ -163,6 +249,10 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
     Note that this call can be converted to a set of rsexecute calls to the serial
     version, using argument use_serial_invert=True
 
+    The graph has a task for each slice and facet of each vis. For many slices and facets it can be compacted
+    using argument compact: the slices of each vis are then inverted in that many tasks (or one per worker if
+    compact=True), each working through its slices and facets in turn and returning their sum.
+
     :param gcfcf:
     :param taper:
     :param overlap:
@@ -191,12 +281,17 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
 
    """
     
+    # Threaded functions share the cores available to each task
+    threads = imaging_threads_rsexecute(context, **kwargs)
+    if threads is not None:
+        kwargs['threads'] = threads
+    
     # Use serial invert for each element of the visibility list. This means that e.g. iteration
     # through w-planes or timeslices is done sequentially thus not incurring the memory cost
     # of doing all at once.
     if get_parameter(kwargs, "use_serial_invert", False):
         from rascil.workflows.serial.imaging.imaging_serial import invert_list_serial_workflow
-        return [rsexecute.execute(invert_list_serial_workflow, nout=1) \
+        return [rsexecute.execute(invert_list_serial_workflow, nout=1, partition=i) \
                     (vis_list=[vis_list[i]], template_model_imagelist=[template_model_imagelist[i]],
                      context=context, dopsf=dopsf, normalize=normalize, vis_slices=vis_slices,
                      facets=facets, gcfcf=gcfcf, **kwargs)[0]
@@ -208,6 +303,14 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
     invert = c['invert']
+    if c.get('batched', False):
+        # The invert function works through the slices itself
+        invert = functools.partial(invert, vis_slices=vis_slices)
+        vis_slices = 1
+    if c.get('faceted', False):
+        # The invert function works through the facets itself
+        invert = functools.partial(invert, facets=facets, overlap=overlap, taper=taper)
+        facets = 1
     
     if facets % 2 == 0 or facets == 1:
         actual_number_facets = facets
@@ -238,10 +341,20 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
         else:
             return create_empty_image_like(model), numpy.zeros([model.nchan, model.npol])
     
+    def invert_chunk(sub_vis_chunk, model, gg):
+        return sum_invert_results([invert_ignore_none(sub_vis, model, gg) for sub_vis in sub_vis_chunk])
+    
+    def invert_facets_chunk(sub_vis_chunk, facet_list, template_model):
+        return sum_invert_results([gather_image_iteration_results([invert_ignore_none(sub_vis, facet, None)
+                                                                   for facet in facet_list], template_model)
+                                   for sub_vis in sub_vis_chunk])
+    
+    nchunks = _compact_chunks(vis_slices, facets, **kwargs)
+    
     # If we are doing facets, we need to create the gcf for each image
     if gcfcf is None and facets == 1:
         assert len(template_model_imagelist) > 0
-        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(template_model_imagelist[0])]
+        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction, memoize=True)(template_model_imagelist[0])]
     
     # Loop over all vis_lists independently
     results_vislist = list()
@@ -252,15 +365,22 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
             else:
                 g = gcfcf[0]
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices) \
+            sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices, partition=ivis) \
                 (sub_vis_list, vis_iter, vis_slices=vis_slices)
             
-            # Iterate within each sub_sub_vis_list
             vis_results = list()
-            for sub_sub_vis_list in sub_sub_vis_lists:
-                vis_results.append(rsexecute.execute(invert_ignore_none, pure=True)
-                                   (sub_sub_vis_list, template_model_imagelist[ivis], g))
-            results_vislist.append(sum_invert_results_rsexecute(vis_results))
+            if nchunks > 0:
+                # Invert and sum a chunk of sub_sub_vis_lists in each task
+                for chunk in _chunk_list(sub_sub_vis_lists, nchunks):
+                    vis_results.append(rsexecute.execute(invert_chunk, nout=2, memoize=dopsf, partition=ivis)
+                                       (chunk, template_model_imagelist[ivis], g))
+            else:
+                # Iterate within each sub_sub_vis_list
+                for sub_sub_vis_list in sub_sub_vis_lists:
+                    vis_results.append(rsexecute.execute(invert_ignore_none, pure=True, memoize=dopsf,
+                                                         partition=ivis)
+                                       (sub_sub_vis_list, template_model_imagelist[ivis], g))
+            results_vislist.append(sum_invert_results_rsexecute(vis_results, partitions=[ivis] * len(vis_results)))
         
         result = results_vislist
     else:
@@ -269,19 +389,26 @@ def invert_list_rsexecute_workflow(vis_list, template_model_imagelist, context,
             facet_lists = rsexecute.execute(image_scatter_facets, nout=actual_number_facets ** 2)(
                 template_model_imagelist[ivis], facets=facets, overlap=overlap, taper=taper)
             # Create the graph to divide the visibility into slices. This is by copy.
-            sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices) \
+            sub_sub_vis_lists = rsexecute.execute(visibility_scatter, nout=vis_slices, partition=ivis) \
                 (sub_vis_list, vis_iter, vis_slices=vis_slices)
             
-            # Iterate within each vis_list
             vis_results = list()
-            for sub_sub_vis_list in sub_sub_vis_lists:
-                facet_vis_results = list()
-                for facet_list in facet_lists:
-                    facet_vis_results.append(
-                        rsexecute.execute(invert_ignore_none, pure=True)(sub_sub_vis_list, facet_list, None))
-                vis_results.append(rsexecute.execute(gather_image_iteration_results, nout=1)
-                                   (facet_vis_results, template_model_imagelist[ivis]))
-            results_vislist.append(sum_invert_results_rsexecute(vis_results))
+            if nchunks > 0:
+                # Invert all facets and sum a chunk of sub_sub_vis_lists in each task
+                for chunk in _chunk_list(sub_sub_vis_lists, nchunks):
+                    vis_results.append(rsexecute.execute(invert_facets_chunk, nout=2, memoize=dopsf, partition=ivis)
+                                       (chunk, facet_lists, template_model_imagelist[ivis]))
+            else:
+                # Iterate within each vis_list
+                for sub_sub_vis_list in sub_sub_vis_lists:
+                    facet_vis_results = list()
+                    for facet_list in facet_lists:
+                        facet_vis_results.append(
+                            rsexecute.execute(invert_ignore_none, pure=True, memoize=dopsf, partition=ivis)
+                            (sub_sub_vis_list, facet_list, None))
+                    vis_results.append(rsexecute.execute(gather_image_iteration_results, nout=1, partition=ivis)
+                                       (facet_vis_results, template_model_imagelist[ivis]))
+            results_vislist.append(sum_invert_results_rsexecute(vis_results, partitions=[ivis] * len(vis_results)))
         
         result = results_vislist
     return rsexecute.optimize(result)
@@ -535,7 +662,9 @@ def deconvolve_list_rsexecute_workflow(dirty_list, psf_list, model_imagelist, pr
 def deconvolve_list_channel_rsexecute_workflow(dirty_list, psf_list, model_imagelist, subimages, **kwargs):
     """Create a graph for deconvolution by channels, adding to the model
 
-    Does deconvolution channel by channel.
+    Does deconvolution channel by channel. If the dirty image data are a dask.array (see
+    convert_image_to_dask), each task reads only its own channels, and if the model data are a dask.array,
+    the channels are gathered into a dask.array rather than a new cube in memory.
 
     :param dirty_list: list or graph of dirty images
     :param psf_list: list or graph of psf images. The psfs must be the size of a facet
@@ -548,11 +677,11 @@ def deconvolve_list_channel_rsexecute_workflow(dirty_list, psf_list, model_image
     def deconvolve_subimage(dirty, psf):
         assert isinstance(dirty, Image)
         assert isinstance(psf, Image)
-        comp = deconvolve_cube(dirty, psf, **kwargs)
+        comp = deconvolve_cube(convert_image_to_numpy(dirty), convert_image_to_numpy(psf), **kwargs)
         return comp[0]
     
     def add_model(sum_model, model):
-        assert isinstance(output, Image)
+        assert isinstance(sum_model, Image)
         assert isinstance(model, Image)
         sum_model.data += model.data
         return sum_model
@@ -586,7 +715,7 @@ def weight_list_rsexecute_workflow(vis_list, model_imagelist, gcfcf=None, weight
 
    """
     if gcfcf is None:
-        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(m, oversampling=1) for m in model_imagelist]
+        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction, memoize=True)(m, oversampling=1) for m in model_imagelist]
     
     def grid_wt(vis, model, g):
         if vis is not None:
@@ -603,11 +732,11 @@ def weight_list_rsexecute_workflow(vis_list, model_imagelist, gcfcf=None, weight
         else:
             return None
     
-    weight_list = [rsexecute.execute(grid_wt, pure=True, nout=1)(vis_list[i], model_imagelist[i],
-                                                                 gcfcf)
+    weight_list = [rsexecute.execute(grid_wt, pure=True, nout=1, memoize=True, partition=i)
+                   (vis_list[i], model_imagelist[i], gcfcf)
                    for i in range(len(vis_list))]
     
-    merged_weight_grid = rsexecute.execute(griddata_merge_weights, nout=1)(weight_list)
+    merged_weight_grid = rsexecute.execute(griddata_merge_weights, nout=1, memoize=True)(weight_list)
     merged_weight_grid = rsexecute.persist(merged_weight_grid, broadcast=True)
     
     def re_weight(vis, model, gd, g):
@@ -627,7 +756,7 @@ def weight_list_rsexecute_workflow(vis_list, model_imagelist, gcfcf=None, weight
         else:
             return vis
     
-    result = [rsexecute.execute(re_weight, nout=1)
+    result = [rsexecute.execute(re_weight, nout=1, partition=i)
               (v, model_imagelist[i], merged_weight_grid, gcfcf)
               for i, v in enumerate(vis_list)]
     
@@ -641,7 +770,8 @@ def taper_list_rsexecute_workflow(vis_list, size_required):
     :param size_required: Size in radians
     :return: List of vis (or graph)
     """
-    result = [rsexecute.execute(taper_visibility_gaussian, nout=1)(v, beam=size_required) for v in vis_list]
+    result = [rsexecute.execute(taper_visibility_gaussian, nout=1, partition=i)(v, beam=size_required)
+              for i, v in enumerate(vis_list)]
     return rsexecute.optimize(result)
 
 
@@ -659,7 +789,7 @@ def zero_list_rsexecute_workflow(vis_list):
         else:
             return None
     
-    result = [rsexecute.execute(zero, pure=True, nout=1)(v) for v in vis_list]
+    result = [rsexecute.execute(zero, pure=True, nout=1, partition=i)(v) for i, v in enumerate(vis_list)]
     return rsexecute.optimize(result)
 
 
@@ -680,38 +810,179 @@ def subtract_list_rsexecute_workflow(vis_list, model_vislist):
         else:
             return None
     
-    result = [rsexecute.execute(subtract_vis, pure=True, nout=1)(vis=vis_list[i],
-                                                                 model_vis=model_vislist[i])
+    result = [rsexecute.execute(subtract_vis, pure=True, nout=1, partition=i)(vis=vis_list[i],
+                                                                              model_vis=model_vislist[i])
               for i in range(len(vis_list))]
     return rsexecute.optimize(result)
 
 
-def sum_predict_results_rsexecute(bvis_list, split=2):
+# Maximum memory in bytes for the inputs of one reduction task
+REDUCTION_MEMORY = 2 ** 30
+
+# Fan-in used when the size of the items being reduced is not known
+_DEFAULT_FAN_IN = 8
+
+
+def _reduction_fan_in(nitems, nbytes=None, n_workers=1):
+    """ Choose the number of items summed by each task of a reduction tree
+
+    Each task holds all its inputs in memory, so the fan-in is limited by REDUCTION_MEMORY / nbytes. Within
+    that limit, the first level of the tree has about one task per worker and later levels are as flat as
+    possible, so few intermediate results are made.
+
+    :param nitems: Number of items to be reduced
+    :param nbytes: Size of one item in bytes (default is unknown)
+    :param n_workers: Number of workers
+    :return: fan-in, at least 2
+    """
+    if nbytes is None or nbytes <= 0:
+        limit = _DEFAULT_FAN_IN
+    else:
+        limit = int(REDUCTION_MEMORY // nbytes)
+    per_worker = -(-nitems // max(1, n_workers))
+    return max(2, min(limit, per_worker))
+
+
+def _reduction_tree(items, partitions, first, accumulate, nout, fan_in):
+    """ Create the graph for a reduction tree
+
+    The items are first reduced separately for each worker (if the partitions are pinned to workers, see
+    rsexecute.set_client), and then across workers. The lowest level calls first and the higher levels call
+    accumulate. Both must make one new result and add their inputs into it: the inputs are the outputs of
+    other tasks, which may be retried or shared. Both are called with a list of inputs and the keyword final,
+    which is True for the root.
+
+    :param items: List of items (or graph)
+    :param partitions: List of the partition of each item
+    :param first: Function to reduce a list of items
+    :param accumulate: Function to reduce a list of results of first or accumulate
+    :param nout: Number of outputs of first and accumulate
+    :param fan_in: Maximum number of inputs of each task
+    :return: graph for the reduction
+    """
+    groups = collections.OrderedDict()
+    for item, partition in zip(items, partitions):
+        groups.setdefault(rsexecute.partition_worker(partition), list()).append((item, partition))
+    
+    def reduce_level(level, func, final):
+        return [(rsexecute.execute(func, nout=nout, partition=level[i][1])([item for item, _ in level[i:i + fan_in]],
+                                                                              final=final), level[i][1])
+                for i in range(0, len(level), fan_in)]
+    
+    single = len(groups) == 1
+    reduced = list()
+    for level in groups.values():
+        level = reduce_level(level, first, final=single and len(level) <= fan_in)
+        while len(level) > 1:
+            level = reduce_level(level, accumulate, final=single and len(level) <= fan_in)
+        reduced.append(level[0])
+    if single:
+        return reduced[0][0]
+    
+    # Across workers: these tasks are not pinned
+    reduced = [(item, None) for item, _ in reduced]
+    while len(reduced) > 1:
+        reduced = reduce_level(reduced, accumulate, final=len(reduced) <= fan_in)
+    return reduced[0][0]
+
+
+def _add_weighted(im, image, sumwt):
+    """ Add sumwt * image into im, a plane at a time to avoid a temporary copy of the whole image
+    """
+    nchan, npol, _, _ = im.shape
+    for chan in range(nchan):
+        for pol in range(npol):
+            im.data[chan, pol] += sumwt[chan, pol] * image.data[chan, pol]
+
+
+def _sum_invert_first(image_list, final=False):
+    """ Sum invert results into a new buffer, weighting by sum of weights
+
+    :param image_list: List of (image, sum weights) tuples
+    :param final: Normalize by the sum of weights
+    :return: image, sum of weights
+    """
+    im = None
+    sumwt = None
+    for arg in image_list:
+        if arg is not None:
+            if im is None:
+                im = create_empty_image_like(arg[0])
+                sumwt = numpy.zeros_like(arg[1])
+            _add_weighted(im, arg[0], arg[1])
+            sumwt += arg[1]
+    assert im is not None, "No invert results"
+    if final:
+        im = normalize_sumwt(im, sumwt)
+    return im, sumwt
+
+
+def _sum_invert_accumulate(partial_list, final=False):
+    """ Sum weighted results of _sum_invert_first into a new buffer
+
+    The partial results are the outputs of other tasks, and so are not changed: a task that is retried
+    or recomputed would otherwise be counted twice.
+
+    :param partial_list: List of (weighted image, sum of weights) tuples
+    :param final: Normalize by the sum of weights
+    :return: image, sum of weights
+    """
+    im = create_empty_image_like(partial_list[0][0])
+    sumwt = numpy.zeros_like(partial_list[0][1])
+    for arg in partial_list:
+        im.data += arg[0].data
+        sumwt += arg[1]
+    if final:
+        im = normalize_sumwt(im, sumwt)
+    return im, sumwt
+
+
+def _sum_predict(bvis_list, final=False):
+    """ Sum predict results into a new visibility, at all levels of the tree
+
+    :param bvis_list: List of visibilities
+    :param final: Ignored
+    :return: visibility
+    """
+    return sum_predict_results(bvis_list)
+
+
+def sum_predict_results_rsexecute(bvis_list, split=None, nbytes=None, partitions=None):
     """ Sum a set of predict results
 
-    :param bvis_list: List of (image, sum weights) tuples
-    :param split: Split into
+    The sum is a tree of tasks, each summing up to split results into one new visibility. If the partitions are
+    pinned to workers (see rsexecute.set_client), the results are summed on each worker before being moved.
+
+    :param bvis_list: List of visibilities (or graph)
+    :param split: Number of results summed by each task (default is chosen from nbytes and the number of workers)
+    :param nbytes: Size of one visibility in bytes, used to choose split
+    :param partitions: Partition of each visibility (default is that the i'th is partition i)
     :return: BlockVis
     """
-    if len(bvis_list) > split:
-        centre = len(bvis_list) // split
-        result = [sum_predict_results_rsexecute(bvis_list[:centre]),
-                  sum_predict_results_rsexecute(bvis_list[centre:])]
-        return rsexecute.execute(sum_predict_results, nout=2)(result)
-    else:
-        return rsexecute.execute(sum_predict_results, nout=2)(bvis_list)
+    if partitions is None:
+        partitions = list(range(len(bvis_list)))
+    if split is None:
+        split = _reduction_fan_in(len(bvis_list), nbytes, rsexecute.n_workers)
+    return _reduction_tree(bvis_list, partitions, _sum_predict, _sum_predict, 1, max(2, split))
 
 
-def sum_invert_results_rsexecute(image_list, split=2):
+def sum_invert_results_rsexecute(image_list, split=None, nbytes=None, partitions=None):
     """ Sum a set of invert results with appropriate weighting
 
-    :param image_list: List of (image, sum weights) tuples
-    :param split: Split into
+    The sum is a tree of tasks, each summing up to split results into one new image: only the root normalizes
+    by the sum of weights. If the partitions are pinned to workers (see rsexecute.set_client), the results are
+    summed on each worker before being moved.
+
+    :param image_list: List of (image, sum weights) tuples (or graph)
+    :param split: Number of results summed by each task (default is chosen from nbytes and the number of workers)
+    :param nbytes: Size of one image in bytes, used to choose split
+    :param partitions: Partition of each result (default is that the i'th is partition i)
     :return: image, sum of weights
     """
-    if len(image_list) > split:
-        centre = len(image_list) // split
-        result = [sum_invert_results_rsexecute(image_list[:centre]), sum_invert_results_rsexecute(image_list[centre:])]
-        return rsexecute.execute(sum_invert_results, nout=2)(result)
-    else:
+    if len(image_list) == 1:
         return rsexecute.execute(sum_invert_results, nout=2)(image_list)
+    if partitions is None:
+        partitions = list(range(len(image_list)))
+    if split is None:
+        split = _reduction_fan_in(len(image_list), nbytes, rsexecute.n_workers)
+    return _reduction_tree(image_list, partitions, _sum_invert_first, _sum_invert_accumulate, 2, max(2, split))
@@ -8,22 +8,163 @@ __all__ = ['ical_list_rsexecute_workflow',
 import logging
 
 from rascil.data_models.parameters import get_parameter
+from rascil.processing_components.calibration import apply_calibration_chain, solve_calibrate_chain
 from rascil.processing_components.griddata import create_pswf_convolutionfunction
-from rascil.processing_components.visibility import copy_visibility
+from rascil.processing_components.image.operations import copy_image
+from rascil.processing_components.visibility import copy_visibility, convert_visibility_to_blockvisibility, \
+    divide_visibility, integrate_visibility_by_channel, subtract_visibility, visibility_gather_channel
 from rascil.workflows.rsexecute.calibration.calibration_rsexecute import calibrate_list_rsexecute_workflow
 from rascil.workflows.rsexecute.execution_support.rsexecute import rsexecute
 from rascil.workflows.rsexecute.imaging.imaging_rsexecute import invert_list_rsexecute_workflow, \
     residual_list_rsexecute_workflow, \
     predict_list_rsexecute_workflow, subtract_list_rsexecute_workflow, \
-    restore_list_rsexecute_workflow, deconvolve_list_rsexecute_workflow
+    restore_list_rsexecute_workflow, deconvolve_list_rsexecute_workflow, imaging_threads_rsexecute
+from rascil.workflows.serial.imaging.imaging_serial import predict_list_serial_workflow, \
+    invert_list_serial_workflow
 
 log = logging.getLogger('logger')
 
 
+def _predict_partition(vis, model, gcfcf, context, vis_slices=1, facets=1, **kwargs):
+    """ Predict the model visibility of one partition in one task, iterating over slices and facets in turn
+
+    :param vis: Visibility
+    :param model: Model image
+    :param gcfcf: Grid correction and convolution function (or None)
+    :param context: Imaging context
+    :return: Model visibility
+    """
+    # The facets branch of the serial predict gathers into its input, so that needs a zeroed copy
+    if facets > 1:
+        vis = copy_visibility(vis, zero=True)
+    return predict_list_serial_workflow([vis], [model], context=context, vis_slices=vis_slices, facets=facets,
+                                        gcfcf=None if gcfcf is None else [gcfcf], **kwargs)[0]
+
+
+def _divide_partition(vis, modelvis):
+    """ Point source equivalent visibility of one partition, used for the global gain solution
+
+    :param vis: Visibility
+    :param modelvis: Model visibility
+    :return: BlockVisibility
+    """
+    return divide_visibility(convert_visibility_to_blockvisibility(vis),
+                             convert_visibility_to_blockvisibility(modelvis))
+
+
+def _solve_global(point_vislist, gt=None, calibration_context='TG', **kwargs):
+    """ Solve for the gains from the point source equivalent visibilities of all partitions
+
+    :param point_vislist: List of BlockVisibility from _divide_partition
+    :param gt: Previous gaintables (or None)
+    :param calibration_context: Sequence of calibration steps e.g. TGB
+    :return: dict of gaintables
+    """
+    point_vis = integrate_visibility_by_channel(visibility_gather_channel(point_vislist))
+    return solve_calibrate_chain(point_vis, None, gt, calibration_context=calibration_context, **kwargs)
+
+
+def _residual_partition(vis, model, gcfcf, context, modelvis=None, gt=None, subtract=True,
+                        calibration_context='TG', vis_slices=1, facets=1, **kwargs):
+    """ Residual image of one partition in one pass over the data
+
+    The gains are applied, the model visibility is subtracted and the result is inverted, all in one task.
+    At most one copy of the visibility is made.
+
+    :param vis: Visibility
+    :param model: Model image, also the template for the residual image
+    :param gcfcf: Grid correction and convolution function (or None)
+    :param context: Imaging context
+    :param modelvis: Model visibility (default is to predict it from model)
+    :param gt: Gaintables to apply (or None)
+    :param subtract: Subtract the model visibility (True)
+    :param calibration_context: Sequence of calibration steps e.g. TGB
+    :return: (image, sumwt)
+    """
+    if gt is not None:
+        # The gains are applied in place, so work on a copy
+        residual = apply_calibration_chain(copy_visibility(vis), gt, calibration_context=calibration_context,
+                                           **kwargs)
+        if subtract:
+            if modelvis is None:
+                modelvis = _predict_partition(vis, model, gcfcf, context, vis_slices, facets, **kwargs)
+            residual.data['vis'] -= modelvis.data['vis']
+    elif subtract and modelvis is None:
+        # The predicted visibility belongs to this task so the residual can be formed in it
+        residual = _predict_partition(vis, model, gcfcf, context, vis_slices, facets, **kwargs)
+        residual.data['vis'] = vis.data['vis'] - residual.data['vis']
+    elif subtract:
+        residual = subtract_visibility(vis, modelvis)
+    else:
+        residual = vis
+    
+    return invert_list_serial_workflow([residual], [model], context=context, dopsf=False, normalize=True,
+                                       vis_slices=vis_slices, facets=facets,
+                                       gcfcf=None if gcfcf is None else [gcfcf], **kwargs)[0]
+
+
+def _fused_residual_list_rsexecute_workflow(vis_list, model_imagelist, context, gcfcf, gt_list=None,
+                                            do_selfcal=False, subtract=True, calibration_context='TG',
+                                            vis_slices=1, facets=1, **kwargs):
+    """ Create graph for the residual images of one major cycle, using one residual task per partition
+
+    If do_selfcal is True, the model visibilities are first predicted and the gains solved for, globally if
+    global_solution is True (the default). Otherwise the gains in gt_list (if any) are applied.
+
+    :param vis_list: List of vis (or graph)
+    :param model_imagelist: List of models (or graph)
+    :param context: Imaging context
+    :param gcfcf: List of (grid correction function, convolution function), one or one per vis
+    :param gt_list: List of gaintables (or graph), one or one per vis
+    :param do_selfcal: Solve for the gains
+    :param subtract: Subtract the model visibility
+    :param calibration_context: Sequence of calibration steps e.g. TGB
+    :param kwargs: Parameters for functions in components
+    :return: list of (image, sumwt) tuples, list of gaintables (or graph)
+    """
+    
+    def select(items, i):
+        if items is None or len(items) == 0:
+            return None
+        return items[i] if len(items) > 1 else items[0]
+    
+    # The serial workflows run inside the tasks, so the threads must be set here
+    threads = imaging_threads_rsexecute(context, **kwargs)
+    if threads is not None:
+        kwargs['threads'] = threads
+    
+    model_vislist = [None for _ in vis_list]
+    if do_selfcal:
+        model_vislist = [rsexecute.execute(_predict_partition, nout=1, partition=i)
+                         (v, model_imagelist[i], select(gcfcf, i), context, vis_slices=vis_slices, facets=facets,
+                          **kwargs)
+                         for i, v in enumerate(vis_list)]
+        if get_parameter(kwargs, 'global_solution', True) and len(vis_list) > 1:
+            point_vislist = [rsexecute.execute(_divide_partition, nout=1, partition=i)(v, model_vislist[i])
+                             for i, v in enumerate(vis_list)]
+            gt_list = [rsexecute.execute(_solve_global, pure=True, nout=1)
+                       (point_vislist, select(gt_list, 0), calibration_context=calibration_context, **kwargs)]
+        else:
+            gt_list = [rsexecute.execute(solve_calibrate_chain, pure=True, nout=1, partition=i)
+                       (v, model_vislist[i], select(gt_list, i), calibration_context=calibration_context, **kwargs)
+                       for i, v in enumerate(vis_list)]
+    
+    residual_imagelist = [rsexecute.execute(_residual_partition, nout=1, partition=i)
+                          (v, model_imagelist[i], select(gcfcf, i), context, modelvis=model_vislist[i],
+                           gt=select(gt_list, i), subtract=subtract, calibration_context=calibration_context,
+                           vis_slices=vis_slices, facets=facets, **kwargs)
+                          for i, v in enumerate(vis_list)]
+    return residual_imagelist, gt_list
+
+
 def ical_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=1, facets=1,
-                                 gcfcf=None, calibration_context='TG', do_selfcal=True, **kwargs):
+                                 gcfcf=None, calibration_context='TG', do_selfcal=True, fused=False, **kwargs):
     """Create graph for ICAL pipeline
 
+    If fused is True, each major cycle has one task per vis to predict the model visibility and one to apply
+    the gains, subtract the model and invert the residual, instead of separate subgraphs for each step.
+    This reduces the size of the graph and the copying of visibilities.
+
     :param vis_list: List of vis (or graph)
     :param model_imagelist:  list of models (or graph)
     :param context: imaging context e.g. '2d'
@@ -31,6 +172,7 @@ def ical_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=
     :param facets: Number of facets on each x,y axis
     :param calibration_context: Sequence of calibration steps e.g. TGB
     :param do_selfcal: Do the selfcalibration?
+    :param fused: Use fused tasks for each major cycle
     :param kwargs: Parameters for functions in components
     :return:
     """
@@ -38,48 +180,62 @@ def ical_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=
     gt_list = list()
     
     if gcfcf is None:
-        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(model_imagelist[0])]
+        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction, memoize=True)(model_imagelist[0])]
     
     psf_imagelist = invert_list_rsexecute_workflow(vis_list, model_imagelist, dopsf=True, context=context,
                                                    vis_slices=vis_slices, facets=facets, gcfcf=gcfcf, **kwargs)
     
-    model_vislist = [rsexecute.execute(copy_visibility, nout=1)(v, zero=True) for v in vis_list]
+    def zero_model_image(im):
+        log.info("ical_list_rsexecute_workflow: setting initial model to zero after initial selfcal")
+        im = copy_image(im)
+        im.data[...] = 0.0
+        return im
     
-    if do_selfcal:
-        cal_vis_list = [rsexecute.execute(copy_visibility, nout=1)(v) for v in vis_list]
+    if fused:
+        # With selfcal the first residual is of the calibrated visibility alone, as below
+        residual_imagelist, gt_list = \
+            _fused_residual_list_rsexecute_workflow(vis_list, model_imagelist, context, gcfcf,
+                                                    do_selfcal=do_selfcal, subtract=not do_selfcal,
+                                                    calibration_context=calibration_context,
+                                                    vis_slices=vis_slices, facets=facets, **kwargs)
+        if do_selfcal:
+            model_imagelist = [rsexecute.execute(zero_model_image, nout=1)(model) for model in model_imagelist]
     else:
-        cal_vis_list = vis_list
-    
-    if do_selfcal:
-        # Make the predicted visibilities, selfcalibrate against it correcting the gains, then
-        # form the residual visibility, then make the residual image
-        predicted_model_vislist = predict_list_rsexecute_workflow(model_vislist, model_imagelist,
-                                                                  context=context, vis_slices=vis_slices,
-                                                                  facets=facets,
-                                                                  gcfcf=gcfcf, **kwargs)
-        cal_vis_list, gt_list = calibrate_list_rsexecute_workflow(cal_vis_list,
-                                                                  predicted_model_vislist,
-                                                                  gt_list,
-                                                                  calibration_context=calibration_context, **kwargs)
+        model_vislist = [rsexecute.execute(copy_visibility, nout=1, partition=i)(v, zero=True)
+                         for i, v in enumerate(vis_list)]
         
-        def zero_model_image(im):
-            log.info("ical_list_rsexecute_workflow: setting initial model to zero after initial selfcal")
-            im.data[...] = 0.0
-            return im
+        if do_selfcal:
+            cal_vis_list = [rsexecute.execute(copy_visibility, nout=1, partition=i)(v)
+                            for i, v in enumerate(vis_list)]
+        else:
+            cal_vis_list = vis_list
         
-        model_imagelist = [rsexecute.execute(zero_model_image, nout=1)(model) for model in model_imagelist]
+        if do_selfcal:
+            # Make the predicted visibilities, selfcalibrate against it correcting the gains, then
+            # form the residual visibility, then make the residual image
+            predicted_model_vislist = predict_list_rsexecute_workflow(model_vislist, model_imagelist,
+                                                                      context=context, vis_slices=vis_slices,
+                                                                      facets=facets,
+                                                                      gcfcf=gcfcf, **kwargs)
+            cal_vis_list, gt_list = calibrate_list_rsexecute_workflow(cal_vis_list,
+                                                                      predicted_model_vislist,
+                                                                      gt_list,
+                                                                      calibration_context=calibration_context,
+                                                                      **kwargs)
+            
+            model_imagelist = [rsexecute.execute(zero_model_image, nout=1)(model) for model in model_imagelist]
+            
+            residual_imagelist = invert_list_rsexecute_workflow(cal_vis_list, model_imagelist,
+                                                                context=context, dopsf=False,
+                                                                vis_slices=vis_slices, facets=facets, gcfcf=gcfcf,
+                                                                iteration=0, **kwargs)
         
-        residual_imagelist = invert_list_rsexecute_workflow(cal_vis_list, model_imagelist,
-                                                            context=context, dopsf=False,
-                                                            vis_slices=vis_slices, facets=facets, gcfcf=gcfcf,
-                                                            iteration=0, **kwargs)
-    
-    else:
-        # If we are not selfcalibrating it's much easier and we can avoid an unnecessary round of gather/scatter
-        # for visibility partitioning such as timeslices and wstack.
-        residual_imagelist = residual_list_rsexecute_workflow(cal_vis_list, model_imagelist, context=context,
-                                                              vis_slices=vis_slices, facets=facets, gcfcf=gcfcf,
-                                                              **kwargs)
+        else:
+            # If we are not selfcalibrating it's much easier and we can avoid an unnecessary round of gather/scatter
+            # for visibility partitioning such as timeslices and wstack.
+            residual_imagelist = residual_list_rsexecute_workflow(cal_vis_list, model_imagelist, context=context,
+                                                                  vis_slices=vis_slices, facets=facets, gcfcf=gcfcf,
+                                                                  **kwargs)
     
     deconvolve_model_imagelist = deconvolve_list_rsexecute_workflow(residual_imagelist, psf_imagelist,
                                                                     model_imagelist,
@@ -88,12 +244,19 @@ def ical_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=
     nmajor = get_parameter(kwargs, "nmajor", 5)
     if nmajor > 1:
         for cycle in range(nmajor):
-            if do_selfcal:
+            if fused:
+                residual_imagelist, gt_list = \
+                    _fused_residual_list_rsexecute_workflow(vis_list, deconvolve_model_imagelist, context, gcfcf,
+                                                            gt_list=gt_list, do_selfcal=do_selfcal,
+                                                            calibration_context=calibration_context,
+                                                            vis_slices=vis_slices, facets=facets,
+                                                            iteration=cycle, **kwargs)
+            elif do_selfcal:
                 model_vislist = predict_list_rsexecute_workflow(model_vislist, deconvolve_model_imagelist,
                                                                 context=context, vis_slices=vis_slices,
                                                                 facets=facets,
                                                                 gcfcf=gcfcf, **kwargs)
-                cal_vis_list = [rsexecute.execute(copy_visibility)(v) for v in vis_list]
+                cal_vis_list = [rsexecute.execute(copy_visibility, partition=i)(v) for i, v in enumerate(vis_list)]
                 cal_vis_list, gt_list = calibrate_list_rsexecute_workflow(cal_vis_list,
                                                                           model_vislist,
                                                                           gt_list,
@@ -116,32 +279,51 @@ def ical_list_rsexecute_workflow(vis_list, model_imagelist, context, vis_slices=
                                                                             deconvolve_model_imagelist,
                                                                             prefix=prefix,
                                                                             **kwargs)
-    residual_imagelist = residual_list_rsexecute_workflow(cal_vis_list, deconvolve_model_imagelist, context=context,
-                                                          vis_slices=vis_slices, facets=facets, gcfcf=gcfcf, **kwargs)
+    if fused:
+        # The last gains are applied, as they were to cal_vis_list
+        residual_imagelist, _ = \
+            _fused_residual_list_rsexecute_workflow(vis_list, deconvolve_model_imagelist, context, gcfcf,
+                                                    gt_list=gt_list, calibration_context=calibration_context,
+                                                    vis_slices=vis_slices, facets=facets,
+                                                    iteration=max(nmajor - 1, 0), **kwargs)
+    else:
+        residual_imagelist = residual_list_rsexecute_workflow(cal_vis_list, deconvolve_model_imagelist,
+                                                              context=context, vis_slices=vis_slices, facets=facets,
+                                                              gcfcf=gcfcf, **kwargs)
     restore_imagelist = restore_list_rsexecute_workflow(deconvolve_model_imagelist, psf_imagelist, residual_imagelist)
     return (deconvolve_model_imagelist, residual_imagelist, restore_imagelist, gt_list)
 
 
 def continuum_imaging_list_rsexecute_workflow(vis_list, model_imagelist, context, gcfcf=None,
-                                              vis_slices=1, facets=1, **kwargs):
+                                              vis_slices=1, facets=1, fused=False, **kwargs):
     """ Create graph for the continuum imaging pipeline.
     
     Same as ICAL but with no selfcal.
     
+    If fused is True, the residual image for each vis in each major cycle is made in one task that predicts,
+    subtracts and inverts.
+    
     :param vis_list: List of vis (or graph)
     :param model_imagelist: List of models (or graph)
     :param context: Imaging context
+    :param fused: Use fused tasks for each major cycle
     :param kwargs: Parameters for functions in components
     :return:
     """
     if gcfcf is None:
-        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction)(model_imagelist[0])]
+        gcfcf = [rsexecute.execute(create_pswf_convolutionfunction, memoize=True)(model_imagelist[0])]
     
     psf_imagelist = invert_list_rsexecute_workflow(vis_list, model_imagelist, context=context, dopsf=True,
                                                    vis_slices=vis_slices, facets=facets, gcfcf=gcfcf, **kwargs)
     
-    residual_imagelist = residual_list_rsexecute_workflow(vis_list, model_imagelist, context=context, gcfcf=gcfcf,
-                                                          vis_slices=vis_slices, facets=facets, **kwargs)
+    def residual_list(model_imagelist):
+        if fused:
+            return _fused_residual_list_rsexecute_workflow(vis_list, model_imagelist, context, gcfcf,
+                                                           vis_slices=vis_slices, facets=facets, **kwargs)[0]
+        return residual_list_rsexecute_workflow(vis_list, model_imagelist, context=context, gcfcf=gcfcf,
+                                                vis_slices=vis_slices, facets=facets, **kwargs)
+    
+    residual_imagelist = residual_list(model_imagelist)
     
     deconvolve_model_imagelist = deconvolve_list_rsexecute_workflow(residual_imagelist, psf_imagelist,
                                                                     model_imagelist,
@@ -151,17 +333,13 @@ def continuum_imaging_list_rsexecute_workflow(vis_list, model_imagelist, context
     if nmajor > 1:
         for cycle in range(nmajor):
             prefix = "cip cycle %d" % (cycle + 1)
-            residual_imagelist = residual_list_rsexecute_workflow(vis_list, deconvolve_model_imagelist,
-                                                                  context=context, vis_slices=vis_slices,
-                                                                  facets=facets,
-                                                                  gcfcf=gcfcf, **kwargs)
+            residual_imagelist = residual_list(deconvolve_model_imagelist)
             deconvolve_model_imagelist = deconvolve_list_rsexecute_workflow(residual_imagelist, psf_imagelist,
                                                                             deconvolve_model_imagelist,
                                                                             prefix=prefix,
                                                                             **kwargs)
     
-    residual_imagelist = residual_list_rsexecute_workflow(vis_list, deconvolve_model_imagelist, context=context,
-                                                          vis_slices=vis_slices, facets=facets, gcfcf=gcfcf, **kwargs)
+    residual_imagelist = residual_list(deconvolve_model_imagelist)
     restore_imagelist = restore_list_rsexecute_workflow(deconvolve_model_imagelist, psf_imagelist, residual_imagelist)
     return (deconvolve_model_imagelist, residual_imagelist, restore_imagelist)
 
@@ -24,6 +24,7 @@ from astropy import units as u
 from astropy.coordinates import SkyCoord, EarthLocation
 
 from rascil.data_models import rascil_data_path
+from rascil.data_models.data_model_helpers import export_blockvisibility_to_hdf5, export_visibility_to_hdf5
 from rascil.data_models.memory_data_models import Visibility, SkyModel, Configuration
 from rascil.data_models.polarisation import PolarisationFrame
 from rascil.processing_components.calibration import apply_gaintable, \
@@ -53,7 +54,7 @@ from rascil.processing_components.visibility import convert_blockvisibility_to_v
     convert_visibility_to_blockvisibility
 from rascil.processing_components.visibility import copy_visibility
 from rascil.processing_components.visibility import create_blockvisibility, \
-    create_visibility
+    create_visibility, export_blockvisibility_to_ms
 from rascil.workflows.rsexecute.execution_support.rsexecute import rsexecute
 from rascil.workflows.rsexecute.imaging.imaging_rsexecute import \
     invert_list_rsexecute_workflow, sum_predict_results_rsexecute, predict_list_rsexecute_workflow, \
@@ -73,7 +74,10 @@ def simulate_list_rsexecute_workflow(config='LOWBD2',
                                      order='frequency',
                                      format='blockvis',
                                      rmax=1000.0,
-                                     zerow=False):
+                                     zerow=False,
+                                     nintegrations=None,
+                                     chunk_function=None,
+                                     export=None):
     """ A component to simulate an observation
 
     The simulation step can generate a single BlockVisibility or a list of BlockVisibility's.
@@ -85,6 +89,22 @@ def simulate_list_rsexecute_workflow(config='LOWBD2',
 
     The output format can be either 'blockvis' (for calibration) or 'vis' (for imaging)
 
+    Long observations can be simulated in chunks of nintegrations times, so that no task holds more than one
+    chunk. Each chunk is then a separate element of the list: for order='frequency' or None, the chunks of
+    each frequency are in time order. Each chunk may be processed as it is made, on the worker holding it,
+    by chunk_function e.g. to predict and corrupt. If export is given, each chunk is then written to a file
+    and discarded, and the list holds the file names. The format is HDF5 or MS according to the extension::
+
+        def predict_and_corrupt(bvis):
+            bvis = dft_skycomponent_visibility(bvis, components)
+            return apply_gaintable(bvis, simulate_gaintable(create_gaintable_from_blockvisibility(bvis),
+                                                            phase_error=0.1))
+
+        filename_list = simulate_list_rsexecute_workflow('LOWBD2', frequency=frequency,
+            channel_bandwidth=channel_bandwidth, times=times, phasecentre=phasecentre, nintegrations=60,
+            chunk_function=predict_and_corrupt, export='simulation_%d.hdf5')
+        filename_list = rsexecute.compute(filename_list, sync=True)
+
     :param config: Name of configuration: def LOWBDS-CORE
     :param phasecentre: Phase centre def: SkyCoord(ra=+15.0 * u.deg, dec=-60.0 * u.deg, frame='icrs', equinox='J2000')
     :param frequency: def [1e8]
@@ -93,7 +113,10 @@ def simulate_list_rsexecute_workflow(config='LOWBD2',
     :param polarisation_frame: def PolarisationFrame("stokesI")
     :param order: 'time' or 'frequency' or 'both' or None: def 'frequency'
     :param format: 'blockvis' or 'vis': def 'blockvis'
-    :return: graph of vis_list with different frequencies in different elements
+    :param nintegrations: Number of times in each chunk (default is all for order 'frequency' or None, else 1)
+    :param chunk_function: Function applied to each chunk as it is made: f(vis) -> vis
+    :param export: File name for each chunk, including %d for the chunk number e.g. 'simulation_%d.ms'
+    :return: graph of vis_list with different frequencies in different elements, or of file names if exporting
     """
     if format == 'vis':
         create_vis = create_visibility
@@ -112,58 +135,70 @@ def simulate_list_rsexecute_workflow(config='LOWBD2',
     else:
         conf = create_named_configuration(config, rmax=rmax)
     
-    if order == 'time':
-        log.debug(
-            "simulate_list_rsexecute_workflow: Simulating distribution in %s" % order)
-        vis_list = list()
-        for i, time in enumerate(times):
-            vis_list.append(
-                rsexecute.execute(create_vis, nout=1)(conf, numpy.array([times[i]]),
-                                                      frequency=frequency,
-                                                      channel_bandwidth=channel_bandwidth,
-                                                      weight=1.0, phasecentre=phasecentre,
-                                                      polarisation_frame=polarisation_frame,
-                                                      zerow=zerow))
-    
-    elif order == 'frequency':
-        log.debug(
-            "simulate_list_rsexecute_workflow: Simulating distribution in %s" % order)
-        vis_list = list()
-        for j, _ in enumerate(frequency):
-            vis_list.append(rsexecute.execute(create_vis, nout=1)(conf, times,
-                                                                  frequency=numpy.array([frequency[j]]),
-                                                                  channel_bandwidth=numpy.array([channel_bandwidth[j]]),
-                                                                  weight=1.0,
-                                                                  phasecentre=phasecentre,
-                                                                  polarisation_frame=polarisation_frame,
-                                                                  zerow=zerow))
-    
-    elif order == 'both':
-        log.debug(
-            "simulate_list_rsexecute_workflow: Simulating distribution in time and frequency")
-        vis_list = list()
-        for i, _ in enumerate(times):
-            for j, _ in enumerate(frequency):
-                vis_list.append(
-                    rsexecute.execute(create_vis, nout=1)(conf, numpy.array([times[i]]),
-                                                          frequency=numpy.array([frequency[j]]),
-                                                          channel_bandwidth=numpy.array([channel_bandwidth[j]]),
-                                                          weight=1.0,
-                                                          phasecentre=phasecentre,
-                                                          polarisation_frame=polarisation_frame,
-                                                          zerow=zerow))
-    
-    elif order is None:
-        log.debug("simulate_list_rsexecute_workflow: Simulating into single %s" % format)
-        vis_list = list()
-        vis_list.append(
-            rsexecute.execute(create_vis, nout=1)(conf, times, frequency=frequency,
-                                                  channel_bandwidth=channel_bandwidth,
-                                                  weight=1.0, phasecentre=phasecentre,
-                                                  polarisation_frame=polarisation_frame,
-                                                  zerow=zerow))
+    if order not in ['time', 'frequency', 'both', None]:
+        raise NotImplementedError("order %s not known" % order)
+    
+    if export is not None:
+        if export.endswith('.ms'):
+            assert format == 'blockvis', "Only BlockVisibility can be exported to MS"
+        elif not (export.endswith('.hdf5') or export.endswith('.h5')):
+            raise ValueError("Cannot determine export format from file name %s" % export)
+    
+    # When chunking or exporting, the integration time is the sample spacing of all the times (hour angles
+    # in radians), so that chunks with a single time get the same integration time as the others. Otherwise
+    # the defaults of create_vis are kept.
+    times = numpy.array(times)
+    create_kwargs = dict()
+    if (nintegrations is not None or chunk_function is not None or export is not None) and len(times) > 1:
+        create_kwargs['integration_time'] = numpy.median(numpy.diff(times)) * 86164.1 / (2.0 * numpy.pi)
+    
+    def simulate_chunk(chunk_times, chunk_frequency, chunk_channel_bandwidth, filename):
+        vis = create_vis(conf, chunk_times, frequency=chunk_frequency, channel_bandwidth=chunk_channel_bandwidth,
+                         weight=1.0, phasecentre=phasecentre, polarisation_frame=polarisation_frame, zerow=zerow,
+                         **create_kwargs)
+        if chunk_function is not None:
+            vis = chunk_function(vis)
+        if filename is None:
+            return vis
+        elif filename.endswith('.ms'):
+            export_blockvisibility_to_ms(filename, [vis])
+        elif format == 'blockvis':
+            export_blockvisibility_to_hdf5(vis, filename)
+        else:
+            export_visibility_to_hdf5(vis, filename)
+        return filename
+    
+    # Chunks in time
+    if nintegrations is None:
+        nintegrations = 1 if order in ['time', 'both'] else len(times)
+    time_chunks = [times[i:i + nintegrations] for i in range(0, len(times), nintegrations)]
+    
+    # Chunks in frequency
+    frequency = numpy.array(frequency)
+    channel_bandwidth = numpy.array(channel_bandwidth)
+    if order in ['frequency', 'both']:
+        frequency_chunks = [(frequency[j:j + 1], channel_bandwidth[j:j + 1]) for j, _ in enumerate(frequency)]
+    else:
+        frequency_chunks = [(frequency, channel_bandwidth)]
+    
+    if order == 'both':
+        log.debug("simulate_list_rsexecute_workflow: Simulating distribution in time and frequency")
+        chunks = [(t, f) for t in time_chunks for f in frequency_chunks]
     else:
-        raise NotImplementedError("order $s not known" % order)
+        log.debug("simulate_list_rsexecute_workflow: Simulating distribution in %s" % order)
+        chunks = [(t, f) for f in frequency_chunks for t in time_chunks]
+    
+    vis_list = list()
+    for ichunk, (chunk_times, (chunk_frequency, chunk_channel_bandwidth)) in enumerate(chunks):
+        if chunk_function is None and export is None:
+            vis_list.append(rsexecute.execute(create_vis, nout=1, partition=ichunk)
+                            (conf, chunk_times, frequency=chunk_frequency,
+                             channel_bandwidth=chunk_channel_bandwidth, weight=1.0, phasecentre=phasecentre,
+                             polarisation_frame=polarisation_frame, zerow=zerow, **create_kwargs))
+        else:
+            filename = None if export is None else export % ichunk
+            vis_list.append(rsexecute.execute(simulate_chunk, nout=1, partition=ichunk)
+                            (chunk_times, chunk_frequency, chunk_channel_bandwidth, filename))
     return vis_list
 
 
@@ -323,7 +358,8 @@ def predict_dft_rsexecute_workflow(sub_bvis_list, sub_components, gt_list, conte
     
     dft_bvis_list = \
         [sum_predict_results_rsexecute([dft_bvis_list[ivis][icomp]
-                                        for icomp, _ in enumerate(sub_components)])
+                                        for icomp, _ in enumerate(sub_components)],
+                                       partitions=[ivis] * len(sub_components))
          for ivis, _ in enumerate(dft_bvis_list)]
     
     return dft_bvis_list
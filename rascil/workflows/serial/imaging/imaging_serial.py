@@ -9,6 +9,7 @@ __all__ = ['predict_list_serial_workflow', 'invert_list_serial_workflow', 'resid
 
 
 import collections
+import functools
 import logging
 
 import numpy
@@ -61,6 +62,14 @@ def predict_list_serial_workflow(vis_list, model_imagelist, context, vis_slices=
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
     predict = c['predict']
+    if c.get('batched', False):
+        # The predict function works through the slices itself
+        predict = functools.partial(predict, vis_slices=vis_slices)
+        vis_slices = 1
+    if c.get('faceted', False):
+        # The predict function works through the facets itself
+        predict = functools.partial(predict, facets=facets)
+        facets = 1
     
     if facets % 2 == 0 or facets == 1:
         actual_number_facets = facets
@@ -153,6 +162,14 @@ def invert_list_serial_workflow(vis_list, template_model_imagelist, dopsf=False,
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
     invert = c['invert']
+    if c.get('batched', False):
+        # The invert function works through the slices itself
+        invert = functools.partial(invert, vis_slices=vis_slices)
+        vis_slices = 1
+    if c.get('faceted', False):
+        # The invert function works through the facets itself
+        invert = functools.partial(invert, facets=facets)
+        facets = 1
     
     if facets % 2 == 0 or facets == 1:
         actual_number_facets = facets
@@ -18,6 +18,9 @@ from rascil.processing_components.imaging import predict_2d, invert_2d
 from rascil.processing_components.visibility import  vis_null_iter, vis_timeslice_iter, vis_wslice_iter
 from rascil.processing_components.imaging import  predict_timeslice_single, invert_timeslice_single
 from rascil.processing_components.imaging import  predict_wstack_single, invert_wstack_single
+from rascil.processing_components.imaging import  predict_wstack, invert_wstack
+from rascil.processing_components.imaging import  predict_idg, invert_idg
+from rascil.processing_components.imaging import  predict_facets, invert_facets
 
 log = logging.getLogger('logger')
 
@@ -30,6 +33,9 @@ def imaging_contexts():
         image_iterator: Iterator for traversing images
         vis_iterator: Iterator for traversing visibilities
         inner: The innermost axis
+        batched: If present and True, the predict and invert functions process all vis_slices in one call
+        faceted: If present and True, the predict and invert functions process all facets in one call
+        threaded: If present and True, the predict and invert functions take the number of threads as argument threads
     
     :return:
     """
@@ -39,31 +45,47 @@ def imaging_contexts():
                        'vis_iterator': vis_null_iter},
                 'ng': {'predict': predict_ng,
                        'invert': invert_ng,
-                       'vis_iterator': vis_null_iter},
+                       'vis_iterator': vis_null_iter,
+                       'threaded': True},
                 'wprojection': {'predict': predict_2d,
                        'invert': invert_2d,
                        'vis_iterator': vis_null_iter},
+                'idg': {'predict': predict_idg,
+                        'invert': invert_idg,
+                        'vis_iterator': vis_null_iter},
                 'wsnapshots': {'predict': predict_timeslice_single,
                        'invert': invert_timeslice_single,
-                       'vis_iterator': vis_timeslice_iter},
+                       'vis_iterator': vis_timeslice_iter,
+                       'threaded': True},
                 'facets': {'predict': predict_2d,
                            'invert': invert_2d,
                            'vis_iterator': vis_null_iter},
+                'facets_batched': {'predict': predict_facets,
+                                   'invert': invert_facets,
+                                   'vis_iterator': vis_null_iter,
+                                   'faceted': True},
                 'facets_ng': {'predict': predict_ng,
                            'invert': invert_ng,
-                           'vis_iterator': vis_null_iter},
+                           'vis_iterator': vis_null_iter,
+                           'threaded': True},
                 'facets_timeslice': {'predict': predict_timeslice_single,
                                      'invert': invert_timeslice_single,
-                                     'vis_iterator': vis_timeslice_iter},
+                                     'vis_iterator': vis_timeslice_iter,
+                                     'threaded': True},
                 'facets_wstack': {'predict': predict_wstack_single,
                                   'invert': invert_wstack_single,
                                   'vis_iterator': vis_wslice_iter},
                 'timeslice': {'predict': predict_timeslice_single,
                               'invert': invert_timeslice_single,
-                              'vis_iterator': vis_timeslice_iter},
+                              'vis_iterator': vis_timeslice_iter,
+                              'threaded': True},
                 'wstack': {'predict': predict_wstack_single,
                            'invert': invert_wstack_single,
-                           'vis_iterator': vis_wslice_iter}}
+                           'vis_iterator': vis_wslice_iter},
+                'wstack_batched': {'predict': predict_wstack,
+                                   'invert': invert_wstack,
+                                   'vis_iterator': vis_null_iter,
+                                   'batched': True}}
 
     return contexts
 
@@ -0,0 +1,87 @@
+""" Unit tests for Dask serialization and sizeof of the data models
+
+
+"""
+
+import unittest
+
+import astropy.units as u
+import numpy
+from astropy.coordinates import SkyCoord, EarthLocation
+from dask.sizeof import sizeof
+from distributed.protocol import serialize, deserialize, dumps, loads, to_serialize
+
+from rascil.data_models.memory_data_models import Configuration
+
+from rascil.data_models.polarisation import PolarisationFrame
+from rascil.processing_components.griddata import create_convolutionfunction_from_image
+from rascil.processing_components.griddata.operations import create_griddata_from_image
+from rascil.processing_components.image.operations import create_image
+from rascil.processing_components.util.sizeof import get_size, get_sizeof
+from rascil.processing_components.visibility.base import create_blockvisibility
+
+
+class TestDaskDataModels(unittest.TestCase):
+    def setUp(self):
+        self.phasecentre = SkyCoord(ra=+180.0 * u.deg, dec=-35.0 * u.deg, frame='icrs', equinox='J2000')
+        self.image = create_image(npixel=64, cellsize=0.001, phasecentre=self.phasecentre,
+                                  frequency=numpy.array([1e8, 1.1e8]), channel_bandwidth=numpy.array([1e7, 1e7]),
+                                  polarisation_frame=PolarisationFrame("stokesIQUV"))
+        self.image.data[...] = numpy.random.random(self.image.data.shape)
+        nants = 6
+        config = Configuration(name='test', location=EarthLocation(lon=21.44 * u.deg, lat=-30.7 * u.deg, height=1000.0),
+                               names='ANT%d', xyz=numpy.random.uniform(-300.0, 300.0, [nants, 3]), mount='altaz',
+                               diameter=numpy.repeat(15.0, nants))
+        times = (numpy.pi / 43200.0) * numpy.arange(0.0, 300.0, 100.0)
+        self.bvis = create_blockvisibility(config, times, numpy.array([1e8, 1.1e8]),
+                                           channel_bandwidth=numpy.array([1e7, 1e7]), phasecentre=self.phasecentre,
+                                           polarisation_frame=PolarisationFrame("linear"), weight=1.0)
+    
+    def check_roundtrip(self, dm):
+        header, frames = serialize(dm, serializers=['dask'])
+        assert header['serializer'] == 'dask'
+        # The data are sent without a copy
+        assert any(numpy.shares_memory(numpy.asarray(frame), dm.data) for frame in frames
+                   if not isinstance(frame, bytes))
+        newdm = deserialize(header, frames)
+        assert type(newdm) == type(dm)
+        numpy.testing.assert_array_equal(newdm.data, dm.data)
+        
+        newdm = loads(dumps({'x': to_serialize(dm)}))['x']
+        numpy.testing.assert_array_equal(newdm.data, dm.data)
+        newdm.data[...] = 0
+        return newdm
+    
+    def test_image(self):
+        newim = self.check_roundtrip(self.image)
+        assert newim.polarisation_frame == self.image.polarisation_frame
+        numpy.testing.assert_array_equal(newim.wcs.wcs.crval, self.image.wcs.wcs.crval)
+        assert sizeof(self.image) >= self.image.data.nbytes
+    
+    def test_griddata(self):
+        gd = create_griddata_from_image(self.image, self.bvis)
+        self.check_roundtrip(gd)
+        assert sizeof(gd) >= gd.data.nbytes
+    
+    def test_convolutionfunction(self):
+        cf = create_convolutionfunction_from_image(self.image)
+        self.check_roundtrip(cf)
+        assert sizeof(cf) >= cf.data.nbytes
+    
+    def test_blockvisibility(self):
+        bvis = self.bvis
+        newbvis = self.check_roundtrip(bvis)
+        numpy.testing.assert_array_equal(newbvis.frequency, bvis.frequency)
+        numpy.testing.assert_array_equal(newbvis.configuration.xyz, bvis.configuration.xyz)
+        assert newbvis.phasecentre.separation(bvis.phasecentre).rad < 1e-15
+        assert sizeof(bvis) >= bvis.data.nbytes + bvis.configuration.data.nbytes
+    
+    def test_get_size(self):
+        assert get_sizeof(self.image) == sizeof(self.image)
+        # The pickled size includes all the attributes
+        assert get_size(self.image) >= self.image.data.nbytes
+        assert get_size([self.image, self.bvis]) > get_size(self.image)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,7 +27,8 @@ from rascil.processing_components.imaging import dft_skycomponent_visibility
 from rascil.processing_components.simulation import simulate_gaintable, create_test_image
 from rascil.processing_components.simulation.pointing import simulate_pointingtable
 from rascil.processing_components.simulation import create_named_configuration
-from rascil.processing_components.visibility.base import create_visibility, create_blockvisibility
+from rascil.processing_components.visibility.base import create_visibility, create_blockvisibility, \
+    create_blockvisibility_iterator_from_hdf5
 from rascil.processing_components.griddata.operations import create_griddata_from_image
 from rascil.processing_components.griddata import create_convolutionfunction_from_image
 
@@ -98,6 +99,26 @@ class TestDataModelHelpers(unittest.TestCase):
         assert numpy.abs(newvis.configuration.location.z.value - self.vis.configuration.location.z.value) < 1e-15
         assert numpy.max(numpy.abs(newvis.configuration.xyz - self.vis.configuration.xyz)) < 1e-15
 
+    def test_readblockvisibility_iterator(self):
+        self.vis = create_blockvisibility(self.mid, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre,
+                                          polarisation_frame=PolarisationFrame("linear"),
+                                          weight=1.0)
+        self.vis = dft_skycomponent_visibility(self.vis, self.comp)
+        export_blockvisibility_to_hdf5(self.vis, '%s/test_data_model_helpers_blockvisibility_iterator.hdf' % self.dir)
+        chunks = list(create_blockvisibility_iterator_from_hdf5(
+            '%s/test_data_model_helpers_blockvisibility_iterator.hdf' % self.dir, nintegrations=2))
+        
+        assert len(chunks) == 2
+        assert chunks[0].vis.shape[0] == 2
+        assert chunks[1].vis.shape[0] == 1
+        for key in self.vis.data.dtype.fields:
+            newcol = numpy.concatenate([chunk.data[key] for chunk in chunks])
+            assert numpy.max(numpy.abs(newcol - self.vis.data[key])) < 1e-15
+        assert numpy.array_equal(chunks[0].frequency, self.vis.frequency)
+        assert numpy.max(numpy.abs(chunks[0].configuration.xyz - self.vis.configuration.xyz)) < 1e-15
+
     def test_readwritegaintable(self):
         self.vis = create_blockvisibility(self.mid, self.times, self.frequency,
                                           channel_bandwidth=self.channel_bandwidth,
@@ -22,7 +22,8 @@ run_ms_tests = False
 try:
     import casacore
     from rascil.processing_components.visibility.base import create_blockvisibility, create_blockvisibility_from_ms
-    from rascil.processing_components.visibility.base import export_blockvisibility_to_ms
+    from rascil.processing_components.visibility.base import export_blockvisibility_to_ms, \
+        export_blockvisibility_iterator_to_ms, create_blockvisibility_iterator_from_ms
 
     run_ms_tests = True
 except ImportError:
@@ -108,6 +109,54 @@ class export_ms_RASCIL_test(unittest.TestCase):
         vis_list.append(v)
         export_blockvisibility_to_ms(msoutfile, vis_list, source_name='M31')
 
+    def test_export_ms_roundtrip(self):
+        if run_ms_tests == False:
+            return
+
+        msoutfile = rascil_path("test_results/test_export_ms_roundtrip.ms")
+
+        from astropy.coordinates import SkyCoord
+        from astropy import units as u
+        from rascil.processing_components.simulation import create_named_configuration
+        from rascil.data_models.polarisation import PolarisationFrame
+
+        lowr3 = create_named_configuration('LOWBD2', rmax=300.0)
+        times = (numpy.pi / 43200.0) * numpy.linspace(-300.0, 300.0, 5)
+        frequency = numpy.linspace(1e8, 1.1e8, 3)
+        channelbandwidth = numpy.array([1e7 / 3.0, 1e7 / 3.0, 1e7 / 3.0])
+        phasecentre = SkyCoord(ra=+15.0 * u.deg, dec=-45.0 * u.deg, frame='icrs', equinox='J2000')
+        bvis = create_blockvisibility(lowr3, times, frequency, phasecentre=phasecentre,
+                                      weight=1.0, polarisation_frame=PolarisationFrame('linear'),
+                                      channel_bandwidth=channelbandwidth)
+        bvis.data['vis'][...] = numpy.arange(bvis.data['vis'].size).reshape(bvis.data['vis'].shape)
+
+        export_blockvisibility_to_ms(msoutfile, [bvis])
+        newbvis = create_blockvisibility_from_ms(msoutfile)[0]
+        nants = bvis.vis.shape[1]
+        lower = numpy.tril(numpy.ones([nants, nants]), -1) > 0
+        assert numpy.max(numpy.abs(newbvis.vis[:, lower] - bvis.vis[:, lower])) < 1e-3
+        assert numpy.max(numpy.abs(newbvis.uvw[:, lower] - bvis.uvw[:, lower])) < 1e-7
+        assert numpy.max(numpy.abs(newbvis.time - bvis.time)) < 1e-3
+
+        # Copy in chunks, a few rows per write
+        copyfile = rascil_path("test_results/test_export_ms_roundtrip_copy.ms")
+        export_blockvisibility_iterator_to_ms(copyfile,
+                                              create_blockvisibility_iterator_from_ms(msoutfile, nintegrations=2),
+                                              max_rows=100)
+        copybvis = create_blockvisibility_from_ms(copyfile)[0]
+        assert numpy.max(numpy.abs(copybvis.vis - newbvis.vis)) < 1e-7
+        assert numpy.max(numpy.abs(copybvis.uvw - newbvis.uvw)) < 1e-7
+
+        # Stopping early closes the tables
+        from casacore.tables import table
+        bvis_iter = create_blockvisibility_iterator_from_ms(msoutfile, nintegrations=2)
+        assert len(next(bvis_iter).time) == 2
+        bvis_iter.close()
+        tab = table(msoutfile, ack=False)
+        assert not tab.ismultiused()
+        tab.close()
+
+
 class export_measurementset_test_suite(unittest.TestSuite):
     """A unittest.TestSuite class which tests exporting measurementset
     tests."""
@@ -11,7 +11,8 @@ import numpy
 from rascil.data_models.polarisation import PolarisationFrame
 
 from rascil.processing_components.image.operations import export_image_to_fits
-from rascil.processing_components.image.operations import create_empty_image_like
+from rascil.processing_components.image.operations import create_empty_image_like, convert_image_to_dask, \
+    image_is_dask
 from rascil.processing_components.image.gather_scatter import image_gather_facets, image_scatter_facets, image_gather_channels, \
     image_scatter_channels
 from rascil.processing_components.simulation import create_test_image
@@ -129,6 +130,19 @@ class TestImageGatherScatters(unittest.TestCase):
             diff = m31cube.data - m31cuberec.data
             assert numpy.max(numpy.abs(diff)) == 0.0, "Scatter gather failed for %d" % nchan
 
+    
+    def test_scatter_gather_channel_dask(self):
+        nchan = 16
+        m31cube = create_test_image(polarisation_frame=PolarisationFrame('stokesI'),
+                                    frequency=numpy.linspace(1e8, 1.1e8, nchan))
+        m31lazy = convert_image_to_dask(m31cube)
+        for subimages in [16, 8, 2, 1]:
+            image_list = image_scatter_channels(m31lazy, subimages=subimages)
+            assert all(image_is_dask(im) for im in image_list)
+            m31cuberec = image_gather_channels(image_list, create_empty_image_like(m31lazy), subimages=subimages)
+            assert image_is_dask(m31cuberec)
+            diff = m31cube.data - m31cuberec.data.compute()
+            assert numpy.max(numpy.abs(diff)) == 0.0, "Scatter gather failed for %d" % subimages
 
 if __name__ == '__main__':
     unittest.main()
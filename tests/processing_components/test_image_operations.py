@@ -14,8 +14,9 @@ from rascil.processing_components import create_image, create_image_from_array,
     import_image_from_fits, create_vp, apply_voltage_pattern_to_image
 from rascil.processing_components.image.operations import export_image_to_fits, \
     calculate_image_frequency_moments, calculate_image_from_frequency_moments, add_image, qa_image, reproject_image, \
-    convert_polimage_to_stokes, \
-    convert_stokes_to_polimage, smooth_image, scale_and_rotate_image
+    reproject_image_obliquity, convert_polimage_to_stokes, \
+    convert_stokes_to_polimage, smooth_image, scale_and_rotate_image, convert_image_to_dask, convert_image_to_numpy, \
+    image_is_dask
 from rascil.processing_components.simulation import create_test_image, create_low_test_image_from_gleam
 
 log = logging.getLogger('logger')
@@ -48,6 +49,18 @@ class TestImage(unittest.TestCase):
         if self.persist: export_image_to_fits(self.m31image, fitsfile='%s/test_model.fits' % (self.dir))
         log.debug(qa_image(m31model_by_array, context='test_create_from_image'))
 
+    def test_convert_image_to_dask(self):
+        cube = create_image(npixel=256, cellsize=0.001, polarisation_frame=PolarisationFrame("stokesI"),
+                            frequency=numpy.linspace(0.8e9, 1.2e9, 5), channel_bandwidth=1e7 * numpy.ones([5]))
+        cube.data[...] = numpy.random.random(cube.shape)
+        lazy = convert_image_to_dask(cube)
+        assert image_is_dask(lazy)
+        assert lazy.data.chunks[0] == (1, 1, 1, 1, 1)
+        export_image_to_fits(lazy, fitsfile='%s/test_convert_image_to_dask.fits' % (self.dir))
+        reread = import_image_from_fits('%s/test_convert_image_to_dask.fits' % (self.dir), chunks=(1, 1, 256, 256))
+        assert image_is_dask(reread)
+        numpy.testing.assert_array_equal(convert_image_to_numpy(reread).data, cube.data)
+    
     def test_create_empty_image_like(self):
         emptyimage = create_empty_image_like(self.m31image)
         assert emptyimage.shape == self.m31image.shape
@@ -65,6 +78,25 @@ class TestImage(unittest.TestCase):
         newshape[3] /= 1.5
         newimage, footprint = reproject_image(self.m31image, newwcs, shape=newshape)
 
+    def test_reproject_obliquity(self):
+        # Reproject to and from a SIN projection with obliquity, as in timeslice imaging
+        image = create_image(npixel=256, cellsize=0.001, polarisation_frame=PolarisationFrame("linear"),
+                             frequency=numpy.linspace(0.8e9, 1.2e9, 2), channel_bandwidth=1e7 * numpy.ones([2]),
+                             phasecentre=self.m31image.phasecentre)
+        x, y = numpy.meshgrid(numpy.arange(256), numpy.arange(256))
+        image.data[...] = numpy.exp(-((x - 100.0) ** 2 + (y - 150.0) ** 2) / 200.0) * (1.0 + 0.5j)
+        newwcs = image.wcs.deepcopy()
+        newwcs.wcs.set_pv([(0, 1, -0.3), (0, 2, 0.2)])
+        for wcs, newwcs in [(image.wcs, newwcs), (newwcs, image.wcs)]:
+            image.wcs = wcs
+            newimage, footprint = reproject_image_obliquity(image, newwcs, shape=image.shape)
+            expected, expected_footprint = reproject_image(image, newwcs, shape=image.shape)
+            numpy.testing.assert_array_equal(footprint.data, expected_footprint.data)
+            valid = footprint.data > 0.0
+            numpy.testing.assert_allclose(newimage.data[valid], expected.data[valid], atol=1e-9)
+            threaded, _ = reproject_image_obliquity(image, newwcs, shape=image.shape, nthreads=4)
+            numpy.testing.assert_array_equal(threaded.data, newimage.data)
+
     def test_stokes_conversion(self):
         assert self.m31image.polarisation_frame == PolarisationFrame("stokesI")
         stokes = create_test_image(cellsize=0.0001, polarisation_frame=PolarisationFrame("stokesIQUV"))
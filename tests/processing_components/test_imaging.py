@@ -16,7 +16,10 @@ from rascil.data_models.polarisation import PolarisationFrame
 from rascil.processing_components import weight_visibility, weight_blockvisibility
 from rascil.processing_components.griddata.kernels import create_awterm_convolutionfunction
 from rascil.processing_components.image.operations import export_image_to_fits, smooth_image, qa_image
+from rascil.processing_components.image.gather_scatter import image_scatter_facets
+from rascil.processing_components.image.operations import create_empty_image_like
 from rascil.processing_components.imaging.base import predict_2d, invert_2d
+from rascil.processing_components.imaging.facets import predict_facets, invert_facets
 from rascil.processing_components.imaging.dft import dft_skycomponent_visibility
 from rascil.processing_components.imaging.primary_beams import create_pb_generic
 from rascil.processing_components.simulation import create_named_configuration, plot_visibility
@@ -326,6 +329,49 @@ class TestImaging2D(unittest.TestCase):
                                                   oversampling=8, support=100, use_aaf=True)
         self._invert_base(name='invert_spec_wterm', positionthreshold=1.0, check_components=False, gcfcf=gcfcf)
 
+    def _predict_facets_base(self, facets=4, **kwargs):
+        vis = predict_facets(copy_visibility(self.vis, zero=True), self.model, facets=facets, **kwargs)
+        expected = copy_visibility(self.vis, zero=True)
+        for facet in image_scatter_facets(self.model, facets=facets):
+            expected.data['vis'] += predict_2d(copy_visibility(self.vis, zero=True), facet).vis
+        error = numpy.max(numpy.abs(vis.vis - expected.vis)) / numpy.max(numpy.abs(expected.vis))
+        assert error < 1e-10, error
+
+    def _invert_facets_base(self, facets=4, dopsf=False, **kwargs):
+        dirty, sumwt = invert_facets(self.vis, self.model, dopsf=dopsf, facets=facets, **kwargs)
+        expected = create_empty_image_like(self.model)
+        for facet, dpatch in zip(image_scatter_facets(self.model, facets=facets),
+                                 image_scatter_facets(expected, facets=facets)):
+            result, expected_sumwt = invert_2d(self.vis, facet, dopsf=dopsf)
+            dpatch.data[...] = result.data
+        numpy.testing.assert_array_almost_equal(sumwt, expected_sumwt)
+        error = numpy.max(numpy.abs(dirty.data - expected.data)) / numpy.max(numpy.abs(expected.data))
+        assert error < 1e-10, error
+
+    def test_predict_facets(self):
+        self.actualSetUp(zerow=False)
+        self._predict_facets_base()
+
+    def test_predict_facets_IQUV(self):
+        self.actualSetUp(zerow=False, image_pol=PolarisationFrame('stokesIQUV'))
+        self._predict_facets_base()
+
+    def test_invert_facets(self):
+        self.actualSetUp(zerow=False)
+        self._invert_facets_base()
+
+    def test_invert_facets_psf(self):
+        self.actualSetUp(zerow=False)
+        self._invert_facets_base(dopsf=True)
+
+    def test_invert_facets_IQUV(self):
+        self.actualSetUp(zerow=False, image_pol=PolarisationFrame('stokesIQUV'))
+        self._invert_facets_base()
+
+    def test_invert_facets_threads(self):
+        self.actualSetUp(zerow=False)
+        self._invert_facets_base(threads=4)
+
     def test_invert_psf(self):
         self.actualSetUp(zerow=False)
         psf = invert_2d(self.vis, self.model, dopsf=True)
@@ -0,0 +1,222 @@
+""" Unit tests for imaging using image domain gridding
+
+"""
+import logging
+import os
+import sys
+import unittest
+
+import numpy
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+
+from rascil.data_models.polarisation import PolarisationFrame
+from rascil.processing_components.image.operations import export_image_to_fits, smooth_image, create_empty_image_like
+from rascil.processing_components.imaging import dft_skycomponent_visibility, predict_idg, invert_idg
+from rascil.processing_components.simulation import create_named_configuration
+from rascil.processing_components.simulation import ingest_unittest_visibility, \
+    create_unittest_model, create_unittest_components
+from rascil.processing_components.skycomponent.operations import find_skycomponents, find_nearest_skycomponent, \
+    insert_skycomponent
+from rascil.processing_components.visibility import copy_visibility
+
+log = logging.getLogger('logger')
+
+log.setLevel(logging.WARNING)
+log.addHandler(logging.StreamHandler(sys.stdout))
+log.addHandler(logging.StreamHandler(sys.stderr))
+
+
+class TestImagingIDG(unittest.TestCase):
+    def setUp(self):
+        
+        from rascil.data_models.parameters import rascil_path
+        self.dir = rascil_path('test_results')
+        
+        self.persist = os.getenv("RASCIL_PERSIST", True)
+    
+    def actualSetUp(self, freqwin=1, block=False, dospectral=True,
+                    image_pol=PolarisationFrame('stokesI'), zerow=False, mfs=False):
+        
+        self.npixel = 512
+        self.low = create_named_configuration('LOWBD2', rmax=750.0)
+        self.freqwin = freqwin
+        self.blockvis = list()
+        self.ntimes = 5
+        self.times = numpy.linspace(-3.0, +3.0, self.ntimes) * numpy.pi / 12.0
+        
+        if freqwin > 1:
+            self.frequency = numpy.linspace(0.8e8, 1.2e8, self.freqwin)
+            self.channelwidth = numpy.array(freqwin * [self.frequency[1] - self.frequency[0]])
+        else:
+            self.frequency = numpy.array([1e8])
+            self.channelwidth = numpy.array([1e6])
+        
+        if image_pol == PolarisationFrame('stokesIQUV'):
+            self.blockvis_pol = PolarisationFrame('linear')
+            self.image_pol = image_pol
+            f = numpy.array([100.0, 20.0, -10.0, 1.0])
+        elif image_pol == PolarisationFrame('stokesIQ'):
+            self.blockvis_pol = PolarisationFrame('linearnp')
+            self.image_pol = image_pol
+            f = numpy.array([100.0, 20.0])
+        elif image_pol == PolarisationFrame('stokesIV'):
+            self.blockvis_pol = PolarisationFrame('circularnp')
+            self.image_pol = image_pol
+            f = numpy.array([100.0, 20.0])
+        else:
+            self.blockvis_pol = PolarisationFrame('stokesI')
+            self.image_pol = PolarisationFrame('stokesI')
+            f = numpy.array([100.0])
+        
+        if dospectral:
+            flux = numpy.array([f * numpy.power(freq / 1e8, -0.7) for freq in self.frequency])
+        else:
+            flux = numpy.array([f])
+        
+        self.phasecentre = SkyCoord(ra=+180.0 * u.deg, dec=-45.0 * u.deg, frame='icrs', equinox='J2000')
+        self.blockvis = ingest_unittest_visibility(self.low,
+                                                   self.frequency,
+                                                   self.channelwidth,
+                                                   self.times,
+                                                   self.blockvis_pol,
+                                                   self.phasecentre,
+                                                   block=block,
+                                                   zerow=zerow)
+        
+        self.model = create_unittest_model(self.blockvis, self.image_pol, npixel=self.npixel, nchan=freqwin)
+        
+        self.components = create_unittest_components(self.model, flux)
+        
+        self.model = insert_skycomponent(self.model, self.components)
+        
+        self.blockvis = dft_skycomponent_visibility(self.blockvis, self.components)
+        
+        # Calculate the model convolved with a Gaussian.
+        
+        self.cmodel = smooth_image(self.model)
+        if self.persist: export_image_to_fits(self.model, '%s/test_imaging_idg_model.fits' % self.dir)
+        if self.persist: export_image_to_fits(self.cmodel, '%s/test_imaging_idg_cmodel.fits' % self.dir)
+        
+        if mfs:
+            self.model = create_unittest_model(self.blockvis, self.image_pol, npixel=self.npixel, nchan=1)
+
+    def _checkcomponents(self, dirty, fluxthreshold=0.6, positionthreshold=0.1):
+        comps = find_skycomponents(dirty, fwhm=1.0, threshold=10 * fluxthreshold, npixels=5)
+        assert len(comps) == len(self.components), "Different number of components found: original %d, recovered %d" % \
+                                                   (len(self.components), len(comps))
+        cellsize = abs(dirty.wcs.wcs.cdelt[0])
+        
+        for comp in comps:
+            # Check for agreement in direction
+            ocomp, separation = find_nearest_skycomponent(comp.direction, self.components)
+            assert separation / cellsize < positionthreshold, "Component differs in position %.3f pixels" % \
+                                                              separation / cellsize
+    
+    def _predict_base(self, fluxthreshold=1.0, name='predict_idg', **kwargs):
+        
+        original_vis = copy_visibility(self.blockvis)
+        vis = predict_idg(self.blockvis, self.model, **kwargs)
+        vis.data['vis'] = vis.data['vis'] - original_vis.data['vis']
+        dirty = invert_idg(vis, self.model, dopsf=False, normalize=True, **kwargs)
+        
+        if self.persist: export_image_to_fits(dirty[0], '%s/test_imaging_idg_%s_residual.fits' %
+                                              (self.dir, name))
+        
+        # assert numpy.max(numpy.abs(dirty[0].data)), "Residual image is empty"
+        
+        maxabs = numpy.max(numpy.abs(dirty[0].data))
+        assert maxabs < fluxthreshold, "Error %.3f greater than fluxthreshold %.3f " % (maxabs, fluxthreshold)
+    
+    def _invert_base(self, fluxthreshold=1.0, positionthreshold=1.0, check_components=True,
+                     name='predict_idg', **kwargs):
+        
+        dirty = invert_idg(self.blockvis, self.model, normalize=True, **kwargs)
+        
+        if self.persist: export_image_to_fits(dirty[0], '%s/test_imaging_idg_%s_dirty.fits' %
+                                              (self.dir, name))
+        
+        assert numpy.max(numpy.abs(dirty[0].data)), "Image is empty"
+        
+        if check_components:
+            self._checkcomponents(dirty[0], fluxthreshold, positionthreshold)
+    
+    def test_predict_idg(self):
+        self.actualSetUp()
+        self._predict_base(name='predict_idg')
+    
+    def test_predict_idg_IQUV(self):
+        self.actualSetUp(image_pol=PolarisationFrame("stokesIQUV"))
+        self._predict_base(name='predict_idg_IQUV')
+    
+    def test_invert_idg(self):
+        self.actualSetUp()
+        self._invert_base(name='invert_idg', positionthreshold=2.0, check_components=True)
+    
+    def test_invert_idg_psf(self):
+        self.actualSetUp()
+        self._invert_base(name='invert_idg_psf', positionthreshold=2.0, check_components=False, dopsf=True)
+    
+    def test_invert_idg_IQUV(self):
+        self.actualSetUp(image_pol=PolarisationFrame("stokesIQUV"))
+        self._invert_base(name='invert_idg_IQUV', positionthreshold=2.0, check_components=True)
+    
+    def test_predict_idg_spec(self):
+        self.actualSetUp(dospectral=True, freqwin=5)
+        self._predict_base(name='predict_idg_spec')
+    
+    def test_invert_idg_spec(self):
+        self.actualSetUp(dospectral=True, freqwin=5)
+        self._invert_base(name='invert_idg_spec', positionthreshold=2.0, check_components=False)
+    
+    def test_invert_idg_aterm(self):
+        self.actualSetUp()
+        times = []
+        
+        def make_aterm(template, time):
+            times.append(time)
+            aterm = create_empty_image_like(template)
+            aterm.data[...] = 1.0
+            return aterm
+        
+        dirty, sumwt = invert_idg(self.blockvis, self.model)
+        adirty, asumwt = invert_idg(self.blockvis, self.model, make_aterm=make_aterm, aterm_interval=3600.0)
+        assert len(times) == self.ntimes, times
+        numpy.testing.assert_allclose(adirty.data, dirty.data, rtol=1e-10,
+                                      atol=1e-10 * numpy.max(numpy.abs(dirty.data)))
+        numpy.testing.assert_array_equal(sumwt, asumwt)
+    
+    def test_invert_idg_aterm_time(self):
+        self.actualSetUp()
+        # The A term attenuates the last two times by a half
+        utimes = numpy.unique(self.blockvis.time)
+        tsplit = 0.5 * (utimes[2] + utimes[3])
+        
+        def make_aterm(template, time):
+            aterm = create_empty_image_like(template)
+            aterm.data[...] = 0.5 if time > tsplit else 1.0
+            return aterm
+        
+        adirty, asumwt = invert_idg(self.blockvis, self.model, normalize=False, make_aterm=make_aterm,
+                                    aterm_interval=3600.0)
+        dirty, sumwt = invert_idg(self.blockvis, self.model, normalize=False)
+        late = copy_visibility(self.blockvis)
+        late.data['imaging_weight'][late.time < tsplit] = 0.0
+        ldirty, lsumwt = invert_idg(late, self.model, normalize=False)
+        numpy.testing.assert_array_equal(sumwt, asumwt)
+        numpy.testing.assert_allclose(adirty.data, dirty.data - 0.5 * ldirty.data,
+                                      atol=1e-10 * numpy.max(numpy.abs(dirty.data)))
+
+    def test_idg_sampling(self):
+        self.actualSetUp()
+        # The cellsize is too coarse for the longest baselines
+        model = create_unittest_model(self.blockvis, self.image_pol, npixel=self.npixel,
+                                      cellsize=10.0 * numpy.radians(abs(self.model.wcs.wcs.cdelt[0])))
+        with self.assertRaises(AssertionError):
+            invert_idg(self.blockvis, model)
+        with self.assertRaises(AssertionError):
+            predict_idg(self.blockvis, model)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+""" Unit tests for per-task profiling
+
+
+"""
+import csv
+import json
+import logging
+import os
+import unittest
+
+import numpy
+
+from rascil.data_models.parameters import rascil_path
+from rascil.processing_components.util.profiling import start_profiling, stop_profiling, profiling_enabled, \
+    profile_function, profile_block, get_profile_records, clear_profile_records, summarise_profile, \
+    export_profile_to_json, export_profile_to_csv, export_profile_to_chrome_trace
+
+log = logging.getLogger('logger')
+
+log.setLevel(logging.WARNING)
+
+
+@profile_function
+def profiled_square(x):
+    return x ** 2
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = rascil_path('test_results/test_profiling')
+        os.makedirs(self.dir, exist_ok=True)
+        start_profiling(self.dir)
+        clear_profile_records()
+
+    def tearDown(self):
+        clear_profile_records()
+        stop_profiling()
+
+    def test_disabled(self):
+        stop_profiling()
+        assert not profiling_enabled()
+        assert (profiled_square(numpy.arange(3)) == numpy.array([0, 1, 4])).all()
+        assert get_profile_records(self.dir) == []
+
+    def test_function_and_block(self):
+        assert profiling_enabled()
+        for i in range(3):
+            profiled_square(numpy.ones(1000))
+        with profile_block('block'):
+            numpy.fft.fft(numpy.ones(1024))
+        records = get_profile_records()
+        assert [r['name'] for r in records] == 3 * ['profiled_square'] + ['block']
+        assert records[0]['bytes_in'] >= 8000
+        assert records[0]['bytes_out'] >= 8000
+        assert records[0]['pid'] == os.getpid()
+        assert records[0]['process_peak_rss'] > 0
+        assert 0 <= records[0]['peak_rss_increase'] <= records[0]['process_peak_rss']
+        summary = summarise_profile(records)
+        assert {s['name']: s['calls'] for s in summary} == {'profiled_square': 3, 'block': 1}
+
+    def test_peak_rss_increase(self):
+        profiled_square(numpy.ones(10))
+        process_peak_rss = get_profile_records()[0]['process_peak_rss']
+        if process_peak_rss > 2 ** 30:
+            self.skipTest("Process peak RSS is too large to raise in a test")
+        # Touch 64 MB more than the process has ever held, so the peak must go up
+        with profile_block('allocate'):
+            x = numpy.ones(process_peak_rss // 8 + 2 ** 23)
+            del x
+        record = get_profile_records()[1]
+        assert record['name'] == 'allocate'
+        assert record['peak_rss_increase'] >= 2 ** 25
+        summary = summarise_profile(get_profile_records())
+        assert max(s['peak_rss_increase'] for s in summary) == record['peak_rss_increase']
+
+    def test_export(self):
+        profiled_square(numpy.ones(10))
+        records = get_profile_records()
+        export_profile_to_json(records, os.path.join(self.dir, 'profile.json'))
+        export_profile_to_csv(records, os.path.join(self.dir, 'profile.csv'))
+        export_profile_to_chrome_trace(records, os.path.join(self.dir, 'trace.json'))
+        with open(os.path.join(self.dir, 'profile.json')) as f:
+            assert json.load(f) == records
+        with open(os.path.join(self.dir, 'profile.csv')) as f:
+            rows = list(csv.DictReader(f))
+            assert rows[0]['name'] == 'profiled_square'
+        with open(os.path.join(self.dir, 'trace.json')) as f:
+            events = json.load(f)['traceEvents']
+            assert events[0]['ph'] == 'X'
+            assert events[0]['dur'] == 1e6 * records[0]['wall_time']
+
+
+if __name__ == '__main__':
+    unittest.main()
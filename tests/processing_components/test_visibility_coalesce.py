@@ -9,12 +9,13 @@ import numpy
 from astropy.coordinates import SkyCoord
 import astropy.units as u
 
+from rascil.data_models.memory_data_models import BlockVisibilityTemplate
 from rascil.data_models.polarisation import PolarisationFrame
 
 from rascil.processing_components.imaging.base import create_image_from_visibility
 from rascil.processing_components.simulation import create_named_configuration
 from rascil.processing_components.visibility.coalesce import coalesce_visibility, decoalesce_visibility, \
-    convert_blockvisibility_to_visibility, convert_visibility_to_blockvisibility
+    convert_blockvisibility_to_visibility, convert_visibility_to_blockvisibility, coalesce_visibility_iterator
 from rascil.processing_components.visibility.base import create_blockvisibility, create_visibility_from_rows
 from rascil.processing_components.visibility.iterators import vis_timeslice_iter
 from rascil.processing_components.imaging.weighting import weight_visibility
@@ -107,6 +108,50 @@ class TestCoalesce(unittest.TestCase):
         dvis = decoalesce_visibility(cvis)
         assert dvis.nvis == self.blockvis.nvis
     
+    def test_coalesce_index(self):
+        self.blockvis.data['flags'][:, 1, 0, ...] = 1
+        weight = numpy.copy(self.blockvis.weight)
+        cvis = coalesce_visibility(self.blockvis, time_coal=1.0, frequency_coal=1.0)
+        numpy.testing.assert_array_equal(self.blockvis.weight, weight)
+        assert cvis.nvis < numpy.prod(self.blockvis.vis.shape[:4])
+        # Each input sample maps to a row of its own baseline
+        cindex = cvis.cindex.reshape(self.blockvis.vis.shape[:4])
+        itime, a2, a1, chan = numpy.indices(cindex.shape)
+        numpy.testing.assert_array_equal(cvis.antenna2[cindex], a2)
+        numpy.testing.assert_array_equal(cvis.antenna1[cindex], a1)
+        assert numpy.all(cvis.flags[cindex[:, 1, 0]] == 1)
+        # The integration times of the rows holding one baseline and channel add up to the observation
+        rows = numpy.unique(cindex[:, 5, 0, 0])
+        numpy.testing.assert_allclose(numpy.sum(cvis.integration_time[rows]),
+                                      numpy.sum(self.blockvis.integration_time))
+
+    def test_coalesce_iterator(self):
+        chunks = [create_visibility_from_rows(self.blockvis, rows) for rows in vis_timeslice_iter(self.blockvis,
+                                                                                                  vis_slices=3)]
+        cvis_list = list(coalesce_visibility_iterator(iter(chunks), time_coal=1.0, frequency_coal=1.0,
+                                                      max_time_coal=10))
+        assert len(cvis_list) == 3
+        for chunk, cvis in zip(chunks, cvis_list):
+            assert cvis.nvis < numpy.prod(chunk.vis.shape[:4])
+            assert cvis.blockvis.uvw.shape == chunk.uvw.shape
+            dvis = decoalesce_visibility(cvis)
+            assert dvis.nvis == chunk.nvis
+
+    def test_convert_decoalesce_values(self):
+        self.blockvis.data['vis'][...] = numpy.arange(self.blockvis.vis.size).reshape(self.blockvis.vis.shape)
+        self.blockvis.data['vis'] += 1j * numpy.swapaxes(self.blockvis.vis.real, 1, 2)
+        cvis = convert_blockvisibility_to_visibility(self.blockvis)
+        # Only the metadata of the original is kept
+        assert isinstance(cvis.blockvis, BlockVisibilityTemplate)
+        dvis = decoalesce_visibility(cvis)
+        numpy.testing.assert_array_equal(dvis.uvw, self.blockvis.uvw)
+        a2, a1 = numpy.tril_indices(self.blockvis.nants, -1)
+        numpy.testing.assert_array_equal(dvis.vis[:, a2, a1], self.blockvis.vis[:, a2, a1])
+        # The upper triangle is the conjugate of the lower triangle, the autocorrelations are flagged
+        numpy.testing.assert_array_equal(dvis.vis[:, a1, a2], numpy.conjugate(self.blockvis.vis[:, a2, a1]))
+        assert numpy.all(dvis.flags[:, a1, a1] == 1)
+        assert numpy.all(dvis.weight[:, a1, a1] == 0.0)
+
     def test_coalesce_decoalesce_tbgrid_vis_null(self):
         cvis = coalesce_visibility(self.blockvis, time_coal=0.0)
         assert numpy.min(cvis.frequency) == numpy.min(self.frequency)
@@ -12,8 +12,9 @@ from astropy.coordinates import SkyCoord
 from rascil.processing_components.simulation import create_named_configuration
 from rascil.processing_components.visibility.gather_scatter import visibility_gather_time, visibility_gather_w, \
     visibility_scatter_time, visibility_scatter_w, visibility_scatter_channel, \
-    visibility_gather_channel
-from rascil.processing_components.visibility.iterators import vis_wslices, vis_timeslices
+    visibility_gather_channel, visibility_sort_order, visibility_rows_view
+from rascil.processing_components.visibility.iterators import vis_wslices, vis_timeslices, vis_wslice_iter, \
+    vis_timeslice_iter
 from rascil.processing_components.visibility.base import create_visibility, create_blockvisibility
 
 import logging
@@ -67,6 +68,50 @@ class TestVisibilityGatherScatter(unittest.TestCase):
         assert self.vis.nvis == newvis.nvis
         assert numpy.max(numpy.abs(newvis.vis)) > 0.0
 
+    def test_vis_scatter_w_views(self):
+        self.actualSetUp()
+        vis_slices = vis_wslices(self.vis, 10.0)
+        vis_list = visibility_scatter_w(self.vis, vis_slices)
+        # The slices are views of a single copy sorted by w
+        bases = set(id(v.data.base) for v in vis_list if v is not None)
+        assert len(bases) == 1
+        for rows, v in zip(vis_wslice_iter(self.vis, vis_slices), vis_list):
+            if v is not None:
+                numpy.testing.assert_array_equal(numpy.sort(self.vis.w[rows]), v.w)
+        original = numpy.copy(self.vis.data)
+        for v in vis_list:
+            if v is not None:
+                v.data['vis'][...] = v.w[:, numpy.newaxis]
+        newvis = visibility_gather_w(vis_list, self.vis, vis_slices)
+        assert newvis is self.vis
+        numpy.testing.assert_array_equal(newvis.vis[:, 0], newvis.w)
+        numpy.testing.assert_array_equal(newvis.uvw, original['uvw'])
+
+    def test_vis_scatter_time_views(self):
+        self.actualSetUp()
+        vis_slices = vis_timeslices(self.vis, 'auto')
+        vis_list = visibility_scatter_time(self.vis, vis_slices)
+        # The slices are views of the original data
+        for rows, v in zip(vis_timeslice_iter(self.vis, vis_slices), vis_list):
+            assert numpy.shares_memory(v.data, self.vis.data)
+            numpy.testing.assert_array_equal(self.vis.data[rows], v.data)
+        vis_list[0].data['vis'][...] = 2.0
+        rows = next(vis_timeslice_iter(self.vis, vis_slices))
+        assert numpy.all(self.vis.vis[rows] == 2.0)
+        newvis = visibility_gather_time(vis_list, self.vis, vis_slices)
+        assert newvis is self.vis
+
+    def test_vis_sort_order_rows_view(self):
+        self.actualSetUp()
+        order = visibility_sort_order(self.vis, 'w')
+        sorted_vis = visibility_rows_view(self.vis, order)
+        assert numpy.all(sorted_vis.w[1:] >= sorted_vis.w[:-1])
+        assert visibility_sort_order(sorted_vis, 'w') is None
+        # A slice gives a view of the data
+        view = visibility_rows_view(sorted_vis, slice(10, 20))
+        assert view.nvis == 10
+        assert numpy.shares_memory(view.data, sorted_vis.data)
+
     def test_vis_scatter_gather_channel(self):
         self.actualSetUp()
         nchan = len(self.blockvis.frequency)
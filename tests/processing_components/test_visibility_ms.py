@@ -9,7 +9,8 @@ import logging
 import numpy
 
 from rascil.data_models import rascil_path, rascil_data_path, BlockVisibility
-from rascil.processing_components.visibility.base import create_blockvisibility_from_ms, create_visibility_from_ms
+from rascil.processing_components.visibility.base import create_blockvisibility_from_ms, create_visibility_from_ms, \
+    create_blockvisibility_iterator_from_ms
 from rascil.processing_components.visibility.operations import integrate_visibility_by_channel
 
 log = logging.getLogger('logger')
@@ -171,6 +172,23 @@ class TestCreateMS(unittest.TestCase):
             assert numpy.max(numpy.abs(v.vis)) > 0.0
             assert numpy.max(numpy.abs(v.flagged_vis)) > 0.0
             
+    def test_create_iterator(self):
+        if not self.casacore_available:
+            return
+    
+        msfile = rascil_path("data/vis/ASKAP_example.ms")
+        bvis = create_blockvisibility_from_ms(msfile, start_chan=0, end_chan=7)[0]
+        
+        chunks = list(create_blockvisibility_iterator_from_ms(msfile, nintegrations=2, start_chan=0, end_chan=7))
+        assert len(chunks) == (len(bvis.time) + 1) // 2
+        for chunk in chunks:
+            assert isinstance(chunk, BlockVisibility)
+            assert chunk.vis.shape[0] <= 2
+            assert chunk.vis.shape[1:] == bvis.vis.shape[1:]
+        assert numpy.max(numpy.abs(numpy.concatenate([c.time for c in chunks]) - bvis.time)) < 1e-7
+        assert numpy.max(numpy.abs(numpy.concatenate([c.vis for c in chunks]) - bvis.vis)) < 1e-7
+        assert numpy.max(numpy.abs(numpy.concatenate([c.uvw for c in chunks]) - bvis.uvw)) < 1e-7
+
     def test_read_all(self):
         ms_list = ["vis/3C277.1C.16channels.ms", "vis/ASKAP_example.ms", "vis/sim-1.ms", "vis/sim-2.ms",
                    "vis/xcasa.ms"]
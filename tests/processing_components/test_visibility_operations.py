@@ -14,8 +14,10 @@ from rascil.data_models.memory_data_models import Skycomponent
 from rascil.data_models.polarisation import PolarisationFrame
 from rascil.processing_components.imaging import dft_skycomponent_visibility
 from rascil.processing_components.simulation import create_named_configuration
+from rascil.processing_components.util import xyz_to_uvw
 from rascil.processing_components.visibility.base import copy_visibility, create_visibility, create_blockvisibility, \
-    create_visibility_from_rows, phaserotate_visibility
+    create_visibility_from_rows, phaserotate_visibility, set_phasor_cache_size, calculate_visibility_phasor, \
+    calculate_blockvisibility_phasor
 from rascil.processing_components.visibility.coalesce import convert_blockvisibility_to_visibility
 from rascil.processing_components.visibility.operations import append_visibility, qa_visibility, \
     subtract_visibility, divide_visibility
@@ -46,6 +48,25 @@ class TestVisibilityOperations(unittest.TestCase):
                                           weight=1.0)
         assert self.vis.nvis == len(self.vis.time)
 
+    def test_create_blockvisibility_uvw(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre,
+                                          polarisation_frame=PolarisationFrame("linear"))
+        for itime, ha in enumerate(self.times):
+            ant_pos = xyz_to_uvw(self.lowcore.xyz, ha, self.phasecentre.dec.rad)
+            for a1, a2 in [(0, 1), (3, 2), (5, 5)]:
+                assert_allclose(self.vis.uvw[itime, a1, a2], ant_pos[a1] - ant_pos[a2], atol=1e-12)
+        nants = self.vis.nants
+        diagonal = numpy.eye(nants, dtype='bool')
+        assert numpy.all(self.vis.flags[:, diagonal] == 1)
+        assert numpy.all(self.vis.flags[:, ~diagonal] == 0)
+        assert numpy.all(self.vis.weight[:, diagonal] == 0.0)
+        assert numpy.all(self.vis.weight[:, ~diagonal] == 1.0)
+        assert numpy.all(self.vis.imaging_weight == 1.0)
+        assert numpy.all(self.vis.vis == 0.0)
+        assert_allclose(self.vis.integration_time, 30.0 * 86164.1 / 86400.0)
+
     def test_create_visibility1(self):
         self.vis = create_visibility(self.lowcore, self.times, self.frequency,
                                      channel_bandwidth=self.channel_bandwidth,
@@ -248,6 +269,47 @@ class TestVisibilityOperations(unittest.TestCase):
         assert_allclose(rotatedvis.uvw, original_uvw, rtol=1e-7)
         assert_allclose(rotatedvis.vis, original_vis, rtol=1e-7)
 
+    def test_phase_rotation_cache(self):
+        self.vis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                          channel_bandwidth=self.channel_bandwidth,
+                                          phasecentre=self.phasecentre, weight=1.0,
+                                          polarisation_frame=PolarisationFrame("stokesIQUV"))
+        self.vismodel = dft_skycomponent_visibility(self.vis, self.comp)
+        rotatedvis = phaserotate_visibility(self.vismodel, self.compabsdirection, tangent=False)
+        # The second rotation uses the cached phasor
+        assert_allclose(phaserotate_visibility(self.vismodel, self.compabsdirection, tangent=False).vis,
+                        rotatedvis.vis, rtol=1e-12)
+        # Changing the uvw in place must not use the cached phasor
+        self.vismodel.data['uvw'][..., 2] *= 2.0
+        changedvis = phaserotate_visibility(self.vismodel, self.compabsdirection)
+        set_phasor_cache_size(0)
+        try:
+            uncachedvis = phaserotate_visibility(self.vismodel, self.compabsdirection)
+        finally:
+            set_phasor_cache_size(2 ** 28)
+        assert_allclose(changedvis.vis, uncachedvis.vis, rtol=1e-12)
+
+    def test_phasor_cache_uvw_changed(self):
+        bvis = create_blockvisibility(self.lowcore, self.times, self.frequency,
+                                      channel_bandwidth=self.channel_bandwidth,
+                                      phasecentre=self.phasecentre, weight=1.0,
+                                      polarisation_frame=PolarisationFrame("stokesIQUV"))
+        # Integer uvw, so that the sum of the uvw is exact: zero for the BlockVisibility, and the same in
+        # any order for the Visibility
+        antuvw = numpy.random.RandomState(17).randint(-1000, 1000, [len(self.times), bvis.nants, 3])
+        bvis.data['uvw'][...] = antuvw[:, :, numpy.newaxis, :] - antuvw[:, numpy.newaxis, :, :]
+        vis = convert_blockvisibility_to_visibility(bvis)
+        for v, calculate in [(bvis, calculate_blockvisibility_phasor), (vis, calculate_visibility_phasor)]:
+            cached = calculate(self.compabsdirection, v)
+            assert numpy.shares_memory(calculate(self.compabsdirection, v), cached)
+            # Changing the uvw in place must not use the cached phasor
+            if v is bvis:
+                v.data['uvw'][...] *= 2.0
+            else:
+                v.data['uvw'][...] = v.data['uvw'][::-1].copy()
+            assert_allclose(calculate(self.compabsdirection, v),
+                            calculate(self.compabsdirection, copy_visibility(v)), rtol=1e-12)
+
     def test_subtract(self):
         vis1 = create_visibility(self.lowcore, self.times, self.frequency,
                                  channel_bandwidth=self.channel_bandwidth,
@@ -0,0 +1,181 @@
+""" Unit tests for reading OSKAR visibility files
+
+
+"""
+import logging
+import os
+import struct
+import sys
+import unittest
+
+import numpy
+
+from rascil.data_models.parameters import rascil_path
+from rascil.processing_components.visibility.oskar import create_blockvisibility_from_oskar, \
+    create_blockvisibility_iterator_from_oskar, list_oskar_blocks
+
+log = logging.getLogger('logger')
+
+log.setLevel(logging.WARNING)
+log.addHandler(logging.StreamHandler(sys.stdout))
+log.addHandler(logging.StreamHandler(sys.stderr))
+
+
+def write_oskar_vis(filename, nstations, ntimes, nchan, max_times_per_block, polarisation_type=10):
+    """ Write a small OSKAR binary visibility file with known contents
+
+    Visibility value encodes time, channel, baseline and polarisation, uvw encode time and baseline.
+    """
+    npol = 4 if polarisation_type in [0, 10] else 1
+    nbaselines = nstations * (nstations - 1) // 2
+
+    def tag(group, tag, index, data, data_type, element_size):
+        payload = data.tobytes()
+        return struct.pack('<3sBBBBBiq', b'TBG', element_size, 0, data_type, group, tag, index,
+                           len(payload)) + payload
+
+    def char(group, tagid, value):
+        return tag(group, tagid, 0, numpy.frombuffer(value.encode() + b'\x00', dtype='u1'), 1, 1)
+
+    def int32(group, tagid, value, index=0):
+        return tag(group, tagid, index, numpy.array(value, dtype='<i4'), 2, 4)
+
+    def double(group, tagid, value, index=0):
+        return tag(group, tagid, index, numpy.array(value, dtype='<f8'), 8, 8)
+
+    chunks = [b'OSKARBIN\x00\x02' + bytes(54)]
+    chunks.append(char(11, 1, 'test_telescope.tm'))
+    chunks.append(int32(11, 2, 6))
+    chunks.append(int32(11, 3, 0))
+    chunks.append(int32(11, 4, 1))
+    chunks.append(int32(11, 5, 0))
+    chunks.append(int32(11, 6, 0))
+    chunks.append(int32(11, 7, max_times_per_block))
+    chunks.append(int32(11, 8, ntimes))
+    chunks.append(int32(11, 9, nchan))
+    chunks.append(int32(11, 10, nchan))
+    chunks.append(int32(11, 11, nstations))
+    chunks.append(int32(11, 12, polarisation_type))
+    chunks.append(int32(11, 21, 0))
+    chunks.append(double(11, 22, [15.0, -45.0]))
+    chunks.append(double(11, 23, 1e8))
+    chunks.append(double(11, 24, 1e6))
+    chunks.append(double(11, 25, 1e6))
+    chunks.append(double(11, 26, 58000.0))
+    chunks.append(double(11, 27, 10.0))
+    chunks.append(double(11, 28, 10.0))
+    chunks.append(double(11, 29, 116.76))
+    chunks.append(double(11, 30, -26.82))
+    chunks.append(double(11, 31, 300.0))
+    chunks.append(double(11, 32, numpy.arange(nstations) * 10.0))
+    chunks.append(double(11, 33, numpy.arange(nstations) * 20.0))
+    chunks.append(double(11, 34, numpy.zeros(nstations)))
+
+    nblocks = (ntimes + max_times_per_block - 1) // max_times_per_block
+    for block in range(nblocks):
+        start = block * max_times_per_block
+        block_times = min(max_times_per_block, ntimes - start)
+        t, c, b, p = numpy.meshgrid(start + numpy.arange(max_times_per_block), numpy.arange(nchan),
+                                    numpy.arange(nbaselines), numpy.arange(npol), indexing='ij')
+        cross = (1000.0 * t + 100.0 * c + b) + 1j * p
+        t, b = numpy.meshgrid(start + numpy.arange(max_times_per_block), numpy.arange(nbaselines),
+                              indexing='ij')
+        chunks.append(int32(12, 1, [start, 0, block_times, nchan, nbaselines, nstations], index=block))
+        chunks.append(tag(12, 3, block, cross.astype('<c8'), 36 if npol == 1 else 100, 8 * npol))
+        chunks.append(double(12, 4, 1000.0 * t + b, index=block))
+        chunks.append(double(12, 5, 2000.0 * t + b, index=block))
+        chunks.append(double(12, 6, 3000.0 * t + b, index=block))
+
+    with open(filename, 'wb') as f:
+        f.write(b''.join(chunks))
+
+
+class TestOskar(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = rascil_path('test_results')
+        os.makedirs(self.dir, exist_ok=True)
+        self.oskar_file = rascil_path('test_results/test_visibility_oskar.vis')
+        self.nstations = 5
+        self.ntimes = 7
+        self.nchan = 3
+        write_oskar_vis(self.oskar_file, self.nstations, self.ntimes, self.nchan, max_times_per_block=3)
+
+    def check_vis(self, bvis, times):
+        assert bvis.vis.shape == (len(times), self.nstations, self.nstations, self.nchan, 4)
+        assert bvis.polarisation_frame.type == 'linear'
+        baseline = 0
+        for i in range(self.nstations):
+            for j in range(i + 1, self.nstations):
+                for it, t in enumerate(times):
+                    expected = 1000.0 * t + 100.0 * numpy.arange(self.nchan) + baseline
+                    numpy.testing.assert_array_almost_equal(bvis.vis[it, j, i, :, 0], expected)
+                    numpy.testing.assert_array_almost_equal(bvis.vis[it, j, i, 0, :].imag, numpy.arange(4))
+                    numpy.testing.assert_array_almost_equal(bvis.uvw[it, j, i, :],
+                                                            -numpy.array([1000.0, 2000.0, 3000.0]) * t - baseline)
+                baseline += 1
+        numpy.testing.assert_array_almost_equal(bvis.time, 58000.0 * 86400.0 + 10.0 * numpy.array(times))
+        assert numpy.sum(bvis.weight[:, numpy.arange(self.nstations), numpy.arange(self.nstations)]) == 0.0
+
+    def test_read_all(self):
+        bvis = create_blockvisibility_from_oskar(self.oskar_file)
+        self.check_vis(bvis, range(self.ntimes))
+        if os.path.exists('/proc/self/maps'):
+            with open('/proc/self/maps') as f:
+                assert os.path.realpath(self.oskar_file) not in f.read()
+        numpy.testing.assert_array_almost_equal(bvis.frequency, 1e8 + 1e6 * numpy.arange(self.nchan))
+        assert abs(bvis.phasecentre.ra.deg - 15.0) < 1e-7
+        assert bvis.configuration.xyz.shape == (self.nstations, 3)
+
+    def test_read_blocks(self):
+        assert list_oskar_blocks(self.oskar_file) == [(0, 3), (3, 3), (6, 1)]
+        bvis = create_blockvisibility_from_oskar(self.oskar_file, start_block=1, end_block=3)
+        self.check_vis(bvis, range(3, self.ntimes))
+
+    def test_iterator(self):
+        bvis_list = list(create_blockvisibility_iterator_from_oskar(self.oskar_file, nblocks=2))
+        assert len(bvis_list) == 2
+        self.check_vis(bvis_list[0], range(0, 6))
+        self.check_vis(bvis_list[1], range(6, 7))
+
+    def test_stokesI(self):
+        write_oskar_vis(self.oskar_file, self.nstations, self.ntimes, self.nchan, max_times_per_block=4,
+                        polarisation_type=1)
+        bvis = create_blockvisibility_from_oskar(self.oskar_file)
+        assert bvis.polarisation_frame.type == 'stokesI'
+        assert bvis.vis.shape == (self.ntimes, self.nstations, self.nstations, self.nchan, 1)
+        assert bvis.vis[6, 1, 0, 2, 0] == 6200.0
+
+
+    def test_compare_read_oskar_vis(self):
+        from util.read_oskar_vis import OskarVis
+        write_oskar_vis(self.oskar_file, self.nstations, self.ntimes, 1, max_times_per_block=3)
+        bvis = create_blockvisibility_from_oskar(self.oskar_file)
+        oskar_vis = OskarVis(self.oskar_file)
+        uu, vv, ww = oskar_vis.uvw()
+        amp = oskar_vis.amplitudes()
+        times = oskar_vis.times()
+        numpy.testing.assert_array_almost_equal(bvis.time, 86400.0 * times[:, 0])
+        numpy.testing.assert_array_almost_equal(bvis.frequency, [oskar_vis.frequency(0)])
+        baseline = 0
+        for i in range(self.nstations):
+            for j in range(i + 1, self.nstations):
+                for it in range(self.ntimes):
+                    numpy.testing.assert_array_almost_equal(bvis.vis[it, j, i, 0, :], amp[it, baseline].reshape(4))
+                    numpy.testing.assert_array_almost_equal(bvis.uvw[it, j, i, :],
+                                                            -numpy.array([uu[it, baseline], vv[it, baseline],
+                                                                          ww[it, baseline]]))
+                baseline += 1
+
+    def test_iterator_close(self):
+        bvis_iter = create_blockvisibility_iterator_from_oskar(self.oskar_file)
+        bvis = next(bvis_iter)
+        bvis_iter.close()
+        self.check_vis(bvis, range(0, 3))
+        if os.path.exists('/proc/self/maps'):
+            with open('/proc/self/maps') as f:
+                assert os.path.realpath(self.oskar_file) not in f.read()
+
+
+if __name__ == '__main__':
+    unittest.main()
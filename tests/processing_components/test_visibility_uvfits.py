@@ -11,7 +11,8 @@ import numpy
 from rascil.data_models.parameters import rascil_path, rascil_data_path
 from rascil.data_models.polarisation import PolarisationFrame
 
-from rascil.processing_components.visibility.base import create_blockvisibility_from_uvfits, create_visibility_from_uvfits
+from rascil.processing_components.visibility.base import create_blockvisibility_from_uvfits, create_visibility_from_uvfits, \
+    create_blockvisibility_iterator_from_uvfits
 from rascil.processing_components.visibility.operations import integrate_visibility_by_channel
 from rascil.processing_components.imaging.base import invert_2d, create_image_from_visibility
 from rascil.processing_components.visibility.coalesce import convert_visibility_to_blockvisibility, \
@@ -80,6 +81,18 @@ class TestCreateMS(unittest.TestCase):
             assert v.vis.data.shape[-2] == 1
             assert v.polarisation_frame.type == "linear"
 
+    def test_create_iterator(self):
+        
+        uvfitsfile = rascil_path("data/vis/ASKAP_example.fits")
+        
+        bvis = create_blockvisibility_from_uvfits(uvfitsfile, range(0, 8))[0]
+        bvis_list = list(create_blockvisibility_iterator_from_uvfits(uvfitsfile, nintegrations=2,
+                                                                     channum=range(0, 8)))
+        assert len(bvis_list) == (bvis.nvis + 1) // 2
+        numpy.testing.assert_array_almost_equal(numpy.concatenate([v.time for v in bvis_list]), bvis.time)
+        numpy.testing.assert_array_almost_equal(numpy.concatenate([v.vis for v in bvis_list]), bvis.vis)
+        numpy.testing.assert_array_almost_equal(numpy.concatenate([v.uvw for v in bvis_list]), bvis.uvw)
+
     def test_invert(self):
         
         uvfitsfile = rascil_path("data/vis/ASKAP_example.fits")
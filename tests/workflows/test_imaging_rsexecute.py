@@ -19,13 +19,14 @@ from rascil.processing_components.imaging import dft_skycomponent_visibility
 from rascil.processing_components.simulation import create_named_configuration
 from rascil.processing_components.simulation import ingest_unittest_visibility, \
     create_unittest_model, insert_unittest_errors, create_unittest_components
+from rascil.processing_components.visibility import copy_visibility
 from rascil.processing_components.skycomponent.operations import find_skycomponents, find_nearest_skycomponent, \
     insert_skycomponent
 from rascil.workflows.rsexecute.execution_support.rsexecute import rsexecute
 from rascil.workflows.rsexecute.imaging.imaging_rsexecute import zero_list_rsexecute_workflow, \
     predict_list_rsexecute_workflow, invert_list_rsexecute_workflow, subtract_list_rsexecute_workflow, \
     weight_list_rsexecute_workflow, residual_list_rsexecute_workflow, sum_invert_results_rsexecute, \
-    restore_list_rsexecute_workflow
+    restore_list_rsexecute_workflow, sum_predict_results_rsexecute
 from rascil.workflows.shared.imaging.imaging_shared import sum_invert_results
 
 log = logging.getLogger('logger')
@@ -225,6 +226,15 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._predict_base(context='facets', fluxthreshold=17.0, facets=8)
     
+    def test_predict_facets_batched(self):
+        self.actualSetUp(block=False)
+        centre = self.freqwin // 2
+        vis = [rsexecute.compute(predict_list_rsexecute_workflow(self.bvis_list, self.model_list,
+                                                                 context=context, facets=4), sync=True)[centre]
+               for context in ['facets', 'facets_batched']]
+        error = numpy.max(numpy.abs(vis[1].vis - vis[0].vis)) / numpy.max(numpy.abs(vis[0].vis))
+        assert error < 1e-10, error
+    
     @unittest.skipUnless(run_ng_tests, "requires the nifty_gridder module")
     def test_predict_facets_ng(self):
         self.actualSetUp()
@@ -257,6 +267,11 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._predict_base(context='timeslice', fluxthreshold=5.5, vis_slices=self.ntimes)
     
+    def test_predict_timeslice_compact(self):
+        self.actualSetUp()
+        self._predict_base(context='timeslice', extra='_compact', fluxthreshold=5.5, vis_slices=self.ntimes,
+                           compact=2)
+    
     def test_predict_wsnapshots(self):
         self.actualSetUp(makegcfcf=True)
         self._predict_base(context='wsnapshots', fluxthreshold=5.5,
@@ -276,6 +291,14 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(block=False)
         self._predict_base(context='wstack', fluxthreshold=3.3, vis_slices=101)
     
+    def test_predict_wstack_batched(self):
+        self.actualSetUp(block=False)
+        self._predict_base(context='wstack_batched', fluxthreshold=3.3, vis_slices=101)
+    
+    def test_predict_idg(self):
+        self.actualSetUp(block=False)
+        self._predict_base(context='idg', fluxthreshold=3.3)
+    
     def test_predict_wstack_wprojection(self):
         self.actualSetUp(makegcfcf=True, block=False)
         self._predict_base(context='wstack', extra='_wprojection', fluxthreshold=3.6, vis_slices=11,
@@ -335,6 +358,23 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
     
+    def _invert_facets_batched_base(self, **kwargs):
+        centre = self.freqwin // 2
+        dirty = [rsexecute.compute(invert_list_rsexecute_workflow(self.bvis_list, self.model_list,
+                                                                  context=context, facets=4, **kwargs),
+                                   sync=True)[centre]
+                 for context in ['facets', 'facets_batched']]
+        error = numpy.max(numpy.abs(dirty[1][0].data - dirty[0][0].data)) / numpy.max(numpy.abs(dirty[0][0].data))
+        assert error < 1e-10, error
+    
+    def test_invert_facets_batched(self):
+        self.actualSetUp(block=False)
+        self._invert_facets_batched_base()
+    
+    def test_invert_facets_batched_threads(self):
+        self.actualSetUp(block=False)
+        self._invert_facets_batched_base(threads=4)
+    
     @unittest.skipUnless(run_ng_tests, "requires the nifty_gridder module")
     def test_invert_facets_ng(self):
         self.actualSetUp()
@@ -346,6 +386,11 @@ class TestImaging(unittest.TestCase):
         self._invert_base(context='facets_timeslice', check_components=True, vis_slices=self.ntimes,
                           positionthreshold=5.0, flux_threshold=1.0, facets=8)
     
+    def test_invert_facets_timeslice_compact(self):
+        self.actualSetUp()
+        self._invert_base(context='facets_timeslice', extra='_compact', check_components=True,
+                          vis_slices=self.ntimes, positionthreshold=5.0, flux_threshold=1.0, facets=8, compact=True)
+    
     @unittest.skip("Facets need overlap")
     def test_invert_facets_wprojection(self):
         self.actualSetUp(makegcfcf=True)
@@ -368,6 +413,11 @@ class TestImaging(unittest.TestCase):
         self._invert_base(context='timeslice', positionthreshold=1.0, check_components=True,
                           vis_slices=self.ntimes)
     
+    def test_invert_timeslice_compact(self):
+        self.actualSetUp()
+        self._invert_base(context='timeslice', extra='_compact', positionthreshold=1.0, check_components=True,
+                          vis_slices=self.ntimes, compact=2)
+    
     def test_invert_wsnapshots(self):
         self.actualSetUp(makegcfcf=True)
         self._invert_base(context='wsnapshots', positionthreshold=1.0,
@@ -391,6 +441,19 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(block=False)
         self._invert_base(context='wstack', positionthreshold=1.0, vis_slices=101)
     
+    def test_invert_idg(self):
+        self.actualSetUp(block=False)
+        self._invert_base(context='idg', positionthreshold=1.0)
+    
+    def test_invert_wstack_batched(self):
+        self.actualSetUp(block=False)
+        self._invert_base(context='wstack_batched', positionthreshold=1.0, vis_slices=101)
+    
+    def test_invert_wstack_batched_float32(self):
+        self.actualSetUp(block=False)
+        self._invert_base(context='wstack_batched', positionthreshold=1.0, vis_slices=101,
+                          wstack_dtype='complex64')
+    
     def test_invert_wstack_spectral(self):
         self.actualSetUp(dospectral=True, block=False)
         self._invert_base(context='wstack', extra='_spectral', positionthreshold=2.0,
@@ -511,6 +574,33 @@ class TestImaging(unittest.TestCase):
             assert numpy.abs(qa.data['min'] + 0.4607090445091728) < 1.0, str(qa)
             assert numpy.abs(r[1] - 831900.) < 1e-7, r
 
+    
+    def test_sum_invert_list_split(self):
+        self.actualSetUp(zerow=True, freqwin=7)
+        
+        residual_image_list = residual_list_rsexecute_workflow(self.bvis_list, self.model_list, context='2d')
+        residual_image_list = rsexecute.compute(residual_image_list, sync=True)
+        route2 = sum_invert_results(residual_image_list)
+        for split in [None, 2, 3, 7]:
+            route1 = sum_invert_results_rsexecute(residual_image_list, split=split)
+            route1 = rsexecute.compute(route1, sync=True)
+            numpy.testing.assert_allclose(route1[0].data, route2[0].data, atol=1e-12)
+            numpy.testing.assert_allclose(route1[1], route2[1])
+    
+    def test_sum_predict_list_split(self):
+        self.actualSetUp(zerow=True, freqwin=1)
+        
+        bvis = rsexecute.compute(self.bvis_list[0], sync=True)
+        bvis_list = [copy_visibility(bvis) for i in range(5)]
+        for i, bvis in enumerate(bvis_list):
+            bvis.data['vis'][...] = float(i)
+        for split in [None, 2, 3, 5]:
+            result = sum_predict_results_rsexecute(bvis_list, split=split)
+            result = rsexecute.compute(result, sync=True)
+            numpy.testing.assert_allclose(result.vis, 10.0)
+        # The inputs are unchanged
+        for i, bvis in enumerate(bvis_list):
+            numpy.testing.assert_allclose(bvis.vis, float(i))
 
 if __name__ == '__main__':
     unittest.main()
@@ -211,6 +211,14 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._predict_base(context='facets', fluxthreshold=17.0, facets=8)
     
+    def test_predict_facets_batched(self):
+        self.actualSetUp(block=False)
+        centre = self.freqwin // 2
+        vis = [predict_list_serial_workflow(self.bvis_list, self.model_list, context=context, facets=4)[centre]
+               for context in ['facets', 'facets_batched']]
+        error = numpy.max(numpy.abs(vis[1].vis - vis[0].vis)) / numpy.max(numpy.abs(vis[0].vis))
+        assert error < 1e-10, error
+    
     @unittest.skipUnless(run_ng_tests, "requires the nifty_gridder module")
     def test_predict_facets_ng(self):
         self.actualSetUp()
@@ -262,6 +270,14 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(block=False)
         self._predict_base(context='wstack', fluxthreshold=3.3, vis_slices=101)
     
+    def test_predict_wstack_batched(self):
+        self.actualSetUp(block=False)
+        self._predict_base(context='wstack_batched', fluxthreshold=3.3, vis_slices=101)
+    
+    def test_predict_idg(self):
+        self.actualSetUp(block=False)
+        self._predict_base(context='idg', fluxthreshold=3.3)
+    
     def test_predict_wstack_wprojection(self):
         self.actualSetUp(makegcfcf=True, block=False)
         self._predict_base(context='wstack', extra='_wprojection', fluxthreshold=3.6, vis_slices=11,
@@ -307,6 +323,22 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
     
+    def _invert_facets_batched_base(self, **kwargs):
+        centre = self.freqwin // 2
+        dirty = [invert_list_serial_workflow(self.bvis_list, self.model_list, context=context, facets=4,
+                                             **kwargs)[centre]
+                 for context in ['facets', 'facets_batched']]
+        error = numpy.max(numpy.abs(dirty[1][0].data - dirty[0][0].data)) / numpy.max(numpy.abs(dirty[0][0].data))
+        assert error < 1e-10, error
+    
+    def test_invert_facets_batched(self):
+        self.actualSetUp(block=False)
+        self._invert_facets_batched_base()
+    
+    def test_invert_facets_batched_threads(self):
+        self.actualSetUp(block=False)
+        self._invert_facets_batched_base(threads=4)
+    
     @unittest.skip("Facets need overlap")
     def test_invert_facets_timeslice(self):
         self.actualSetUp()
@@ -358,6 +390,19 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(block=False)
         self._invert_base(context='wstack', positionthreshold=1.0, vis_slices=101)
     
+    def test_invert_idg(self):
+        self.actualSetUp(block=False)
+        self._invert_base(context='idg', positionthreshold=1.0)
+    
+    def test_invert_wstack_batched(self):
+        self.actualSetUp(block=False)
+        self._invert_base(context='wstack_batched', positionthreshold=1.0, vis_slices=101)
+    
+    def test_invert_wstack_batched_float32(self):
+        self.actualSetUp(block=False)
+        self._invert_base(context='wstack_batched', positionthreshold=1.0, vis_slices=101,
+                          wstack_dtype='complex64')
+    
     def test_invert_wstack_spectral(self):
         self.actualSetUp(dospectral=True, block=False)
         self._invert_base(context='wstack', extra='_spectral', positionthreshold=2.0,
@@ -300,6 +300,62 @@ class TestPipelineGraphs(unittest.TestCase):
         assert numpy.abs(qa.data['max'] - 100.00790047266979) < 1.0e-7, str(qa)
         assert numpy.abs(qa.data['min'] + 0.033804341730225826) < 1.0e-7, str(qa)
     
+    def _compare_fused(self, unfused, fused):
+        """ Compare the clean, residual and restored images of the unfused and fused pipelines
+        """
+        clean, residual, restored = unfused[:3]
+        fclean, fresidual, frestored = fused[:3]
+        for chan in range(len(clean)):
+            for im, fim in [(clean[chan], fclean[chan]), (residual[chan][0], fresidual[chan][0]),
+                            (restored[chan], frestored[chan])]:
+                numpy.testing.assert_allclose(fim.data, im.data, atol=1e-7 * numpy.max(numpy.abs(im.data)))
+            numpy.testing.assert_allclose(fresidual[chan][1], residual[chan][1])
+    
+    def test_continuum_imaging_pipeline_fused(self):
+        self.actualSetUp(add_errors=False, zerow=True, dopol=False)
+        
+        def continuum_imaging(fused):
+            return continuum_imaging_list_rsexecute_workflow(self.vis_list,
+                                                             model_imagelist=self.model_imagelist,
+                                                             context='2d',
+                                                             algorithm='mmclean', facets=1,
+                                                             scales=[0, 3, 10],
+                                                             niter=1000, fractional_threshold=0.1, threshold=0.1,
+                                                             nmoment=3,
+                                                             nmajor=5, gain=0.1,
+                                                             deconvolve_facets=4, deconvolve_overlap=32,
+                                                             deconvolve_taper='tukey', psf_support=64,
+                                                             restore_facets=4, psfwidth=1.0, fused=fused)
+        
+        unfused = rsexecute.compute(continuum_imaging(False), sync=True)
+        fused = rsexecute.compute(continuum_imaging(True), sync=True)
+        self._compare_fused(unfused, fused)
+    
+    def test_ical_pipeline_global_fused(self):
+        self.actualSetUp(add_errors=True)
+        controls = create_calibration_controls()
+        controls['T']['first_selfcal'] = 1
+        controls['T']['timeslice'] = 'auto'
+        
+        def ical(fused):
+            return ical_list_rsexecute_workflow(self.vis_list,
+                                                model_imagelist=self.model_imagelist,
+                                                context='2d',
+                                                algorithm='mmclean', facets=1,
+                                                scales=[0, 3, 10],
+                                                niter=1000, fractional_threshold=0.1, threshold=0.1,
+                                                nmoment=3,
+                                                nmajor=5, gain=0.1,
+                                                deconvolve_facets=4, deconvolve_overlap=32,
+                                                deconvolve_taper='tukey', psf_support=64,
+                                                restore_facets=4, psfwidth=1.0,
+                                                calibration_context='T', controls=controls, do_selfcal=True,
+                                                global_solution=True, fused=fused)
+        
+        unfused = rsexecute.compute(ical(False), sync=True)
+        fused = rsexecute.compute(ical(True), sync=True)
+        self._compare_fused(unfused, fused)
+    
     def test_continuum_imaging_pipeline_serialclean(self):
         self.actualSetUp(add_errors=False, zerow=True)
         continuum_imaging_list = \
@@ -3,10 +3,13 @@
 
 """
 import logging
+import os
 import unittest
 
 import numpy
 
+from rascil.data_models.parameters import rascil_path
+from rascil.processing_components.util.profiling import profile_function, stop_profiling
 # Import the base and then make a global version
 from rascil.workflows.rsexecute.execution_support.rsexecute import rsexecute
 
@@ -14,6 +17,12 @@ log = logging.getLogger('logger')
 
 log.setLevel(logging.WARNING)
 
+
+@profile_function
+def profiled_square(x):
+    return x ** 2
+
+
 class Testrsexecute(unittest.TestCase):
     
     def setUp(self):
@@ -45,3 +54,139 @@ class Testrsexecute(unittest.TestCase):
         graph = rsexecute.execute(square)(numpy.arange(10))
         result = rsexecute.compute(graph, sync=True)
         assert (result == numpy.array([0, 1, 4, 9, 16, 25, 36, 49, 64, 81])).all()
+
+    def test_threads_per_task(self):
+        workers = rsexecute.client.scheduler_info()['workers'].values()
+        threads = sum(w['nthreads'] for w in workers)
+        calls = list()
+        run = rsexecute.client.run
+        rsexecute.client.run = lambda *args, **kwargs: calls.append(args) or run(*args, **kwargs)
+        try:
+            for i in range(3):
+                assert rsexecute.threads_per_task == max(1, os.cpu_count() // threads), rsexecute.threads_per_task
+        finally:
+            del rsexecute.client.run
+        # The workers are only asked for their cores once per client
+        assert len(calls) == 1
+
+
+class Testrsexecute_pool(unittest.TestCase):
+    
+    def tearDown(self):
+        rsexecute.close()
+    
+    def check_pool(self, use_pool):
+        rsexecute.set_client(use_pool=use_pool, n_workers=2)
+        
+        def square(x):
+            return x ** 2
+        
+        def add(x, y):
+            return x + y
+        
+        graph = rsexecute.execute(square)(numpy.arange(10))
+        result = rsexecute.compute(graph, sync=True)
+        assert (result == numpy.array([0, 1, 4, 9, 16, 25, 36, 49, 64, 81])).all(), result
+        result = rsexecute.compute(graph).result()
+        assert (result == numpy.array([0, 1, 4, 9, 16, 25, 36, 49, 64, 81])).all(), result
+        
+        # Large arrays, persisted and then used in a further graph
+        graph_list = [rsexecute.execute(numpy.full)(2 ** 18, float(i)) for i in range(4)]
+        graph_list = rsexecute.persist(graph_list)
+        sum_list = [rsexecute.execute(add)(graph_list[i], graph_list[(i + 1) % 4]) for i in range(4)]
+        result = rsexecute.gather(rsexecute.compute(sum_list))
+        assert [r[0] for r in result] == [1.0, 3.0, 5.0, 3.0], result
+    
+    def check_profile(self, use_pool):
+        rsexecute.set_client(use_pool=use_pool, n_workers=2)
+        rsexecute.start_profiling()
+        graph_list = [rsexecute.execute(profiled_square)(numpy.arange(10)) for i in range(4)]
+        rsexecute.compute(graph_list, sync=True)
+        records = rsexecute.save_profile(name=rascil_path('test_results/test_rsexecute_profile'))
+        stop_profiling()
+        assert [r['name'] for r in records] == 4 * ['profiled_square'], records
+        if use_pool == 'processes':
+            assert os.getpid() not in [r['pid'] for r in records]
+
+    def test_threads(self):
+        self.check_pool('threads')
+
+    def test_threads_per_task(self):
+        rsexecute.set_client(use_pool='threads', n_workers=2)
+        assert rsexecute.threads_per_task == max(1, os.cpu_count() // 2), rsexecute.threads_per_task
+
+    def test_imaging_threads(self):
+        from rascil.workflows.rsexecute.imaging.imaging_rsexecute import imaging_threads_rsexecute
+        rsexecute.set_client(use_pool='threads', n_workers=2)
+        assert imaging_threads_rsexecute('ng') == rsexecute.threads_per_task
+        assert imaging_threads_rsexecute('ng', threads=3) == 3
+        assert imaging_threads_rsexecute('timeslice') == rsexecute.threads_per_task
+        assert imaging_threads_rsexecute('2d') is None
+
+    def test_profile_threads(self):
+        self.check_profile('threads')
+
+    def test_profile_processes(self):
+        self.check_profile('processes')
+    
+    def test_processes(self):
+        self.check_pool('processes')
+
+
+class Testrsexecute_function(unittest.TestCase):
+    
+    def setUp(self):
+        rsexecute.set_client(use_dask=False)
+    
+    def test_threads_per_task(self):
+        assert rsexecute.threads_per_task == os.cpu_count()
+
+
+class Testrsexecute_locality(unittest.TestCase):
+    
+    def setUp(self):
+        rsexecute.set_client(use_dask=True, processes=True, threads_per_worker=1, n_workers=2, locality=True)
+    
+    def tearDown(self):
+        rsexecute.close()
+    
+    def test_locality(self):
+        from distributed import get_task_stream
+        
+        def scatter(x):
+            return [x[:5], x[5:]]
+        
+        def add(x, y):
+            return x + y
+        
+        assert rsexecute.locality
+        workers = [rsexecute.partition_worker(i) for i in range(4)]
+        assert workers[0] != workers[1]
+        assert workers[0] == workers[2]
+        
+        data_list = [rsexecute.execute(numpy.full, partition=i)(10, float(i)) for i in range(4)]
+        data_list = rsexecute.persist(data_list)
+        sum_list = list()
+        for i in range(4):
+            parts = rsexecute.execute(scatter, nout=2, partition=i)(data_list[i])
+            sum_list.append(rsexecute.execute(add, partition=i)(parts[0], parts[1]))
+        with get_task_stream() as ts:
+            result = rsexecute.compute(sum_list, sync=True)
+        assert [r[0] for r in result] == [0.0, 2.0, 4.0, 6.0]
+        partitions = {s.key: i for i, s in enumerate(sum_list)}
+        for t in ts.data:
+            if t['key'] in partitions:
+                assert t['worker'] == workers[partitions[t['key']]], t
+
+    def test_locality_worker_lost(self):
+        worker = rsexecute.partition_worker(1)
+        data = rsexecute.execute(numpy.full, partition=1)(10, 1.0)
+        parts = rsexecute.execute(numpy.split, nout=2, partition=1)(data, 2)
+        total = rsexecute.execute(numpy.sum, partition=1)(parts[1])
+        # The graph is pinned to a worker that is lost before it runs
+        rsexecute.client.retire_workers(workers=[worker], close_workers=True)
+        assert rsexecute.client.compute(total).result(timeout=60) == 5.0
+
+
+if __name__ == '__main__':
+    unittest.main()
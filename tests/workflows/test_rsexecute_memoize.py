@@ -0,0 +1,143 @@
+""" Unit tests for memoization in rsexecute
+
+
+"""
+import logging
+import os
+import shutil
+import unittest
+
+import astropy.units as u
+import numpy
+from astropy.coordinates import SkyCoord
+
+from rascil.data_models.parameters import rascil_path
+from rascil.data_models.polarisation import PolarisationFrame
+from rascil.processing_components.image.operations import create_image
+from rascil.processing_components.simulation import create_named_configuration
+from rascil.processing_components.visibility.base import create_blockvisibility
+from rascil.processing_components.visibility.coalesce import convert_blockvisibility_to_visibility
+from rascil.workflows.rsexecute.execution_support.memoize import MemoizeCache
+from rascil.workflows.rsexecute.execution_support.rsexecute import rsexecute
+
+log = logging.getLogger('logger')
+
+log.setLevel(logging.WARNING)
+
+calls = list()
+
+
+def make_image(npixel, value):
+    calls.append(npixel)
+    phasecentre = SkyCoord(ra=+15.0 * u.deg, dec=-45.0 * u.deg, frame='icrs', equinox='J2000')
+    im = create_image(npixel=npixel, phasecentre=phasecentre)
+    im.data[...] = value
+    return im, numpy.full([1, 1], value)
+
+
+def sum_vis(vis):
+    calls.append(vis.nvis)
+    return numpy.sum(vis.vis)
+
+
+class TestMemoize(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = rascil_path('test_results/test_rsexecute_memoize')
+        shutil.rmtree(self.dir, ignore_errors=True)
+        calls.clear()
+
+    def tearDown(self):
+        rsexecute.invalidate_cache()
+        rsexecute.unset_cache()
+        rsexecute.close()
+
+    def test_memoize(self):
+        cache = MemoizeCache(self.dir)
+        memoized = cache.memoize(make_image)
+        im, sumwt = memoized(64, 1.0)
+        im_cached, sumwt_cached = memoized(64, 1.0)
+        assert calls == [64]
+        numpy.testing.assert_array_equal(im.data, im_cached.data)
+        numpy.testing.assert_array_equal(sumwt, sumwt_cached)
+        assert im_cached.wcs.wcs.crval[0] == im.wcs.wcs.crval[0]
+        memoized(64, 2.0)
+        memoized(32, 1.0)
+        assert calls == [64, 64, 32]
+
+    def test_closure(self):
+        cache = MemoizeCache(self.dir)
+
+        def make(scale):
+            def scaled(x):
+                calls.append(scale)
+                return scale * x
+
+            return cache.memoize(scaled)
+
+        assert make(2.0)(numpy.ones(3))[0] == 2.0
+        assert make(3.0)(numpy.ones(3))[0] == 3.0
+        assert make(2.0)(numpy.ones(3))[0] == 2.0
+        assert calls == [2.0, 3.0]
+
+    def test_not_deterministic(self):
+        cache = MemoizeCache(self.dir)
+        memoized = cache.memoize(lambda x: calls.append(x))
+        memoized(object())
+        memoized(object())
+        assert len(calls) == 2
+        assert cache.size() == 0
+
+    def test_visibility(self):
+        # The converted Visibility holds the metadata of the BlockVisibility, which must also be hashed
+        phasecentre = SkyCoord(ra=+15.0 * u.deg, dec=-45.0 * u.deg, frame='icrs', equinox='J2000')
+        bvis = create_blockvisibility(create_named_configuration('LOWBD2-CORE'),
+                                      numpy.linspace(-0.1, 0.1, 3), numpy.array([1e8]), phasecentre=phasecentre,
+                                      channel_bandwidth=numpy.array([1e6]),
+                                      polarisation_frame=PolarisationFrame('stokesI'))
+        bvis.data['vis'][...] = 1.0
+        cache = MemoizeCache(self.dir)
+        memoized = cache.memoize(sum_vis)
+        vis = convert_blockvisibility_to_visibility(bvis)
+        assert cache.key(sum_vis, vis) is not None
+        assert cache.key(sum_vis, vis) == cache.key(sum_vis, convert_blockvisibility_to_visibility(bvis))
+        assert memoized(vis) == memoized(convert_blockvisibility_to_visibility(bvis))
+        assert calls == [vis.nvis]
+        # Different block metadata give a different key
+        bvis.data['time'] += 1.0
+        assert cache.key(sum_vis, vis) != cache.key(sum_vis, convert_blockvisibility_to_visibility(bvis))
+
+    def test_evict_invalidate(self):
+        cache = MemoizeCache(self.dir)
+        memoized = cache.memoize(make_image)
+        for value in range(4):
+            memoized(64, float(value))
+        size = cache.size()
+        assert len(os.listdir(self.dir)) == 4
+        cache.evict(size // 2)
+        assert len(os.listdir(self.dir)) == 2
+        # The most recently used remain
+        memoized(64, 3.0)
+        assert calls == [64, 64, 64, 64]
+        cache.invalidate(make_image)
+        assert len(os.listdir(self.dir)) == 0
+
+    def check_rsexecute(self, use_pool):
+        rsexecute.set_client(use_pool=use_pool, n_workers=2)
+        rsexecute.set_cache(self.dir)
+        for i in range(2):
+            graph = [rsexecute.execute(make_image, nout=2, memoize=True)(64, float(value)) for value in range(3)]
+            result = rsexecute.compute(graph, sync=True)
+            assert [r[1][0, 0] for r in result] == [0.0, 1.0, 2.0]
+        assert len(os.listdir(self.dir)) == 3
+
+    def test_rsexecute_threads(self):
+        self.check_rsexecute('threads')
+        assert calls == [64, 64, 64]
+
+    def test_rsexecute_processes(self):
+        self.check_rsexecute('processes')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,7 @@ import numpy
 from astropy import units as u
 from astropy.coordinates import SkyCoord
 
+from rascil.data_models.data_model_helpers import import_blockvisibility_from_hdf5
 from rascil.data_models.memory_data_models import BlockVisibility
 from rascil.workflows.rsexecute.execution_support.rsexecute import rsexecute
 
@@ -39,4 +40,47 @@ class TestSimulationrsexecuteSupport(unittest.TestCase):
         vt = rsexecute.compute(vis_list[0], sync=True)
         assert isinstance(vt, BlockVisibility)
         assert vt.nvis > 0
- 
+
+    def test_create_simulate_vis_list_chunked(self):
+        times = numpy.linspace(-300.0, 300.0, 5) * numpy.pi / 43200.0
+        vis_list = simulate_list_rsexecute_workflow(frequency=self.frequency, channel_bandwidth=self.channel_bandwidth,
+                                                    times=times, nintegrations=2)
+        vis_list = rsexecute.compute(vis_list, sync=True)
+        assert len(vis_list) == 3 * len(self.frequency)
+        assert [len(vt.time) for vt in vis_list[:3]] == [2, 2, 1]
+        whole = simulate_list_rsexecute_workflow(frequency=self.frequency, channel_bandwidth=self.channel_bandwidth,
+                                                 times=times)
+        whole = rsexecute.compute(whole[1], sync=True)
+        numpy.testing.assert_array_equal(numpy.concatenate([vt.uvw for vt in vis_list[3:6]]), whole.uvw)
+        numpy.testing.assert_array_equal(numpy.concatenate([vt.time for vt in vis_list[3:6]]), whole.time)
+        numpy.testing.assert_allclose(numpy.concatenate([vt.integration_time for vt in vis_list[3:6]]),
+                                      whole.integration_time)
+
+    def test_create_simulate_vis_list_default_integration_time(self):
+        # Without chunking or exporting, single time chunks keep the default integration time
+        vis_list = simulate_list_rsexecute_workflow(frequency=self.frequency, channel_bandwidth=self.channel_bandwidth,
+                                                    times=self.times, order='time')
+        vis_list = rsexecute.compute(vis_list, sync=True)
+        assert len(vis_list) == len(self.times)
+        for vt in vis_list:
+            numpy.testing.assert_array_equal(vt.integration_time, 1.0)
+
+    def test_create_simulate_vis_list_export(self):
+        def fill(vt):
+            vt.data['vis'][...] = 1.0
+            return vt
+
+        export = '%s/test_simulation_rsexecute_%%d.hdf5' % self.dir
+        filename_list = simulate_list_rsexecute_workflow(frequency=self.frequency,
+                                                         channel_bandwidth=self.channel_bandwidth,
+                                                         times=self.times, order=None, nintegrations=1,
+                                                         chunk_function=fill, export=export)
+        filename_list = rsexecute.compute(filename_list, sync=True)
+        assert filename_list == [export % i for i in range(len(self.times))]
+        for i, filename in enumerate(filename_list):
+            vt = import_blockvisibility_from_hdf5(filename)
+            assert isinstance(vt, BlockVisibility)
+            assert vt.vis.shape[-2] == len(self.frequency)
+            assert len(vt.time) == 1
+            assert numpy.all(vt.vis == 1.0)
+
@@ -202,7 +202,7 @@ class OskarBinary(object):
                 block['data'] = numpy.array([complex(v[0], v[1]) for v
                                              in block['data'].reshape(n // 2, 2)
                                              ])
-                block['block_length'] = n / 2
+                block['block_length'] = n // 2
             # Wrap matrix data into 2 x 2 blocks.
             if self.is_set(block['data_type'], self.DataType.Matrix):
                 n = block['block_length']